@@ -47,7 +47,9 @@ from eutester.euconfig import EuConfig
 from eutester.euproperties import Euproperty_Manager
 from eutester.machine import Machine
 from eutester.euvolume import EuVolume
+from eutester.teardown import TeardownEngine
 from eutester import eulogger
+from concurrent.futures import ThreadPoolExecutor, wait
 import re
 import os
 
@@ -56,7 +58,13 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
     def __init__(self, config_file=None, password=None, keypath=None, credpath=None, aws_access_key_id=None,
                  aws_secret_access_key = None,  account="eucalyptus", user="admin", username=None, APIVersion='2011-01-01',
                  region=None, ec2_ip=None, s3_ip=None, as_ip=None, elb_ip=None, download_creds=True,boto_debug=0,
-                 debug_method=None):
+                 debug_method=None, machine_connect='serial', connect_concurrency=16):
+        """
+        :param machine_connect: how machines in the config file are connected to. 'serial' (default) connects each
+                                in turn, 'parallel' connects them all on a bounded pool reporting all unreachable
+                                hosts together, 'lazy' connects each machine the first time its ssh/sftp is used
+        :param connect_concurrency: max number of machines connected to at once in 'parallel' mode
+        """
         self.config_file = config_file 
         self.APIVersion = APIVersion
         self.eucapath = "/opt/eucalyptus"
@@ -82,6 +90,9 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
         self.account_id = None
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self.machine_connect = machine_connect
+        self.connect_concurrency = connect_concurrency
+        self.startup_times = []
 
 
         if self.config_file is not None:
@@ -104,6 +115,7 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
             self.clc = clc_array[0]
             walrus_array = self.get_component_machines("ws")
             self.walrus = walrus_array[0]
+            phase_start = time.time()
             self.sftp = self.clc.ssh.connection.open_sftp()
             if self.download_creds:
                 if self.credpath is None:
@@ -122,10 +134,12 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
                         self.swap_clc()
                         self.sftp = self.clc.ssh.connection.open_sftp()
                         self.get_credentials(account,user)
+                phase_start = self.record_startup_phase('credential fetch', phase_start)
                         
                 self.service_manager = EuserviceManager(self)
                 self.clc = self.service_manager.get_enabled_clc().machine
                 self.walrus = self.service_manager.get_enabled_walrus().machine 
+                self.record_startup_phase('service discovery', phase_start)
 
 
 
@@ -134,6 +148,7 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
         if self.credpath and not aws_secret_access_key:
             aws_secret_access_key = self.get_secret_key()
         self.test_resources = {}
+        phase_start = time.time()
         if self.download_creds:
             try:
                 if self.credpath and not ec2_ip:
@@ -169,8 +184,28 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
                 self.setup_elb_connection(endpoint=elb_ip, path="/services/LoadBalancing", port=8773, is_secure=False, region=region, aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key, boto_debug=boto_debug)
             except Exception, e:
                 self.debug("Unable to create ELB connection because of: " + str(e) )
+            self.record_startup_phase('boto connections', phase_start)
         if self.clc and account == 'eucalytpus':
             self.update_property_manager()
+        if self.startup_times:
+            self.show_startup_times()
+
+    def record_startup_phase(self, phase, start):
+        """
+        Record the time spent in a startup phase which began at 'start', returns the current time
+        """
+        now = time.time()
+        self.startup_times.append((phase, now - start))
+        return now
+
+    def show_startup_times(self, printmethod=None):
+        printmethod = printmethod or self.debug
+        buf = "STARTUP TIMES (machine_connect:" + str(self.machine_connect) + ", total:" + \
+              str(round(time.time() - self.start_time, 2)) + "s)\n"
+        for phase, elapsed in self.startup_times:
+            buf += "    " + str(phase).ljust(20) + str(round(elapsed, 2)) + "s\n"
+        printmethod(buf)
+        return buf
 
     def get_available_vms(self, type=None, zone=None):
         """
@@ -234,81 +269,44 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
             raise Exception("Setting property " + property + " failed")
     
    
-    def cleanup_artifacts(self,instances=True, snapshots=True, volumes=True, load_balancers=True):
+    def cleanup_artifacts(self,instances=True, snapshots=True, volumes=True, load_balancers=True, timeout=1800,
+                          concurrency=10):
         """
         Description: Attempts to remove artifacts created during and through this eutester's lifespan.
+        Resources are removed in dependency order, instances first, then load balancers, volumes, images, snapshots,
+        security groups, keypairs, buckets and anything else in test_resources. Requests within each step are
+        sent concurrently and pending resources are polled in batches. See eutester.teardown.TeardownEngine.
+
+        :param timeout: int seconds allowed for the entire cleanup
+        :param concurrency: int max number of delete requests in flight
         """
-        failmsg = ""
-        failcount = 0
         self.debug("Starting cleanup of artifacts")
-        if instances:
-            for res in self.test_resources["reservations"]:
-                try:
-                    self.terminate_instances(res)
-                except Exception, e:
-                    tb = self.get_traceback()
-                    failcount +=1
-                    failmsg += str(tb) + "\nError#:"+ str(failcount)+ ":" + str(e)+"\n"
-        if volumes:
-            try:
-                self.clean_up_test_volumes(timeout_per_vol=60)
-            except Exception, e:
-                tb = self.get_traceback()
-                failcount +=1
-                failmsg += str(tb) + "\nError#:"+ str(failcount)+ ":" + str(e)+"\n"
-        if snapshots:
-            try:
-                self.cleanup_test_snapshots()
-            except Exception, e:
-                tb = self.get_traceback()
-                failcount +=1
-                failmsg += str(tb) + "\nError#:"+ str(failcount)+ ":" + str(e)+"\n"
-        if load_balancers:
-            try:
-                self.cleanup_load_balancers()
-            except Exception, e:
-                tb = self.get_traceback()
-                failcount +=1
-                failmsg += str(tb) + "\nError#:"+ str(failcount)+ ":" + str(e)+"\n"
-
-        for key,array in self.test_resources.iteritems():
-            for item in array:
-                try:
-                    ### SWITCH statement for particulars of removing a certain type of resources
-                    self.debug("Deleting " + str(item))
-                    if isinstance(item, Image):
-                        item.deregister()
-                    elif isinstance(item, Reservation):
-                        self.terminate_instances(item)
-                    elif isinstance(item, Volume):
-                        try:
-                            self.detach_volume(item)
-                        except:
-                            pass
-                        item.update()
-                        if item.status != 'deleted':
-                            self.delete_volume(item)
-                    else:
-                        item.delete()
-                except Exception, e:
-                    tb = self.get_traceback()
-                    failcount += 1
-                    failmsg += str(tb) + "\nUnable to delete item: " + str(item) + "\n" + str(e)+"\n"
-        if failmsg:
-            failmsg += "\nFound " + str(failcount) + " number of errors while cleaning up. See above"
+        skip = []
+        if not instances:
+            skip.append('instances')
+        if not volumes:
+            skip.append('volumes')
+        if not snapshots:
+            skip.append('snapshots')
+        if not load_balancers:
+            skip.append('load_balancers')
+        engine = TeardownEngine(self, deadline=timeout, concurrency=concurrency)
+        errors = engine.run(skip=skip)
+        engine.show_summary()
+        if errors:
+            failmsg = "\n".join(["Error#:" + str(count + 1) + ":" + str(error) for count, error in enumerate(errors)])
+            failmsg += "\nFound " + str(len(errors)) + " number of errors while cleaning up. See above"
             raise Exception(failmsg)
 
     def cleanup_load_balancers(self, lbs=None):
         """
         :param lbs: optional list of load balancers, otherwise it will attempt to delete from test_resources[]
         """
-        if lbs:
-            self.delete_load_balancers(lbs)
-        else:
-            try:
-                self.delete_load_balancers(self.test_resources['load_balancers'])
-            except KeyError:
-                self.debug("No loadbalancers to delete")
+        engine = TeardownEngine(self)
+        if not engine.teardown_load_balancers(lbs):
+            self.debug("No loadbalancers to delete")
+        if engine.errors:
+            raise Exception("Failed to delete load balancers:\n" + "\n".join(engine.errors))
 
     def cleanup_test_snapshots(self,snaps=None, clean_images=False, add_time_per_snap=10, wait_for_valid_state=120, base_timeout=180):
         """
@@ -324,95 +322,41 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
             return
         self.debug('Attempting to clean the following snapshots:')
         self.print_eusnapshot_list(snaps)
+        engine = TeardownEngine(self, deadline=wait_for_valid_state + base_timeout + (add_time_per_snap * len(snaps)))
         if clean_images:
-            for snap in snaps:
-                for image in self.test_resources['images']:
-                    for dev in image.block_device_mapping:
-                        if image.block_device_mapping[dev].snapshot_id == snap.id:
-                            self.delete_image(image)
-        if snaps:
-            return self.delete_snapshots(snaps,
-                                        base_timeout=base_timeout,
-                                        add_time_per_snap=add_time_per_snap,
-                                        wait_for_valid_state=wait_for_valid_state)
-
-
-
+            snap_ids = [snap.id for snap in snaps]
+            images = []
+            for image in self.test_resources['images']:
+                for dev in getattr(image, 'block_device_mapping', None) or {}:
+                    if image.block_device_mapping[dev].snapshot_id in snap_ids and image not in images:
+                        images.append(image)
+            if images:
+                engine.teardown_images(images)
+        engine.teardown_snapshots(snaps)
+        if engine.errors:
+            raise Exception("Failed to delete snapshots:\n" + "\n".join(engine.errors))
 
     def clean_up_test_volumes(self, volumes=None, min_timeout=180, timeout_per_vol=30):
         """
         Definition: cleaup helper method intended to clean up volumes created within a test, after the test has ran.
+        Attached volumes are detached, then all volumes are deleted, sending requests concurrently and polling the
+        volumes' states in batches.
 
         :param volumes: optional list of volumes to delete from system, otherwise will use test_resources['volumes']
         """
-        euvolumes = []
-        detaching = []
-        not_exist = []
-        line = '\n----------------------------------------------------------------------------------------------------\n'
-
         volumes = volumes or self.test_resources['volumes']
         if not volumes:
             self.debug('clean_up_test_volumes, no volumes passed to delete')
             return
         self.debug('clean_up_test_volumes starting\nVolumes to be deleted:' + ",".join(str(x) for x in volumes))
-
-
-
-        for vol in volumes:
-            try:
-                vol = self.get_volume(volume_id=vol.id)
-            except:
-                tb = self.get_traceback()
-                self.debug("\n" + line + " Ignoring caught Exception:\n" + str(tb) + "\n"+ str(vol.id) +
-                           ', Could not retrieve volume, may no longer exist?' + line)
-                vol = None
-            if vol:
-                try:
-                    vol.update()
-                    if not isinstance(vol, EuVolume):
-                        vol = EuVolume.make_euvol_from_vol(vol, self)
-                    euvolumes.append(vol)
-                except:
-                    tb = self.get_traceback()
-                    self.debug('Ignoring caught Exception: \n' + str(tb))
         try:
             self.debug('Attempting to clean up the following volumes:')
-            self.print_euvolume_list(euvolumes)
+            self.print_euvolume_list([vol for vol in volumes if isinstance(vol, EuVolume)])
         except: pass
-        self.debug('Clean_up_volumes: Detaching any attached volumes to be deleted...')
-        for vol in euvolumes:
-            try:
-                vol.update()
-                if vol.status == 'in-use':
-                    if vol.attach_data and (vol.attach_data.status != 'detaching' or vol.attach_data.status != 'detached'):
-                        try:
-                            self.debug(str(vol.id) + ', Sending detach. Status:' +str(vol.status) +
-                                       ', attach_data.status:' + str(vol.attach_data.status))
-                            vol.detach()
-                        except EC2ResponseError, be:
-                            if 'Volume does not exist' in be.error_message:
-                                not_exist.append(vol)
-                                self.debug(str(vol.id) + ', volume no longer exists')
-                            else:
-                                raise be
-                    detaching.append(vol)
-            except:
-                print self.get_traceback()
-        #If the volume was found to no longer exist on the system, remove it from further monitoring...
-        for vol in not_exist:
-            if vol in detaching:
-                detaching.remove(vol)
-            if vol in euvolumes:
-                euvolumes.remove(vol)
-        self.test_resources['volumes'] = euvolumes
-        timeout = min_timeout + (len(volumes) * timeout_per_vol)
-        #If detaching wait for detaching to transition to detached...
-        if detaching:
-            self.monitor_euvolumes_to_status(detaching, status='available', attached_status=None,timeout=timeout)
-        self.debug('clean_up_volumes: Deleteing volumes now...')
-        self.print_euvolume_list(euvolumes)
-        if euvolumes:
-            self.delete_volumes(euvolumes, timeout=timeout)
+        engine = TeardownEngine(self, deadline=min_timeout + (len(volumes) * timeout_per_vol))
+        engine.teardown_volumes(volumes)
+        if engine.errors:
+            raise Exception("Failed to clean up volumes:\n" + "\n".join(engine.errors))
 
                     
     def get_current_resources(self,verbose=False):
@@ -433,7 +377,7 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
             self.debug("Current resources in the system:\n" + str(current_artifacts))
         return current_artifacts
     
-    def read_config(self, filepath, username="root"):
+    def read_config(self, filepath, username="root", machine_connect=None, concurrency=None):
         """ Parses the config file at filepath returns a dictionary with the config
             Config file
             ----------
@@ -458,7 +402,13 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
                 SC00 - Storage controller for cluster 00   
                 CC00 - Cluster controller for cluster 00    
                 NC00 - A node controller in cluster 00   
+
+            machine_connect - optional - 'serial', 'parallel' or 'lazy', defaults to self.machine_connect
+            concurrency - optional - max machines connected to at once in 'parallel' mode
         """
+        machine_connect = machine_connect or self.machine_connect
+        concurrency = concurrency or self.connect_concurrency
+        phase_start = time.time()
         config_hash = {}
         machines = []
         f = None
@@ -494,7 +444,8 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
                                         connect = True,
                                         password = self.password,
                                         keypath = self.keypath,
-                                        username = username
+                                        username = username,
+                                        lazy = (machine_connect != 'serial')
                                         )
                 machines.append(cloud_machine)
                 
@@ -507,8 +458,41 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
                 config_hash["network"] = "unknown"
         #f.close()   
         config_hash["machines"] = machines 
+        if machine_connect == 'serial':
+            self.record_startup_phase('config parse/ssh', phase_start)
+        else:
+            phase_start = self.record_startup_phase('config parse', phase_start)
+        if machine_connect == 'parallel':
+            try:
+                self.connect_machines(machines, concurrency=concurrency)
+            finally:
+                self.record_startup_phase('ssh connect', phase_start)
         return config_hash
 
+    def connect_machines(self, machines, concurrency=16):
+        """
+        Connect to a list of lazily created machines in parallel on a bounded pool.
+        All hosts which could not be reached are reported together in a single exception.
+        """
+        failed = {}
+
+        def connect(machine):
+            try:
+                machine.connect_ssh()
+            except Exception, e:
+                failed[machine.hostname] = str(e)
+
+        if machines:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(machines))) as executor:
+                for future in [executor.submit(connect, machine) for machine in machines]:
+                    future.result()
+        if failed:
+            buf = "Unable to connect to " + str(len(failed)) + " of " + str(len(machines)) + " machines:\n"
+            for host in sorted(failed):
+                buf += "    " + str(host).ljust(30) + " | " + failed[host] + "\n"
+            self.critical(buf)
+            raise Exception(buf)
+
     def update_property_manager(self,machine=None):
         machine = machine or self.clc
         self.property_manager = Euproperty_Manager(self,debugmethod=self.debug)
@@ -567,6 +551,86 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops):
             else:
                 return machines_with_role
 
+    def run_on_machines(self, machines, cmd, concurrency=10, timeout=120, total_timeout=None, code=None,
+                        verbose=False, printresults=True):
+        """
+        Run 'cmd' on a list of machines in parallel on a bounded thread pool. Each host's result is recorded
+        instead of raising, so a single failed host does not hide the results of the others.
+        Example:
+            results = tester.run_on_machines(tester.get_component_machines('nc'), 'uptime', concurrency=20)
+            for machine, result in results.iteritems():
+                print machine.hostname, result['status'], result['output']
+
+        :param machines: list of machine objs, or a component string passed to get_component_machines(), ie 'nc'
+        :param cmd: string, the command to be run on each machine
+        :param concurrency: max number of machines running the command at once
+        :param timeout: per host command timeout in seconds
+        :param total_timeout: optional timeout in seconds for the whole call. Hosts which have not completed by
+                              then are returned with status None and an error. Their commands are not
+                              interrupted, they keep running in the background until they finish or hit 'timeout'
+        :param code: optional expected exit code, hosts returning another code are marked with an error
+        :param verbose: boolean, print each host's command output as it's received
+        :param printresults: boolean, print a per host summary table when done
+        :return: dict keyed by machine obj (several machine objs can share a hostname) with dict values:
+                 ['machine'], ['output'] (list of lines), ['status'], ['elapsed'], ['error'] (None on success)
+        """
+        if isinstance(machines, basestring):
+            machines = self.get_component_machines(machines)
+        #Run once per machine obj even if it is listed more than once
+        unique = []
+        for machine in machines or []:
+            if machine not in unique:
+                unique.append(machine)
+        machines = unique
+        results = {}
+        if not machines:
+            return results
+        start = time.time()
+
+        def run(machine):
+            result = {'machine': machine, 'output': [], 'status': None, 'elapsed': None, 'error': None}
+            cmdstart = time.time()
+            try:
+                out = machine.cmd(cmd, verbose=verbose, timeout=timeout, listformat=True)
+                result['output'] = out['output']
+                result['status'] = out['status']
+                if code is not None and out['status'] != code:
+                    result['error'] = 'Cmd exited with status:' + str(out['status']) + ', expected:' + str(code)
+            except Exception, e:
+                result['error'] = str(e)
+            result['elapsed'] = round(time.time() - cmdstart, 2)
+            return result
+
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, len(machines)))
+        futures = {}
+        try:
+            for machine in machines:
+                futures[executor.submit(run, machine)] = machine
+            done, not_done = wait(futures.keys(), timeout=total_timeout)
+        finally:
+            #Dont block on hosts still running past the total timeout, their results are reported as timed out.
+            #Queued hosts are cancelled below, commands already started keep running until they finish or time out
+            executor.shutdown(wait=False)
+        for future in done:
+            result = future.result()
+            results[result['machine']] = result
+        for future in not_done:
+            future.cancel()
+            machine = futures[future]
+            results[machine] = {'machine': machine, 'output': [], 'status': None, 'elapsed': None,
+                                'error': 'Did not complete within total_timeout:' + str(total_timeout)}
+        if printresults:
+            buf = "run_on_machines cmd:'" + str(cmd) + "', hosts:" + str(len(machines)) + ", elapsed:" + \
+                  str(round(time.time() - start, 2)) + "\n"
+            buf += str('HOST').ljust(30) + " | " + str('STATUS').center(8) + " | " + str('ELAPSED').center(8) + \
+                   " | ERROR\n"
+            for machine in sorted(results, key=lambda m: str(m.hostname)):
+                result = results[machine]
+                buf += str(machine.hostname).ljust(30) + " | " + str(result['status']).center(8) + " | " + \
+                       str(result['elapsed']).center(8) + " | " + str(result['error'] or '') + "\n"
+            self.debug(buf)
+        return results
+
     def swap_component_hostname(self, hostname):
         if hostname != None:
             if len(hostname) < 5:
@@ -42,6 +42,7 @@ from boto.ec2.regioninfo import RegionInfo
 import time
 
 from eutester import Eutester
+from eutester.tracing import trace_boto_connection
 
 
 ASRegionData = {
@@ -139,6 +140,7 @@ class ASops(Eutester):
             as_connection_args['region'] = as_region
             self.debug("Attempting to create auto scale connection to " + as_region.endpoint + ':' + str(port) + path)
             self.autoscale = boto.ec2.autoscale.AutoScaleConnection(**as_connection_args)
+            trace_boto_connection(self.autoscale, 'autoscaling')
         except Exception, e:
             self.critical("Was unable to create auto scale connection because of exception: " + str(e))
 
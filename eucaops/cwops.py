@@ -33,10 +33,21 @@ import re
 import copy
 import time
 import datetime
+import calendar
 from boto.ec2.regioninfo import RegionInfo
 import boto.ec2.cloudwatch
+from concurrent.futures import ThreadPoolExecutor
 from eutester.euinstance import EuInstance
 from eutester import Eutester
+from eutester.tracing import trace_boto_connection
+try:
+    import numpy
+    #numpy.full and ufunc.at were added in numpy 1.8
+    if not (hasattr(numpy, 'full') and hasattr(numpy.minimum, 'at')):
+        numpy = None
+except ImportError:
+    #Expected statistics are computed in pure python when numpy is not installed, or is older than 1.8
+    numpy = None
 
 
 CWRegionData =        {
@@ -53,6 +64,12 @@ StatsArray          = ['Average', 'Sum', 'Maximum', 'Minimum','SampleCount']
 
 ComparisonOperator  = ['>=', '>', '<', '<=']
 
+#Max number of MetricData members allowed in a single PutMetricData request
+MaxPutMetricDataBatch = 20
+
+#Max number of datapoints returned by a single GetMetricStatistics request
+MaxMetricStatisticsDatapoints = 1440
+
 InstanceMetricArray = [
                       {'name':'CPUUtilization','unit':'Percent' },
                       {'name':'DiskReadOps','unit':'Count'},
@@ -170,6 +187,7 @@ class CWops(Eutester):
             cw_connection_args['region'] = cw_region
             self.debug('Attempting to create cloud watch connection to ' + cw_region.endpoint + ':' + str(port) + path)
             self.cw = boto.connect_cloudwatch(**cw_connection_args)
+            trace_boto_connection(self.cw, 'cloudwatch')
         except Exception, e:
             self.critical('Was unable to create Cloud Watch connection because of exception: ' + str(e))
 
@@ -215,6 +233,211 @@ class CWops(Eutester):
                    p1=namespace, p2=name, p3=value, p4=timestamp, p5=unit, p6=dimensions, p7=dimensions))
         return self.cw.put_metric_data(namespace, name, value, timestamp, unit, dimensions, statistics)
 
+    def put_metric_data_batch(self, namespace, datapoints, batch_size=MaxPutMetricDataBatch):
+        '''
+        Publishes a list of datapoints to namespace using as few PutMetricData requests as possible,
+        up to batch_size (max 20) datapoints or statistic sets per request.
+
+        :param namespace: The namespace of the metrics
+        :param datapoints: list of dicts, each with keys 'name' and either 'value' or 'statistics'
+                           ({'maximum','minimum','samplecount','sum'}), and optionally
+                           'timestamp' (datetime, utc), 'unit' and 'dimensions' (dict)
+        :param batch_size: max number of datapoints per request
+        :return: number of requests made
+        '''
+        batch_size = min(int(batch_size), MaxPutMetricDataBatch)
+        requests = 0
+        for index in xrange(0, len(datapoints), batch_size):
+            params = {'Namespace': namespace}
+            self.build_put_metric_data_params(params, datapoints[index:index + batch_size])
+            self.cw.get_status('PutMetricData', params, verb="POST")
+            requests += 1
+        self.debug('Put ' + str(len(datapoints)) + ' datapoints to namespace:' + str(namespace) + ' in ' +
+                   str(requests) + ' requests')
+        return requests
+
+    def build_put_metric_data_params(self, params, datapoints):
+        '''
+        Fills in the MetricData.member.N params for a PutMetricData request. Unlike boto's build_put_params()
+        each datapoint may carry its own unit, timestamp, dimensions, and value or statistic set.
+        '''
+        for index, datapoint in enumerate(datapoints):
+            metric_data = {'MetricName': datapoint['name']}
+            if datapoint.get('timestamp'):
+                metric_data['Timestamp'] = datapoint['timestamp'].isoformat()
+            if datapoint.get('unit'):
+                metric_data['Unit'] = datapoint['unit']
+            if datapoint.get('dimensions'):
+                self.cw.build_dimension_param(datapoint['dimensions'], metric_data)
+            if datapoint.get('statistics'):
+                stats = datapoint['statistics']
+                metric_data['StatisticValues.Maximum'] = stats['maximum']
+                metric_data['StatisticValues.Minimum'] = stats['minimum']
+                metric_data['StatisticValues.SampleCount'] = stats['samplecount']
+                metric_data['StatisticValues.Sum'] = stats['sum']
+            elif datapoint.get('value') is not None:
+                metric_data['Value'] = datapoint['value']
+            else:
+                raise Exception('Must specify a value or statistics to put for datapoint:' + str(datapoint))
+            for key, value in metric_data.iteritems():
+                params['MetricData.member.%d.%s' % (index + 1, key)] = value
+        return params
+
+    def list_all_metrics(self, dimensions=None, metric_name=None, namespace=None):
+        '''
+        Returns all metrics matching the filters, following next_token across as many list_metrics
+        pages as the service returns.
+        '''
+        metrics = []
+        next_token = None
+        while True:
+            page = self.cw.list_metrics(next_token, dimensions, metric_name, namespace)
+            metrics.extend(page)
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                break
+        self.debug('list_all_metrics found ' + str(len(metrics)) + ' metrics')
+        return metrics
+
+    def get_all_metric_statistics(self, period, start_time, end_time, metric_name, namespace, statistics,
+                                  dimensions=None, unit=None, max_datapoints=MaxMetricStatisticsDatapoints,
+                                  workers=1):
+        '''
+        get_metric_statistics() for windows larger than the service will return in one request. The window is
+        split into chunks of at most max_datapoints periods, fetched with up to 'workers' requests in flight.
+
+        :return: list of datapoints sorted by 'Timestamp'
+        '''
+        if isinstance(statistics, basestring):
+            statistics = [statistics]
+        chunk = datetime.timedelta(seconds=int(period) * int(max_datapoints))
+        windows = []
+        chunk_start = start_time
+        while chunk_start < end_time:
+            chunk_end = min(chunk_start + chunk, end_time)
+            windows.append((chunk_start, chunk_end))
+            chunk_start = chunk_end
+
+        def fetch(window):
+            return self.cw.get_metric_statistics(period, window[0], window[1], metric_name, namespace,
+                                                 statistics, dimensions, unit)
+        if workers > 1 and len(windows) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(windows))) as executor:
+                results = list(executor.map(fetch, windows))
+        else:
+            results = [fetch(window) for window in windows]
+        datapoints = []
+        for result in results:
+            datapoints.extend(result)
+        datapoints.sort(key=lambda datapoint: datapoint['Timestamp'])
+        self.debug('get_all_metric_statistics got ' + str(len(datapoints)) + ' datapoints for ' +
+                   str(metric_name) + ' in ' + str(len(windows)) + ' requests')
+        return datapoints
+
+    @staticmethod
+    def get_epoch_seconds(timestamp):
+        '''
+        Returns seconds since the epoch for a naive utc datetime (as used by boto for cloudwatch timestamps)
+        '''
+        return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1000000.0
+
+    def compute_expected_stats(self, datapoints, period=60):
+        '''
+        Computes the Sum, Average, Minimum, Maximum and SampleCount the service should report per period
+        for the datapoints which were put. Uses numpy >= 1.8 when available.
+
+        :param datapoints: list of datapoint dicts as given to put_metric_data_batch(), each with a 'timestamp'
+        :param period: period in seconds, datapoints are grouped by timestamp floored to the period
+        :return: dict of {period start datetime: {'Sum','Average','Minimum','Maximum','SampleCount'}}
+        '''
+        period = int(period)
+        size = len(datapoints)
+        times = [0] * size
+        sums = [0.0] * size
+        counts = [0.0] * size
+        mins = [0.0] * size
+        maxs = [0.0] * size
+        for index, datapoint in enumerate(datapoints):
+            times[index] = int(self.get_epoch_seconds(datapoint['timestamp'])) // period * period
+            stats = datapoint.get('statistics')
+            if stats:
+                sums[index] = float(stats['sum'])
+                counts[index] = float(stats['samplecount'])
+                mins[index] = float(stats['minimum'])
+                maxs[index] = float(stats['maximum'])
+            else:
+                value = float(datapoint['value'])
+                sums[index] = mins[index] = maxs[index] = value
+                counts[index] = 1.0
+        if not size:
+            return {}
+        if numpy is not None:
+            periods, bins = numpy.unique(numpy.array(times, dtype=numpy.int64), return_inverse=True)
+            total = numpy.bincount(bins, weights=numpy.array(sums), minlength=len(periods))
+            samples = numpy.bincount(bins, weights=numpy.array(counts), minlength=len(periods))
+            minimum = numpy.full(len(periods), numpy.inf)
+            numpy.minimum.at(minimum, bins, numpy.array(mins))
+            maximum = numpy.full(len(periods), -numpy.inf)
+            numpy.maximum.at(maximum, bins, numpy.array(maxs))
+            rows = zip(periods.tolist(), total.tolist(), samples.tolist(), minimum.tolist(), maximum.tolist())
+        else:
+            grouped = {}
+            for index in xrange(size):
+                row = grouped.get(times[index])
+                if row is None:
+                    grouped[times[index]] = [sums[index], counts[index], mins[index], maxs[index]]
+                else:
+                    row[0] += sums[index]
+                    row[1] += counts[index]
+                    row[2] = min(row[2], mins[index])
+                    row[3] = max(row[3], maxs[index])
+            rows = [[start] + grouped[start] for start in sorted(grouped)]
+        expected = {}
+        for start, total, samples, minimum, maximum in rows:
+            expected[datetime.datetime.utcfromtimestamp(start)] = {'Sum': total,
+                                                                   'Average': total / samples,
+                                                                   'Minimum': minimum,
+                                                                   'Maximum': maximum,
+                                                                   'SampleCount': samples}
+        return expected
+
+    def verify_metric_statistics(self, expected, datapoints, statistics=None, tolerance=0.001, raise_error=True):
+        '''
+        Compares the expected per period statistics from compute_expected_stats() against the datapoints
+        returned by the service, ie from get_all_metric_statistics().
+
+        :param expected: dict of {period start datetime: {statistic: value}}
+        :param datapoints: list of datapoints returned by the service
+        :param statistics: list of statistics to compare, defaults to all in StatsArray
+        :param tolerance: allowed relative difference between expected and reported values
+        :param raise_error: boolean, raise an exception if any mismatches are found
+        :return: list of mismatch strings
+        '''
+        statistics = statistics or StatsArray
+        reported = {}
+        for datapoint in datapoints:
+            timestamp = datapoint['Timestamp'].replace(tzinfo=None, microsecond=0)
+            reported[timestamp] = datapoint
+        mismatches = []
+        for start in sorted(expected):
+            datapoint = reported.get(start)
+            if datapoint is None:
+                mismatches.append(str(start) + ' | missing datapoint')
+                continue
+            for stat in statistics:
+                want = expected[start][stat]
+                got = datapoint.get(stat)
+                if got is None or abs(float(got) - want) > tolerance * max(abs(want), 1.0):
+                    mismatches.append(str(start) + ' | ' + str(stat).ljust(12) + ' | expected:' + str(want) +
+                                      ', reported:' + str(got))
+        for start in sorted(set(reported) - set(expected)):
+            mismatches.append(str(start) + ' | unexpected datapoint:' + str(reported[start]))
+        self.debug('Verified ' + str(len(expected)) + ' periods, ' + str(len(mismatches)) + ' mismatches')
+        if mismatches and raise_error:
+            raise Exception('Metric statistics did not match for ' + str(len(mismatches)) + ' entries:\n' +
+                            "\n".join(mismatches[:50]))
+        return mismatches
+
     def metric_alarm(self, name, metric, comparison, threshold, period, evaluation_periods, statistic,
                      description=None, dimensions=None, alarm_actions=None,
                      ok_actions=None, insufficient_data_actions=None, unit=None, namespace=None):
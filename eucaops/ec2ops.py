@@ -54,12 +54,14 @@ from boto.ec2.regioninfo import RegionInfo
 import boto
 
 from eutester import Eutester
+from eutester.tracing import trace_boto_connection, traced
 import eutester
 from eutester.euinstance import EuInstance
 from eutester.windows_instance import WinInstance
 from eutester.euvolume import EuVolume
 from eutester.eusnapshot import EuSnapshot
 from eutester.euzone import EuZone
+from eutester.resource_monitor import ResourceStateMonitor
 
 EC2RegionData = {
     'us-east-1' : 'ec2.us-east-1.amazonaws.com',
@@ -163,6 +165,7 @@ disable_root: false"""
             ec2_connection_args['region'] = ec2_region
             self.debug("Attempting to create ec2 connection to " + ec2_region.endpoint + ':' + str(port) + path)
             self.ec2 = boto.connect_ec2(**ec2_connection_args)
+            trace_boto_connection(self.ec2, 'ec2')
         except Exception, e:
             self.critical("Was unable to create ec2 connection because of exception: " + str(e))
 
@@ -520,6 +523,7 @@ disable_root: false"""
         instance.terminate()
         return self.wait_for_instance(instance, state='terminated', timeout=timeout)
 
+    @traced('wait')
     def wait_for_instance(self,instance, state="running", poll_count = None, timeout=480):
         """
         Wait for the instance to enter the state
@@ -555,6 +559,7 @@ disable_root: false"""
         self.debug( str(instance) + ' is now in ' + instance.state )
         return True
 
+    @traced('wait')
     def wait_for_reservation(self,reservation, state="running",timeout=480):
         """
         Wait for an entire reservation to enter the state
@@ -693,6 +698,7 @@ disable_root: false"""
         return retlist
     
     
+    @traced('wait')
     @Eutester.printinfo
     def monitor_created_euvolumes_to_state(self,
                                            volumes,
@@ -808,6 +814,7 @@ disable_root: false"""
         self.print_euvolume_list(origlist)
         return retlist
 
+    @traced('wait')
     @Eutester.printinfo
     def monitor_euvolumes_to_status(self,
                                    euvolumes,
@@ -870,18 +877,16 @@ disable_root: false"""
                 self.debug(self.get_traceback())
 
         self.print_euvolume_list(monitor)
+        self.debug("Monitoring volumes to state/attached_state: '"+str(status)+"/"+str(attached_status)+"'")
+        #Poll all volumes with one batched request per cycle, only state changes are logged
+        state_monitor = ResourceStateMonitor(self, max_interval=poll_interval)
+        last_attached_states = dict((vol.id, vol.eutest_attached_status) for vol in monitor)
         while monitor and (elapsed < timeout):
             elapsed = int(time.time()-start)
-            for vol in monitor:
-                last_attached_status = vol.eutest_attached_status
-                vol.update()
-                if vol.eutest_attached_instance_id:
-                    instance_debug_str = ', (att_instance'+str(vol.eutest_attached_instance_id)+")"
-                else:
-                    instance_debug_str = ""
-                self.debug("Monitoring volume:"+str(vol.id)+". Currently state/attached_state:'"+str(vol.status)
-                            +"/"+str(vol.eutest_attached_status)+"', needed: '"+str(status)+"/"+str(attached_status)+
-                           "'"+instance_debug_str)
+            state_monitor.update(monitor)
+            for vol in list(monitor):
+                last_attached_status = last_attached_states.get(vol.id)
+                last_attached_states[vol.id] = vol.eutest_attached_status
                 #fail fast for improper state transitions when attaching:
                 if attached_status and last_attached_status and not vol.eutest_attached_status:
                     failmsg += str(vol.id)+" - state:"+str(vol.status)+", reverted from attached state:'"\
@@ -903,11 +908,10 @@ disable_root: false"""
                 if vol.status == status:
                         if vol.eutest_attached_status == attached_status:
                             good.append(monitor.pop(monitor.index(vol)))
-            self.debug('Waiting for '+str(len(monitor))+ " remaining Volumes. Sleeping for poll_interval: "
-                       +str(poll_interval)+" seconds ...")
-            self.print_euvolume_list(euvolumes)
-            time.sleep(poll_interval)
-        self.debug('Done with monitor volumes after '+str(elapsed)+"/"+str(timeout)+"...")
+            if monitor:
+                state_monitor.wait(monitor, max_wait=(timeout - (time.time() - start)))
+        self.debug('Done with monitor volumes after '+str(elapsed)+"/"+str(timeout)+", describe requests:"
+                   +str(state_monitor.api_calls)+"...")
         self.print_euvolume_list(euvolumes)
         if monitor:
             for vol in monitor:
@@ -972,6 +976,7 @@ disable_root: false"""
             buf += snapshot.printself(title=False)
         self.debug("\n"+str(buf)+"\n")
 
+    @traced('wait')
     def wait_for_volume(self, volume, status="available"):
         def get_volume_state():
             volume.update()
@@ -1041,10 +1046,12 @@ disable_root: false"""
             vollist = copy.copy(volume_list)
         else:
             raise Exception("delete_volumes: volume_list was empty")
+        #Refresh, then poll all volumes with one batched describe per cycle
+        state_monitor = ResourceStateMonitor(self, max_interval=poll_interval)
+        state_monitor.update(vollist, force=True)
         for volume in vollist:
             try:
                 self.debug( "Sending delete for volume: " +  str(volume.id)  )
-                volume.update()
                 previous_status = volume.status
                 self.ec2.delete_volume(volume.id)
             except EC2ResponseError, be:
@@ -1062,18 +1069,16 @@ disable_root: false"""
         start = time.time()
         elapsed = 0
         while vollist and elapsed < timeout:
-            for volume in vollist:
-                volume.update()
-                self.debug( str(volume) + " in " + volume.status)
-                volume.update()
-                if volume.status == "deleted":
-                    vollist.remove(volume)
-                    if volume in self.test_resources['volumes']:
-                        self.test_resources['volumes'].remove(volume)
-                elapsed = int(time.time()-start)
-            time.sleep(poll_interval)
-            self.debug("---Waiting for:"+str(len(vollist))+" volumes to delete. Sleeping:"+
-                       str(poll_interval)+", elapsed:"+str(elapsed)+"/"+str(timeout)+"---")
+            state_monitor.update(vollist)
+            for volume in [vol for vol in vollist if vol.status == "deleted"]:
+                vollist.remove(volume)
+                if volume in self.test_resources['volumes']:
+                    self.test_resources['volumes'].remove(volume)
+            elapsed = int(time.time()-start)
+            if vollist:
+                self.debug("---Waiting for:"+str(len(vollist))+" volumes to delete, elapsed:"+str(elapsed)+"/"+
+                           str(timeout)+"---")
+                state_monitor.wait(vollist, max_wait=(timeout - (time.time() - start)))
         if vollist or errmsg:
             for volume in vollist:
                 errmsg += "ERROR:"+str(volume) + " left in " +  volume.status + ',elapsed:'+str(elapsed) + "\n"
@@ -1468,6 +1473,7 @@ disable_root: false"""
         return snapshots
         
         
+    @traced('wait')
     @Eutester.printinfo
     def monitor_eusnaps_to_completed(self,
                                      snaps,
@@ -1518,15 +1524,21 @@ disable_root: false"""
         for snap in snapshots:
             if not snap.eutest_polls:
                 snap.eutest_poll_count = poll_count
+            snap.eutest_last_progress_time = monitor_start
+        #Progress stalls are measured in time, polls come faster than poll_interval while snapshots change state
+        stall_timeout = poll_count * poll_interval
         
         self.debug('Waiting for '+str(len(snapshots))+" snapshots to go to completed state...")
         
+        #Poll all snapshots with one batched request per cycle, only state changes are logged
+        state_monitor = ResourceStateMonitor(self, max_interval=poll_interval)
         while (timeout == 0 or elapsed <= timeout) and snapshots:
-            self.debug("Waiting for "+str(len(snapshots))+" snapshots to complete creation")
-            for snapshot in snapshots:
+            due = [snapshot for snapshot in snapshots
+                   if state_monitor.next_poll.get(snapshot.id, 0) <= time.time()]
+            state_monitor.update(due)
+            for snapshot in due:
                 try:
                     snapshot.eutest_polls += 1
-                    snapshot.update()
                     snapshot.eutest_laststatus = snapshot.status
                     if snapshot.status == 'failed':
                         raise Exception(str(snapshot) + " failed after Polling("+str(snapshot.eutest_polls)+
@@ -1535,17 +1547,13 @@ disable_root: false"""
                     curr_progress = int(snapshot.progress.replace('%',''))
                     #if progress was made, then reset timer 
                     if (wait_on_progress > 0) and (curr_progress > snapshot.eutest_last_progress):
-                        snapshot.eutest_poll_count = wait_on_progress
-                    else: 
-                        snapshot.eutest_poll_count -= 1
+                        snapshot.eutest_last_progress_time = time.time()
                     snapshot.eutest_last_progress = curr_progress
                     elapsed = int(time.time()-monitor_start)
-                    if snapshot.eutest_poll_count <= 0:
-                        raise Exception("Snapshot did not make progress for "+str(wait_on_progress)+" polls, after "+
+                    if time.time() - snapshot.eutest_last_progress_time > stall_timeout:
+                        raise Exception("Snapshot did not make progress for "+str(stall_timeout)+" seconds ("+
+                                        str(poll_count)+" poll intervals of "+str(poll_interval)+"s), after "+
                                         str(elapsed)+" seconds")
-                    self.debug(str(snapshot.id)+", Status:"+snapshot.status+", Progress:"+snapshot.progress+
-                               ", Polls w/o progress:"+str(wait_on_progress-snapshot.eutest_poll_count)+"/"+
-                               str(wait_on_progress)+", Time Elapsed:"+str(elapsed)+"/"+str(timeout))
                     if snapshot.status == 'completed':
                         self.debug(str(snapshot.id)+" created after " + str(elapsed) + " seconds. Status:"+
                                    snapshot.status+", Progress:"+snapshot.progress)
@@ -1576,7 +1584,7 @@ disable_root: false"""
                         snapshots.remove(snapshot)
             elapsed = int(time.time()-monitor_start)
             if snapshots:
-                time.sleep(poll_interval)
+                state_monitor.wait(snapshots)
         for snap in snapshots:
             snapshot.eutest_failmsg = "Snapshot timed out in creation after "+str(elapsed)+" seconds"
             snapshot.eutest_timeintest = elapsed
@@ -1690,18 +1698,18 @@ disable_root: false"""
         if not valid_delete_states:
             raise Exception("delete_snapshots, error in valid_states provided:"+str(valid_states))
 
+        valid_delete_states = [str(v_state).strip() for v_state in valid_delete_states]
+        #Poll all snapshots with one batched describe per cycle
+        state_monitor = ResourceStateMonitor(self, max_interval=poll_interval)
         #Wait for snapshot to enter a state that will accept the deletion action, before attempting to delete it...
         while snaps and (elapsed < wait_for_valid_state):
             elapsed = int(time.time()-start)
+            state_monitor.update(snaps)
             for snap in snaps:
-                snap.update()
-                self.debug("Checking snapshot:"+str(snap.id)+" status:"+str(snap.status))
-                for v_state in valid_delete_states:
-                    v_state = str(v_state).rstrip().lstrip()
-                    if snap.status == v_state:
-                        delete_me.append(snap)
-                        snap.delete()
-                        break
+                if snap.status in valid_delete_states:
+                    self.debug("Sending delete for snapshot:"+str(snap.id)+" status:"+str(snap.status))
+                    delete_me.append(snap)
+                    snap.delete()
             for snap in delete_me:
                 if snap in snaps:
                     snaps.remove(snap)
@@ -1711,8 +1719,7 @@ disable_root: false"""
                 for snap in snaps:
                     buf = buf +"\nSnapshot:"+str(snap.id)+",status:"+str(snap.status)+", progress:"+str(snap.progress)
                 self.debug(buf)
-                self.debug('waiting poll_interval to recheck snapshots:'+str(poll_interval)+' seconds')
-                time.sleep(poll_interval)
+                state_monitor.wait(snaps, max_wait=(wait_for_valid_state - (time.time() - start)))
             
 
         if snaps:
@@ -1729,13 +1736,13 @@ disable_root: false"""
         timeout= base_timeout + (add_time_per_snap*len(delete_me))
         while delete_me and (elapsed < timeout):
             self.debug('Waiting for remaining '+str(int(len(delete_me)))+' snaps to delete...' )
-            for snapshot in delete_me:
-                snapshot.update()
-                if not self.ec2.get_all_snapshots(snapshot_ids=[snapshot.id]) or snapshot.status == 'deleted':
-                    self.debug('Snapshot:'+str(snapshot.id)+" is deleted")
-                    delete_me.remove(snapshot)
-            time.sleep(poll_interval)
+            state_monitor.update(delete_me)
+            for snapshot in [snap for snap in delete_me if snap.status == 'deleted']:
+                self.debug('Snapshot:'+str(snapshot.id)+" is deleted")
+                delete_me.remove(snapshot)
             elapsed = int(time.time()-start)
+            if delete_me:
+                state_monitor.wait(delete_me, max_wait=(timeout - (time.time() - start)))
         if delete_me:
             buf = ""
             for snap in snaps:
@@ -2623,6 +2630,7 @@ disable_root: false"""
             raise e 
     
     
+    @traced('wait')
     def wait_for_instances_block_dev_mapping(self, instances, poll_interval=1, timeout=60):
         waiting = copy.copy(instances)
         elapsed = 0
@@ -2678,6 +2686,7 @@ disable_root: false"""
                                ' from instance:' + str(instance.id) + " block dev map, err:" + str(e))
 
 
+    @traced('wait')
     @Eutester.printinfo 
     def monitor_euinstances_to_running(self,instances, poll_interval=10, timeout=480):
         self.debug("("+str(len(instances))+") Monitor_instances_to_running starting...")
@@ -2876,6 +2885,7 @@ disable_root: false"""
                     return res
         raise Exception('No reservation found for instance:'+str(instance.id))
     
+    @traced('wait')
     @Eutester.printinfo    
     def monitor_euinstances_to_state(self,
                                      instance_list,
@@ -2911,13 +2921,18 @@ disable_root: false"""
         #If no min allowed successful instance count is given, set it to the length of the list provdied. 
         if min is None:
             min = len(instance_list)
+        #Poll all instances and their ebs root volumes with one batched request per resource type per cycle
+        state_monitor = ResourceStateMonitor(self, max_interval=poll_interval)
         while monitor and elapsed < timeout:
             elapsed = int(time.time() - start)
             self.debug("\n------>Waiting for remaining "+str(len(monitor))+"/"+str(len(instance_list))+
                        " instances to go to state:"+str(state)+', elapsed:('+str(elapsed)+'/'+str(timeout)+")...")
-            for instance in monitor:
+            due = [instance for instance in monitor
+                   if state_monitor.next_poll.get(instance.id, 0) <= time.time()]
+            root_vols = [instance.bdm_root_vol for instance in due if getattr(instance, 'bdm_root_vol', None)]
+            state_monitor.update(due + root_vols, force=True)
+            for instance in due:
                 try:
-                    instance.update()
                     bdm_root_vol_status = None
                     bdm_root_vol_id = None
                     if instance.root_device_type == 'ebs':
@@ -2928,7 +2943,6 @@ disable_root: false"""
                                 bdm_root_vol_status = instance.bdm_root_vol.status
                             except: pass
                         else:
-                            instance.bdm_root_vol.update()
                             bdm_root_vol_id = instance.bdm_root_vol.id
                             bdm_root_vol_status = instance.bdm_root_vol.status
                         if instance.laststate:
@@ -2947,8 +2961,6 @@ disable_root: false"""
                         for failed_state in failstates:
                             if instance.state == failed_state:
                                 raise Exception('FAILED STATE:'+ dbgmsg )
-
-                    self.debug("WAITING for "+dbgmsg)
                 except Exception, e:
                     failed.append(instance)
                     tb = self.get_traceback()
@@ -2963,12 +2975,12 @@ disable_root: false"""
                         failmsg += str(e)+"\n"
                         
             #remove good instances from list to monitor
-            for instance in monitor:
+            for instance in list(monitor):
                 if (instance in good) or (instance in failed):
                     monitor.remove(instance)
                     
             if monitor:
-                time.sleep(poll_interval)
+                state_monitor.wait(monitor, max_wait=(timeout - (time.time() - start)))
                 
         self.print_euinstance_list(instance_list)
         if monitor:
@@ -3033,6 +3045,7 @@ disable_root: false"""
             buf += instance.printself(title=False, footer=True)
         self.debug("\n"+str(buf)+"\n")
 
+    @traced('wait')
     @Eutester.printinfo
     def wait_for_valid_ip(self, instances, regex="0.0.0.0", poll_interval=10, timeout = 60):
         """
@@ -3335,7 +3348,7 @@ disable_root: false"""
         Terminate instances in the system
 
         :param reservation: Reservation object to terminate all instances in, default is to terminate all instances
-        :raise: Exception when instance does not reach terminated state
+        :raise: Exception when the terminate request fails for an instance, after the others have been monitored
         """
         ### If a reservation is not passed then kill all instances
         aggregate_result = False
@@ -3358,14 +3371,32 @@ disable_root: false"""
                 else:
                     raise Exception('Need type instance or reservation in terminate_instances. type:' + str(type(res)))
 
+        #Send terminate for all instances in batched requests, fall back to one at a time if a batch is rejected
+        ids = [instance.id for instance in instance_list]
+        failed = []
+        for index in xrange(0, len(ids), 200):
+            chunk = ids[index:index + 200]
+            self.debug("Sending terminate for " + ",".join(chunk))
+            try:
+                self.ec2.terminate_instances(instance_ids=chunk)
+            except EC2ResponseError, ee:
+                self.debug('Batched terminate failed, sending per instance. Err:' + str(ee))
+                for instance in instance_list[index:index + 200]:
+                    try:
+                        instance.terminate()
+                    except EC2ResponseError, ie:
+                        self.debug('Terminate for ' + str(instance.id) + ' failed:' + str(ie))
+                        #An instance which no longer exists is left to the monitor, any other error is raised below
+                        if not str(ie.error_code).endswith('NotFound'):
+                            failed.append((instance, ie))
+        failed_instances = [instance for instance, ie in failed]
         for instance in instance_list:
-                    self.debug( "Sending terminate for " + str(instance) )
-                    instance.terminate()
-                    instance.update()
-                    if instance.state != 'terminated':
-                        monitor_list.append(instance)
-                    else:
-                        self.debug('Instance: ' + str(instance.id) + ' in terminated state:' + str(instance.state))
+            if instance in failed_instances:
+                continue
+            if instance.state != 'terminated':
+                monitor_list.append(instance)
+            else:
+                self.debug('Instance: ' + str(instance.id) + ' in terminated state:' + str(instance.state))
 
         self.print_euinstance_list(euinstance_list=monitor_list)
         try:
@@ -3373,7 +3404,9 @@ disable_root: false"""
             aggregate_result = True
         except Exception, e:
             self.debug('Caught Exception in monitoring instances to terminated state:' + str(e))
-
+        if failed:
+            raise Exception('Failed to send terminate for ' + str(len(failed)) + ' instances:\n' +
+                            "\n".join([str(instance.id) + ': ' + str(ie) for instance, ie in failed]))
         return aggregate_result
     
     def stop_instances(self,reservation, timeout=480):
@@ -3546,6 +3579,7 @@ disable_root: false"""
         """
         return str(bundle.bucket) + "/" + str(bundle.prefix) + ".manifest.xml"
 
+    @traced('wait')
     def monitor_bundle_tasks(self, bundle_list, poll_interval_seconds=20, timeout_minutes=25, eof=True):
         """
         Attempts to monitor the state of the bundle task id provided until completed or failed.
@@ -37,6 +37,7 @@ import boto
 from concurrent.futures import ThreadPoolExecutor
 import urllib2
 from eutester import Eutester
+from eutester.tracing import trace_boto_connection
 from boto.ec2.elb.listener import Listener
 from boto.ec2.elb.healthcheck import HealthCheck
 
@@ -139,6 +140,7 @@ class ELBops(Eutester):
             self.debug(
                 "Attempting to create load balancer connection to " + elb_region.endpoint + ':' + str(port) + path)
             self.elb = boto.connect_elb(**elb_connection_args)
+            trace_boto_connection(self.elb, 'elb')
         except Exception, e:
             self.critical("Was unable to create elb connection because of exception: " + str(e))
 
@@ -30,6 +30,7 @@
 #
 # Author: vic.iglesias@eucalyptus.com
 from eutester import Eutester
+from eutester.tracing import trace_boto_connection
 import re
 import boto
 
@@ -54,6 +55,7 @@ class IAMops(Eutester):
                                       'host' : endpoint}
             self.debug("Attempting to create IAM connection to " + endpoint + ':' + str(port) + path)
             self.euare = boto.connect_iam(**euare_connection_args)
+            trace_boto_connection(self.euare, 'iam')
         except Exception, e:
             self.critical("Was unable to create IAM connection because of exception: " + str(e))
     
@@ -31,8 +31,13 @@
 # Author: vic.iglesias@eucalyptus.com
 
 from eutester import Eutester
+from eutester.tracing import trace_boto_connection
 import os
+import time
+import base64
 import hashlib
+from StringIO import StringIO
+from concurrent.futures import ThreadPoolExecutor
 from boto.s3.connection import OrdinaryCallingFormat
 from boto.s3.key import Key
 from boto.s3.acl import ACL, Grant
@@ -53,6 +58,12 @@ class S3opsException(Exception):
         print self.msg
 
 class S3ops(Eutester):
+    # None until the first multi-object delete request tells us whether the service supports it
+    multi_delete_supported = None
+    # Responses to a multi-object delete meaning the service does not implement it. Other errors, ie a 400
+    # MalformedXML, are failures of the request itself
+    multi_delete_unsupported_statuses = [405, 501]
+    multi_delete_unsupported_codes = ['NotImplemented', 'MethodNotAllowed']
     s3_groups = {
              "all_users":"http://acs.amazonaws.com/groups/global/AllUsers",
              "authenticated_users":"http://acs.amazonaws.com/groups/global/AuthenticatedUsers",
@@ -84,6 +95,7 @@ class S3ops(Eutester):
                                    }
             self.debug("Attempting to create S3 connection to " + endpoint + ':' + str(port) + path)
             self.s3 = boto.connect_s3(**s3_connection_args)
+            trace_boto_connection(self.s3, 's3')
         except Exception, e:
             raise Exception("Was unable to create S3 connection because of exception: " + str(e))
 
@@ -177,6 +189,213 @@ class S3ops(Eutester):
         self.test_resources["keys"].append(key)
         return key
     
+    def upload_object_multipart(self, bucket_name, key_name, path_to_file=None, fileobj=None, contents=None,
+                                size=None, part_size=8388608, concurrency=4, check_md5=True, headers=None):
+        """
+        Write an object to walrus as a multipart upload, sending parts in parallel on a bounded pool.
+        The source is read one part at a time, so at most 'concurrency' + 1 parts are held in memory.
+        bucket_name   The name of the walrus Bucket.
+        key_name      The name of the object containing the data in walrus.
+        path_to_file  Fully qualified path to local file.
+        fileobj       File like object to read the object data from.
+        contents      String or generator/iterable yielding strings of object data.
+        size          Bytes of random data to upload when no source is given, default one part.
+        part_size     Size of each part in bytes, S3 requires >= 5MB for all but the last part.
+        concurrency   Max number of parts in flight at once.
+        check_md5     Verify each part's eTag and the final multipart eTag against locally computed md5s.
+        Returns the key, with key.md5 set to the hex md5 of the entire object.
+        """
+        bucket = self.get_bucket_by_name(bucket_name)
+        if bucket == None:
+            raise S3opsException("Could not find bucket " + bucket_name + " to upload file")
+        if path_to_file is not None:
+            fileobj = open(path_to_file, 'rb')
+            parts = self._iter_file_parts(fileobj, part_size)
+        elif fileobj is not None:
+            parts = self._iter_file_parts(fileobj, part_size)
+        elif contents is not None:
+            if isinstance(contents, basestring):
+                contents = [contents]
+            parts = self._iter_rechunk(contents, part_size)
+        else:
+            parts = self._iter_random_parts(size or part_size, part_size)
+        mp = None
+        whole_md5 = hashlib.md5()
+        part_digests = []
+        total = 0
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        pending = []
+        try:
+            #Inside the try so the source file is closed if the upload can not be started
+            mp = bucket.initiate_multipart_upload(key_name, headers=headers)
+            self.debug("Started multipart upload:" + str(mp.id) + " for key:" + str(key_name) +
+                       ", part_size:" + str(part_size) + ", concurrency:" + str(concurrency))
+            part_num = 0
+            for data in parts:
+                part_num += 1
+                total += len(data)
+                whole_md5.update(data)
+                pending.append(executor.submit(self._upload_part, mp, part_num, data, check_md5))
+                # Bound the parts held in memory, wait for the oldest part before reading more
+                if len(pending) >= concurrency:
+                    part_digests.append(pending.pop(0).result())
+            for future in pending:
+                part_digests.append(future.result())
+            if not part_num:
+                raise S3opsException("No data to upload for key " + str(key_name))
+            completed = mp.complete_upload()
+        except Exception, e:
+            if mp is None:
+                raise
+            self.debug("Multipart upload of " + str(key_name) + " failed, canceling upload:" + str(e))
+            #Let parts already uploading finish first, a part landing after the abort would be orphaned
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            try:
+                mp.cancel_upload()
+            except Exception, ce:
+                self.debug("Failed to cancel multipart upload " + str(mp.id) + ":" + str(ce))
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            if path_to_file is not None:
+                fileobj.close()
+        if check_md5:
+            etag = completed.etag.strip('"')
+            # A multipart eTag is the md5 of the concatenated part digests, suffixed with the part count
+            if '-' not in etag:
+                if etag != whole_md5.hexdigest():
+                    raise S3opsException("Hash/eTag mismatch: \nhash = " + whole_md5.hexdigest() + "\neTag= " + etag)
+            else:
+                hash, count = etag.split('-', 1)
+                if int(count) != len(part_digests):
+                    raise S3opsException("Multipart eTag:" + etag + " part count does not match parts sent:" +
+                                         str(len(part_digests)))
+                self.check_md5(eTag=hash, data="".join(part_digests))
+        elapsed = time.time() - start
+        self.debug("Uploaded key: " + str(key_name) + " to bucket:" + str(bucket_name) + " in " +
+                   str(len(part_digests)) + " parts, " + str(total) + " bytes in " + "%.2f" % elapsed + "s (" +
+                   "%.2f" % (total / 1048576.0 / max(elapsed, 0.001)) + "MB/s)")
+        key = bucket.get_key(key_name)
+        key.md5 = whole_md5.hexdigest()
+        self.test_resources["keys"].append(key)
+        return key
+
+    def _upload_part(self, mp, part_num, data, check_md5=True):
+        """
+        Upload a single part of a multipart upload, returns the binary md5 digest of the part
+        """
+        hasher = hashlib.md5(data)
+        part = mp.upload_part_from_file(StringIO(data), part_num, md5=(hasher.hexdigest(),
+                                        base64.b64encode(hasher.digest())))
+        if check_md5:
+            self.check_md5(eTag=part.etag.strip('"'), data=data)
+        return hasher.digest()
+
+    def _iter_file_parts(self, fileobj, part_size):
+        while True:
+            data = fileobj.read(part_size)
+            if not data:
+                return
+            yield data
+
+    def _iter_rechunk(self, chunks, part_size):
+        buf = []
+        buf_len = 0
+        for chunk in chunks:
+            buf.append(chunk)
+            buf_len += len(chunk)
+            if buf_len >= part_size:
+                data = "".join(buf)
+                while len(data) >= part_size:
+                    yield data[:part_size]
+                    data = data[part_size:]
+                buf = [data]
+                buf_len = len(data)
+        if buf_len:
+            yield "".join(buf)
+
+    def _iter_random_parts(self, size, part_size):
+        while size > 0:
+            data = os.urandom(min(size, part_size))
+            size -= len(data)
+            yield data
+
+    def download_object_ranged(self, bucket_name, key_name, path_to_file=None, fileobj=None, part_size=8388608,
+                               concurrency=4, check_md5=True, expected_md5=None):
+        """
+        Read an object from walrus using parallel ranged GETs. Ranges are written to the destination
+        in order as they complete, so at most 'concurrency' ranges are held in memory.
+        bucket_name   The name of the walrus Bucket.
+        key_name      The name of the object in walrus.
+        path_to_file  Fully qualified path to local file to write to.
+        fileobj       File like object to write to, if neither is given the data is read and discarded.
+        part_size     Size of each ranged GET in bytes. Use the upload part size to verify multipart eTags.
+        concurrency   Max number of ranges in flight at once.
+        check_md5     Verify the md5 of the data read against the object's eTag when possible.
+        expected_md5  Hex md5 of the entire object to verify against, ie: key.md5 from upload_object_multipart
+        Returns the hex md5 of the data read.
+        """
+        bucket = self.get_bucket_by_name(bucket_name)
+        if bucket == None:
+            raise S3opsException("Could not find bucket " + bucket_name + " to download from")
+        key = bucket.get_key(key_name)
+        if key is None:
+            raise S3opsException("Could not find key " + str(key_name) + " in bucket " + bucket_name)
+        ranges = [(offset, min(offset + part_size, key.size) - 1) for offset in xrange(0, key.size, part_size)]
+        whole_md5 = hashlib.md5()
+        part_digests = []
+        start = time.time()
+        if path_to_file is not None:
+            fileobj = open(path_to_file, 'wb')
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            pending = []
+            next_range = 0
+            while next_range < len(ranges) or pending:
+                while next_range < len(ranges) and len(pending) < concurrency:
+                    pending.append(executor.submit(self._download_range, bucket, key_name, *ranges[next_range]))
+                    next_range += 1
+                data = pending.pop(0).result()
+                whole_md5.update(data)
+                part_digests.append(hashlib.md5(data).digest())
+                if fileobj is not None:
+                    fileobj.write(data)
+        finally:
+            executor.shutdown(wait=True)
+            if path_to_file is not None:
+                fileobj.close()
+        md5 = whole_md5.hexdigest()
+        if expected_md5 and md5 != expected_md5:
+            raise S3opsException("Hash mismatch for " + str(key_name) + ": \nhash = " + md5 +
+                                 "\nexpected= " + expected_md5)
+        if check_md5:
+            etag = key.etag.strip('"')
+            if '-' not in etag:
+                if md5 != etag:
+                    raise S3opsException("Hash/eTag mismatch: \nhash = " + md5 + "\neTag= " + etag)
+            elif int(etag.split('-')[1]) == len(part_digests):
+                self.check_md5(eTag=etag.split('-')[0], data="".join(part_digests))
+            else:
+                self.debug("Can not verify multipart eTag:" + etag + " with " + str(len(part_digests)) +
+                           " ranges, use the upload part_size to verify")
+        elapsed = time.time() - start
+        self.debug("Downloaded key: " + str(key_name) + " from bucket:" + str(bucket_name) + ", " +
+                   str(key.size) + " bytes in " + str(len(ranges)) + " ranges in " + "%.2f" % elapsed + "s (" +
+                   "%.2f" % (key.size / 1048576.0 / max(elapsed, 0.001)) + "MB/s)")
+        return md5
+
+    def _download_range(self, bucket, key_name, first, last):
+        # Each request gets its own key object, boto keys hold per request response state
+        key = Key(bucket, key_name)
+        data = key.get_contents_as_string(headers={'Range': 'bytes=' + str(first) + '-' + str(last)})
+        if len(data) != last - first + 1:
+            raise S3opsException("Short read of " + str(key_name) + " range " + str(first) + "-" + str(last) +
+                                 ", got " + str(len(data)) + " bytes")
+        return data
+
     def get_objects_by_prefix(self, bucket_name, prefix):
         """
         Get keys in the specified bucket that match the prefix if no prefix is passed all objects are returned
@@ -213,16 +432,8 @@ class S3ops(Eutester):
             raise Exception('Not found')
         
         try:
-            self.debug( "Getting bucket listing for " + bucket.name )     
-            self.debug(  "Iterating throught the bucket" )
-            key_list = bucket.list()        
-            self.debug(  "Starting loop" )
-            for k in key_list:
-                if isinstance(k, boto.s3.prefix.Prefix):
-                    self.debug(  "Skipping prefix" )
-                    continue
-                self.debug(  "Deleting key: " + k.name )
-                bucket.delete_key(k)
+            self.debug( "Deleting keys in bucket " + bucket.name )
+            self.delete_keys_bulk(bucket, bucket.list())
             bucket.delete()
         except S3ResponseError as e:
             self.debug(  "Exception caught doing bucket cleanup." )
@@ -231,43 +442,126 @@ class S3ops(Eutester):
                 #Do version cleanup
                 self.debug(  "Cleaning up versioning artifacts" )
                 try:
-                    keys = bucket.get_all_versions()
-                    for k in keys:
-                        if isinstance(k, Key):
-                            self.debug(  "Got version: " + k.name + "--" + k.version_id + "-- Delete marker? " + str(k.delete_marker) )
-                            self.debug(  "Deleting key: " + k.name )
-                            bucket.delete_key(key_name=k.name,version_id=k.version_id)
-                        elif isinstance(k, DeleteMarker):
-                            self.debug(  "Got marker: " + k.name + "--" + k.version_id + "--" + str(k.is_latest) )
-                            self.debug(  "Deleting delete marker" )
-                            bucket.delete_key(key_name=k.name,version_id=k.version_id)
+                    self.delete_keys_bulk(bucket, bucket.list_versions())
                     self.debug(  "Deleting bucket " + bucket.name )
                     bucket.delete()
                 except Exception as e:
-                    self.debug(  "Exception deleting versioning artifacts: " + e.message )
+                    self.debug(  "Exception deleting versioning artifacts: " + str(e) )
             else:
                 self.debug('Got ' + e.message + ' and status ' + str(e.status))
                     
     def clear_keys_with_prefix(self, bucket, prefix):
         try :
-            listing = self.walrus.get_all_buckets()        
+            listing = self.s3.get_all_buckets()
             for bucket in listing:
                 if bucket.name.startswith(prefix):
-                    self.debug( "Getting bucket listing for " + bucket.name)
-                    key_list = bucket.list()
-                    for k in key_list:
-                        if isinstance(k, boto.s3.prefix.Prefix):
-                            self.debug( "Skipping prefix" )
-                            continue
-                        self.debug( "Deleting key: " + k.name )
-                        bucket.delete_key(k)
+                    self.debug( "Deleting keys in bucket " + bucket.name)
+                    self.delete_keys_bulk(bucket, bucket.list())
                     bucket.delete()
                 else:
                     self.debug( "skipping bucket: " + bucket.name )
         except S3ResponseError as e:
             raise S3opsException( "Exception caught doing bucket cleanup." )
-                    
-    
+
+    def delete_keys_bulk(self, bucket, keys, batch_size=1000, concurrency=10):
+        """
+        Delete keys from a bucket using multi-object delete requests of up to 'batch_size' keys, sent
+        concurrently. The keys iterable is consumed lazily so a paged bucket.list() or bucket.list_versions()
+        listing is never held in memory. If the service does not support multi-object delete, falls back
+        to concurrent single key deletes.
+        bucket       The bucket object to delete keys from
+        keys         Iterable of key names, (key_name, version_id) tuples, Key or DeleteMarker objects
+        batch_size   Max keys per multi-object delete request, S3 allows up to 1000
+        concurrency  Max number of delete requests in flight
+        Returns dict with 'deleted' count, list of 'failed' (key_name, version_id, error) tuples, 'elapsed'
+        and 'keys_per_sec'
+        """
+        batch_size = min(batch_size, 1000)
+        deleted = 0
+        failed = []
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        pending = []
+
+        def collect(future):
+            count, errors = future.result()
+            failed.extend(errors)
+            return count
+
+        try:
+            for batch in self._iter_delete_batches(keys, batch_size):
+                if self.multi_delete_supported is None:
+                    # Probe support with the first batch before fanning out
+                    result = self._multi_delete_batch(bucket, batch)
+                    if result is not None:
+                        deleted += result[0]
+                        failed.extend(result[1])
+                        continue
+                if self.multi_delete_supported:
+                    pending.append(executor.submit(self._multi_delete_batch, bucket, batch))
+                else:
+                    pending.extend([executor.submit(self._delete_single_key, bucket, entry) for entry in batch])
+                while len(pending) > concurrency:
+                    deleted += collect(pending.pop(0))
+            for future in pending:
+                deleted += collect(future)
+        finally:
+            executor.shutdown(wait=True)
+        elapsed = time.time() - start
+        keys_per_sec = deleted / max(elapsed, 0.001)
+        self.debug("Deleted " + str(deleted) + " keys from bucket:" + str(bucket.name) + " in " + "%.2f" % elapsed +
+                   "s (" + "%.1f" % keys_per_sec + " keys/sec) using " +
+                   ("multi-object delete" if self.multi_delete_supported else "single key deletes") +
+                   ", failures:" + str(len(failed)))
+        for key_name, version_id, error in failed[:10]:
+            self.debug("Failed to delete key:" + str(key_name) + " version:" + str(version_id) + ", " + str(error))
+        return {'deleted': deleted, 'failed': failed, 'elapsed': elapsed, 'keys_per_sec': keys_per_sec}
+
+    def _iter_delete_batches(self, keys, batch_size):
+        batch = []
+        for k in keys:
+            if isinstance(k, boto.s3.prefix.Prefix):
+                continue
+            if isinstance(k, basestring):
+                batch.append((k, None))
+            elif isinstance(k, tuple):
+                batch.append(k)
+            else:
+                batch.append((k.name, getattr(k, 'version_id', None)))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _multi_delete_batch(self, bucket, batch):
+        """
+        Delete a batch of (key_name, version_id) entries in one multi-object delete request.
+        Returns (deleted count, failed entries), or None if the service does not support multi-object delete
+        """
+        try:
+            result = bucket.delete_keys([(name, version_id) if version_id else name for name, version_id in batch],
+                                        quiet=True)
+        except S3ResponseError, e:
+            if self.multi_delete_supported is None and (e.status in self.multi_delete_unsupported_statuses or
+                                                        e.error_code in self.multi_delete_unsupported_codes):
+                self.debug("Multi-object delete not supported (" + str(e.status) + " " + str(e.error_code) +
+                           "), falling back to single key deletes")
+                self.multi_delete_supported = False
+                return None
+            return 0, [(name, version_id, str(e.status) + " " + str(e.error_code)) for name, version_id in batch]
+        self.multi_delete_supported = True
+        errors = [(error.key, error.version_id, str(error.code) + " " + str(error.message)) for error in result.errors]
+        return len(batch) - len(errors), errors
+
+    def _delete_single_key(self, bucket, entry):
+        name, version_id = entry
+        try:
+            bucket.delete_key(name, version_id=version_id)
+        except S3ResponseError, e:
+            return 0, [(name, version_id, str(e.status) + " " + str(e.error_code))]
+        return 1, []
+
     def get_canned_acl(self, canned_acl=None, bucket_owner_id=None, bucket_owner_display_name=None):
         '''
         Returns an acl object that can be applied to a bucket or key. It is intended to be used to verify
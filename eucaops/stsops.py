@@ -24,6 +24,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from eutester import Eutester
+from eutester.tracing import trace_boto_connection
 import boto
 from boto.ec2.regioninfo import RegionInfo
 
@@ -72,6 +73,7 @@ class STSops(Eutester):
                                     'region' : sts_region}
             self.debug("Attempting to create STS connection to " + self.get_ec2_ip() + ':' + str(port) + path)
             self.tokens = boto.connect_sts(**sts_connection_args)
+            trace_boto_connection(self.tokens, 'sts')
         except Exception, e:
             self.critical("Was unable to create STS connection because of exception: " + str(e))
 
@@ -44,6 +44,7 @@ import sys
 import traceback
 import StringIO
 import eulogger
+import tracing
 import types
 import operator
 
@@ -85,6 +86,46 @@ class Eutester(object):
             self.account_id = self.get_account_id()
             self.user_id = self.get_user_id()
 
+    @property
+    def test_resources(self):
+        return self.__dict__.get('_test_resources')
+
+    @test_resources.setter
+    def test_resources(self, resources):
+        """
+        When a resource inventory is enabled, test_resources lists record resources in the inventory as they are
+        added and removed. See eutester.inventory
+        """
+        from inventory import get_default_inventory, TrackedResources
+        inventory = self.__dict__.get('inventory')
+        if inventory is None:
+            inventory = get_default_inventory()
+        if inventory and resources is not None and not isinstance(resources, TrackedResources):
+            resources = TrackedResources(self, inventory, resources)
+        self.__dict__['_test_resources'] = resources
+
+    def enable_inventory(self, path=None, run_id=None):
+        """
+        Record the resources in test_resources, and any added from now on, in a durable inventory file so they can
+        be reaped by a later run if this one dies before cleaning them up.
+        :param path: inventory file path, defaults to $EUTESTER_INVENTORY or ~/.eutester/inventory.db
+        :param run_id: id to record this run's resources under, generated if not given
+        :returns: ResourceInventory
+        """
+        from inventory import get_default_inventory, ResourceInventory
+        inventory = None
+        if path is None and run_id is None:
+            inventory = get_default_inventory()
+        self.inventory = inventory or ResourceInventory(path=path, run_id=run_id, debugmethod=self.debug)
+        self.test_resources = dict(self.test_resources or {})
+        self.debug('Recording test resources in inventory:' + str(self.inventory.path) + ', run id:' +
+                   str(self.inventory.run_id))
+        return self.inventory
+
+    def disable_inventory(self):
+        self.inventory = False
+        self.test_resources = dict([(key, list(value)) for key, value in (self.test_resources or {}).iteritems()])
+
     def get_access_key(self):
         if not self.aws_access_key_id:     
             """Parse the eucarc for the EC2_ACCESS_KEY"""
@@ -263,7 +304,12 @@ class Eutester(object):
     def sleep(self, seconds=1):
         """Convinience function for time.sleep()"""
         self.debug("Sleeping for " + str(seconds) + " seconds")
-        time.sleep(seconds)
+        if tracing.tracer.enabled:
+            #Name the span after the caller so the trace summary shows whose sleep loops the time went to
+            with tracing.span('sleep', 'sleep:' + sys._getframe(1).f_code.co_name, seconds=seconds):
+                time.sleep(seconds)
+        else:
+            time.sleep(seconds)
 
     @staticmethod
     def render_file_template(src, dest, **kwargs):
@@ -363,14 +409,20 @@ class Eutester(object):
         self.debug( "Beginning poll loop for result " + str(callback.func_name) + " to go to " + str(result) )
         start = time.time()
         elapsed = 0
-        current_state =  callback(**callback_kwargs)
-        ### If the instance changes state or goes to the desired state before my poll count is complete
-        while( elapsed <  timeout and not oper(current_state,result) ):
-            self.debug(  str(callback.func_name) + ' returned: "' + str(current_state) + '" after '
-                       + str(elapsed/60) + " minutes " + str(elapsed%60) + " seconds.")
-            self.sleep(poll_wait)
-            current_state = callback(**callback_kwargs)
-            elapsed = int(time.time()- start)
+        polls = 1
+        span = tracing.tracer.start('wait', 'wait_for_result:' + str(callback.func_name), timeout=timeout)
+        try:
+            current_state =  callback(**callback_kwargs)
+            ### If the instance changes state or goes to the desired state before my poll count is complete
+            while( elapsed <  timeout and not oper(current_state,result) ):
+                self.debug(  str(callback.func_name) + ' returned: "' + str(current_state) + '" after '
+                           + str(elapsed/60) + " minutes " + str(elapsed%60) + " seconds.")
+                self.sleep(poll_wait)
+                current_state = callback(**callback_kwargs)
+                polls += 1
+                elapsed = int(time.time()- start)
+        finally:
+            span.finish(polls=polls)
         self.debug(  str(callback.func_name) + ' returned: "' + str(current_state) + '" after '
                     + str(elapsed/60) + " minutes " + str(elapsed%60) + " seconds.")
         if not oper(current_state,result):
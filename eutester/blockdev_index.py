@@ -0,0 +1,175 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Guest block device fingerprint index.
+
+Matching volumes to guest devices by md5 used to mean one remote 'head -c <len> <dev> | md5sum' per device,
+per volume, per poll. A BlockDevIndex instead hashes the head of every device for every requested length in a
+single remote command, and keeps the results keyed by a per device signature (ie inode/major:minor/size).
+Devices are only hashed again when their signature changes, they are (re)added, or the entry is invalidated
+(ie after the test writes to the device). Matching a volume is then a dict lookup.
+
+example usage:
+    index = BlockDevIndex(lambda cmd, timeout: instance.sys(cmd, code=0, timeout=timeout, verbose=False))
+    index.update(['/dev/vdb', '/dev/vdc'], lengths=[32])
+    dev = index.find(volume.md5, volume.md5len)
+'''
+import time
+
+
+class BlockDevIndex():
+    def __init__(self, runmethod, debugmethod=None, timeout=120):
+        '''
+        :param runmethod: method used to run a shell command on the guest, called as runmethod(cmd, timeout).
+                          Must return the output as a list of lines.
+        :param debugmethod: method used for debug output
+        :param timeout: timeout for the remote hashing command
+        '''
+        self.runmethod = runmethod
+        self.debugmethod = debugmethod
+        self.timeout = timeout
+        #dev -> {'sig': signature, 'md5': {length: md5}}
+        self.devices = {}
+        #devs in the order they were last listed by the guest, first match wins as with the old per dev loop
+        self.dev_order = []
+        #Number of devices served from cache by the last update()
+        self.cached_devs = 0
+        self.last_updated = None
+
+    def debug(self, msg):
+        if self.debugmethod:
+            self.debugmethod(msg)
+
+    def invalidate(self, dev=None):
+        '''
+        Drops cached hashes for dev, or for all devices if dev is None. Should be called after writing to a device.
+        '''
+        if dev is None:
+            self.devices = {}
+        else:
+            self.devices.pop(str(dev).strip(), None)
+
+    def update(self, devs, lengths, signatures=None, force=False):
+        '''
+        Brings the index up to date for the given device list and md5 lengths.
+        At most one remote command is run, and only if a device/length has not already been hashed.
+
+        :param devs: list of guest device paths currently present
+        :param lengths: list of byte lengths to hash from the head of each device, 0 hashes the whole device
+        :param signatures: optional dict of dev -> signature string, a changed signature forces a re-hash of the dev
+        :param force: re-hash every device
+        '''
+        signatures = signatures or {}
+        lengths = sorted(set([int(l) for l in lengths if l is not None]))
+        self.dev_order = list(devs)
+        #Forget devices which are no longer present, and any whose signature has changed
+        for dev in self.devices.keys():
+            if dev not in devs or force or self.devices[dev]['sig'] != signatures.get(dev):
+                self.devices.pop(dev)
+        need_devs = []
+        need_lengths = set()
+        self.cached_devs = 0
+        for dev in devs:
+            entry = self.devices.setdefault(dev, {'sig': signatures.get(dev), 'md5': {}})
+            missing = [l for l in lengths if l not in entry['md5']]
+            if missing:
+                need_devs.append(dev)
+                need_lengths.update(missing)
+            if len(missing) < len(lengths):
+                self.cached_devs += 1
+        if need_devs:
+            self.hash_devices(need_devs, sorted(need_lengths))
+        self.last_updated = time.time()
+        return self
+
+    def is_fresh(self, lengths, max_age):
+        '''
+        Returns True if the index was updated within max_age seconds and has every dev hashed for every length
+        '''
+        if self.last_updated is None or (time.time() - self.last_updated) > max_age:
+            return False
+        for dev in self.dev_order:
+            entry = self.devices.get(dev)
+            if not entry:
+                return False
+            for length in lengths:
+                if length is not None and int(length) not in entry['md5']:
+                    return False
+        return True
+
+    def get_hash_cmd(self, devs, lengths):
+        '''
+        Returns a single shell command which prints 'dev length md5' for every dev and length
+        '''
+        hashcmd = []
+        for length in lengths:
+            if length:
+                hashcmd.append('echo $d ' + str(length) + ' $(head -c ' + str(length) + ' $d 2>/dev/null | md5sum)')
+            else:
+                hashcmd.append('echo $d 0 $(md5sum < $d 2>/dev/null)')
+        return 'for d in ' + " ".join(devs) + '; do ' + '; '.join(hashcmd) + '; done'
+
+    def hash_devices(self, devs, lengths):
+        start = time.time()
+        out = self.runmethod(self.get_hash_cmd(devs, lengths), self.timeout)
+        for line in out:
+            fields = str(line).split()
+            if len(fields) < 3 or fields[0] not in self.devices:
+                continue
+            try:
+                self.devices[fields[0]]['md5'][int(fields[1])] = fields[2]
+            except ValueError:
+                continue
+        self.debug('Hashed ' + str(len(devs)) + ' devices for lengths:' + ",".join([str(l) for l in lengths]) +
+                   ' in ' + str(round(time.time() - start, 2)) + ' seconds')
+
+    def get_md5_map(self, length):
+        '''
+        Returns dict of md5 -> dev for the given length. Where devices share an md5 (ie zero filled) the
+        first device in the guest's listing order is used.
+        '''
+        md5map = {}
+        for dev in self.dev_order:
+            entry = self.devices.get(dev)
+            if entry and int(length) in entry['md5']:
+                md5map.setdefault(entry['md5'][int(length)], dev)
+        return md5map
+
+    def find(self, md5, length):
+        '''
+        Returns the dev whose first 'length' bytes hash to md5, or None
+        '''
+        return self.get_md5_map(length).get(md5)
+
+    def get_dev_md5(self, dev, length):
+        entry = self.devices.get(dev)
+        if entry:
+            return entry['md5'].get(int(length))
+        return None
@@ -0,0 +1,367 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+CloudWatch metric load generator built on a CWops connection.
+
+Generates datapoints for namespaces x metric names x dimension combinations and publishes them with batched
+PutMetricData requests from a pool of worker threads, paced to a target aggregate datapoints/sec. Optionally
+creates alarms on the generated metrics so the service is also evaluating alarms under the load.
+While the load runs a probe thread periodically puts a uniquely dimensioned datapoint and polls
+get_metric_statistics until it shows up, measuring how long data takes to become visible.
+Put request latencies and visibility delays are kept in log scaled histograms. If the achieved rate falls short
+of the target, or visibility delays grow through the run, the service is not keeping up with the load.
+
+example usage:
+    load = CWLoadGenerator(tester, namespaces=5, metrics=20, dimensions=10, rate=500, concurrency=8,
+                           duration=600, warmup=30, alarms=50)
+    load.run()
+    load.show_results()
+    load.write_json('/tmp/cw_load.json')
+    load.clean_up()
+'''
+import datetime
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from eutester.s3load import LatencyHistogram
+
+
+class CWLoadGenerator():
+    probe_metric_name = 'VisibilityProbe'
+    #DeleteAlarms accepts at most 100 alarm names per request
+    max_alarms_per_delete = 100
+
+    def __init__(self,
+                 tester,
+                 namespaces=1,
+                 metrics=10,
+                 dimensions=10,
+                 rate=100,
+                 batch_size=20,
+                 concurrency=4,
+                 duration=60,
+                 warmup=5,
+                 alarms=0,
+                 probe_interval=10,
+                 visibility_timeout=300,
+                 name_prefix=None,
+                 unit='Count',
+                 debugmethod=None):
+        """
+        :param tester: eutester obj with a cloudwatch connection, ie CWops/Eucaops
+        :param namespaces: number of namespaces to generate
+        :param metrics: number of metric names per namespace
+        :param dimensions: number of dimension values per metric, each is a separate metric series
+        :param rate: target aggregate datapoints/sec, if None workers send requests back to back
+        :param batch_size: datapoints per PutMetricData request (max 20)
+        :param concurrency: number of worker threads issuing requests
+        :param duration: seconds to run the load for, including warmup
+        :param warmup: seconds at the start of the run whose requests are not recorded
+        :param alarms: number of alarms to create on the generated metrics before the run
+        :param probe_interval: seconds between visibility probes, 0 disables probes
+        :param visibility_timeout: seconds to wait for a probe datapoint to become visible
+        :param name_prefix: prefix of the namespaces and alarms created by this generator
+        :param unit: unit of the generated datapoints
+        :param debugmethod: method used for logging, defaults to tester.debug
+        """
+        self.tester = tester
+        self.batch_size = max(1, min(int(batch_size), 20))
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.alarm_count = alarms
+        self.probe_interval = probe_interval
+        self.visibility_timeout = visibility_timeout
+        self.name_prefix = name_prefix or 'Load-' + str(int(time.time()))
+        self.unit = unit
+        self.debugmethod = debugmethod or tester.debug
+        self.namespaces = [self.name_prefix + '-ns' + str(x) for x in xrange(namespaces)]
+        self.metric_names = ['Metric' + str(x) for x in xrange(metrics)]
+        self.dimension_values = ['dim' + str(x) for x in xrange(dimensions)]
+        #Each batch is drawn from the series of a single namespace, since PutMetricData takes one namespace
+        self.series = {}
+        for namespace in self.namespaces:
+            self.series[namespace] = [(name, {'Series': value})
+                                      for name in self.metric_names for value in self.dimension_values]
+        self.alarms = []
+        self.lock = threading.Lock()
+        self.cursor = 0
+        self.next_send = None
+        self.start = None
+        self.end = None
+        self.probe_count = 0
+        self.results = {}
+        self.reset_results()
+
+    def debug(self, msg):
+        self.debugmethod(msg)
+
+    def reset_results(self):
+        self.results = {'put': LatencyHistogram(),
+                        'visibility': LatencyHistogram(),
+                        'requests': 0,
+                        'datapoints': 0,
+                        'errors': 0,
+                        'late_sends': 0,
+                        'max_send_lag': 0.0,
+                        'probes': 0,
+                        'probes_not_visible': 0}
+
+    def series_count(self):
+        return len(self.namespaces) * len(self.metric_names) * len(self.dimension_values)
+
+    def _next_batch(self):
+        """
+        Hands out batches round robin across all metric series, returns (namespace, [(name, dimensions),])
+        """
+        with self.lock:
+            per_namespace = len(self.metric_names) * len(self.dimension_values)
+            namespace_index, offset = divmod(self.cursor, per_namespace)
+            namespace = self.namespaces[namespace_index]
+            batch = self.series[namespace][offset:offset + self.batch_size]
+            self.cursor = (self.cursor + len(batch)) % (per_namespace * len(self.namespaces))
+        return namespace, batch
+
+    def _wait_for_send_slot(self, datapoints):
+        """
+        When running at a target rate, hand out send times across all workers spaced by the number of
+        datapoints in each request. Returns how late (seconds) this request was sent compared to its slot.
+        """
+        with self.lock:
+            send_at = self.next_send
+            self.next_send = max(self.next_send, time.time() - 1) + float(datapoints) / self.rate
+        delay = send_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+            return 0
+        return -delay
+
+    def worker(self):
+        while time.time() < self.end:
+            namespace, batch = self._next_batch()
+            lag = 0
+            if self.rate:
+                lag = self._wait_for_send_slot(len(batch))
+                if time.time() >= self.end:
+                    return
+            timestamp = datetime.datetime.utcnow()
+            datapoints = [{'name': name, 'value': random.randint(0, 100), 'timestamp': timestamp,
+                           'unit': self.unit, 'dimensions': dimensions} for name, dimensions in batch]
+            started = time.time()
+            try:
+                #Send directly rather than through put_metric_data_batch() to keep per request logging out of the load
+                params = self.tester.build_put_metric_data_params({'Namespace': namespace}, datapoints)
+                self.tester.cw.get_status('PutMetricData', params, verb="POST")
+                error = False
+            except Exception, e:
+                error = True
+                self.debug('Load PutMetricData to ' + namespace + ' failed:' + str(e))
+            finished = time.time()
+            if started < self.start + self.warmup:
+                continue
+            with self.lock:
+                self.results['requests'] += 1
+                if error:
+                    self.results['errors'] += 1
+                else:
+                    self.results['datapoints'] += len(datapoints)
+                    self.results['put'].add((finished - started) * 1000)
+                #Sends more than a second behind their slot mean the workers can't keep up with the target rate
+                if lag > 1:
+                    self.results['late_sends'] += 1
+                self.results['max_send_lag'] = max(self.results['max_send_lag'], lag)
+
+    def put_probe(self):
+        """
+        Puts a single datapoint on a dimension value unique to this probe, returns (dimensions, put time)
+        """
+        with self.lock:
+            self.probe_count += 1
+            dimensions = {'Probe': self.name_prefix + '-' + str(self.probe_count)}
+        self.tester.put_metric_data_batch(self.namespaces[0],
+                                          [{'name': self.probe_metric_name, 'value': 1, 'unit': self.unit,
+                                            'timestamp': datetime.datetime.utcnow(), 'dimensions': dimensions}])
+        return dimensions, time.time()
+
+    def is_probe_visible(self, dimensions, put_time):
+        start = datetime.datetime.utcfromtimestamp(put_time - 120)
+        end = datetime.datetime.utcfromtimestamp(put_time + 120)
+        datapoints = self.tester.cw.get_metric_statistics(60, start, end, self.probe_metric_name, self.namespaces[0],
+                                                          ['SampleCount'], dimensions, self.unit)
+        return len(datapoints) > 0
+
+    def prober(self, poll_interval=1):
+        """
+        Puts a probe every probe_interval seconds for the duration of the run and polls outstanding
+        probes until each is visible or has hit visibility_timeout
+        """
+        outstanding = []
+        next_probe = self.start + self.warmup
+        while True:
+            now = time.time()
+            if now < self.end and now >= next_probe:
+                try:
+                    outstanding.append(self.put_probe())
+                    with self.lock:
+                        self.results['probes'] += 1
+                except Exception, e:
+                    self.debug('Visibility probe put failed:' + str(e))
+                next_probe = now + self.probe_interval
+            for probe in list(outstanding):
+                dimensions, put_time = probe
+                try:
+                    visible = self.is_probe_visible(dimensions, put_time)
+                except Exception, e:
+                    self.debug('Visibility probe check failed:' + str(e))
+                    visible = False
+                if visible:
+                    outstanding.remove(probe)
+                    with self.lock:
+                        self.results['visibility'].add((time.time() - put_time) * 1000)
+                elif time.time() - put_time > self.visibility_timeout:
+                    outstanding.remove(probe)
+                    with self.lock:
+                        self.results['probes_not_visible'] += 1
+                    self.debug('Visibility probe ' + str(dimensions) + ' not visible after ' +
+                               str(self.visibility_timeout) + 's')
+            if not outstanding and time.time() >= self.end:
+                return
+            time.sleep(poll_interval)
+
+    def create_alarms(self):
+        """
+        Creates alarm_count alarms spread across the generated metric series
+        """
+        series = [(namespace, name, dimensions) for namespace in self.namespaces
+                  for name, dimensions in self.series[namespace]]
+        for x in xrange(len(self.alarms), self.alarm_count):
+            namespace, name, dimensions = series[x % len(series)]
+            alarm = self.tester.metric_alarm(self.name_prefix + '-alarm' + str(x), name, '>', 50, 60, 1, 'Average',
+                                             description='load test', dimensions=dimensions, unit=self.unit,
+                                             namespace=namespace)
+            self.tester.put_metric_alarm(alarm)
+            self.alarms.append(alarm.name)
+        self.debug('Created ' + str(len(self.alarms)) + ' alarms')
+
+    def run(self):
+        """
+        Create any alarms then run the load for the configured duration, returns the results dict
+        """
+        self.reset_results()
+        if self.alarm_count > len(self.alarms):
+            self.create_alarms()
+        self.debug('Running cloudwatch load, namespaces:' + str(len(self.namespaces)) + ', series:' +
+                   str(self.series_count()) + ', batch size:' + str(self.batch_size) + ', concurrency:' +
+                   str(self.concurrency) + ', rate:' + str(self.rate or 'unthrottled') + ' datapoints/sec, duration:' +
+                   str(self.duration) + 's, warmup:' + str(self.warmup) + 's, alarms:' + str(len(self.alarms)))
+        self.start = time.time()
+        self.next_send = self.start
+        self.end = self.start + self.duration
+        with ThreadPoolExecutor(max_workers=self.concurrency + 1) as executor:
+            futures = [executor.submit(self.worker) for x in xrange(self.concurrency)]
+            if self.probe_interval:
+                futures.append(executor.submit(self.prober))
+            for future in futures:
+                future.result()
+        return self.get_results()
+
+    def get_results(self):
+        """
+        Returns dict of the run's stats
+        """
+        measured = max(float(self.duration - self.warmup), 0.001)
+        put = self.results['put']
+        visibility = self.results['visibility']
+
+        def seconds(ms):
+            if ms is None:
+                return None
+            return ms / 1000.0
+        return {'target_datapoints_per_sec': self.rate,
+                'datapoints_per_sec': self.results['datapoints'] / measured,
+                'requests_per_sec': self.results['requests'] / measured,
+                'datapoints': self.results['datapoints'],
+                'requests': self.results['requests'],
+                'errors': self.results['errors'],
+                'late_sends': self.results['late_sends'],
+                'max_send_lag_sec': self.results['max_send_lag'],
+                'put_p50_ms': put.percentile(50),
+                'put_p95_ms': put.percentile(95),
+                'put_p99_ms': put.percentile(99),
+                'put_max_ms': put.max,
+                'probes': self.results['probes'],
+                'probes_not_visible': self.results['probes_not_visible'],
+                'visibility_p50_sec': seconds(visibility.percentile(50)),
+                'visibility_p95_sec': seconds(visibility.percentile(95)),
+                'visibility_max_sec': seconds(visibility.max)}
+
+    def show_results(self, printmethod=None):
+        printmethod = printmethod or self.debug
+        stats = self.get_results()
+        buf = 'CLOUDWATCH LOAD RESULTS, series:' + str(self.series_count()) + ', alarms:' + str(len(self.alarms)) + '\n'
+        for key in sorted(stats):
+            value = stats[key]
+            if isinstance(value, float):
+                value = '%.2f' % value
+            buf += str(key).ljust(28) + str(value) + '\n'
+        printmethod(buf)
+        return buf
+
+    def write_json(self, path):
+        config = {'namespaces': self.namespaces, 'metrics': len(self.metric_names),
+                  'dimensions': len(self.dimension_values), 'batch_size': self.batch_size,
+                  'concurrency': self.concurrency, 'rate': self.rate, 'duration': self.duration,
+                  'warmup': self.warmup, 'alarms': len(self.alarms)}
+        with open(path, 'w') as out:
+            json.dump({'config': config, 'results': self.get_results()}, out, indent=2)
+
+    def clean_up(self):
+        """
+        Delete the alarms created by this generator. Metrics can not be deleted and age out on their own.
+        """
+        if not self.alarms:
+            return
+        remaining = []
+        errors = []
+        for index in xrange(0, len(self.alarms), self.max_alarms_per_delete):
+            chunk = self.alarms[index:index + self.max_alarms_per_delete]
+            try:
+                self.tester.cw.delete_alarms(chunk)
+            except Exception, e:
+                #Keep going so one failed request does not leak the rest, the failed alarms are kept for a retry
+                remaining.extend(chunk)
+                errors.append(str(e))
+        self.debug('Deleted ' + str(len(self.alarms) - len(remaining)) + ' of ' + str(len(self.alarms)) + ' alarms')
+        self.alarms = remaining
+        if errors:
+            raise Exception('Failed to delete ' + str(len(remaining)) + ' alarms: ' + "; ".join(errors))
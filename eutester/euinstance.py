@@ -52,6 +52,8 @@ from eutester import Eutester
 from eutester.euvolume import EuVolume
 from eutester import eulogger
 from eutester.taggedresource import TaggedResource
+from eutester.guest_io import GuestIO, GuestIOStartException
+from eutester.blockdev_index import BlockDevIndex
 from random import randint
 import sshconnection
 import sys
@@ -117,6 +119,8 @@ class EuInstance(Instance, TaggedResource):
         newins.vmtype_info = None
         newins.use_sudo = None
         newins.security_groups = []
+        newins.guest_io = None
+        newins.blockdev_index = None
 
         newins.tester = tester
         newins.debugmethod = debugmethod
@@ -255,7 +259,7 @@ class EuInstance(Instance, TaggedResource):
         self.debug('reset_ssh_connection for:'+str(self.id))
         if ((self.keypath is not None) or ((self.username is not None)and(self.password is not None))):
             if self.ssh is not None:
-                self.ssh.close()
+                self.ssh.close(discard=True)
             self.debug('Connecting ssh '+str(self.id))
             self.ssh = sshconnection.SshConnection(
                                                     self.ip_address,
@@ -292,8 +296,12 @@ class EuInstance(Instance, TaggedResource):
             start = time.time()
             elapsed = 0
             if self.ssh is not None:
-                self.ssh.close()
+                self.ssh.close(discard=True)
             self.ssh = None
+            #Helper copied to the guest's /tmp may not survive a reboot, copy it again on next use
+            self.guest_io = None
+            #Device names and contents may have changed, ie after a reboot or stop/start
+            self.blockdev_index = None
             while (elapsed < timeout):
                 attempts += 1
                 try:
@@ -316,6 +324,27 @@ class EuInstance(Instance, TaggedResource):
         else:
             self.debug("keypath or username/password need to be populated for ssh connection")
 
+    def get_guest_io(self):
+        '''
+        Returns this instance's GuestIO helper, or None if the guest can not run it (ie no python on the guest)
+        in which case callers should fall back to dd.
+        '''
+        guest_io = getattr(self, 'guest_io', None)
+        if guest_io is None:
+            guest_io = GuestIO(self, debugmethod=self.debug)
+            if not guest_io.is_supported():
+                self.debug('Guest io helper not supported on ' + str(self.id) + ', using dd')
+                guest_io = False
+            self.guest_io = guest_io
+        return guest_io or None
+
+    def disable_guest_io(self, err=None):
+        '''
+        Stops using the guest io helper on this instance, ie when it failed to start. Callers fall back to dd.
+        '''
+        self.debug('Guest io helper failed to start on ' + str(self.id) + ', using dd. err:' + str(err))
+        self.guest_io = False
+
     def has_sudo(self):
         try:
             # Run ssh command directly from ssh interface not local sys()
@@ -528,6 +557,71 @@ class EuInstance(Instance, TaggedResource):
             retlist.append(line.strip())
         return retlist
     
+    def get_blockdev_index(self):
+        '''
+        Returns the BlockDevIndex used to match volumes to guest devices by md5
+        '''
+        index = getattr(self, 'blockdev_index', None)
+        if index is None:
+            index = BlockDevIndex(lambda cmd, timeout: self.sys(cmd, code=0, timeout=timeout, verbose=False),
+                                  debugmethod=self.debug)
+            self.blockdev_index = index
+        return index
+
+    def invalidate_blockdev_index(self, dev=None):
+        '''
+        Drops cached md5 fingerprints for dev (or all devs). Needed after data is written to a guest device.
+        '''
+        index = getattr(self, 'blockdev_index', None)
+        if index is not None:
+            index.invalidate(dev)
+
+    def update_blockdev_index(self, lengths, prefixes=None, force=False):
+        '''
+        Lists the guest's block devices along with a signature per device (inode, major:minor, size) in a single
+        command, then fingerprints any new or changed devices in at most one more command.
+        Returns the updated BlockDevIndex.
+        lengths - mandatory - list of md5 lengths needed, ie the md5len of each volume being matched
+        prefixes - optional - list of /dev name prefixes, defaults to sd, vd, xd and xvd
+        force - optional - boolean, re-hash all devices instead of using cached fingerprints
+        '''
+        prefixes = prefixes or ['sd', 'vd', 'xd', 'xvd']
+        globs = " ".join(['/dev/' + str(prefix) + '*' for prefix in prefixes])
+        #No quotes used here so the cmd survives cmd_with_sudo()'s sh -c quoting intact
+        out = self.sys('for d in ' + globs + '; do [ -e $d ] || continue; ' +
+                       'echo $d $(stat -L -c %i-%t:%T $d 2>/dev/null) $(cat /sys/class/block/${d#/dev/}/size 2>/dev/null); ' +
+                       'done', code=0, verbose=False)
+        devs = []
+        signatures = {}
+        for line in out:
+            fields = str(line).strip().split(None, 1)
+            if not fields or not fields[0].startswith('/dev/') or fields[0] in signatures:
+                continue
+            devs.append(fields[0])
+            signatures[fields[0]] = len(fields) > 1 and fields[1] or ''
+        return self.get_blockdev_index().update(devs, lengths, signatures=signatures, force=force)
+
+    def lookup_blockdev_by_md5(self, md5, md5len, lengths=None, max_age=None):
+        '''
+        Returns the guest dev whose first md5len bytes match md5, or None. Uses the cached fingerprint index,
+        if nothing matches and cached fingerprints were used, the devices are re-hashed once before giving up.
+        md5 - mandatory - md5 checksum to look for
+        md5len - mandatory - length in bytes the checksum was calculated over
+        lengths - optional - other md5 lengths to fingerprint in the same pass, ie for other volumes being matched
+        max_age - optional - seconds, skip re-listing the guest devices if the index was updated this recently
+        '''
+        if md5 is None or md5len is None:
+            return None
+        lengths = list(lengths or []) + [md5len]
+        index = self.get_blockdev_index()
+        if not (max_age and index.is_fresh(lengths, max_age)):
+            index = self.update_blockdev_index(lengths)
+        vdev = index.find(md5, md5len)
+        if not vdev and index.cached_devs:
+            self.debug('No fingerprint match for md5:' + str(md5) + ', re-hashing cached devices')
+            vdev = self.update_blockdev_index(lengths, force=True).find(md5, md5len)
+        return vdev
+
     def assertFilePresent(self,filepath):
         '''
         Method to check for the presence of a file at 'filepath' on the instance
@@ -832,6 +926,7 @@ class EuInstance(Instance, TaggedResource):
         ''' 
         voldev = euvolume.guestdev.strip()
         self.assertFilePresent(voldev)
+        self.invalidate_blockdev_index(voldev)
         fillcmd = "dd if=/dev/zero of="+str(voldev)+"; sync"
         return self.time_dd(fillcmd)
 
@@ -845,7 +940,8 @@ class EuInstance(Instance, TaggedResource):
         :param euvolume: the attached euvolume object to write data to
         :param srcdev: the source device to copy data from 
         :param length: the number of bytes to copy into the euvolume
-        :returns dd's data/time stat
+        :returns dd's data/time stat. When the guest io helper is used (no srcdev given and the guest has python)
+                 the dict also contains 'md5' and 'md5len' for the written range.
         '''
         mb = 1048576
         gb = 1073741824 
@@ -855,28 +951,28 @@ class EuInstance(Instance, TaggedResource):
         
         voldev = euvolume.guestdev.strip()
         self.assertFilePresent(voldev)
+        self.invalidate_blockdev_index(voldev)
+        if not length:
+            timeout = int(euvolume.size) * timepergig
+        else:
+            timeout = timepergig * ((length/gb) or 1)
         if srcdev is None:
+            guest_io = self.get_guest_io()
+            if guest_io:
+                try:
+                    return self.guest_io_fill(guest_io, voldev, header=euvolume.id, length=length,
+                                              timeout=timeout)
+                except GuestIOStartException, e:
+                    self.disable_guest_io(e)
             if self.found('ls /dev/urandom', 'urandom'):
                 srcdev = '/dev/urandom'
             else:
                 #look for the another large device we can read from in random size increments
                 srcdev = "/dev/"+str(self.sys("ls -1 /dev | grep 'da$'")[0]).strip()
                 fsize = randint(1048576,10485760)
-        if not length:
-            timeout = int(euvolume.size) * timepergig
-        else:
-            timeout = timepergig * ((length/gb) or 1)
         #write the volume id into the volume for starters
         ddcmd = 'echo '+str(euvolume.id)+' | dd of='+str(voldev)
         dd_res_for_id = self.dd_monitor(ddcmd=ddcmd, timeout=timeout, sync=False)
-        len_remaining = length - int(dd_res_for_id['dd_bytes'])
-        self.debug('length remaining to write after adding volumeid:' + str(len_remaining))
-        if len_remaining <= 0:
-            self.sys('sync')
-            return dd_res_for_id
-        ddbs = 1024
-        if len_remaining < ddbs:
-            ddbs = len_remaining
         if not length:
             return self.dd_monitor(ddif=str(srcdev),
                                    ddof=str(voldev),
@@ -884,6 +980,14 @@ class EuInstance(Instance, TaggedResource):
                                    ddseek=int(dd_res_for_id['dd_bytes']),
                                    timeout=timeout)
         else:
+            len_remaining = length - int(dd_res_for_id['dd_bytes'])
+            self.debug('length remaining to write after adding volumeid:' + str(len_remaining))
+            if len_remaining <= 0:
+                self.sys('sync')
+                return dd_res_for_id
+            ddbs = 1024
+            if len_remaining < ddbs:
+                ddbs = len_remaining
             return self.dd_monitor(ddif=str(srcdev),
                                    ddof=str(voldev),
                                    ddbs=ddbs,
@@ -894,6 +998,34 @@ class EuInstance(Instance, TaggedResource):
                 
             
     
+    def guest_io_fill(self, guest_io, voldev, header=None, length=None, offset=0, timeout=300):
+        '''
+        Fills voldev using the guest io helper and returns a dict with the same keys as dd_monitor() plus
+        'md5' and 'md5len', the checksum of the written range computed during the write.
+        guest_io - mandatory - GuestIO object for this instance, see get_guest_io()
+        voldev - mandatory - string, guest device to write to
+        header - optional - string written at the start of the device, ie the volume id
+        length - optional - number of bytes to write, defaults to the whole device
+        offset - optional - byte offset to start writing at
+        timeout - optional - seconds without write progress before failing
+        '''
+        mb = 1048576
+        gig = 1073741824
+        start = time.time()
+        res = guest_io.write(voldev, length=length, offset=offset, header=header, timeout=timeout)
+        elapsed = time.time() - start
+        return {'dd_bytes': int(res['bytes']),
+                'dd_mb': float("{0:.2f}".format(res['bytes']/float(mb))),
+                'dd_gig': float("{0:.2f}".format(res['bytes']/float(gig))),
+                'dd_elapsed': res['elapsed'],
+                'dd_rate': res['mbps'],
+                'dd_units': 'MB/s',
+                'test_time': "{0:.4f}".format(elapsed),
+                'test_rate': float("{0:.2f}".format((res['bytes']/float(mb)) / (elapsed or 1))),
+                'ddcmd': 'guest_io write ' + str(voldev),
+                'md5': res['md5'],
+                'md5len': int(res['bytes'])}
+
     def time_dd(self,ddcmd, timeout=90, poll_interval=1, tmpfile=None):
         '''
         (Added for legacy support, use dd_monitor instead) Executes dd command on instance, parses and returns stats on dd outcome
@@ -1146,14 +1278,18 @@ class EuInstance(Instance, TaggedResource):
                             ', euvolume.guestdev:' + str(euvolume.guestdev) +
                             ', voldev:' + str(voldev))
         #check to see if there's existing data that we should avoid overwriting 
+        md5 = None
         if overwrite or ( int(self.sys('head -c '+str(length)+ ' '+str(voldev)+' | xargs -0 printf %s | wc -c')[0]) == 0):
             
-            self.random_fill_volume(euvolume, srcdev=srcdev, length=length)
-            #length = dd_dict['dd_bytes']
+            dd_dict = self.random_fill_volume(euvolume, srcdev=srcdev, length=length)
+            #The guest io helper checksums the data as it writes it, no need to read it back again
+            if dd_dict.get('md5') and dd_dict.get('md5len') == length:
+                md5 = dd_dict['md5']
         else:
             self.debug("Volume has existing data, skipping random data fill")
-        #calculate checksum of euvolume attached device for given length
-        md5 = self.md5_attached_euvolume(euvolume, timepergig=timepergig,length=length)
+        if md5 is None:
+            #calculate checksum of euvolume attached device for given length
+            md5 = self.md5_attached_euvolume(euvolume, timepergig=timepergig,length=length)
         self.debug("Filled Volume:"+euvolume.id+" dev:"+voldev+" md5:"+md5)
         euvolume.md5 = md5
         euvolume.md5len = length
@@ -1188,6 +1324,12 @@ class EuInstance(Instance, TaggedResource):
     
     def get_dev_md5(self, devpath, length, timeout=60): 
         self.assertFilePresent(devpath)
+        guest_io = self.get_guest_io()
+        if guest_io:
+            try:
+                return str(guest_io.md5(devpath, length=(length or None), timeout=timeout)['md5'])
+            except GuestIOStartException, e:
+                self.disable_guest_io(e)
         if length == 0:
             md5 = str(self.sys("md5sum "+devpath, timeout=timeout)[0]).split(' ')[0].strip()
         else:
@@ -1331,15 +1473,15 @@ class EuInstance(Instance, TaggedResource):
         '''
         bad_list = []
         vol_list = []
-        checked_vdevs = []
         poll_count = 0
-        dev_list = self.get_dev_dir()
         found = False
 
         if euvol_list is not None:
             vol_list.extend(euvol_list)
         else:
             vol_list = self.attached_vols
+        #Fingerprint every length in use in the same pass, so all vols are matched from one device hash
+        md5_lengths = [vol.md5len for vol in vol_list if getattr(vol, 'md5len', None) is not None]
         self.debug("Checking for volumes whos state is not in sync with our instance's test state...")
         for vol in vol_list:
             #first see if the cloud believes this volume is still attached. 
@@ -1350,7 +1492,6 @@ class EuInstance(Instance, TaggedResource):
                     found = False
                     elapsed = 0 
                     start = time.time()
-                    checked_vdevs = []
                     #loop here for timepervol in case were waiting for a volume to appear in the guest. ie attaching
                     while (not found) and ((elapsed <= timepervol) or (poll_count < min_polls)):
                         try:
@@ -1358,30 +1499,20 @@ class EuInstance(Instance, TaggedResource):
                             #Ugly... :-(
                             #handle virtio and non virtio cases differently (KVM case needs improvement here).
                             if self.virtio_blk or check_md5:
-                                self.debug('Checking any new devs for md5:'+str(vol.md5))
+                                self.debug('Checking guest dev fingerprints for md5:'+str(vol.md5))
                                 #Do some detective work to see what device name the previously attached volume is using
-                                devlist = self.get_dev_dir()
-                                for vdev in devlist:
-                                    vdev = "/dev/"+str(vdev)
-                                    
-                                    #if we've already checked the md5 on this dev no need to re-check it. 
-                                    if not vdev in checked_vdevs: 
-                                        self.debug('Checking '+str(vdev)+" for match against euvolume:"+str(vol.id))
-                                        md5 = self.get_dev_md5(vdev, vol.md5len )
-                                        self.debug('comparing '+str(md5)+' vs '+str(vol.md5))
-                                        if md5 == vol.md5:
-                                            self.debug('Found match at dev:'+str(vdev))
-                                            found = True
-                                            if (vol.guestdev != vdev ):
-                                                self.debug("("+str(vol.id)+")Found dev match. Guest dev changed! Updating from previous:'"
-                                                           + str(vol.guestdev) + "' to:'"+str(vdev)+"'")
-                                            else:
-                                                self.debug("(" + str(vol.id) + ")Found dev match. Previous dev:'"
-                                                           + str(vol.guestdev) + "', Current dev:'" + str(vdev) + "'")
-                                            vol.guestdev = vdev
-                                        checked_vdevs.append(vdev) # add to list of devices we've already checked.
-                                    if found:
-                                        break
+                                vdev = self.lookup_blockdev_by_md5(vol.md5, vol.md5len, lengths=md5_lengths,
+                                                                   max_age=10)
+                                if vdev:
+                                    self.debug('Found match at dev:'+str(vdev))
+                                    found = True
+                                    if (vol.guestdev != vdev ):
+                                        self.debug("("+str(vol.id)+")Found dev match. Guest dev changed! Updating from previous:'"
+                                                   + str(vol.guestdev) + "' to:'"+str(vdev)+"'")
+                                    else:
+                                        self.debug("(" + str(vol.id) + ")Found dev match. Previous dev:'"
+                                                   + str(vol.guestdev) + "', Current dev:'" + str(vdev) + "'")
+                                    vol.guestdev = vdev
                             else:
                                 #Not using virtio_blk assume the device will be the same
                                 self.assertFilePresent(vol.guestdev.strip())
@@ -1410,21 +1541,18 @@ class EuInstance(Instance, TaggedResource):
 
         md5 = md5 or euvolume.md5
         md5len = md5len or euvolume.md5len
-        for vdev in  self.get_dev_dir():
-            vdev = '/dev/'+ str(vdev).replace('/dev/','')
-            self.debug('Checking '+str(vdev)+" for a matching block device")
-            block_md5 = self.get_dev_md5(vdev, md5len )
-            self.debug('comparing dev' + str(vdev) +': '+str(block_md5)+' vs vol:'+str(md5))
-            if block_md5 == md5:
-                self.debug('Found match at dev:'+str(vdev))
-                if (euvolume):
-                    if ( euvolume.guestdev != vdev ):
-                        self.debug("("+str(euvolume.id)+")Found dev match. Guest dev changed! Updating from previous:'"+str(euvolume.guestdev)+"' to:'"+str(vdev)+"'")
-                    else:
-                        self.debug("("+str(euvolume.id)+")Found dev match. Previous dev:'"+str(euvolume.guestdev)+"', Current dev:'"+str(vdev)+"'")
-                    euvolume.guestdev = vdev
-                guestdev = vdev
-                break
+        self.debug('Checking guest dev fingerprints for a block device matching md5:' + str(md5) +
+                   ', len:' + str(md5len))
+        vdev = self.lookup_blockdev_by_md5(md5, md5len)
+        if vdev:
+            self.debug('Found match at dev:'+str(vdev))
+            if (euvolume):
+                if ( euvolume.guestdev != vdev ):
+                    self.debug("("+str(euvolume.id)+")Found dev match. Guest dev changed! Updating from previous:'"+str(euvolume.guestdev)+"' to:'"+str(vdev)+"'")
+                else:
+                    self.debug("("+str(euvolume.id)+")Found dev match. Previous dev:'"+str(euvolume.guestdev)+"', Current dev:'"+str(vdev)+"'")
+                euvolume.guestdev = vdev
+            guestdev = vdev
         if add_to_attached_list:
             if not euvolume in self.attached_vols:
                 euvolume.md5 = md5
@@ -70,6 +70,7 @@ cat my_cloud.conf
 import types
 import re
 import copy
+import time
 
 class Euproperty_Type():
     authentication = 'authentication'
@@ -107,9 +108,10 @@ class Euproperty():
         self.prop_mgr = prop_mgr
         self.lastvalue = value
         self.mandatory=mandatory
+        self.last_update = time.time()
         
     def update(self):
-        self.propmgr.update_property_list()
+        self.prop_mgr.update_properties([self])
 
     def get(self):
         return self.value
@@ -153,7 +155,11 @@ class Euproperty_Manager():
     verbose = False
     debugmethod = None
     
-    def __init__(self, tester, verbose=False, machine=None, debugmethod=None):
+    def __init__(self, tester, verbose=False, machine=None, debugmethod=None, property_ttl=300):
+        """
+        :param property_ttl: seconds a property value is used before it is fetched again from the cloud.
+                             None to only fetch properties on request (force_update).
+        """
         self.tester = tester
         self.debugmethod = debugmethod or tester.debug
         self.verbose = verbose
@@ -162,7 +168,13 @@ class Euproperty_Manager():
         self.secret_key = self.tester.aws_secret_access_key
         self.service_url = 'http://'+str(self.tester.get_ec2_ip())+':8773/services/Eucalytpus'
         self.cmdpath = self.tester.eucapath+'/usr/sbin/'
+        self.property_ttl = property_ttl
+        self.last_update = None
         self.properties = []
+        # Indexes of self.properties, keyed by (service_type, partition, name), property string and name
+        self.property_index = {}
+        self.property_string_index = {}
+        self.property_name_index = {}
         self.update_property_list()
         self.tester.property_manager = self
         
@@ -258,7 +270,7 @@ class Euproperty_Manager():
                                                 + ", value:" + str(value) \
                                                 + ", force_update:" +str(force_update))
         ret_props = []
-        if not self.properties or force_update:
+        if force_update or self.is_expired(self.last_update):
             self.update_property_list()
         properties = copy.copy(self.properties)
         if partition and properties:
@@ -277,21 +289,95 @@ class Euproperty_Manager():
         return ret_props
 
     def get_property(self,name,service_type, partition, force_update=False):
+        '''
+        Returns the property matching name, service_type and partition from the indexed property list.
+        If the property's value is older than property_ttl, or force_update is set, only this property is
+        fetched again from the cloud.
+        '''
         self.debug('Get Property:' + str(name))
-        ret_prop = None
-        list = self.get_properties(partition=partition,service_type=service_type,force_update=force_update)
-        if list:
-            ret_prop =  self.get_euproperty_by_name(name, list=list)
+        ret_prop = self.lookup_property(name, service_type, partition)
+        if not ret_prop:
+            list = self.get_properties(partition=partition,service_type=service_type,force_update=force_update)
+            if list:
+                ret_prop =  self.get_euproperty_by_name(name, list=list)
+        elif force_update or self.is_expired(ret_prop.last_update):
+            self.update_properties([ret_prop])
         return ret_prop
 
+    def lookup_property(self, name, service_type=None, partition=None):
+        '''
+        Index lookup of a property, returns None if not found
+        '''
+        if service_type:
+            service_type = Euproperty_Type.get_type_by_string(service_type)
+        prop = self.property_index.get((service_type, partition, name))
+        if prop:
+            return prop
+        for prop in self.property_name_index.get(name, []):
+            if (service_type is None or prop.service_type == service_type) and \
+                    (partition is None or prop.partition == partition):
+                return prop
+        return None
+
+    def is_expired(self, last_update):
+        if last_update is None:
+            return True
+        if self.property_ttl is None:
+            return False
+        return (time.time() - last_update) > self.property_ttl
+
+    def index_property(self, prop):
+        self.property_index[(prop.service_type, prop.partition, prop.name)] = prop
+        self.property_string_index[prop.property_string] = prop
+        names = self.property_name_index.setdefault(prop.name, [])
+        if prop not in names:
+            names.append(prop)
+
+    def describe_properties(self, property_strings=None):
+        '''
+        Run euca-describe-properties on the work machine, returns the PROPERTY lines of its output
+        property_strings - optional - list of property strings to describe, defaults to all properties
+        '''
+        props = ""
+        if property_strings:
+            props = " " + " ".join(property_strings)
+        return self.work_machine.sys(self.cmdpath+'euca-describe-properties -U '+str(self.service_url)+' -I '+str(self.access_key)+' -S '+ str(self.secret_key) + props + ' | grep PROPERTY', code=0, verbose=self.verbose)
+
     def update_property_list(self):
         newlist = []
         self.debug("updating property list...")
-        cmdout = self.work_machine.sys(self.cmdpath+'euca-describe-properties -U '+str(self.service_url)+' -I '+str(self.access_key)+' -S '+ str(self.secret_key) +' | grep PROPERTY', code=0, verbose=self.verbose)
+        cmdout = self.describe_properties()
         for propstring in cmdout:
             newlist.append(self.parse_euproperty_from_string(propstring))
         self.properties = newlist
+        self.property_index = {}
+        self.property_string_index = {}
+        self.property_name_index = {}
+        for prop in newlist:
+            self.index_property(prop)
+        self.last_update = time.time()
         return newlist
+
+    def update_properties(self, properties):
+        '''
+        Fetch the current values of only the given properties from the cloud
+        properties - list of euproperties or property strings
+        Returns the list of updated euproperties
+        '''
+        property_strings = []
+        for prop in properties:
+            if isinstance(prop, Euproperty):
+                prop = prop.property_string
+            property_strings.append(str(prop))
+        self.debug("updating properties:" + ", ".join(property_strings))
+        updated = []
+        for propstring in self.describe_properties(property_strings):
+            prop = self.parse_euproperty_from_string(propstring)
+            if prop.property_string not in self.property_string_index:
+                self.properties.append(prop)
+                self.index_property(prop)
+            updated.append(prop)
+        return updated
         
                 
     def parse_euproperty_from_string(self, propstring):
@@ -310,12 +396,13 @@ class Euproperty_Manager():
         ret_value = " ".join(splitstring)
         #self.debug('ret_property_string:'+str(ret_property_string)+", ret_value:"+str(ret_value))
         #toss, ret_property_string, ret_value = propstring.split()
-        for prop in self.properties:
-            #if this property is in our list, update the value and return
-            if prop.property_string == ret_property_string:
-                prop.lastvalue = prop.value
-                prop.value = ret_value
-                return prop
+        prop = self.property_string_index.get(ret_property_string)
+        #if this property is in our list, update the value and return
+        if prop:
+            prop.lastvalue = prop.value
+            prop.value = ret_value
+            prop.last_update = time.time()
+            return prop
         ret_name = ret_property_string
         #...otherwise this property is not in our list yet, create a new property
         #parse property string into values...
@@ -398,8 +485,11 @@ class Euproperty_Manager():
 
 
     def get_euproperty_by_name(self,name, list=None):
-        props = []
-        list = list or self.properties
+        if list is None:
+            props = self.property_name_index.get(name)
+            if props:
+                return props[0]
+            raise EupropertyNotFoundException('Property not found by name:'+str(name))
         for property in list:
             if property.name == name:
                 return property
@@ -449,6 +539,8 @@ class Euproperty_Manager():
         eucaops - optional - the eucaops/eutester object to set the property at
         '''
         value = str(value)
+        if not isinstance(property,Euproperty):
+            property = self.property_string_index.get(property, property)
         if not isinstance(property,Euproperty):
             try:
                 property = self.get_all_properties_by_search_string(property)
@@ -470,7 +562,54 @@ class Euproperty_Manager():
         if (ret_value != value):
             raise EupropertiesException("set property("+property.property_string+") to value("+str(value)+") failed.Ret Value ("+str(ret_value)+")\nRet String\n"+ret_string)
         property.value = ret_value
+        property.last_update = time.time()
         return ret_value
+
+    def set_properties(self, prop_values):
+        '''
+        Sets several properties with a single remote invocation on the work machine.
+        prop_values - mandatory - dict or list of (property, value) tuples, properties can be euproperties
+                      or property strings
+        Returns dict of property string to new value
+        '''
+        if isinstance(prop_values, dict):
+            prop_values = prop_values.items()
+        props = []
+        for property, value in prop_values:
+            if not isinstance(property, Euproperty):
+                prop = self.property_string_index.get(property)
+                if not prop:
+                    found = self.get_all_properties_by_search_string(property)
+                    if len(found) != 1:
+                        raise Exception('Could not fetch single property to set. Using string:' + str(property))
+                    prop = found[0]
+                property = prop
+            property.lastvalue = property.value
+            props.append((property, str(value)))
+        self.debug('Setting properties:' + ", ".join([prop.property_string + '=' + value for prop, value in props]))
+        cmds = [self.cmdpath+'euca-modify-property -U '+str(self.service_url)+' -I '+str(self.access_key)+' -S '+ str(self.secret_key) +' -p '+prop.property_string+'='+value for prop, value in props]
+        try:
+            out = self.work_machine.sys(" && ".join(cmds), code=0)
+        except Exception, e:
+            #Some of the properties may have been set before the failure, refresh them
+            self.update_properties([prop for prop, value in props])
+            raise EupropertiesException("set_properties failed:" + str(e))
+        returned = {}
+        for line in out:
+            fields = str(line).split()
+            if len(fields) > 2 and fields[0] == 'PROPERTY':
+                returned[fields[1]] = fields[2]
+        failed = []
+        for prop, value in props:
+            ret_value = returned.get(prop.property_string)
+            if ret_value != value:
+                failed.append(prop.property_string + "=" + value + " (returned:" + str(ret_value) + ")")
+            if ret_value is not None:
+                prop.value = ret_value
+                prop.last_update = time.time()
+        if failed:
+            raise EupropertiesException("set_properties failed for:" + ", ".join(failed))
+        return returned
         
     def reset_property_to_default(self, prop):
         '''
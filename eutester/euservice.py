@@ -536,7 +536,83 @@ class Partition:
     
     def get_disabled_vb(self):
         return self.get_disabled(self.vbs)
- 
+
+
+class TopologyEvent:
+    SERVICE_ADDED = 'SERVICE_ADDED'
+    SERVICE_REMOVED = 'SERVICE_REMOVED'
+    SERVICE_STATE = 'SERVICE_STATE'
+    NODE_ADDED = 'NODE_ADDED'
+    NODE_REMOVED = 'NODE_REMOVED'
+    NODE_STATE = 'NODE_STATE'
+    INSTANCE_ADDED = 'INSTANCE_ADDED'
+    INSTANCE_REMOVED = 'INSTANCE_REMOVED'
+    INSTANCE_MOVED = 'INSTANCE_MOVED'
+
+    def __init__(self, event_type, key, old=None, new=None):
+        """
+        A single change found between two topology snapshots.
+
+        :param event_type: one of the TopologyEvent type strings
+        :param key: service fullname, node hostname or instance id this event is about
+        :param old: previous service/node state, or node hostname for instance events. None when added
+        :param new: current service/node state, or node hostname for instance events. None when removed
+        """
+        self.type = event_type
+        self.key = key
+        self.old = old
+        self.new = new
+        self.time = time.time()
+
+    def __repr__(self):
+        return str(self.type) + ":" + str(self.key) + " (" + str(self.old) + " -> " + str(self.new) + ")"
+
+
+class TopologySnapshot:
+    def __init__(self, services=None, nodes=None, placements=None):
+        """
+        Point in time view of the cloud's services, nodes and instance placements kept as plain dicts so
+        two snapshots can be compared without talking to the cloud.
+
+        :param services: dict of service fullname -> service state
+        :param nodes: dict of node hostname -> node state
+        :param placements: dict of instance id -> hostname of the node the instance is on
+        """
+        self.services = services or {}
+        self.nodes = nodes or {}
+        self.placements = placements or {}
+        self.time = time.time()
+
+    def diff(self, previous):
+        """
+        Returns the changes from snapshot 'previous' to this snapshot
+
+        :param previous: older TopologySnapshot
+        :return: list of TopologyEvents
+        """
+        events = []
+        events.extend(self._diff_dict(previous.services, self.services, TopologyEvent.SERVICE_ADDED,
+                                      TopologyEvent.SERVICE_REMOVED, TopologyEvent.SERVICE_STATE))
+        events.extend(self._diff_dict(previous.nodes, self.nodes, TopologyEvent.NODE_ADDED,
+                                      TopologyEvent.NODE_REMOVED, TopologyEvent.NODE_STATE))
+        events.extend(self._diff_dict(previous.placements, self.placements, TopologyEvent.INSTANCE_ADDED,
+                                      TopologyEvent.INSTANCE_REMOVED, TopologyEvent.INSTANCE_MOVED))
+        return events
+
+    @staticmethod
+    def _diff_dict(old, new, added, removed, changed):
+        events = []
+        for key in sorted(new.keys()):
+            if key not in old:
+                events.append(TopologyEvent(added, key, new=new[key]))
+            elif old[key] != new[key]:
+                events.append(TopologyEvent(changed, key, old=old[key], new=new[key]))
+        for key in sorted(old.keys()):
+            if key not in new:
+                events.append(TopologyEvent(removed, key, old=old[key]))
+        return events
+
+
 class EuserviceManager(object):
     cluster_type_string = "cluster"
     walrus_type_string = 'walrus'
@@ -545,10 +621,14 @@ class EuserviceManager(object):
     node_type_string = 'node'
 
         
-    def __init__(self, tester ):
+    def __init__(self, tester, topology_ttl=1):
         '''
         SERVICE    storage            PARTI00            SC_61              ENABLED       16      http://192.168.51.32:8773/services/Storage    arn:euca:eucalyptus:PARTI00:storage:SC_61/
         update this service based up on the information parsed out of the "describestring"
+
+        :param tester: eutester object
+        :param topology_ttl: seconds the cached services/nodes are used by update() before they are fetched again,
+                             defaults to 1s. Callers which poll the get_enabled_* helpers can pass a longer ttl.
         '''
         ### Make sure i have the right connection to make first contact with euca-describe-services
         self.walruses= []
@@ -559,6 +639,13 @@ class EuserviceManager(object):
         self.dns = None
         self.all_services = []
         self.node_list = []
+        #Topology cache, services by fullname, nodes by hostname and instance id -> node
+        self.services = {}
+        self.nodes = {}
+        self.instance_placements = {}
+        self.topology = TopologySnapshot()
+        self.topology_listeners = []
+        self.topology_ttl = topology_ttl
         self.tester = tester
         self.debug = tester.debug
         self.eucaprefix = ". " + self.tester.credpath + "/eucarc && " + self.tester.eucapath
@@ -780,25 +867,14 @@ class EuserviceManager(object):
                 hostname = split_string[hostname_loc]
                 partition_name = split_string[partition_loc]
                 state = split_string[state_loc]
-                # grab the list of instances if any found in the string
-                #Try to match the part_name to the partition name it resides in
-                for part in self.get_all_partitions():
-                    if part.name == partition_name:
-                            partition = part
-                            break
+                #Match the part_name to the partition name it resides in
+                partition = self.partitions.get(partition_name)
                 if not partition:
                     raise Exception('populate_nodes: Node:' + str(hostname) + ' Failed to find partition for name: '
                                     + str(partition_name))
-                node = Eunode(self.tester,
-                              hostname,
-                              partition,
-                              state = state)
+                node = self.merge_node(hostname, partition, state=state)
                 return_list.append(node)
-                if node in part.ncs:
-                    part.ncs[part.ncs.index(node)]=node
-                else:
-                    part.ncs.append(node)
-        self.node_list = return_list
+        self.set_node_list(return_list)
         return return_list
 
 
@@ -824,6 +900,11 @@ class EuserviceManager(object):
         clc = enabled_clc or self.get_enabled_clc()
         nodes_strings = clc.machine.sys(self.eucaprefix + \
                                         "/usr/sbin/euca_conf --list-nodes 2>/dev/null | grep '^NODE'")
+        #Map cluster controller names to the partition they reside in
+        cc_partitions = {}
+        for part in self.get_all_partitions():
+            for cc in part.ccs:
+                cc_partitions[cc.name] = part
 
         for node_string in nodes_strings:
             #handle/skip any blank lines first...
@@ -840,28 +921,64 @@ class EuserviceManager(object):
             # grab the list of instances if any found in the string
             if len(split_string) > instances_loc:
                 instance_list = split_string[instances_loc:]
-                #Try to match the part_name to the partition name it resides in
-            for part in self.get_all_partitions():
-                for cc in part.ccs:
-                    if cc.name == cc_name:
-                        partition = part
-                        break
+            #Match the cc_name to the partition it resides in
+            partition = cc_partitions.get(cc_name)
             if not partition:
                 raise Exception('populate_nodes: Node:' + str(hostname) + ' Failed to find partition for component: '
                                 + str(cc_name))
-            node = Eunode(self.tester,
-                          hostname,
-                          partition,
-                          instance_ids = instance_list,
-                          state = 'ENABLED')
+            node = self.merge_node(hostname,
+                                   partition,
+                                   instance_ids = instance_list,
+                                   state = 'ENABLED')
             return_list.append(node)
-            if node in part.ncs:
-                part.ncs[part.ncs.index(node)]=node
-            else:
-                part.ncs.append(node)
-        self.node_list = return_list
+        self.set_node_list(return_list)
         return return_list
 
+    def merge_node(self, hostname, partition, instance_ids=None, state=None):
+        """
+        Returns the cached eunode for 'hostname' updated with the provided values, or a new eunode if this
+        host has not been seen before. Reusing the eunode avoids the machine lookup and remote service state
+        check done when creating one, and keeps references held by callers current.
+
+        :param hostname: hostname of the node
+        :param partition: partition obj the node resides in
+        :param instance_ids: list of instance ids reported on this node
+        :param state: node state as reported by the CLC
+        :return: eunode obj
+        """
+        node = self.nodes.get(hostname)
+        if not node:
+            return Eunode(self.tester,
+                          hostname,
+                          partition,
+                          instance_ids = instance_ids,
+                          state = state)
+        node.partition = partition
+        node.part_name = partition.name
+        node.instance_ids = instance_ids or []
+        node.state = state
+        return node
+
+    def set_node_list(self, nodes):
+        """
+        Stores the list of eunodes from the latest node listing in the topology cache, rebuilds the
+        per partition node lists and the instance placements, then publishes any topology changes.
+
+        :param nodes: list of eunode objs
+        :return: list of TopologyEvents published
+        """
+        self.node_list = nodes
+        self.nodes = {}
+        self.instance_placements = {}
+        for part in self.get_all_partitions():
+            part.ncs = []
+        for node in nodes:
+            self.nodes[node.hostname] = node
+            node.partition.ncs.append(node)
+            for instance_id in node.instance_ids:
+                self.instance_placements[instance_id] = node
+        return self.publish_topology()
+
 
     def update_node_list(self, enabled_clc=None):
         self.populate_nodes(enabled_clc=enabled_clc)
@@ -1054,6 +1171,9 @@ class EuserviceManager(object):
             nodes = self.node_list or self.populate_nodes()
         else:
             nodes = self.populate_nodes()
+        if instance_id:
+            node = self.instance_placements.get(instance_id)
+            nodes = node and [node] or []
         for node in nodes:
             if partition and node.partition != partition:
                 continue
@@ -1139,14 +1259,21 @@ class EuserviceManager(object):
 
 
 
-    def update(self, name=None):
+    def update(self, name=None, force=False):
+        """
+        Refreshes the cached services, partitions and nodes from the CLC. The cached topology is used as is
+        while it is younger than self.topology_ttl seconds unless 'force' is set. Services and nodes already
+        in the cache are updated in place and any changes are published to the topology listeners.
+
+        :param name: optional service type to refresh, cached services of other types are kept
+        :param force: boolean, refresh even if the cached topology has not expired
+        """
         ### Get all services
-        if self.last_updated:
-            if (time.time() - self.last_updated) < 1:
+        if self.last_updated and not force:
+            if (time.time() - self.last_updated) < self.topology_ttl:
                 return
+        services = self.merge_services(self.get(name), partial=(name is not None))
         self.reset()
-        services = self.get(name)
-        self.all_services = services
         for current_euservice in services:
             ### If this is system wide component add it to the base level array
             if re.search("eucalyptus", current_euservice.type) :
@@ -1185,7 +1312,91 @@ class EuserviceManager(object):
         if enabled_clc:
             enabled_clc = enabled_clc[0]
             self.update_node_list(enabled_clc=enabled_clc)
+        else:
+            self.publish_topology()
         self.last_updated=time.time()
+
+    def merge_services(self, services, partial=False):
+        """
+        Merges freshly parsed euservices into the topology cache. Services already cached (matched by fullname
+        and hostname) are kept and have their state updated, so references held by callers stay current.
+
+        :param services: list of euservice objs, ie from get()
+        :param partial: boolean, services is a filtered list and cached services not in it should be kept
+        :return: list of cached euservice objs, also stored in self.all_services
+        """
+        merged = {}
+        all_services = []
+        for service in services:
+            cached = self.services.get(service.fullname)
+            if cached and cached.hostname == service.hostname and type(cached) == type(service):
+                cached.state = service.state
+                cached.uri = service.uri
+                service = cached
+            merged[service.fullname] = service
+            all_services.append(service)
+        if partial:
+            for service in self.all_services:
+                if not service.fullname in merged:
+                    merged[service.fullname] = service
+                    all_services.append(service)
+        self.services = merged
+        self.all_services = all_services
+        return all_services
+
+    def get_topology_snapshot(self):
+        """
+        :return: TopologySnapshot of the currently cached services, nodes and instance placements
+        """
+        services = {}
+        nodes = {}
+        placements = {}
+        for fullname, service in self.services.iteritems():
+            services[fullname] = service.state
+        for hostname, node in self.nodes.iteritems():
+            nodes[hostname] = node.state
+        for instance_id, node in self.instance_placements.iteritems():
+            placements[instance_id] = node.hostname
+        return TopologySnapshot(services=services, nodes=nodes, placements=placements)
+
+    def publish_topology(self):
+        """
+        Compares the cached topology against the last published snapshot and calls each of the topology
+        listeners with every TopologyEvent found.
+
+        :return: list of TopologyEvents published
+        """
+        snapshot = self.get_topology_snapshot()
+        events = snapshot.diff(self.topology)
+        self.topology = snapshot
+        for event in events:
+            for listener in list(self.topology_listeners):
+                try:
+                    listener(event)
+                except Exception, e:
+                    self.debug('Topology listener:' + str(listener) + ' failed for event:' + str(event) +
+                               ', err:' + str(e))
+        return events
+
+    def add_topology_listener(self, listener):
+        """
+        Registers a callback to be called with each TopologyEvent found when the topology is refreshed,
+        ie: service state changes or instances showing up on a node.
+
+        :param listener: method taking a single TopologyEvent arg
+        """
+        if not listener in self.topology_listeners:
+            self.topology_listeners.append(listener)
+
+    def remove_topology_listener(self, listener):
+        if listener in self.topology_listeners:
+            self.topology_listeners.remove(listener)
+
+    def invalidate_topology(self):
+        """
+        Expires the cached topology so the next update() fetches it from the CLC
+        """
+        self.last_updated = None
     
     def isReachable(self, address):
         return self.tester.ping(address)
@@ -1194,6 +1405,7 @@ class EuserviceManager(object):
         if not self.isReachable(self.tester.clc.hostname):
             self.tester.clc = self.tester.get_component_machines("clc")[1]
         modify_response = self.tester.clc.sys(self.eucaprefix + "/usr/sbin/euca-modify-service -s " + str(state)  + " " + euservice.name)
+        self.invalidate_topology()
         if re.search("true",modify_response[0]):
             return True
         else:
@@ -1216,6 +1428,7 @@ class EuserviceManager(object):
         else:
             self.modify_process(euservice, "stop")
         euservice.running = False
+        self.invalidate_topology()
         
     def start(self, euservice):
         if euservice.type == 'cluster':
@@ -1227,6 +1440,7 @@ class EuserviceManager(object):
                 euservice.running = True
                 return
         self.modify_process(euservice, "start")
+        self.invalidate_topology()
 
     
     def enable(self,euservice):
@@ -55,6 +55,7 @@ class EuSnapshot(Snapshot, TaggedResource):
     eutest_polls = None
     eutest_poll_count = None
     eutest_last_progress = None
+    eutest_last_progress_time = None
     eutest_timeintest = None
     
         
@@ -81,6 +82,13 @@ class EuSnapshot(Snapshot, TaggedResource):
     
     def update(self):
         super(EuSnapshot, self).update()
+        self.post_update()
+
+    def post_update(self):
+        """
+        Updates the eutester status info after the snapshot's attributes have been refreshed,
+        ie by update() or a batched describe in ResourceStateMonitor
+        """
         self.set_last_status()
     
     def set_last_status(self,status=None):
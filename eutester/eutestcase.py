@@ -11,8 +11,13 @@ import types
 import traceback
 import random
 import string
+import logging
+import tempfile
+import threading
 from eutester.eulogger import Eulogger
 from eutester.euconfig import EuConfig
+from eutester import tracing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import StringIO
 import copy
 
@@ -24,7 +29,7 @@ Currently included:
  - Debug method
  - Allow parameterized test cases
  - Method to run test case
- - Run a list of test cases
+ - Run a list of test cases, serially or on a worker pool honoring unit dependencies and resource groups
  - Start, end and current status messages
  - Enum class for possible test results
  
@@ -172,6 +177,15 @@ class EutesterTestUnit():
     
     type eof: boolean
     param eof: boolean to indicate whether a failure while running the given 'method' should end the test case exectution. 
+
+    The following are only used when a test list is run with concurrency > 1, see run_test_case_list()...
+    type depends_on: list
+    param depends_on: EutesterTestUnits, or testunit names, which must pass before this unit is started.
+                      If a dependency fails or is not run, this unit is not run.
+
+    type resource_groups: list
+    param resource_groups: strings naming shared resources this unit uses (ie a zone, an image).
+                           Units sharing a resource group never run at the same time.
     '''
     def __init__(self,method, *args, **kwargs):
         self.method = method
@@ -192,6 +206,9 @@ class EutesterTestUnit():
         self.description=self.get_test_method_description()
         self.eof=False
         self.error = ""
+        self.depends_on = []
+        self.resource_groups = []
+        self.log_file = None
         print "Creating testunit:" + str(self.name)+", args:"
         for count, thing in enumerate(args):
             print '{0}. {1}'.format(count, thing)
@@ -269,6 +286,7 @@ class EutesterTestUnit():
         for name, value in self.kwargs.items():
             print 'KWARG:{0} = {1}'.format(name, value)
         
+        span = tracing.tracer.start('testunit', self.name)
         try:
             start = time.time()
             if not self.args and not self.kwargs:
@@ -302,8 +320,86 @@ class EutesterTestUnit():
                 pass
         finally:
             self.time_to_run = int(time.time()-start)
+            if self.result != EutesterTestResult.passed and self.error:
+                span.set(error=self.error[:200])
+            span.finish(result=self.result)
         
                 
+class TestUnitOutputRouter():
+    '''
+    Description: Stand in for sys.stdout while test units run in parallel. Output written by a thread running
+    a test unit goes to that unit's own log, anything else is passed through to the real stdout. Logging
+    StreamHandlers already writing to stdout are pointed at the router for the duration of the run.
+    Note: threads started by a test unit itself are not routed and write to stdout directly.
+    '''
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.sinks = {}
+        self.lock = threading.Lock()
+        self.swapped_handlers = []
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        sink = self.sinks.get(threading.current_thread().ident)
+        if sink is not None:
+            sink.write(data)
+        else:
+            self.lock.acquire()
+            try:
+                self.stream.write(data)
+            finally:
+                self.lock.release()
+
+    def flush(self):
+        if self.sinks.get(threading.current_thread().ident) is None:
+            self.stream.flush()
+
+    def start(self):
+        sys.stdout = self
+        loggers = [logging.getLogger()] + logging.Logger.manager.loggerDict.values()
+        for logger in loggers:
+            for handler in getattr(logger, 'handlers', []):
+                if isinstance(handler, logging.StreamHandler) and handler.stream is self.stream:
+                    handler.stream = self
+                    self.swapped_handlers.append(handler)
+
+    def stop(self):
+        for handler in self.swapped_handlers:
+            if handler.stream is self:
+                handler.stream = self.stream
+        self.swapped_handlers = []
+        if sys.stdout is self:
+            sys.stdout = self.stream
+
+    def register(self, sink):
+        self.sinks[threading.current_thread().ident] = sink
+
+    def unregister(self):
+        self.sinks.pop(threading.current_thread().ident, None)
+
+    def write_unit_log(self, sink, title):
+        '''
+        Writes a unit's captured output to the real stdout as one contiguous block
+        '''
+        sink.flush()
+        sink.seek(0)
+        line = "========================================================================="
+        self.lock.acquire()
+        try:
+            self.stream.write("\n" + line + "\nBEGIN TESTUNIT LOG: " + str(title) + "\n" + line + "\n")
+            while True:
+                data = sink.read(65536)
+                if not data:
+                    break
+                self.stream.write(data)
+            self.stream.write("\n" + line + "\nEND TESTUNIT LOG: " + str(title) + "\n" + line + "\n")
+            self.stream.flush()
+        finally:
+            self.lock.release()
+
+
 class EutesterTestCase(unittest.TestCase):
     color = TestColor()
 
@@ -501,6 +597,13 @@ class EutesterTestCase(unittest.TestCase):
                                 help="log level for log file logging", default='debug')
         parser.add_argument('--html-anchors', dest='html_anchors', action='store_true',
                                 help="Print HTML anchors for jumping through test results", default=False)
+        parser.add_argument('--test-concurrency', dest='test_concurrency', type=int,
+                                help="Number of test units to run in parallel, default:1 (serial)", default=1)
+        parser.add_argument('--unit-log-dir', dest='unit_log_dir',
+                                help="Directory to write a log per test unit to when running in parallel", default=None)
+        parser.add_argument('--trace-file', dest='trace_file',
+                                help="Record timing of cloud api calls, remote commands and waits to this file "
+                                     "(json lines) and print a summary of the top time sinks", default=None)
         self.parser = parser  
         return parser
     
@@ -648,12 +751,20 @@ class EutesterTestCase(unittest.TestCase):
                 eof = kwargs['eof']
             else:
                 eof = kwargs.pop('eof')
+        depends_on = []
+        resource_groups = []
+        if 'depends_on' in kwargs and not 'depends_on' in methvars:
+            depends_on = kwargs.pop('depends_on') or []
+        if 'resource_groups' in kwargs and not 'resource_groups' in methvars:
+            resource_groups = kwargs.pop('resource_groups') or []
         ## Only pass the arg if we need it otherwise it will print with all methods/testunits
         if self.args.html_anchors:
             testunit = EutesterTestUnit(method, *args, html_anchors=self.args.html_anchors ,**kwargs)
         else:
             testunit = EutesterTestUnit(method, *args, **kwargs)
         testunit.eof = eof
+        testunit.depends_on = depends_on
+        testunit.resource_groups = resource_groups
         #if autoarg, auto populate testunit arguements from local testcase.args namespace values
         if autoarg:
             self.populate_testunit_with_args(testunit)
@@ -758,7 +869,8 @@ class EutesterTestCase(unittest.TestCase):
             buf += "---------------------\n"
         return buf
     
-    def run_test_case_list(self, list, eof=False, clean_on_exit=True, printresults=True):
+    def run_test_case_list(self, list, eof=False, clean_on_exit=True, printresults=True, concurrency=None,
+                           unit_log_dir=None):
         '''
         Desscription: wrapper to execute a list of ebsTestCase objects
         
@@ -774,6 +886,14 @@ class EutesterTestCase(unittest.TestCase):
         
         :type printresults: boolean
         :param printresults: Flag to indicate whether or not to print a summary of results upon run_test_case_list completion. 
+
+        :type concurrency: integer
+        :param concurrency: Number of test units to run at once. Defaults to the 'test_concurrency' arg, or 1.
+                            When > 1 units are run on a worker pool, see run_test_units_parallel().
+
+        :type unit_log_dir: string
+        :param unit_log_dir: When running in parallel, directory to write each unit's log to. Defaults to the
+                             'unit_log_dir' arg.
         
         :rtype: integer
         :returns: integer exit code to represent pass/fail of the list executed. 
@@ -782,22 +902,32 @@ class EutesterTestCase(unittest.TestCase):
         start = time.time()
         tests_ran=0
         test_count = len(list)
+        if concurrency is None:
+            concurrency = self.get_arg('test_concurrency') or 1
+        unit_log_dir = unit_log_dir or self.get_arg('unit_log_dir')
+        trace_file = self.get_arg('trace_file')
+        if trace_file and not tracing.tracer.enabled:
+            tracing.enable(trace_file)
         try:
-            for test in list:
-                tests_ran += 1
-                self.print_test_unit_startmsg(test)
-                try:
-                    test.run(eof=eof or test.eof)
-                except Exception, e:
-                    self.debug('Testcase:'+ str(test.name)+' error:'+str(e))
-                    if eof or (not eof and test.eof):
-                        self.endfailure(str(test.name))
-                        raise e
+            if concurrency > 1:
+                tests_ran = self.run_test_units_parallel(list, eof=eof, concurrency=concurrency,
+                                                         unit_log_dir=unit_log_dir)
+            else:
+                for test in list:
+                    tests_ran += 1
+                    self.print_test_unit_startmsg(test)
+                    try:
+                        test.run(eof=eof or test.eof)
+                    except Exception, e:
+                        self.debug('Testcase:'+ str(test.name)+' error:'+str(e))
+                        if eof or (not eof and test.eof):
+                            self.endfailure(str(test.name))
+                            raise e
+                        else:
+                            self.endfailure(str(test.name))
                     else:
-                        self.endfailure(str(test.name))
-                else:
-                    self.endsuccess(str(test.name))
-                self.debug(self.print_test_list_short_stats(list))
+                        self.endsuccess(str(test.name))
+                    self.debug(self.print_test_list_short_stats(list))
                         
         finally:
             elapsed = int(time.time()-start)
@@ -808,6 +938,8 @@ class EutesterTestCase(unittest.TestCase):
                 try:
                     self.debug("Printing pre-cleanup results:")
                     msgout += self.print_test_list_results(list=list,printout=False)
+                    if tracing.tracer.enabled:
+                        msgout += "\n" + tracing.tracer.get_summary()
                     self.status(msgout)
                 except:pass
             try:
@@ -845,6 +977,165 @@ class EutesterTestCase(unittest.TestCase):
             else:
                 return(0)
 
+    def get_testunit_dependencies(self, testunit, unitlist):
+        '''
+        Description: Resolves a testunit's depends_on entries, which may be EutesterTestUnits or testunit names,
+        to the EutesterTestUnits within unitlist.
+
+        :type testunit: EutesterTestUnit
+        :param testunit: The testunit to resolve dependencies for
+
+        :type unitlist: list
+        :param unitlist: list of EutesterTestUnits being run
+
+        :rtype: list
+        :returns: list of EutesterTestUnits
+        '''
+        deps = []
+        for dep in testunit.depends_on or []:
+            if isinstance(dep, EutesterTestUnit):
+                if not dep in unitlist:
+                    raise Exception('Testunit:' + str(testunit.name) + ' depends on:' + str(dep.name) +
+                                    ', which is not in the test list')
+                matches = [dep]
+            else:
+                matches = [unit for unit in unitlist if unit.name == str(dep)]
+                if not matches:
+                    raise Exception('Testunit:' + str(testunit.name) + ' depends on:' + str(dep) +
+                                    ', no testunit by that name is in the test list')
+            for unit in matches:
+                if unit is testunit:
+                    raise Exception('Testunit:' + str(testunit.name) + ' depends on itself')
+                if not unit in deps:
+                    deps.append(unit)
+        return deps
+
+    def run_test_units_parallel(self, unitlist, eof=False, concurrency=4, unit_log_dir=None):
+        '''
+        Description: Runs a list of EutesterTestUnits on a worker pool of 'concurrency' threads.
+        Units are started in list order as soon as all of their depends_on units have passed, and no running unit
+        shares one of their resource_groups. Units whose dependencies fail or are not run are marked not_run.
+        Each unit's output is captured separately and printed as one block when the unit ends (and written to
+        unit_log_dir/<index>_<name>.log if provided).
+        If a unit fails and eof (or the unit's eof) is set, no further units are started, running units are allowed
+        to finish, and the failure is raised.
+
+        :type unitlist: list
+        :param unitlist: list of EutesterTestUnit objects to be run
+
+        :type eof: boolean
+        :param eof: Flag to indicate whether to stop on any failure
+
+        :type concurrency: integer
+        :param concurrency: max number of units to run at once
+
+        :type unit_log_dir: string
+        :param unit_log_dir: optional directory to write a log file per unit to
+
+        :rtype: integer
+        :returns: number of units which were started
+        '''
+        deps = {}
+        for unit in unitlist:
+            deps[unit] = self.get_testunit_dependencies(unit, unitlist)
+        if unit_log_dir and not os.path.exists(unit_log_dir):
+            os.makedirs(unit_log_dir)
+        pending = [unit for unit in unitlist]
+        finished = []
+        running = {}
+        groups_in_use = set()
+        tests_ran = 0
+        stop_error = None
+        self.debug('Running ' + str(len(unitlist)) + ' testunits with concurrency:' + str(concurrency))
+        router = TestUnitOutputRouter()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        router.start()
+        try:
+            while pending or running:
+                progress = False
+                if stop_error is None:
+                    for unit in [u for u in pending]:
+                        if len(running) >= concurrency:
+                            break
+                        bad_deps = [dep for dep in deps[unit]
+                                    if dep in finished and dep.result != EutesterTestResult.passed]
+                        if bad_deps:
+                            pending.remove(unit)
+                            finished.append(unit)
+                            progress = True
+                            unit.result = EutesterTestResult.not_run
+                            unit.error = 'Dependencies did not pass: ' + \
+                                         ",".join([str(dep.name) for dep in bad_deps])
+                            self.debug('Not running testunit:' + str(unit.name) + ', ' + unit.error)
+                            continue
+                        if [dep for dep in deps[unit] if not dep in finished]:
+                            continue
+                        if groups_in_use.intersection(unit.resource_groups or []):
+                            continue
+                        pending.remove(unit)
+                        groups_in_use.update(unit.resource_groups or [])
+                        tests_ran += 1
+                        progress = True
+                        future = executor.submit(self.run_test_unit_isolated, unit, eof or unit.eof, router,
+                                                 unit_log_dir, unitlist.index(unit))
+                        running[future] = unit
+                if not running:
+                    if progress:
+                        continue
+                    if pending and stop_error is None:
+                        #Nothing running and nothing can start, remaining units have circular dependencies
+                        for unit in pending:
+                            unit.result = EutesterTestResult.not_run
+                            unit.error = 'Dependencies could not be resolved: ' + \
+                                         ",".join([str(dep.name) for dep in deps[unit] if not dep in finished])
+                            self.debug('Not running testunit:' + str(unit.name) + ', ' + unit.error)
+                    break
+                done, not_done = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    unit = running.pop(future)
+                    finished.append(unit)
+                    groups_in_use.difference_update(unit.resource_groups or [])
+                    try:
+                        future.result()
+                    except Exception, e:
+                        self.debug('Testunit:' + str(unit.name) + ' failed with end on failure set, not starting '
+                                   'any more testunits. Error:' + str(e))
+                        if stop_error is None:
+                            stop_error = e
+                    self.debug(self.print_test_list_short_stats(unitlist))
+        finally:
+            executor.shutdown(wait=True)
+            router.stop()
+        if stop_error is not None:
+            raise stop_error
+        return tests_ran
+
+    def run_test_unit_isolated(self, testunit, eof, router, unit_log_dir=None, index=0):
+        '''
+        Description: Runs a single testunit on a worker thread with its output captured to its own log.
+        Mirrors the per unit handling in run_test_case_list(); raises if the unit fails with eof set.
+        '''
+        if unit_log_dir:
+            testunit.log_file = os.path.join(unit_log_dir, str(index) + "_" + str(testunit.name) + '.log')
+            sink = open(testunit.log_file, 'w+')
+        else:
+            sink = tempfile.TemporaryFile()
+        router.register(sink)
+        try:
+            self.print_test_unit_startmsg(testunit)
+            try:
+                testunit.run(eof=eof)
+            except Exception, e:
+                self.debug('Testcase:'+ str(testunit.name)+' error:'+str(e))
+                self.endfailure(str(testunit.name))
+                raise e
+            else:
+                self.endsuccess(str(testunit.name))
+        finally:
+            router.unregister()
+            router.write_unit_log(sink, str(index) + ":" + str(testunit.name))
+            sink.close()
+
     def print_test_unit_startmsg(self,test):
         startbuf = ''
         if self.args.html_anchors:
@@ -1122,6 +1413,12 @@ class EutesterTestCase(unittest.TestCase):
                 eof = kwargs['eof']
             else:
                 eof = kwargs.pop('eof')
+        depends_on = []
+        resource_groups = []
+        if 'depends_on' in kwargs and not 'depends_on' in methvars:
+            depends_on = kwargs.pop('depends_on') or []
+        if 'resource_groups' in kwargs and not 'resource_groups' in methvars:
+            resource_groups = kwargs.pop('resource_groups') or []
         if 'obj' in kwargs:
             if 'obj' in methvars:
                 obj = kwargs['obj']
@@ -1130,6 +1427,8 @@ class EutesterTestCase(unittest.TestCase):
 
         testunit = EutesterTestUnit(meth, *args, **kwargs)
         testunit.eof = eof
+        testunit.depends_on = depends_on
+        testunit.resource_groups = resource_groups
 
         #if autoarg, auto populate testunit arguements from local testcase.args namespace values
         if autoarg:
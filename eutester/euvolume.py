@@ -80,6 +80,13 @@ class EuVolume(Volume, TaggedResource):
     
     def update(self):
         super(EuVolume, self).update()
+        self.post_update()
+
+    def post_update(self):
+        """
+        Syncs the eutester attach info tags and status after the volume's attributes have been refreshed,
+        ie by update() or a batched describe in ResourceStateMonitor
+        """
         if (self.tags.has_key(self.tag_md5_key) and (self.md5 != self.tags[self.tag_md5_key])) or \
             (self.tags.has_key(self.tag_md5len_key) and (self.md5len != self.tags[self.tag_md5len_key])):
             self.update_volume_attach_info_tags()
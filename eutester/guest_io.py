@@ -0,0 +1,274 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Host side driver for the guest I/O helper (eutester/guest_io_helper.py).
+
+The helper script is copied to the instance once over sftp, and then each fill or checksum is a single
+remote command. The helper writes/reads with large blocks and several parallel streams, computes the md5
+in the same pass, and streams json progress events back over the command's ssh channel. There is no
+nohup'd dd, temp file or once a second kill -USR1 polling.
+
+example usage:
+    gio = GuestIO(instance)
+    gio.setup()
+    result = gio.write('/dev/vdb', length=1073741824, header=volume.id)
+    print result['md5'], result['mbps']
+    check = gio.md5('/dev/vdb', length=1073741824, expect=result['md5'])
+'''
+import json
+import os
+import sys
+from eutester.sshconnection import SshCbReturn
+
+
+class GuestIOException(Exception):
+    pass
+
+
+class GuestIOStartException(GuestIOException):
+    """
+    The helper could not be installed or exited before reporting anything, nothing was done on the guest
+    """
+    pass
+
+
+class GuestIO():
+    helper_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'guest_io_helper.py')
+    python_candidates = ['python', 'python2', 'python3', '/usr/libexec/platform-python']
+    #The helper needs json, mmap and bytearray, ie python 2.6 or later
+    python_check = 'import sys,json,mmap; sys.exit(sys.version_info < (2,6))'
+
+    def __init__(self, instance, remote_path='/tmp/eutester_guest_io.py', debugmethod=None):
+        '''
+        :param instance: EuInstance (or anything with cmd(), sys() and an ssh connection) to run the helper on
+        :param remote_path: path the helper script is copied to on the instance
+        :param debugmethod: method used for debug output, defaults to the instance's debug method
+        '''
+        self.instance = instance
+        self.remote_path = remote_path
+        self.debugmethod = debugmethod or getattr(instance, 'debug', None)
+        self.python = None
+        self.supported = None
+        self.installed = False
+        self._started = False
+        self._partial = ''
+        self._result = None
+        self._last_bytes = 0
+        self._timeout = None
+
+    def debug(self, msg):
+        if self.debugmethod:
+            self.debugmethod(msg)
+        else:
+            print msg
+
+    def get_python(self):
+        '''
+        Returns the path of a python interpreter on the guest able to run the helper, or None if the guest
+        does not have one
+        '''
+        if self.python is None:
+            out = self.instance.sys('for p in ' + " ".join(self.python_candidates) +
+                                    '; do command -v $p >/dev/null 2>&1 && $p -c "' + self.python_check +
+                                    '" >/dev/null 2>&1 && command -v $p && break; done', verbose=False)
+            for line in out:
+                line = str(line).strip()
+                if line.startswith('/'):
+                    self.python = line
+                    break
+        return self.python
+
+    def is_supported(self):
+        '''
+        Returns True if the helper can be run on this guest. The result is cached.
+        '''
+        if self.supported is None:
+            try:
+                self.supported = self.get_python() is not None
+            except Exception, e:
+                self.debug('GuestIO could not check guest for python: ' + str(e))
+                return False
+        return self.supported
+
+    def setup(self, force=False):
+        '''
+        Copies the helper to the instance. Only done once per GuestIO unless force is set.
+        '''
+        if self.installed and not force:
+            return
+        if not self.is_supported():
+            raise GuestIOStartException('No python 2.6+ interpreter found on guest, can not run guest io helper')
+        self.debug('Copying guest io helper to ' + str(self.remote_path) + ', guest python:' + str(self.python))
+        try:
+            self.instance.ssh.sftp_put(self.helper_file, self.remote_path)
+        except Exception, e:
+            raise GuestIOStartException('Failed to copy guest io helper to guest: ' + str(e))
+        self.installed = True
+
+    def write(self, dev, length=None, offset=0, header=None, bs=4194304, streams=4, direct=False,
+              timeout=300, interval=1):
+        '''
+        Fills 'length' bytes of dev starting at offset with unique non-zero data.
+        Returns the helper's result dict: bytes, md5 (of the written range), elapsed, mbps, direct
+
+        :param dev: device or file path on the guest
+        :param length: number of bytes to write, defaults to the rest of the device
+        :param offset: byte offset in dev to start writing at
+        :param header: optional string (ie a volume id) written at the start of the range
+        :param bs: block size used for each write
+        :param streams: number of parallel write streams
+        :param direct: use O_DIRECT on the guest when supported
+        :param timeout: seconds without progress before the operation is considered hung
+        :param interval: seconds between progress updates
+        '''
+        args = ['--bs', bs, '--streams', streams, '--offset', offset, '--interval', interval]
+        if length is not None:
+            args += ['--length', length]
+        if header:
+            args += ['--header', header]
+        if direct:
+            args.append('--direct')
+        return self.run('write', dev, args, timeout=timeout)
+
+    def md5(self, dev, length=None, offset=0, expect=None, bs=4194304, streams=4, timeout=300, interval=1):
+        '''
+        Reads 'length' bytes of dev starting at offset and returns the helper's result dict: bytes, md5,
+        elapsed, mbps. If expect is provided a mismatch raises GuestIOException.
+
+        :param dev: device or file path on the guest
+        :param length: number of bytes to read, defaults to the rest of the device
+        :param offset: byte offset in dev to start reading at
+        :param expect: optional expected md5
+        :param bs: block size used for each read
+        :param streams: number of parallel read streams
+        :param timeout: seconds without progress before the operation is considered hung
+        :param interval: seconds between progress updates
+        '''
+        args = ['--bs', bs, '--streams', streams, '--offset', offset, '--interval', interval]
+        if length is not None:
+            args += ['--length', length]
+        if expect:
+            args += ['--expect', expect]
+        result = self.run('md5', dev, args, timeout=timeout)
+        if expect and not result.get('match'):
+            raise GuestIOException('MD5 mismatch for ' + str(dev) + ', expected:' + str(expect) +
+                                   ', got:' + str(result.get('md5')))
+        return result
+
+    def run(self, mode, dev, args, timeout=300):
+        '''
+        Runs the helper on the guest, printing progress as it arrives. Returns the helper's 'done' event.
+        '''
+        self.setup()
+        cmd = str(self.python) + ' ' + str(self.remote_path) + ' ' + str(mode) + ' ' + str(dev)
+        cmd += ' ' + " ".join([str(x) for x in args])
+        #Usage errors, tracebacks and dd errors go to stderr, keep them in the output for failure reports
+        cmd += ' 2>&1'
+        self._partial = ''
+        self._result = None
+        self._last_bytes = 0
+        self._started = False
+        self._timeout = timeout
+        self.show_header(cmd)
+        out = self.instance.cmd(cmd, verbose=False, timeout=timeout, cb=self._output_cb, get_pty=False)
+        if self._partial.strip():
+            #Last line of output had no trailing newline
+            out['output'] = str(out.get('output') or '') + self._partial.strip()
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+        result = self._result
+        if result is None:
+            #Nothing parsable came back, the helper never got going on this guest
+            if not self._started:
+                raise GuestIOStartException('Guest io helper failed to start. cmd:"' + str(cmd) + '", status:' +
+                                            str(out.get('status')) + ', output:' + str(out.get('output')))
+            raise GuestIOException('Guest io helper did not return a result. cmd:"' + str(cmd) + '", status:' +
+                                   str(out.get('status')) + ', output:' + str(out.get('output')))
+        if result.get('event') == 'error':
+            raise GuestIOException('Guest io helper failed. cmd:"' + str(cmd) + '", error:' + str(result.get('msg')))
+        self.debug('Guest io ' + str(mode) + ' done, dev:' + str(dev) + ', bytes:' + str(result.get('bytes')) +
+                   ', md5:' + str(result.get('md5')) + ', elapsed:' + str(result.get('elapsed')) +
+                   ', MB/s:' + str(result.get('mbps')))
+        return result
+
+    def _output_cb(self, buf):
+        '''
+        ssh cmd() callback, parses the json lines sent by the helper. Unparsable lines are returned to be
+        included in the cmd output.
+        '''
+        settimer = 0
+        other = []
+        lines = (self._partial + str(buf)).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                other.append(line)
+                continue
+            self._started = True
+            if event.get('event') == 'progress':
+                self.show_progress(event)
+                #Only reset the cmd timer when bytes are actually moving
+                if event.get('bytes', 0) > self._last_bytes:
+                    self._last_bytes = event.get('bytes')
+                    settimer = self._timeout
+            else:
+                self._result = event
+                if event.get('event') == 'done':
+                    self.show_progress(event)
+        return SshCbReturn(settimer=settimer, buf="".join([line + "\n" for line in other]) or None)
+
+    def show_header(self, cmd):
+        linediv = '\n' + '-' * 90 + '\n'
+        buf = linediv + 'GUEST IO: ' + str(cmd) + linediv
+        buf += str('BYTES').ljust(15)
+        buf += '|' + str('MBs').center(12)
+        buf += '|' + str('ELAPSED').center(12)
+        buf += '|' + str('RATE MB/s').center(12)
+        buf += '|' + str('LAT AVG ms').center(12)
+        buf += '|' + str('LAT MAX ms').center(12)
+        buf += linediv
+        sys.stdout.write(buf)
+        sys.stdout.flush()
+
+    def show_progress(self, event):
+        bytes = event.get('bytes', 0)
+        buf = str(bytes).ljust(15)
+        buf += '|' + str("{0:.2f}".format(bytes / 1048576.0)).center(12)
+        buf += '|' + str(event.get('elapsed')).center(12)
+        buf += '|' + str(event.get('mbps')).center(12)
+        buf += '|' + str(event.get('lat_ms_avg', '')).center(12)
+        buf += '|' + str(event.get('lat_ms_max', '')).center(12)
+        sys.stdout.write("\r\x1b[K" + buf)
+        sys.stdout.flush()
@@ -0,0 +1,419 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Guest side I/O helper used by eutester.guest_io.GuestIO.
+
+This file is copied as is to a running instance and executed there with whatever python the guest
+provides (2.6+ or 3.x), so it must only use the standard library and must not import eutester.
+
+Modes:
+    write - Fills a device (or file) range with unique non-zero data using large blocks and several
+            parallel write streams. The md5 of the written range is computed in the same pass by
+            regenerating the block pattern in memory, so no second read of the device is needed.
+    md5   - Reads a device range with several parallel streams and returns its md5. If --expect is
+            given the result also reports whether the checksum matched.
+
+Progress and results are written to stdout as one json object per line:
+    {"event": "progress", "bytes": ..., "elapsed": ..., "mbps": ..., "lat_ms_avg": ..., "lat_ms_max": ...}
+    {"event": "done", "mode": ..., "bytes": ..., "md5": ..., "elapsed": ..., "mbps": ...}
+    {"event": "error", "msg": ...}
+
+example usage (on the guest):
+    python guest_io_helper.py write /dev/vdb --length 1073741824 --header vol-12345678 --streams 4
+    python guest_io_helper.py md5 /dev/vdb --length 1073741824 --expect 9e107d9d372bb6826bd81d3542a419d6
+'''
+import hashlib
+import json
+import mmap
+import optparse
+import os
+import struct
+import sys
+import threading
+import time
+
+
+class IOStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.bytes = 0
+        self.interval_ops = 0
+        self.interval_lat = 0.0
+        self.interval_lat_max = 0.0
+
+    def add(self, nbytes, latency):
+        self.lock.acquire()
+        try:
+            self.bytes += nbytes
+            self.interval_ops += 1
+            self.interval_lat += latency
+            if latency > self.interval_lat_max:
+                self.interval_lat_max = latency
+        finally:
+            self.lock.release()
+
+    def progress(self):
+        self.lock.acquire()
+        try:
+            elapsed = time.time() - self.start
+            lat_avg = 0
+            if self.interval_ops:
+                lat_avg = self.interval_lat / self.interval_ops
+            ret = {'event': 'progress',
+                   'bytes': self.bytes,
+                   'elapsed': round(elapsed, 3),
+                   'mbps': round((self.bytes / 1048576.0) / (elapsed or 1), 2),
+                   'lat_ms_avg': round(lat_avg * 1000, 3),
+                   'lat_ms_max': round(self.interval_lat_max * 1000, 3)}
+            self.interval_ops = 0
+            self.interval_lat = 0.0
+            self.interval_lat_max = 0.0
+            return ret
+        finally:
+            self.lock.release()
+
+
+def emit(obj):
+    sys.stdout.write(json.dumps(obj) + '\n')
+    sys.stdout.flush()
+
+
+def get_size(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, 2)
+    finally:
+        os.close(fd)
+
+
+def open_dev(path, flags, direct):
+    '''
+    Opens path, with O_DIRECT if requested and supported. Returns (fd, direct_in_use)
+    '''
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError:
+            pass
+    return os.open(path, flags), False
+
+
+def alloc_block(bs, direct):
+    '''
+    O_DIRECT needs page aligned buffers, anonymous mmaps always are.
+    '''
+    if direct:
+        return mmap.mmap(-1, bs)
+    return bytearray(bs)
+
+
+class BlockPattern():
+    '''
+    Deterministic per run block content. Every block is a shared random base buffer with the
+    block's offset stamped into its first 8 bytes, the first block instead starts with the header.
+    The writer streams and the in memory hasher each own a BlockPattern and produce identical blocks.
+    '''
+    def __init__(self, base, header, offset, length, direct=False):
+        self.bs = len(base)
+        self.header = header
+        self.offset = offset
+        self.length = length
+        self.base = base
+        self.buf = alloc_block(self.bs, direct)
+        self.buf[0:self.bs] = base
+        self.dirty = 0
+
+    def block(self, index):
+        '''
+        Returns (buffer, size) for block 'index', relative to the start of the range
+        '''
+        pos = index * self.bs
+        size = min(self.bs, self.length - pos)
+        if self.dirty:
+            #Header bytes from block 0 must not leak into the blocks after it
+            self.buf[0:self.dirty] = self.base[0:self.dirty]
+            self.dirty = 0
+        self.buf[0:8] = struct.pack('>Q', self.offset + pos)
+        if index == 0 and self.header:
+            self.buf[0:len(self.header)] = self.header
+            self.dirty = len(self.header)
+        return self.buf, size
+
+
+def region_bounds(nblocks, streams):
+    '''
+    Splits nblocks into contiguous [start, end) block regions, one per stream
+    '''
+    per = nblocks // streams
+    extra = nblocks % streams
+    bounds = []
+    start = 0
+    for x in range(streams):
+        end = start + per + (x < extra and 1 or 0)
+        if end > start:
+            bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def run_threads(threads, stats, interval):
+    '''
+    Starts the worker threads and emits a progress event every interval until they are all done.
+    Returns the first error raised by any worker, or None.
+    '''
+    for t in threads:
+        t.daemon = True
+        t.start()
+    while True:
+        alive = [t for t in threads if t.is_alive()]
+        if not alive:
+            break
+        alive[0].join(interval)
+        if [t for t in threads if t.error]:
+            break
+        emit(stats.progress())
+    for t in threads:
+        if t.error:
+            return t.error
+    return None
+
+
+class Worker(threading.Thread):
+    def __init__(self, target, *args):
+        threading.Thread.__init__(self)
+        self.target = target
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(*self.args)
+        except Exception:
+            self.error = str(sys.exc_info()[1]) or repr(sys.exc_info()[1])
+
+
+def do_write(opts, dev, offset, length):
+    bs = opts.bs
+    nblocks = (length + bs - 1) // bs
+    base = os.urandom(bs)
+    header = opts.header.encode('utf-8') if opts.header else b''
+    if header:
+        header += b'\n'
+    stats = IOStats()
+    md5 = hashlib.md5()
+    status = {'direct': False}
+
+    def writer(start, end):
+        fd, direct = open_dev(dev, os.O_WRONLY, opts.direct)
+        status['direct'] = direct
+        tail_fd = None
+        try:
+            pattern = BlockPattern(base, header, offset, length, direct=direct)
+            os.lseek(fd, offset + start * bs, 0)
+            for index in range(start, end):
+                buf, size = pattern.block(index)
+                wstart = time.time()
+                if size == bs:
+                    written = os.write(fd, buf)
+                else:
+                    #A short tail block can not be written with O_DIRECT, use a buffered fd for it
+                    if direct:
+                        tail_fd = os.open(dev, os.O_WRONLY)
+                        os.lseek(tail_fd, offset + index * bs, 0)
+                        written = os.write(tail_fd, bytes(buf[0:size]))
+                    else:
+                        written = os.write(fd, bytes(buf[0:size]))
+                if written != size:
+                    raise IOError('Short write at offset ' + str(offset + index * bs) + ', wrote ' +
+                                  str(written) + ' of ' + str(size))
+                stats.add(size, time.time() - wstart)
+            os.fsync(fd)
+            if tail_fd is not None:
+                os.fsync(tail_fd)
+        finally:
+            os.close(fd)
+            if tail_fd is not None:
+                os.close(tail_fd)
+
+    def hasher():
+        pattern = BlockPattern(base, header, offset, length)
+        for index in range(nblocks):
+            buf, size = pattern.block(index)
+            if size == bs:
+                md5.update(buf)
+            else:
+                md5.update(bytes(buf[0:size]))
+
+    threads = [Worker(writer, start, end) for start, end in region_bounds(nblocks, opts.streams)]
+    threads.append(Worker(hasher))
+    error = run_threads(threads, stats, opts.interval)
+    if error:
+        return {'event': 'error', 'msg': error}
+    elapsed = time.time() - stats.start
+    return {'event': 'done',
+            'mode': 'write',
+            'bytes': stats.bytes,
+            'offset': offset,
+            'md5': md5.hexdigest(),
+            'elapsed': round(elapsed, 3),
+            'mbps': round((stats.bytes / 1048576.0) / (elapsed or 1), 2),
+            'direct': status['direct']}
+
+
+def do_md5(opts, dev, offset, length):
+    bs = opts.bs
+    nblocks = (length + bs - 1) // bs
+    #Readers may only run 'window' blocks ahead of the hasher, this bounds memory use
+    window = opts.streams * 4
+    stats = IOStats()
+    md5 = hashlib.md5()
+    pending = {}
+    cond = threading.Condition()
+    state = {'next': 0, 'error': False}
+
+    def reader(stream):
+        fd, direct = open_dev(dev, os.O_RDONLY, False)
+        try:
+            for index in range(stream, nblocks, opts.streams):
+                cond.acquire()
+                try:
+                    while index >= state['next'] + window and not state['error']:
+                        cond.wait(1)
+                    if state['error']:
+                        return
+                finally:
+                    cond.release()
+                pos = index * bs
+                size = min(bs, length - pos)
+                rstart = time.time()
+                os.lseek(fd, offset + pos, 0)
+                chunks = []
+                got = 0
+                while got < size:
+                    data = os.read(fd, size - got)
+                    if not data:
+                        raise IOError('Short read at offset ' + str(offset + pos + got) +
+                                      ', device smaller than requested length?')
+                    chunks.append(data)
+                    got += len(data)
+                stats.add(size, time.time() - rstart)
+                cond.acquire()
+                try:
+                    pending[index] = b''.join(chunks)
+                    cond.notify_all()
+                finally:
+                    cond.release()
+        except Exception:
+            cond.acquire()
+            state['error'] = True
+            cond.notify_all()
+            cond.release()
+            raise
+        finally:
+            os.close(fd)
+
+    def hasher():
+        while state['next'] < nblocks:
+            cond.acquire()
+            try:
+                while state['next'] not in pending:
+                    if state['error']:
+                        return
+                    cond.wait(1)
+                data = pending.pop(state['next'])
+                state['next'] += 1
+                cond.notify_all()
+            finally:
+                cond.release()
+            md5.update(data)
+
+    threads = [Worker(reader, x) for x in range(min(opts.streams, nblocks) or 1)]
+    threads.append(Worker(hasher))
+    error = run_threads(threads, stats, opts.interval)
+    if error:
+        return {'event': 'error', 'msg': error}
+    elapsed = time.time() - stats.start
+    ret = {'event': 'done',
+           'mode': 'md5',
+           'bytes': stats.bytes,
+           'offset': offset,
+           'md5': md5.hexdigest(),
+           'elapsed': round(elapsed, 3),
+           'mbps': round((stats.bytes / 1048576.0) / (elapsed or 1), 2)}
+    if opts.expect:
+        ret['expect'] = opts.expect
+        ret['match'] = (opts.expect == ret['md5'])
+    return ret
+
+
+def get_options(argv):
+    parser = optparse.OptionParser(usage='%prog <write|md5> <device> [options]')
+    parser.add_option('--offset', type='int', default=0, help='Byte offset to start at')
+    parser.add_option('--length', type='int', default=None,
+                      help='Number of bytes, defaults to the remainder of the device')
+    parser.add_option('--bs', type='int', default=4194304, help='Block size in bytes')
+    parser.add_option('--streams', type='int', default=4, help='Number of parallel read/write streams')
+    parser.add_option('--header', default=None, help='String written at the start of the range (write mode)')
+    parser.add_option('--expect', default=None, help='Expected md5 (md5 mode)')
+    parser.add_option('--interval', type='float', default=1.0, help='Seconds between progress events')
+    parser.add_option('--direct', action='store_true', default=False,
+                      help='Bypass the guest page cache with O_DIRECT (write mode)')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 2 or args[0] not in ['write', 'md5']:
+        parser.error('Need mode (write or md5) and a device')
+    if opts.direct and opts.bs % 4096:
+        parser.error('--bs must be a multiple of 4096 with --direct')
+    opts.streams = max(1, opts.streams)
+    return opts, args[0], args[1]
+
+
+def main(argv):
+    opts, mode, dev = get_options(argv)
+    try:
+        length = opts.length
+        if length is None:
+            length = get_size(dev) - opts.offset
+        if length <= 0:
+            raise ValueError('Nothing to do for ' + str(dev) + ', length:' + str(length))
+        if mode == 'write':
+            ret = do_write(opts, dev, opts.offset, length)
+        else:
+            ret = do_md5(opts, dev, opts.offset, length)
+    except Exception:
+        ret = {'event': 'error', 'msg': str(sys.exc_info()[1])}
+    emit(ret)
+    if ret['event'] != 'done' or ret.get('match') is False:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,503 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+In-process image bundling, an alternative to running euca-bundle-image and euca-upload-bundle on a remote machine.
+
+The image is streamed through a chain of generators; tar -> sha1 digest -> gzip -> AES-128-CBC encryption ->
+part splitting, without writing intermediate files. Reading the source and the tar/gzip stage each run in their
+own thread, handing chunks to the next stage through bounded queues, and parts are handed to a pool of workers as
+soon as they are produced, so uploading overlaps with bundling. Memory use is bounded by the queue sizes and
+(concurrency + 1) parts. Once all parts are stored, the manifest is generated, signed and stored alongside them.
+The bundle and manifest use the same format as euca2ools so the manifest can be registered as usual.
+
+The source may be a local file path, an http(s) url (streamed directly, no local copy is made), or a file like
+object along with its size. Requires M2Crypto, and the user's cert, private key and the cloud cert. By default
+these are found in the tester's credpath.
+
+example usage:
+    bundler = ImageBundler(tester, concurrency=4)
+    manifest = bundler.bundle_and_upload('http://server/images/centos.img', bucket_name='centos',
+                                         arch='x86_64', kernel='eki-12345678', ramdisk='eri-12345678')
+    emi = tester.register_image(image_location=manifest)
+
+    #Or write the bundle to a local directory
+    manifest_path = bundler.bundle_image('/disk1/storage/centos.img', destination='/disk1/storage/bundle')
+'''
+import binascii
+import glob
+import hashlib
+import os
+import Queue
+import sys
+import tarfile
+import threading
+import time
+import urllib2
+import zlib
+from xml.dom.minidom import Document
+from concurrent.futures import ThreadPoolExecutor
+
+DefaultPartSize = 10 * 1048576
+DefaultChunkSize = 1048576
+ManifestVersion = '2007-10-10'
+
+
+def get_m2crypto():
+    try:
+        from M2Crypto import RSA, X509, EVP
+    except ImportError:
+        raise ImportError("Unable to load M2Crypto. Please install by using your package manager to install "
+                          "python-m2crypto or 'easy_install M2crypto'")
+    return RSA, X509, EVP
+
+
+def iter_file(fileobj, chunk_size=DefaultChunkSize):
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            return
+        yield data
+
+
+def iter_tar(chunks, name, size, mtime=None, mode=0644):
+    '''
+    Wraps the data of a single file in a tar stream
+    :param chunks: iterable of the file's data
+    :param name: file name within the archive
+    :param size: size of the file, must match the data provided
+    '''
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    info.mode = mode
+    info.mtime = int(mtime or time.time())
+    info.type = tarfile.REGTYPE
+    header = info.tobuf(format=tarfile.GNU_FORMAT)
+    yield header
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > size:
+            raise Exception('Image data exceeded expected size:' + str(size) + ' for ' + str(name))
+        yield chunk
+    if total != size:
+        raise Exception('Image data ended after ' + str(total) + ' of ' + str(size) + ' bytes for ' + str(name))
+    offset = len(header) + total
+    #Pad the file to a full block, add the 2 end of archive blocks, then pad to a full record
+    padding = (tarfile.BLOCKSIZE - (offset % tarfile.BLOCKSIZE)) % tarfile.BLOCKSIZE
+    padding += 2 * tarfile.BLOCKSIZE
+    offset += padding
+    padding += (tarfile.RECORDSIZE - (offset % tarfile.RECORDSIZE)) % tarfile.RECORDSIZE
+    yield tarfile.NUL * padding
+
+
+def iter_digest(chunks, hasher):
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+def iter_gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_encrypt(chunks, key, iv):
+    '''
+    AES-128-CBC encrypts the data with PKCS#7 padding, the same as 'openssl enc -aes-128-cbc -K key -iv iv'
+    :param key: hex string key
+    :param iv: hex string iv
+    '''
+    RSA, X509, EVP = get_m2crypto()
+    cipher = EVP.Cipher(alg='aes_128_cbc', key=binascii.unhexlify(key), iv=binascii.unhexlify(iv), op=1)
+    for chunk in chunks:
+        data = cipher.update(chunk)
+        if data:
+            yield data
+    yield cipher.final()
+
+
+def iter_parts(chunks, part_size):
+    buf = []
+    buf_len = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_len += len(chunk)
+        if buf_len >= part_size:
+            data = "".join(buf)
+            while len(data) >= part_size:
+                yield data[:part_size]
+                data = data[part_size:]
+            buf = [data]
+            buf_len = len(data)
+    if buf_len:
+        yield "".join(buf)
+
+
+def iter_threaded(chunks, maxsize=4):
+    '''
+    Runs the chunks generator (and so every stage chained before it) in its own thread, handing its output over
+    through a bounded queue. The upstream stages work on the next chunks while the caller processes this one.
+    Errors raised upstream are re-raised to the caller.
+    '''
+    handoff = Queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                handoff.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    return
+            put((done, None))
+        except Exception:
+            put((done, sys.exc_info()))
+
+    thread = threading.Thread(target=produce, name='bundle-stage')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk, err = handoff.get()
+            if chunk is done:
+                if err:
+                    raise err[0], err[1], err[2]
+                return
+            yield chunk
+    finally:
+        stop.set()
+        thread.join(5)
+
+
+class ImageBundler():
+    def __init__(self,
+                 tester,
+                 part_size=DefaultPartSize,
+                 concurrency=4,
+                 chunk_size=DefaultChunkSize,
+                 queue_size=8,
+                 compress_level=6,
+                 cert=None,
+                 private_key=None,
+                 cloud_cert=None,
+                 user_id=None,
+                 debugmethod=None):
+        """
+        :param tester: eutester obj, an S3ops connection is required for bundle_and_upload(), ie Eucaops
+        :param part_size: bytes per bundle part
+        :param concurrency: max parts being stored at once
+        :param chunk_size: bytes read from the source at a time
+        :param queue_size: max chunks queued between pipeline stages
+        :param compress_level: gzip compression level
+        :param cert: user's x509 cert path, defaults to EC2_CERT from the tester's eucarc
+        :param private_key: user's private key path, defaults to EC2_PRIVATE_KEY from the tester's eucarc
+        :param cloud_cert: cloud's x509 cert path, defaults to EUCALYPTUS_CERT from the tester's eucarc
+        :param user_id: account id recorded in the manifest, defaults to the tester's
+        :param debugmethod: method used for debug output, defaults to tester.debug
+        """
+        self.tester = tester
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.compress_level = compress_level
+        self.cert = cert
+        self.private_key = private_key
+        self.cloud_cert = cloud_cert
+        self.user_id = user_id
+        self.debugmethod = debugmethod or tester.debug
+
+    def debug(self, msg):
+        self.debugmethod(msg)
+
+    def get_credential_path(self, path, eucarc_field, pattern, exclude=None):
+        '''
+        Returns path if given, otherwise the file named by eucarc_field in the tester's eucarc, otherwise the
+        single file in the tester's credpath matching pattern
+        '''
+        if path:
+            return path
+        credpath = getattr(self.tester, 'credpath', None)
+        if credpath:
+            try:
+                value = self.tester.parse_eucarc(eucarc_field)
+                value = value.replace('${EUCA_KEY_DIR}', credpath).replace('$EUCA_KEY_DIR', credpath)
+                if os.path.isfile(value):
+                    return value
+            except Exception, e:
+                self.debug('Could not get ' + str(eucarc_field) + ' from eucarc:' + str(e))
+            matches = [match for match in sorted(glob.glob(os.path.join(credpath, pattern)))
+                       if os.path.basename(match) != exclude]
+            if len(matches) == 1:
+                return matches[0]
+        raise Exception('Could not find ' + str(eucarc_field) + ' file in credpath:' + str(credpath) +
+                        ', provide the path when creating the ImageBundler')
+
+    def get_user_id(self):
+        if self.user_id:
+            return self.user_id
+        try:
+            return self.tester.get_user_id()
+        except Exception:
+            return self.tester.get_account_id()
+
+    def open_source(self, source, size=None):
+        '''
+        :param source: local file path, http(s) url, or file like object
+        :param size: size in bytes, required when source is a file like object
+        :returns: tuple (file like object, size, name)
+        '''
+        if not isinstance(source, basestring):
+            if size is None:
+                raise Exception('size is required when bundling from a file like object')
+            return source, size, os.path.basename(str(getattr(source, 'name', 'image.img')))
+        if source.startswith('http://') or source.startswith('https://'):
+            response = urllib2.urlopen(source)
+            length = response.info().getheader('content-length')
+            if size is None:
+                if length is None:
+                    raise Exception('No content-length returned for:' + str(source) + ', size must be provided')
+                size = long(length)
+            return response, size, os.path.basename(source.split('?')[0].rstrip('/'))
+        if size is None:
+            size = os.path.getsize(source)
+        return open(source, 'rb'), size, os.path.basename(source)
+
+    def bundle(self,
+               source,
+               store_method,
+               prefix=None,
+               size=None,
+               arch='x86_64',
+               kernel=None,
+               ramdisk=None,
+               block_device_mapping=None,
+               image_type='machine'):
+        '''
+        Streams the source through the bundle pipeline, calling store_method(filename, data) from worker threads
+        for each part while later parts are being produced, then once with the signed manifest.
+        :param source: local file path, http(s) url, or file like object
+        :param store_method: method called with (filename, data) to store each part and the manifest
+        :param prefix: bundle name, defaults to the source's file name
+        :param size: image size in bytes, required for file like objects
+        :param arch: image architecture
+        :param kernel: kernel id to record in the manifest
+        :param ramdisk: ramdisk id to record in the manifest
+        :param block_device_mapping: dict of {virtual:device}, or string 'ami=sda1,root=/dev/sda1'
+        :param image_type: 'machine', 'kernel' or 'ramdisk'
+        :returns: manifest filename
+        '''
+        RSA, X509, EVP = get_m2crypto()
+        cert = self.get_credential_path(self.cert, 'EC2_CERT', '*-cert.pem', exclude='cloud-cert.pem')
+        private_key = self.get_credential_path(self.private_key, 'EC2_PRIVATE_KEY', '*-pk.pem')
+        cloud_cert = self.get_credential_path(self.cloud_cert, 'EUCALYPTUS_CERT', 'cloud-cert.pem')
+        fileobj, size, name = self.open_source(source, size=size)
+        prefix = prefix or name
+        key = binascii.hexlify(os.urandom(16))
+        iv = binascii.hexlify(os.urandom(16))
+        tar_digest = hashlib.sha1()
+        self.debug('Bundling ' + str(name) + ', size:' + str(size) + ', prefix:' + str(prefix) +
+                   ', part_size:' + str(self.part_size) + ', concurrency:' + str(self.concurrency))
+        start = time.time()
+        reader = iter_threaded(iter_file(fileobj, self.chunk_size), maxsize=self.queue_size)
+        chunks = iter_digest(iter_tar(reader, name, size), tar_digest)
+        compressor = iter_threaded(iter_gzip(chunks, level=self.compress_level), maxsize=self.queue_size)
+        parts = iter_parts(iter_encrypt(compressor, key, iv), self.part_size)
+        part_list = []
+        bundled_size = 0
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            pending = []
+            for index, data in enumerate(parts):
+                filename = '%s.part.%02d' % (prefix, index)
+                bundled_size += len(data)
+                pending.append(executor.submit(self._store_part, store_method, filename, data))
+                # Bound the parts held in memory, wait for the oldest part before producing more
+                if len(pending) >= self.concurrency:
+                    part_list.append(pending.pop(0).result())
+            for future in pending:
+                part_list.append(future.result())
+        finally:
+            executor.shutdown(wait=True)
+            #Stop the stage threads if bundling was interrupted
+            for stage in [compressor, reader]:
+                try:
+                    stage.close()
+                except Exception, e:
+                    self.debug('Error stopping bundle stage:' + str(e))
+            fileobj.close()
+        bundle_elapsed = time.time() - start
+        manifest = self.generate_manifest(prefix=prefix,
+                                          image_size=size,
+                                          bundled_size=bundled_size,
+                                          digest=tar_digest.hexdigest(),
+                                          key=key,
+                                          iv=iv,
+                                          parts=part_list,
+                                          cert=cert,
+                                          private_key=private_key,
+                                          cloud_cert=cloud_cert,
+                                          arch=arch,
+                                          kernel=kernel,
+                                          ramdisk=ramdisk,
+                                          block_device_mapping=block_device_mapping,
+                                          image_type=image_type)
+        manifest_name = str(prefix) + '.manifest.xml'
+        store_method(manifest_name, manifest)
+        self.debug('Bundled ' + str(name) + ' into ' + str(len(part_list)) + ' parts, ' + str(bundled_size) +
+                   ' bytes from ' + str(size) + ' in ' + "%.2f" % bundle_elapsed + 's (' +
+                   "%.2f" % (size / 1048576.0 / max(bundle_elapsed, 0.001)) + 'MB/s), manifest:' + manifest_name)
+        return manifest_name
+
+    def _store_part(self, store_method, filename, data):
+        digest = hashlib.sha1(data).hexdigest()
+        store_method(filename, data)
+        return filename, digest
+
+    def bundle_image(self, source, destination, **kwargs):
+        '''
+        Bundles the source into parts and a manifest written to the local destination directory.
+        See bundle() for kwargs.
+        :returns: local path of the manifest
+        '''
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+
+        def write_file(filename, data):
+            with open(os.path.join(destination, filename), 'wb') as out:
+                out.write(data)
+
+        return os.path.join(destination, self.bundle(source, write_file, **kwargs))
+
+    def bundle_and_upload(self, source, bucket_name, **kwargs):
+        '''
+        Bundles the source, uploading each part to the bucket as it is produced, followed by the manifest.
+        The bucket is created if it does not exist. See bundle() for kwargs.
+        :returns: manifest location to register, ie: 'bucket/prefix.manifest.xml'
+        '''
+        if self.tester.get_bucket_by_name(bucket_name) is None:
+            self.tester.create_bucket(bucket_name)
+
+        def upload(filename, data):
+            self.tester.upload_object(bucket_name, filename, contents=data)
+
+        return str(bucket_name) + '/' + self.bundle(source, upload, **kwargs)
+
+    def generate_manifest(self,
+                          prefix,
+                          image_size,
+                          bundled_size,
+                          digest,
+                          key,
+                          iv,
+                          parts,
+                          cert,
+                          private_key,
+                          cloud_cert,
+                          arch='x86_64',
+                          kernel=None,
+                          ramdisk=None,
+                          block_device_mapping=None,
+                          image_type='machine'):
+        '''
+        Returns the signed manifest xml for a bundle.
+        The key and iv are encrypted with both the user's and cloud's certs. The <machine_configuration> and
+        <image> elements are signed with the user's private key.
+        :param parts: list of (filename, sha1 hex digest) tuples in order
+        '''
+        RSA, X509, EVP = get_m2crypto()
+
+        def encrypt(cert_path, data):
+            rsa = X509.load_cert(cert_path).get_pubkey().get_rsa()
+            return binascii.hexlify(rsa.public_encrypt(data, RSA.pkcs1_padding))
+
+        doc = Document()
+
+        def add_element(parent, name, text=None, **attrs):
+            elem = doc.createElement(name)
+            for attr in sorted(attrs):
+                elem.setAttribute(attr, str(attrs[attr]))
+            if text is not None:
+                elem.appendChild(doc.createTextNode(str(text)))
+            parent.appendChild(elem)
+            return elem
+
+        manifest = add_element(doc, 'manifest')
+        add_element(manifest, 'version', ManifestVersion)
+        bundler = add_element(manifest, 'bundler')
+        add_element(bundler, 'name', 'eutester')
+        add_element(bundler, 'version', '1.0')
+        add_element(bundler, 'release', '1')
+        machine_config = add_element(manifest, 'machine_configuration')
+        add_element(machine_config, 'architecture', arch)
+        if kernel:
+            add_element(machine_config, 'kernel_id', kernel)
+        if ramdisk:
+            add_element(machine_config, 'ramdisk_id', ramdisk)
+        if block_device_mapping:
+            if isinstance(block_device_mapping, basestring):
+                block_device_mapping = dict(mapping.split('=', 1) for mapping in block_device_mapping.split(','))
+            bdm = add_element(machine_config, 'block_device_mapping')
+            for virtual in sorted(block_device_mapping):
+                mapping = add_element(bdm, 'mapping')
+                add_element(mapping, 'virtual', virtual.strip())
+                add_element(mapping, 'device', block_device_mapping[virtual].strip())
+        image = add_element(manifest, 'image')
+        add_element(image, 'name', prefix)
+        add_element(image, 'user', self.get_user_id())
+        add_element(image, 'type', image_type)
+        add_element(image, 'digest', digest, algorithm='SHA1')
+        add_element(image, 'size', image_size)
+        add_element(image, 'bundled_size', bundled_size)
+        add_element(image, 'ec2_encrypted_key', encrypt(cloud_cert, key), algorithm='AES-128-CBC')
+        add_element(image, 'user_encrypted_key', encrypt(cert, key), algorithm='AES-128-CBC')
+        add_element(image, 'ec2_encrypted_iv', encrypt(cloud_cert, iv))
+        add_element(image, 'user_encrypted_iv', encrypt(cert, iv))
+        parts_elem = add_element(image, 'parts', count=len(parts))
+        for index, (filename, part_digest) in enumerate(parts):
+            part = add_element(parts_elem, 'part', index=index)
+            add_element(part, 'filename', filename)
+            add_element(part, 'digest', part_digest, algorithm='SHA1')
+        string_to_sign = machine_config.toxml() + image.toxml()
+        signature = RSA.load_key(private_key).sign(hashlib.sha1(string_to_sign).digest(), 'sha1')
+        add_element(manifest, 'signature', binascii.hexlify(signature))
+        return doc.toxml()
@@ -0,0 +1,561 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Durable, cross-run inventory of the resources created by test runs, plus a reaper for the orphans of dead runs.
+
+A ResourceInventory is a SQLite file shared by every run on a test machine. Each run registers itself (host, pid,
+heartbeat) under a run id, and a background thread keeps its heartbeat current for as long as the run is alive.
+When inventory tracking is enabled on a eutester object its test_resources dict is replaced with a
+TrackedResources dict, so every resource added to (or removed from) one of its lists is recorded in (or removed
+from) the inventory as it happens, without changes to the code creating the resources.
+Tracking is enabled with tester.enable_inventory(), or for every eutester object in the process by setting the
+EUTESTER_INVENTORY environment variable to the inventory file's path.
+
+A run is considered dead once it has finished, its process is gone (same host), or its heartbeat is older than
+'stale_after'. OrphanReaper looks the resources of dead runs up on the cloud in batches and removes them with a
+TeardownEngine, so the deletes run in parallel and in dependency order, then drops them from the inventory.
+
+example usage:
+    tester.enable_inventory('/var/tmp/eutester_inventory.db')
+    ...
+    reaper = OrphanReaper(tester, ResourceInventory('/var/tmp/eutester_inventory.db'), stale_after=6 * 3600)
+    reaper.show_orphans()
+    reaper.reap()
+'''
+import atexit
+import errno
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from boto.ec2.instance import Instance, Reservation
+from boto.ec2.image import Image
+from boto.exception import BotoServerError
+from eutester.teardown import TeardownEngine
+
+#Resource type recorded for each test_resources key, and the tester connection which owns that type
+resource_types = {'reservations': ('instance', 'ec2'),
+                  'volumes': ('volume', 'ec2'),
+                  'snapshots': ('snapshot', 'ec2'),
+                  'images': ('image', 'ec2'),
+                  'keypairs': ('keypair', 'ec2'),
+                  'security-groups': ('security-group', 'ec2'),
+                  'buckets': ('bucket', 's3'),
+                  'keys': ('key', 's3'),
+                  'load_balancers': ('load_balancer', 'elb'),
+                  'alarms': ('alarm', 'cw')}
+
+
+def get_resource_records(key, item):
+    """
+    Returns a list of (resource type, resource id) for an item in test_resources[key]
+    """
+    rtype = resource_types.get(key, (key, None))[0]
+    if isinstance(item, Reservation):
+        return [('instance', instance.id) for instance in item.instances or []]
+    if isinstance(item, Instance):
+        return [('instance', item.id)]
+    if isinstance(item, basestring):
+        return [(rtype, item)]
+    if rtype == 'key':
+        return [(rtype, str(item.bucket.name) + '/' + str(item.name))]
+    if rtype in ['keypair', 'bucket', 'load_balancer', 'alarm']:
+        return [(rtype, str(item.name))]
+    rid = getattr(item, 'id', None) or getattr(item, 'name', None)
+    if rid is None:
+        return []
+    return [(rtype, str(rid))]
+
+
+def get_endpoint(tester, key):
+    """
+    Returns the host of the tester's connection for the resources under test_resources[key]
+    """
+    connection = getattr(tester, resource_types.get(key, (None, 'ec2'))[1] or 'ec2', None)
+    return getattr(connection, 'host', None)
+
+
+default_inventory = None
+
+
+def get_default_inventory():
+    """
+    Returns the inventory shared by all eutester objects in this process when $EUTESTER_INVENTORY is set, else None
+    """
+    global default_inventory
+    if default_inventory is None and os.environ.get('EUTESTER_INVENTORY'):
+        default_inventory = ResourceInventory(os.environ['EUTESTER_INVENTORY'])
+    return default_inventory
+
+
+class ResourceInventory():
+    def __init__(self, path=None, run_id=None, debugmethod=None, heartbeat_interval=60):
+        """
+        :param path: path of the sqlite inventory file, defaults to $EUTESTER_INVENTORY or
+                     ~/.eutester/inventory.db
+        :param run_id: id of this run, a new one is generated if not given
+        :param debugmethod: method used for logging
+        :param heartbeat_interval: seconds between heartbeats written by the background thread while this run
+                                   is registered, must be well under the reaper's stale_after
+        """
+        self.path = path or os.environ.get('EUTESTER_INVENTORY') or \
+                    os.path.join(os.path.expanduser('~'), '.eutester', 'inventory.db')
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.run_id = run_id or socket.gethostname() + '-' + str(os.getpid()) + '-' + uuid.uuid4().hex[:8]
+        self.debugmethod = debugmethod
+        self.lock = threading.Lock()
+        self.registered = False
+        self.last_heartbeat = 0
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread = None
+        #Shared by several processes, wait on each other's writes rather than failing
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, host TEXT, pid INTEGER, '
+                        'started REAL, heartbeat REAL, status TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS resources (run_id TEXT, rtype TEXT, rid TEXT, endpoint TEXT, '
+                        'access_key TEXT, created REAL, PRIMARY KEY (run_id, rtype, rid))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS resources_rtype ON resources (rtype, rid)')
+
+    def debug(self, msg):
+        if self.debugmethod:
+            self.debugmethod(msg)
+
+    def execute(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def register_run(self):
+        """
+        Record this run as running, and as finished when the process exits
+        """
+        if self.registered:
+            return
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                     (self.run_id, socket.gethostname(), os.getpid(), now, now, 'running'))
+        self.registered = True
+        self.last_heartbeat = now
+        atexit.register(self.finish_run)
+        #Keep the heartbeat current while the run is alive, whether or not it is creating resources
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='inventory-heartbeat')
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        while not self.heartbeat_stop.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat(min_interval=0)
+            except sqlite3.Error, e:
+                self.debug('Failed to write inventory heartbeat for run:' + str(self.run_id) + ', err:' + str(e))
+
+    def heartbeat(self, min_interval=60):
+        now = time.time()
+        if now - self.last_heartbeat >= min_interval:
+            self.last_heartbeat = now
+            self.execute('UPDATE runs SET heartbeat=? WHERE run_id=?', (now, self.run_id))
+
+    def finish_run(self):
+        """
+        Mark this run finished. Anything it still has in the inventory is then an orphan.
+        """
+        self.heartbeat_stop.set()
+        try:
+            self.execute('UPDATE runs SET status=?, heartbeat=? WHERE run_id=?', ('finished', time.time(), self.run_id))
+        except sqlite3.Error:
+            pass
+
+    def add(self, records, endpoint=None, access_key=None):
+        """
+        :param records: list of (resource type, resource id)
+        """
+        if not records:
+            return
+        self.register_run()
+        now = time.time()
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?)',
+                                [(self.run_id, rtype, rid, endpoint, access_key, now) for rtype, rid in records])
+        self.heartbeat()
+
+    def remove(self, records, run_id=None):
+        """
+        :param records: list of (resource type, resource id)
+        :param run_id: run to remove the records from, defaults to this run
+        """
+        if not records:
+            return
+        with self.lock:
+            self.db.executemany('DELETE FROM resources WHERE run_id=? AND rtype=? AND rid=?',
+                                [(run_id or self.run_id, rtype, rid) for rtype, rid in records])
+        if self.registered:
+            self.heartbeat()
+
+    def get_resources(self, run_ids=None):
+        """
+        :return: list of (run_id, rtype, rid, endpoint, access_key, created) rows
+        """
+        if run_ids is None:
+            return self.execute('SELECT * FROM resources ORDER BY created')
+        rows = []
+        for run_id in run_ids:
+            rows.extend(self.execute('SELECT * FROM resources WHERE run_id=? ORDER BY created', (run_id,)))
+        return rows
+
+    @classmethod
+    def is_pid_alive(cls, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+
+    def get_dead_runs(self, stale_after=6 * 3600):
+        """
+        Returns the ids of runs which have finished, whose process no longer exists on this host, or whose heartbeat
+        is older than stale_after seconds. Registered runs refresh their heartbeat every heartbeat_interval seconds
+        from a background thread, so a stale heartbeat means the process is gone or hung, not just idle.
+        Never includes this run.
+        """
+        host = socket.gethostname()
+        now = time.time()
+        dead = []
+        for run_id, run_host, pid, started, heartbeat, status in self.execute('SELECT * FROM runs'):
+            if run_id == self.run_id:
+                continue
+            if (status == 'finished' or (run_host == host and not self.is_pid_alive(pid)) or
+                    now - (heartbeat or started or 0) > stale_after):
+                dead.append(run_id)
+        return dead
+
+    def prune_runs(self, run_ids=None):
+        """
+        Removes finished runs, and the given (dead) runs, which have no resources left
+        """
+        self.execute("DELETE FROM runs WHERE status='finished' AND run_id NOT IN (SELECT DISTINCT run_id FROM resources)")
+        for run_id in run_ids or []:
+            self.execute("DELETE FROM runs WHERE run_id=? AND run_id NOT IN (SELECT DISTINCT run_id FROM resources)",
+                         (run_id,))
+
+
+class TrackedResourceList(list):
+    """
+    A test_resources list which records resources in the inventory as they are added and removed
+    """
+    def __init__(self, tracker, key, items=None):
+        list.__init__(self, items or [])
+        self.tracker = tracker
+        self.key = key
+
+    def append(self, item):
+        list.append(self, item)
+        self.tracker.record_added(self.key, [item])
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self.tracker.record_added(self.key, [item])
+
+    def extend(self, items):
+        items = list(items)
+        list.extend(self, items)
+        self.tracker.record_added(self.key, items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def remove(self, item):
+        list.remove(self, item)
+        self.tracker.record_removed(self.key, [item], remaining=self)
+
+    def pop(self, *args):
+        item = list.pop(self, *args)
+        self.tracker.record_removed(self.key, [item], remaining=self)
+        return item
+
+    def __delitem__(self, index):
+        removed = self[index]
+        list.__delitem__(self, index)
+        if not isinstance(index, slice):
+            removed = [removed]
+        self.tracker.record_removed(self.key, removed, remaining=self)
+
+    def __delslice__(self, start, end):
+        self.__delitem__(slice(start, end))
+
+    def __setitem__(self, index, value):
+        old = self[index]
+        list.__setitem__(self, index, value)
+        if not isinstance(index, slice):
+            old, value = [old], [value]
+        self.tracker.record_removed(self.key, old, remaining=self)
+        self.tracker.record_added(self.key, value)
+
+    def __setslice__(self, start, end, values):
+        self.__setitem__(slice(start, end), list(values))
+
+
+class TrackedResources(dict):
+    """
+    test_resources dict whose lists are TrackedResourceLists recording to a ResourceInventory
+    """
+    def __init__(self, tester, inventory, items=None):
+        dict.__init__(self)
+        self.tester = tester
+        self.inventory = inventory
+        for key, value in (items or {}).iteritems():
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        old = dict.get(self, key)
+        if isinstance(value, list) and not (isinstance(value, TrackedResourceList) and value.tracker is self):
+            value = TrackedResourceList(self, key, value)
+            self.record_added(key, value)
+        dict.__setitem__(self, key, value)
+        if old:
+            self.record_removed(key, [item for item in old if item not in value], remaining=value)
+
+    def __delitem__(self, key):
+        old = dict.get(self, key)
+        dict.__delitem__(self, key)
+        if old:
+            self.record_removed(key, old)
+
+    def record_added(self, key, items):
+        records = []
+        for item in items:
+            records.extend(get_resource_records(key, item))
+        try:
+            self.inventory.add(records, endpoint=get_endpoint(self.tester, key),
+                               access_key=getattr(self.tester, 'aws_access_key_id', None))
+        except sqlite3.Error, e:
+            self.tester.debug('Failed to record resources in inventory:' + str(e))
+
+    def record_removed(self, key, items, remaining=None):
+        records = []
+        for item in items:
+            #The same resource may be listed more than once, keep it until the last is removed
+            if remaining and item in remaining:
+                continue
+            records.extend(get_resource_records(key, item))
+        try:
+            self.inventory.remove(records)
+        except sqlite3.Error, e:
+            self.tester.debug('Failed to remove resources from inventory:' + str(e))
+
+
+class OrphanReaper():
+    def __init__(self, tester, inventory, stale_after=6 * 3600, run_ids=None, deadline=1800, concurrency=20,
+                 debugmethod=None):
+        """
+        :param tester: eutester obj with connections to the cloud the orphans were created on, ie Eucaops
+        :param inventory: ResourceInventory to reap orphans from
+        :param stale_after: seconds without a heartbeat after which a run is considered dead
+        :param run_ids: list of run ids to reap, defaults to all dead runs
+        :param deadline: seconds allowed for the teardown
+        :param concurrency: max number of delete requests in flight
+        :param debugmethod: method used for logging, defaults to tester.debug
+        """
+        self.tester = tester
+        self.inventory = inventory
+        self.stale_after = stale_after
+        self.run_ids = run_ids
+        self.deadline = deadline
+        self.concurrency = concurrency
+        self.debugmethod = debugmethod or tester.debug
+
+    def debug(self, msg):
+        self.debugmethod(msg)
+
+    def get_run_ids(self):
+        if self.run_ids is not None:
+            return self.run_ids
+        return self.inventory.get_dead_runs(stale_after=self.stale_after)
+
+    def get_orphans(self, run_ids=None):
+        """
+        Returns inventory rows of dead runs' resources which belong to the cloud and account the tester is using
+        """
+        if run_ids is None:
+            run_ids = self.get_run_ids()
+        orphans = []
+        access_key = getattr(self.tester, 'aws_access_key_id', None)
+        for row in self.inventory.get_resources(run_ids):
+            run_id, rtype, rid, endpoint, row_access_key, created = row
+            key = self.get_key(rtype)
+            if endpoint and endpoint != get_endpoint(self.tester, key):
+                continue
+            if row_access_key and access_key and row_access_key != access_key:
+                continue
+            orphans.append(row)
+        return orphans
+
+    @classmethod
+    def get_key(cls, rtype):
+        for key, (key_type, service) in resource_types.iteritems():
+            if key_type == rtype:
+                return key
+        return rtype
+
+    def show_orphans(self, orphans=None, printmethod=None):
+        printmethod = printmethod or self.debug
+        orphans = self.get_orphans() if orphans is None else orphans
+        buf = 'RUN ID'.ljust(40) + 'TYPE'.ljust(16) + 'ID'.ljust(40) + 'CREATED\n'
+        for run_id, rtype, rid, endpoint, access_key, created in orphans:
+            buf += str(run_id).ljust(40) + str(rtype).ljust(16) + str(rid).ljust(40) + \
+                   time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)) + '\n'
+        buf += str(len(orphans)) + ' orphaned resources\n'
+        printmethod(buf)
+        return buf
+
+    def _chunks(self, ids, size=200):
+        return [ids[index:index + size] for index in xrange(0, len(ids), size)]
+
+    def lookup(self, rtype, ids):
+        """
+        Looks up the resources which still exist on the cloud, in batches where the api allows
+        :return: dict of resource id to resource object
+        """
+        ec2 = getattr(self.tester, 'ec2', None)
+        found = {}
+        if rtype == 'instance':
+            for chunk in self._chunks(ids):
+                for reservation in ec2.get_all_instances(filters={'instance-id': chunk}):
+                    for instance in reservation.instances:
+                        if instance.state != 'terminated':
+                            found[instance.id] = instance
+        elif rtype == 'volume':
+            for chunk in self._chunks(ids):
+                for volume in ec2.get_all_volumes(filters={'volume-id': chunk}):
+                    found[volume.id] = volume
+        elif rtype == 'snapshot':
+            for chunk in self._chunks(ids):
+                for snapshot in ec2.get_all_snapshots(filters={'snapshot-id': chunk}):
+                    found[snapshot.id] = snapshot
+        elif rtype == 'image':
+            for chunk in self._chunks(ids):
+                for image in ec2.get_all_images(filters={'image-id': chunk}):
+                    found[image.id] = image
+        elif rtype == 'keypair':
+            for chunk in self._chunks(ids):
+                for keypair in ec2.get_all_key_pairs(filters={'key-name': chunk}):
+                    found[keypair.name] = keypair
+        elif rtype == 'security-group':
+            for chunk in self._chunks(ids):
+                for group in ec2.get_all_security_groups(filters={'group-id': chunk}):
+                    found[group.id] = group
+        elif rtype == 'bucket':
+            for name in ids:
+                bucket = self.tester.s3.lookup(name)
+                if bucket:
+                    found[name] = bucket
+        elif rtype == 'key':
+            buckets = {}
+            for rid in ids:
+                bucket_name, key_name = rid.split('/', 1)
+                if bucket_name not in buckets:
+                    buckets[bucket_name] = self.tester.s3.lookup(bucket_name)
+                if buckets[bucket_name]:
+                    key = buckets[bucket_name].get_key(key_name)
+                    if key:
+                        found[rid] = key
+        elif rtype == 'load_balancer':
+            for name in ids:
+                try:
+                    found[name] = self.tester.elb.get_all_load_balancers(load_balancer_names=[name])[0]
+                except BotoServerError, e:
+                    if not TeardownEngine.is_not_found(e) and e.error_code != 'LoadBalancerNotFound':
+                        raise
+        elif rtype == 'alarm':
+            for chunk in self._chunks(ids, 100):
+                for alarm in self.tester.cw.describe_alarms(alarm_names=chunk):
+                    found[alarm.name] = alarm
+        else:
+            raise Exception('OrphanReaper does not know how to look up resource type:' + str(rtype))
+        return found
+
+    def reap(self, dry_run=False):
+        """
+        Deletes the orphaned resources still on the cloud and drops all reaped rows from the inventory
+        :return: list of error strings
+        """
+        run_ids = self.get_run_ids()
+        orphans = self.get_orphans(run_ids)
+        self.show_orphans(orphans)
+        if dry_run:
+            return []
+        if not orphans:
+            self.inventory.prune_runs(run_ids)
+            return []
+        by_type = {}
+        for row in orphans:
+            by_type.setdefault(row[1], []).append(row)
+        resources = {}
+        rows_for = {}
+        errors = []
+        for rtype, rows in by_type.iteritems():
+            try:
+                found = self.lookup(rtype, list(set([row[2] for row in rows])))
+            except Exception, e:
+                errors.append('Could not look up ' + str(rtype) + ' orphans:' + str(e))
+                continue
+            key = self.get_key(rtype)
+            items = resources.setdefault(key, [])
+            for row in rows:
+                item = found.get(row[2])
+                if item is None:
+                    #No longer exists, nothing to delete
+                    self.inventory.remove([(rtype, row[2])], run_id=row[0])
+                    continue
+                rows_for.setdefault((rtype, row[2]), []).append(row)
+                if item not in items:
+                    items.append(item)
+        self.debug('Reaping ' + str(len(rows_for)) + ' orphaned resources which still exist')
+        #Tear down a plain dict rather than the tester's test_resources, so the reaper's own run doesn't track them
+        engine = TeardownEngine(self.tester, deadline=self.deadline, concurrency=self.concurrency,
+                                resources=resources, debugmethod=self.debugmethod)
+        errors.extend(engine.run())
+        engine.show_summary()
+        remaining = set()
+        for key, items in resources.iteritems():
+            for item in items:
+                remaining.update(get_resource_records(key, item))
+        for record, rows in rows_for.iteritems():
+            if record in remaining:
+                continue
+            for row in rows:
+                self.inventory.remove([record], run_id=row[0])
+        self.inventory.prune_runs(run_ids)
+        return errors
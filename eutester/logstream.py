@@ -0,0 +1,349 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Streaming log capture for remote log files.
+
+Each LogStream tails a single remote file on its own ssh channel. Captured bytes are written straight to a
+bounded sink, either a set of size rotated local files (LogRotatingFile) or an in memory ring buffer
+(LogRingBuffer), so memory use stays constant no matter how long the capture runs.
+Regex watchers are checked against each complete line as it arrives and fire a callback on a match.
+Markers record a position in the stream, and the text between two markers can be sliced back out of the sink.
+By default a marker is also echoed into the remote log itself (like euservice.log_marker), so its position
+in the stream is exact.
+
+example usage:
+    stream = LogStream(clc, '/var/log/eucalyptus/cloud-output.log', local_path='logs/cloud-output.log')
+    stream.add_watcher('ERROR|Exception', lambda line, match: errors.append(line))
+    stream.start()
+    start = stream.mark()
+    ...run test...
+    end = stream.mark()
+    test_log = stream.get_slice(start, end)
+    stream.stop()
+'''
+import os
+import re
+import select
+import threading
+import time
+from collections import deque
+
+
+class LogRingBuffer():
+    '''
+    Keeps the last 'max_bytes' of a stream in memory
+    '''
+    def __init__(self, max_bytes=10485760):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.start_offset = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.max_bytes:
+            dropped = self.chunks.popleft()
+            self.size -= len(dropped)
+            self.start_offset += len(dropped)
+
+    def read(self, start, end):
+        '''
+        Returns the retained bytes between stream offsets start and end
+        '''
+        start = max(start, self.start_offset)
+        if end <= start:
+            return ''
+        return ''.join(self.chunks)[start - self.start_offset:end - self.start_offset]
+
+    def close(self):
+        return
+
+
+class LogRotatingFile():
+    '''
+    Writes a stream to a local file, rotating it to path.1 ... path.<backup_count> every 'max_bytes'
+    '''
+    def __init__(self, path, max_bytes=104857600, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.file = open(path, 'wb')
+        self.size = 0
+        # Stream offset of the start of each retained file, current file first then path.1, path.2...
+        self.segments = [0]
+
+    @property
+    def start_offset(self):
+        return self.segments[-1]
+
+    def get_segment_path(self, index):
+        if index == 0:
+            return self.path
+        return self.path + '.' + str(index)
+
+    def rotate(self):
+        self.file.close()
+        if len(self.segments) > self.backup_count:
+            os.remove(self.get_segment_path(len(self.segments) - 1))
+            self.segments.pop()
+        for index in xrange(len(self.segments) - 1, -1, -1):
+            os.rename(self.get_segment_path(index), self.get_segment_path(index + 1))
+        self.segments.insert(0, self.segments[0] + self.size)
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def read(self, start, end):
+        '''
+        Returns the retained bytes between stream offsets start and end
+        '''
+        buf = []
+        for index in xrange(len(self.segments) - 1, -1, -1):
+            seg_start = self.segments[index]
+            seg_end = self.segments[index - 1] if index else self.segments[0] + self.size
+            if seg_end <= start or seg_start >= end:
+                continue
+            with open(self.get_segment_path(index), 'rb') as segment:
+                segment.seek(max(start - seg_start, 0))
+                buf.append(segment.read(min(end, seg_end) - max(start, seg_start)))
+        return ''.join(buf)
+
+    def close(self):
+        self.file.close()
+
+
+class LogWatcher():
+    def __init__(self, regex, callback, once=False):
+        '''
+        :param regex: regex string or compiled pattern searched for in each line
+        :param callback: method called as callback(line, match) for each matching line
+        :param once: remove the watcher after its first match
+        '''
+        if isinstance(regex, basestring):
+            regex = re.compile(regex)
+        self.regex = regex
+        self.callback = callback
+        self.once = once
+        self.matches = 0
+        # Stream offset of the start of the last matching line
+        self.line_offset = None
+
+
+class LogStream():
+    def __init__(self,
+                 machine,
+                 log_file,
+                 local_path=None,
+                 max_bytes=104857600,
+                 backup_count=5,
+                 ring_size=10485760,
+                 max_line=65536,
+                 debugmethod=None):
+        '''
+        :param machine: eutester Machine obj with an ssh connection to the host of log_file
+        :param log_file: path of the remote log file to capture
+        :param local_path: local file to write the capture to, rotated every max_bytes. If None the capture is
+                           kept in a ring buffer of ring_size bytes instead.
+        :param max_bytes: size at which the local file is rotated
+        :param backup_count: number of rotated local files to keep
+        :param ring_size: bytes kept in memory when local_path is not given
+        :param max_line: lines longer than this are checked by watchers in pieces
+        :param debugmethod: method used for logging, defaults to machine.debug
+        '''
+        self.machine = machine
+        self.log_file = log_file
+        if local_path:
+            self.sink = LogRotatingFile(local_path, max_bytes=max_bytes, backup_count=backup_count)
+        else:
+            self.sink = LogRingBuffer(max_bytes=ring_size)
+        self.max_line = max_line
+        self.debugmethod = debugmethod or machine.debug
+        self.watchers = []
+        self.markers = {}
+        self.offset = 0
+        self.partial = ''
+        self.lock = threading.Lock()
+        self.active = False
+        self.channel = None
+        self.transport = None
+        self.thread = None
+
+    def debug(self, msg):
+        self.debugmethod(msg)
+
+    def add_watcher(self, regex, callback, once=False):
+        '''
+        Call callback(line, match) from the capture thread for each captured line matching regex
+        '''
+        watcher = LogWatcher(regex, callback, once=once)
+        with self.lock:
+            self.watchers.append(watcher)
+        return watcher
+
+    def remove_watcher(self, watcher):
+        with self.lock:
+            if watcher in self.watchers:
+                self.watchers.remove(watcher)
+
+    def start(self):
+        if self.active:
+            return
+        # Lease the channel from the ssh transport pool so it counts against the per host channel cap
+        self.transport = self.machine.ssh.connection.get_transport()
+        self.channel = self.machine.ssh.open_session(self.transport)
+        try:
+            # tail exits when the channel is closed, since closing the channel ends the stdin of 'cat'
+            self.channel.exec_command('tail -n0 -F ' + self.log_file + ' 2>/dev/null & TAILPID=$!; '
+                                      'cat > /dev/null; kill $TAILPID')
+        except:
+            self.release_channel()
+            raise
+        self.active = True
+        self.thread = threading.Thread(target=self.poll, name='LogStream:' + str(self.log_file))
+        self.thread.daemon = True
+        self.thread.start()
+        self.debug("Started log capture of " + str(self.machine.hostname) + ":" + str(self.log_file))
+
+    def poll(self):
+        while self.active:
+            rl, wl, xl = select.select([self.channel], [], [], 1)
+            if not rl:
+                continue
+            data = self.channel.recv(65536)
+            if not data:
+                self.debug("Log capture channel closed for " + str(self.log_file))
+                self.active = False
+                break
+            self.handle_data(data)
+
+    def handle_data(self, data):
+        with self.lock:
+            start = self.offset - len(self.partial)
+            self.sink.write(data)
+            self.offset += len(data)
+            watchers = list(self.watchers)
+        if not watchers:
+            self.partial = ''
+            return
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        if len(self.partial) > self.max_line:
+            lines.append(self.partial)
+            self.partial = ''
+        for line in lines:
+            for watcher in watchers:
+                match = watcher.regex.search(line)
+                if not match:
+                    continue
+                watcher.matches += 1
+                watcher.line_offset = start
+                if watcher.once:
+                    self.remove_watcher(watcher)
+                try:
+                    watcher.callback(line, match)
+                except Exception, e:
+                    self.debug("Log watcher callback for '" + str(watcher.regex.pattern) + "' failed:" + str(e))
+            start += len(line) + 1
+
+    def mark(self, marker=None, inject=True, timeout=30):
+        '''
+        Record the current position in the stream under the name 'marker'.
+        If inject is True the marker is echoed into the remote log and its position is recorded when
+        the marker line is captured, otherwise the position is the number of bytes captured so far.
+        Returns the marker name
+        '''
+        marker = marker or "eutester_marker:" + str(time.time()) + str(self.machine.hostname)
+        if not inject or not self.active:
+            with self.lock:
+                self.markers[marker] = self.offset
+            return marker
+        seen = threading.Event()
+        watcher = self.add_watcher(re.escape(marker), lambda line, match: seen.set(), once=True)
+        self.machine.sys("echo '" + marker + "' >> " + self.log_file, code=0, verbose=False)
+        seen.wait(timeout)
+        with self.lock:
+            if seen.is_set():
+                self.markers[marker] = watcher.line_offset
+            else:
+                self.debug("Marker " + marker + " not seen in capture of " + str(self.log_file) + " after " +
+                           str(timeout) + " seconds, using current position")
+                self.markers[marker] = self.offset
+        self.remove_watcher(watcher)
+        return marker
+
+    def get_slice(self, start_marker=None, end_marker=None):
+        '''
+        Returns the captured text between two markers. A start marker of None starts from the oldest retained
+        data, an end marker of None ends at the latest captured data.
+        '''
+        with self.lock:
+            start = self.sink.start_offset
+            if start_marker:
+                start = self.markers[start_marker]
+            end = self.offset
+            if end_marker:
+                end = self.markers[end_marker]
+            if start < self.sink.start_offset:
+                self.debug("Start of slice has been rotated out of the capture of " + str(self.log_file))
+            return self.sink.read(start, end)
+
+    def get_value(self):
+        return self.get_slice()
+
+    def stop(self):
+        self.active = False
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(5)
+        self.release_channel()
+        with self.lock:
+            if isinstance(self.sink, LogRotatingFile):
+                self.sink.file.flush()
+        self.debug("Stopped log capture of " + str(self.machine.hostname) + ":" + str(self.log_file))
+
+    def release_channel(self):
+        if self.channel:
+            self.channel.close()
+            self.channel = None
+            self.machine.ssh.release_session(self.transport)
+            self.transport = None
+
+    def close(self):
+        self.stop()
+        self.sink.close()
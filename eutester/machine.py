@@ -29,13 +29,14 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 # Author: vic.iglesias@eucalyptus.com
-import select
 import threading
 import time
 import eulogger
 from eutester import Eutester
 from eutester.euconfig import EuConfig
 import sshconnection
+from transfer import FileTransfer
+from logstream import LogStream
 import re
 import os
 import sys
@@ -81,6 +82,9 @@ class Distro:
     
 
 class Machine:
+    #Attributes which trigger the ssh connection of a lazily connected machine on first access
+    lazy_connect_attrs = ['ssh', 'sftp', 'config', 'eucalyptus_conf']
+
     def __init__(self, 
                  hostname, 
                  distro="", 
@@ -95,8 +99,15 @@ class Machine:
                  timeout=120,
                  retry=2,
                  debugmethod=None, 
-                 verbose = True ):
-        
+                 verbose = True,
+                 lazy = False):
+        """
+        connect - optional - boolean, create an ssh connection to this machine
+        lazy - optional - boolean, if connect is set, defer the ssh connection until the first time
+               ssh/sftp is used, or connect_ssh() is called
+        """
+        self._connect_lock = threading.Lock()
+        self._connected = False
         self.hostname = hostname
         self.distro_ver = distro_ver
         self.distro = self.convert_to_distro(distro, distro_ver)
@@ -115,25 +126,45 @@ class Machine:
         self.debugmethod = debugmethod
         self.verbose = verbose
         self.log_threads = {}
-        self.log_buffers = {}
-        self.log_active = {}
+        self.log_streams = {}
         self.wget_last_status = 0
         if self.debugmethod is None:
             logger = eulogger.Eulogger(identifier= str(hostname) + ":" + str(components))
             self.debugmethod = logger.log.debug
-        if self.connect:
-            self.ssh = sshconnection.SshConnection( hostname, 
-                                                    keypath=keypath,          
-                                                    password=password, 
-                                                    username=username, 
-                                                    timeout=timeout, 
-                                                    retry=retry,
+        if self.connect and not lazy:
+            self.connect_ssh()
+        elif not self.connect:
+            self.get_eucalyptus_conf()
+
+    def connect_ssh(self):
+        """
+        Create the ssh and sftp connections to this machine, if not already connected
+        """
+        with self._connect_lock:
+            if self._connected:
+                return
+            self.ssh = sshconnection.SshConnection( self.hostname,
+                                                    keypath=self.keypath,
+                                                    password=self.password,
+                                                    username=self.username,
+                                                    timeout=self.timeout,
+                                                    retry=self.retry,
                                                     debugmethod=self.debugmethod,
                                                     verbose=True)
             self.sftp = self.ssh.connection.open_sftp()
+            self._connected = True
         # If we were given a conf file, and have an ssh/sftp session, attempt to populate eucalyptus_conf into
         # a euconfig object for this machine...
         self.get_eucalyptus_conf()
+
+    def __getattr__(self, name):
+        # Only called for attributes not yet set, ie ssh/sftp of a machine created with lazy=True
+        if name in Machine.lazy_connect_attrs and self.__dict__.get('connect') and \
+                not self.__dict__.get('_connected'):
+            self.connect_ssh()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
             
     def convert_to_distro(self, distro_name, distro_release):
         distro_name = distro_name.lower()
@@ -425,6 +456,38 @@ class Machine:
     def get_file_size(self, path):
         return self.sftp.lstat(path).st_size
     
+    def put_file(self, localpath, remotepath, **kwargs):
+        """
+        Copy a local file to this machine with parallel, resumable and verified transfer
+        :param localpath: path of the file on the local host
+        :param remotepath: path to write on this machine
+        :param kwargs: FileTransfer options, ie: streams, chunk_size, resume, verify
+        :returns: dict of transfer stats, see FileTransfer.transfer()
+        """
+        return FileTransfer(debugmethod=self.debug, **kwargs).put(self, localpath, remotepath)
+
+    def get_file(self, remotepath, localpath, **kwargs):
+        """
+        Copy a file from this machine to the local host with parallel, resumable and verified transfer
+        :param remotepath: path of the file on this machine
+        :param localpath: path to write on the local host
+        :param kwargs: FileTransfer options, ie: streams, chunk_size, resume, verify
+        :returns: dict of transfer stats, see FileTransfer.transfer()
+        """
+        return FileTransfer(debugmethod=self.debug, **kwargs).get(self, remotepath, localpath)
+
+    def copy_file_to(self, machines, path, destpath=None, **kwargs):
+        """
+        Copy a file from this machine directly to one or more other machines. Data is streamed through memory
+        on the local host, the source is read once regardless of the number of destinations.
+        :param machines: Machine obj or list of Machine objs to copy to
+        :param path: path of the file on this machine
+        :param destpath: path to write on the destination machines, defaults to path
+        :param kwargs: FileTransfer options, ie: streams, chunk_size, resume, verify
+        :returns: dict of transfer stats, see FileTransfer.transfer()
+        """
+        return FileTransfer(debugmethod=self.debug, **kwargs).copy(self, path, machines, destpath)
+
     def get_file_perms_flag(self,path):
         return self.sftp.lstat(path).FLAG_PERMISSIONS 
     
@@ -613,39 +676,65 @@ class Machine:
         return size/unit
     
     def poll_log(self, log_file="/var/log/messages"):
-        self.debug( "Starting to poll " + log_file )     
-        self.log_channel = self.ssh.connection.invoke_shell()
-        self.log_channel.send("tail -f " + log_file + " \n")
-        ### Begin polling channel for any new data
-        while self.log_active[log_file]:
-            ### CLOUD LOG
-            rl, wl, xl = select.select([self.log_channel],[],[],0.0)
-            if len(rl) > 0:
-                self.log_buffers[log_file] += self.log_channel.recv(1024)
-            time.sleep(1)
+        """
+        Kept for compatibility, does nothing. Capture now runs in the LogStream thread started by start_log(),
+        a second reader on its channel would interleave the captured log.
+        """
+        return None
     
-    def start_log(self, log_file="/var/log/messages"):
-        """Start thread to poll logs"""
-        thread = threading.Thread(target=self.poll_log, args=log_file)
-        thread.daemon = True
-        self.log_threads[log_file]= thread.start()
-        self.log_active[log_file] = True
+    def start_log(self, log_file="/var/log/messages", local_path=None, max_bytes=104857600, backup_count=5,
+                  ring_size=10485760):
+        """
+        Start capturing log_file on its own ssh channel and thread.
+        log_file - remote log file to capture
+        local_path - optional - local file to write the capture to, rotated every max_bytes keeping backup_count
+                     files. If not given the last ring_size bytes are kept in memory.
+        Returns the LogStream obj
+        """
+        stream = self.log_streams.get(log_file)
+        if stream and stream.active:
+            return stream
+        stream = LogStream(self, log_file, local_path=local_path, max_bytes=max_bytes, backup_count=backup_count,
+                           ring_size=ring_size, debugmethod=self.debugmethod)
+        self.log_streams[log_file] = stream
+        stream.start()
+        self.log_threads[log_file] = stream.thread
+        return stream
         
     def stop_log(self, log_file="/var/log/messages"):
         """Terminate thread that is polling logs"""
-        self.log_active[log_file] = False
+        if log_file in self.log_streams:
+            self.log_streams[log_file].stop()
+
+    def add_log_watcher(self, log_file, regex, callback, once=False):
+        """
+        Call callback(line, match) for every captured line of log_file matching regex
+        """
+        return self.log_streams[log_file].add_watcher(regex, callback, once=once)
+
+    def mark_log(self, log_file, marker=None, inject=True):
+        """
+        Mark the current position in the capture of log_file, returns the marker name for get_log_slice()
+        """
+        return self.log_streams[log_file].mark(marker=marker, inject=inject)
+
+    def get_log_slice(self, log_file, start_marker=None, end_marker=None):
+        """
+        Returns the captured text of log_file between two markers returned by mark_log()
+        """
+        return self.log_streams[log_file].get_slice(start_marker, end_marker)
         
-    def save_log(self, log_file, path="logs"):
-        """Save log buffer for log_file to the path to a file"""
+    def save_log(self, log_file, path="logs", start_marker=None, end_marker=None):
+        """Save captured log_file, or the slice between two markers, to a file in path"""
         if not os.path.exists(path):
             os.mkdir(path)
-        FILE = open( path + '/' + log_file,"w")
-        FILE.writelines(self.log_buffers[log_file])
+        FILE = open( path + '/' + os.path.basename(log_file),"w")
+        FILE.write(self.get_log_slice(log_file, start_marker, end_marker))
         FILE.close()
         
     def save_all_logs(self, path="logs"):
-        """Save log buffers to a file"""
-        for log_file in self.log_buffers.keys():
+        """Save log captures to files"""
+        for log_file in self.log_streams.keys():
             self.save_log(log_file,path)
 
     def get_eucalyptus_conf(self,eof=False,verbose=False):
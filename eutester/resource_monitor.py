@@ -0,0 +1,221 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Batched, filter based state monitor for instances, volumes and snapshots.
+
+Instead of calling update() on every resource each poll cycle (one DescribeX request per resource), a
+ResourceStateMonitor issues one batched get_all_instances/get_all_volumes/get_all_snapshots request per resource
+type with an id filter, and fans the results back out to the (Eu)Instance, (Eu)Volume and (Eu)Snapshot objects.
+Each resource is polled on its own adaptive interval; resources which change state are polled again quickly,
+resources which do not are backed off up to max_interval. Only state changes are logged.
+
+example usage:
+    monitor = ResourceStateMonitor(tester, max_interval=10)
+    while pending:
+        monitor.update(pending)
+        pending = [vol for vol in pending if vol.status != 'available']
+        monitor.wait(pending)
+'''
+import time
+from boto.ec2.instance import Instance
+from boto.ec2.volume import Volume
+from boto.ec2.snapshot import Snapshot
+from boto.exception import EC2ResponseError
+from eutester.tracing import traced
+
+
+class ResourceStateMonitor():
+    #Error codes returned by the cloud when requests are being throttled
+    throttle_codes = ['RequestLimitExceeded', 'Throttling']
+
+    def __init__(self,
+                 tester,
+                 min_interval=2,
+                 max_interval=10,
+                 backoff=1.5,
+                 max_ids_per_request=200,
+                 debugmethod=None):
+        """
+        :param tester: eutester obj with an ec2 connection, ie EC2ops/Eucaops
+        :param min_interval: seconds between polls of a resource which has just changed state
+        :param max_interval: max seconds between polls of a resource whose state is not changing
+        :param backoff: multiplier applied to a resource's poll interval each time its state is found unchanged
+        :param max_ids_per_request: max ids sent in a single describe request's id filter
+        :param debugmethod: method used to log state changes, defaults to tester.debug
+        """
+        self.tester = tester
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_ids_per_request = max_ids_per_request
+        self.debugmethod = debugmethod or tester.debug
+        self.start = time.time()
+        self.intervals = {}
+        self.next_poll = {}
+        self.states = {}
+        self.api_calls = 0
+        self.throttled = 0
+
+    def debug(self, msg):
+        self.debugmethod(msg)
+
+    @classmethod
+    def get_resource_type(cls, resource):
+        if isinstance(resource, Instance):
+            return 'instance'
+        if isinstance(resource, Volume):
+            return 'volume'
+        if isinstance(resource, Snapshot):
+            return 'snapshot'
+        raise Exception('ResourceStateMonitor unsupported resource type:' + str(type(resource)))
+
+    @classmethod
+    def get_state(cls, resource):
+        """
+        Returns the string used to detect state changes of a resource
+        """
+        rtype = cls.get_resource_type(resource)
+        if rtype == 'instance':
+            return str(resource.state)
+        if rtype == 'volume':
+            attach_status = None
+            if resource.attach_data:
+                attach_status = resource.attach_data.status
+            return str(resource.status) + "/" + str(attach_status)
+        return str(resource.status) + ":" + str(resource.progress)
+
+    def describe(self, rtype, ids):
+        """
+        Issue batched describe requests for 'ids' of type 'rtype'
+        :return: dict of boto objs keyed by resource id. Ids not returned by the cloud are absent.
+        """
+        ec2 = self.tester.ec2
+        found = {}
+        for index in xrange(0, len(ids), self.max_ids_per_request):
+            chunk = ids[index:index + self.max_ids_per_request]
+            self.api_calls += 1
+            if rtype == 'instance':
+                for reservation in ec2.get_all_instances(filters={'instance-id': chunk}):
+                    for instance in reservation.instances:
+                        found[instance.id] = instance
+            elif rtype == 'volume':
+                for volume in ec2.get_all_volumes(filters={'volume-id': chunk}):
+                    found[volume.id] = volume
+            else:
+                for snapshot in ec2.get_all_snapshots(filters={'snapshot-id': chunk}):
+                    found[snapshot.id] = snapshot
+        return found
+
+    def update(self, resources, force=False):
+        """
+        Refresh the resources which are due to be polled, using one batched describe request per resource type.
+        Resources no longer returned by the cloud are marked 'deleted' (volumes, snapshots) or 'terminated'
+        (instances).
+        :param resources: list of boto/eutester instances, volumes and/or snapshots
+        :param force: boolean, refresh all resources regardless of their poll interval
+        :return: list of resources whose state changed in this update
+        """
+        now = time.time()
+        changed = []
+        by_type = {}
+        for resource in resources:
+            if force or self.next_poll.get(resource.id, 0) <= now:
+                by_type.setdefault(self.get_resource_type(resource), []).append(resource)
+        for rtype, due in by_type.iteritems():
+            try:
+                found = self.describe(rtype, list(set([resource.id for resource in due])))
+            except EC2ResponseError, ee:
+                if ee.error_code not in self.throttle_codes:
+                    raise
+                #Back off every resource of this type, retry on the next update
+                self.throttled += 1
+                self.debug('ResourceStateMonitor: ' + str(rtype) + ' describe throttled, backing off. Err:' + str(ee))
+                for resource in due:
+                    self._set_next_poll(resource, changed=False, throttled=True)
+                continue
+            for resource in due:
+                new = found.get(resource.id)
+                if new:
+                    resource._update(new)
+                    #Same side effects as the eutester objects' own update(), ie EuVolume tag sync
+                    if hasattr(resource, 'post_update'):
+                        resource.post_update()
+                    elif hasattr(resource, 'set_last_status'):
+                        resource.set_last_status()
+                else:
+                    if rtype == 'instance':
+                        resource.state = 'terminated'
+                    else:
+                        resource.status = 'deleted'
+                    if hasattr(resource, 'set_last_status'):
+                        resource.set_last_status()
+                last_state = self.states.get(resource.id)
+                state = self.get_state(resource)
+                if state != last_state:
+                    changed.append(resource)
+                    self.states[resource.id] = state
+                    if new is None:
+                        state += ' (no longer returned by describe ' + rtype + 's)'
+                    self.debug(str(resource.id) + ": " + str(last_state) + " -> " + str(state) +
+                               ", elapsed:" + str(int(time.time() - self.start)))
+                self._set_next_poll(resource, changed=(state != last_state))
+        return changed
+
+    def _set_next_poll(self, resource, changed, throttled=False):
+        interval = self.intervals.get(resource.id, self.min_interval)
+        if throttled:
+            interval = self.max_interval
+        elif changed:
+            interval = self.min_interval
+        else:
+            interval = min(self.max_interval, interval * self.backoff)
+        self.intervals[resource.id] = interval
+        self.next_poll[resource.id] = time.time() + interval
+
+    def get_poll_wait(self, resources):
+        """
+        :return: seconds until the next of 'resources' is due to be polled
+        """
+        if not resources:
+            return 0
+        now = time.time()
+        return max(0, min([self.next_poll.get(resource.id, now) for resource in resources]) - now)
+
+    @traced('wait', 'ResourceStateMonitor.wait')
+    def wait(self, resources, max_wait=None):
+        """
+        Sleep until the next of 'resources' is due to be polled, or max_wait seconds
+        """
+        wait = self.get_poll_wait(resources)
+        if max_wait is not None:
+            wait = min(wait, max(0, max_wait))
+        if wait:
+            time.sleep(wait)
+
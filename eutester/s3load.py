@@ -0,0 +1,382 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Object store load generator for Walrus/S3 built on an S3ops connection.
+
+Runs a weighted mix of PUT/GET/HEAD/DELETE requests against a single bucket, either with a fixed number of
+concurrent workers issuing requests back to back, or paced to a target aggregate request rate. Object sizes are
+drawn from a weighted size distribution. Requests completed during the warmup period are not recorded.
+Latencies are kept in log scaled histograms per operation, from which p50/p95/p99 are reported along with
+ops/sec and MB/sec. Results can be written as JSON or CSV so runs can be compared.
+
+example usage:
+    load = S3LoadGenerator(tester, 'loadbucket', op_mix={'put': 0.3, 'get': 0.6, 'head': 0.1},
+                           sizes=[(4096, 0.8), (1048576, 0.2)], concurrency=32, duration=300, warmup=30)
+    load.run()
+    load.show_results()
+    load.write_json('/tmp/walrus_load.json')
+'''
+import csv
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from boto.s3.key import Key
+
+
+class LatencyHistogram():
+    #Each bucket covers latencies within 'resolution' (2%) of each other
+    resolution = 1.02
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        index = int(math.log(max(ms, 0.001)) / math.log(self.resolution))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct):
+        """
+        Returns the latency in ms at percentile 'pct' (0-100), accurate to the histogram resolution
+        """
+        if not self.count:
+            return None
+        target = self.count * pct / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(self.resolution ** (index + 1), self.max)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+class S3LoadGenerator():
+    operations = ['put', 'get', 'head', 'delete']
+
+    def __init__(self,
+                 tester,
+                 bucket_name,
+                 op_mix=None,
+                 sizes=None,
+                 concurrency=10,
+                 rate=None,
+                 duration=60,
+                 warmup=5,
+                 preload=100,
+                 key_prefix='load',
+                 debugmethod=None):
+        """
+        :param tester: eutester obj with an s3 connection, ie S3ops/Eucaops
+        :param bucket_name: existing bucket to run the load against
+        :param op_mix: dict of operation to weight, operations are 'put', 'get', 'head' and 'delete'
+        :param sizes: list of (size in bytes, weight) tuples used for PUT object sizes
+        :param concurrency: number of worker threads issuing requests
+        :param rate: target aggregate requests/sec, if None each worker issues requests back to back
+        :param duration: seconds to run the load for, including warmup
+        :param warmup: seconds at the start of the run whose requests are not recorded
+        :param preload: number of objects PUT before the run so GET/HEAD/DELETE have keys to work on
+        :param key_prefix: prefix of the key names created by this generator
+        :param debugmethod: method used for logging, defaults to tester.debug
+        """
+        self.tester = tester
+        self.bucket_name = bucket_name
+        self.op_mix = op_mix or {'put': 0.5, 'get': 0.5}
+        for op in self.op_mix:
+            if op not in self.operations:
+                raise Exception('Unknown operation in op_mix:' + str(op) + ', valid operations:' +
+                                str(self.operations))
+        self.sizes = sizes or [(1024, 1)]
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.preload = preload
+        self.key_prefix = key_prefix
+        self.debugmethod = debugmethod or tester.debug
+        self.bucket = tester.s3.get_bucket(bucket_name)
+        # PUT payloads are slices of one random buffer so data generation doesn't skew the results
+        self.payload = os.urandom(max([size for size, weight in self.sizes]))
+        self.lock = threading.Lock()
+        self.keys = []
+        self.key_count = 0
+        self.next_send = None
+        self.start = None
+        self.end = None
+        self.results = {}
+        self.reset_results()
+
+    def debug(self, msg):
+        self.debugmethod(msg)
+
+    @classmethod
+    def parse_op_mix(cls, mix):
+        """
+        Parse an op mix string, ie: 'put:50,get:40,head:5,delete:5'
+        """
+        op_mix = {}
+        for item in mix.split(','):
+            op, weight = item.split(':')
+            op_mix[op.strip().lower()] = float(weight)
+        return op_mix
+
+    @classmethod
+    def parse_sizes(cls, sizes):
+        """
+        Parse a size distribution string of size:weight pairs, sizes may use K/M suffixes, ie: '4K:80,1M:20'
+        """
+        size_list = []
+        for item in sizes.split(','):
+            if ':' in item:
+                size, weight = item.split(':')
+            else:
+                size, weight = item, 1
+            size = size.strip().upper()
+            multiplier = 1
+            if size.endswith('K'):
+                multiplier, size = 1024, size[:-1]
+            elif size.endswith('M'):
+                multiplier, size = 1048576, size[:-1]
+            size_list.append((int(size) * multiplier, float(weight)))
+        return size_list
+
+    def reset_results(self):
+        self.results = {}
+        for op in self.operations:
+            self.results[op] = {'histogram': LatencyHistogram(), 'errors': 0, 'bytes': 0}
+
+    def _weighted_choice(self, choices):
+        total = sum([weight for choice, weight in choices])
+        pick = random.uniform(0, total)
+        for choice, weight in choices:
+            pick -= weight
+            if pick <= 0:
+                return choice
+        return choices[-1][0]
+
+    def _new_key_name(self):
+        with self.lock:
+            self.key_count += 1
+            return self.key_prefix + '-' + str(self.key_count)
+
+    def _pick_key(self, remove=False):
+        with self.lock:
+            if not self.keys:
+                return None
+            index = random.randint(0, len(self.keys) - 1)
+            if remove:
+                # Swap with the last key so the removal is O(1)
+                self.keys[index], self.keys[-1] = self.keys[-1], self.keys[index]
+                return self.keys.pop()
+            return self.keys[index]
+
+    def do_put(self):
+        size = self._weighted_choice(self.sizes)
+        name = self._new_key_name()
+        Key(self.bucket, name).set_contents_from_string(self.payload[:size])
+        with self.lock:
+            self.keys.append(name)
+        return size
+
+    def do_get(self):
+        name = self._pick_key()
+        if name is None:
+            return None
+        return len(Key(self.bucket, name).get_contents_as_string())
+
+    def do_head(self):
+        name = self._pick_key()
+        if name is None:
+            return None
+        self.bucket.get_key(name)
+        return 0
+
+    def do_delete(self):
+        name = self._pick_key(remove=True)
+        if name is None:
+            return None
+        self.bucket.delete_key(name)
+        return 0
+
+    def _wait_for_send_slot(self):
+        """
+        When running at a target rate, hand out evenly spaced send times across all workers
+        """
+        with self.lock:
+            send_at = self.next_send
+            self.next_send = max(self.next_send, time.time() - 1) + 1.0 / self.rate
+        delay = send_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def worker(self):
+        mix = self.op_mix.items()
+        while time.time() < self.end:
+            if self.rate:
+                self._wait_for_send_slot()
+                if time.time() >= self.end:
+                    return
+            op = self._weighted_choice(mix)
+            started = time.time()
+            try:
+                nbytes = getattr(self, 'do_' + op)()
+                if nbytes is None:
+                    # No keys left to read or delete, create one instead
+                    op = 'put'
+                    nbytes = self.do_put()
+                error = False
+            except Exception, e:
+                nbytes = 0
+                error = True
+                self.debug('Load request ' + op + ' failed:' + str(e))
+            finished = time.time()
+            if started < self.start + self.warmup:
+                continue
+            with self.lock:
+                result = self.results[op]
+                if error:
+                    result['errors'] += 1
+                else:
+                    result['histogram'].add((finished - started) * 1000)
+                    result['bytes'] += nbytes
+
+    def run(self):
+        """
+        Preload the bucket then run the load for the configured duration, returns the results dict
+        """
+        self.reset_results()
+        if self.preload > len(self.keys):
+            self.debug('Preloading ' + str(self.preload - len(self.keys)) + ' objects into ' + self.bucket_name)
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for future in [executor.submit(self.do_put) for x in xrange(self.preload - len(self.keys))]:
+                    future.result()
+        self.debug('Running load against ' + self.bucket_name + ', mix:' + str(self.op_mix) + ', concurrency:' +
+                   str(self.concurrency) + ', rate:' + str(self.rate or 'unthrottled') + ', duration:' +
+                   str(self.duration) + 's, warmup:' + str(self.warmup) + 's')
+        self.start = time.time()
+        self.next_send = self.start
+        self.end = self.start + self.duration
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(self.worker) for x in xrange(self.concurrency)]:
+                future.result()
+        return self.get_results()
+
+    def get_results(self):
+        """
+        Returns dict of per operation stats, keyed by operation name
+        """
+        measured = max(float(self.duration - self.warmup), 0.001)
+        stats = {}
+        for op in self.operations:
+            result = self.results[op]
+            histogram = result['histogram']
+            if not histogram.count and not result['errors']:
+                continue
+            stats[op] = {'count': histogram.count,
+                         'errors': result['errors'],
+                         'ops_per_sec': histogram.count / measured,
+                         'mb_per_sec': result['bytes'] / 1048576.0 / measured,
+                         'min_ms': histogram.min,
+                         'mean_ms': histogram.mean(),
+                         'p50_ms': histogram.percentile(50),
+                         'p95_ms': histogram.percentile(95),
+                         'p99_ms': histogram.percentile(99),
+                         'max_ms': histogram.max}
+        return stats
+
+    def show_results(self, printmethod=None):
+        printmethod = printmethod or self.debug
+        stats = self.get_results()
+        columns = ['count', 'errors', 'ops_per_sec', 'mb_per_sec', 'min_ms', 'mean_ms', 'p50_ms', 'p95_ms',
+                   'p99_ms', 'max_ms']
+        buf = 'op'.ljust(8) + ''.join([column.ljust(13) for column in columns]) + '\n'
+        for op in self.operations:
+            if op not in stats:
+                continue
+            buf += op.ljust(8)
+            for column in columns:
+                value = stats[op][column]
+                if isinstance(value, float):
+                    value = '%.2f' % value
+                buf += str(value).ljust(13)
+            buf += '\n'
+        printmethod(buf)
+        return buf
+
+    def write_json(self, path):
+        config = {'bucket': self.bucket_name, 'op_mix': self.op_mix, 'sizes': self.sizes,
+                  'concurrency': self.concurrency, 'rate': self.rate, 'duration': self.duration,
+                  'warmup': self.warmup}
+        histograms = {}
+        for op in self.operations:
+            histogram = self.results[op]['histogram']
+            if histogram.count:
+                # Bucket upper bound in ms -> count
+                histograms[op] = [[round(histogram.resolution ** (index + 1), 3), histogram.buckets[index]]
+                                  for index in sorted(histogram.buckets)]
+        with open(path, 'w') as out:
+            json.dump({'config': config, 'results': self.get_results(), 'histograms': histograms}, out, indent=2)
+
+    def write_csv(self, path):
+        stats = self.get_results()
+        columns = ['count', 'errors', 'ops_per_sec', 'mb_per_sec', 'min_ms', 'mean_ms', 'p50_ms', 'p95_ms',
+                   'p99_ms', 'max_ms']
+        with open(path, 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(['op'] + columns)
+            for op in self.operations:
+                if op in stats:
+                    writer.writerow([op] + [stats[op][column] for column in columns])
+
+    def clean_up(self):
+        """
+        Delete the objects created by this generator
+        """
+        with self.lock:
+            keys = list(self.keys)
+            self.keys = []
+        return self.tester.delete_keys_bulk(self.bucket, keys)
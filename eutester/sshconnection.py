@@ -87,6 +87,7 @@ example with proxy:
 
 
 import copy
+import hashlib
 import os
 import paramiko
 import re
@@ -96,8 +97,9 @@ import time
 import types
 import sys
 import termios
+import threading
 import tty
-import eucaops
+import tracing
 
 
 
@@ -127,9 +129,273 @@ class SshCbReturn():
         self.buf = buf
 
 
+class SshTransportPool():
+    def __init__(self, max_channels_per_host=8, idle_timeout=300, keepalive=30):
+        """
+        Process wide pool of authenticated paramiko ssh clients, keyed by (host, username, proxy, port, credentials).
+        SshConnection objects created for the same key share a single keep-alive transport and lease
+        channels (sessions) on it instead of performing a new key exchange + auth per object.
+        :param max_channels_per_host: max concurrent leased channels on a single pooled transport. Note sshd's
+                                      MaxSessions defaults to 10 per connection, sftp channels also count against it.
+        :param idle_timeout: seconds a pooled transport with no holders and no leased channels is kept before reaping
+        :param keepalive: seconds between ssh keep-alive packets sent on pooled transports, 0 disables
+        """
+        self.max_channels_per_host = max_channels_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.lock = threading.RLock()
+        self.entries = {}
+        #Discarded entries whose client is still held by other SshConnections, keyed by id(client)
+        self.retired = {}
+        self.hits = 0
+        self.misses = 0
+        self.reaped = 0
+        self.discarded = 0
+        self.channel_waits = 0
+
+    @staticmethod
+    def get_key(host, username, proxy=None, port=22, credentials=None):
+        """
+        Returns the pool key for a connection. Connections only share a pooled transport when the host, user, proxy,
+        port and credentials all match.
+        :param credentials: tuple of the values used to authenticate, ie (password, keypath, key_files). Only a
+                            digest of these is kept in the key.
+        """
+        fingerprint = hashlib.sha1(repr(credentials)).hexdigest()[:16]
+        return (str(host), str(username), proxy and str(proxy) or None, int(port), fingerprint)
+
+    def get_connection(self, key, connect_method, proxy_key=None):
+        """
+        Returns a pooled paramiko ssh client for 'key', creating one with 'connect_method' on a miss.
+        Each caller is counted as a holder of the connection until release_connection() is called.
+        :param key: tuple (host, username, proxy, port, credential fingerprint), see get_key()
+        :param connect_method: method returning a connected paramiko SSHClient, used on a pool miss
+        :param proxy_key: optional pool key of a proxy transport the new connection is tunneled through. The proxy
+                          transport will not be reaped while this connection is pooled.
+        :return: paramiko SSHClient
+        """
+        self.reap_idle()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                transport = entry['client'].get_transport()
+                if transport and transport.is_active():
+                    self.hits += 1
+                    entry['holders'] += 1
+                    entry['last_used'] = time.time()
+                    return entry['client']
+                self._remove_entry(key)
+            self.misses += 1
+        #Connect outside of the pool lock so handshakes to different hosts are not serialized
+        client = connect_method()
+        transport = client.get_transport()
+        if self.keepalive and transport:
+            transport.set_keepalive(self.keepalive)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                #Another thread pooled a connection for this key while we connected, use the pooled one
+                entry['holders'] += 1
+                entry['last_used'] = time.time()
+                client.close()
+                return entry['client']
+            self.entries[key] = {'client': client,
+                                 'holders': 1,
+                                 'channels': 0,
+                                 'proxy_key': proxy_key,
+                                 'created': time.time(),
+                                 'last_used': time.time(),
+                                 'cond': threading.Condition(self.lock)}
+        return client
+
+    def release_connection(self, key, client):
+        """
+        Drop a holder reference on the pooled connection. The transport remains open until reaped.
+        :param key: pool key the client was leased under
+        :param client: paramiko SSHClient returned from get_connection()
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['client'] is client:
+                entry['holders'] = max(0, entry['holders'] - 1)
+                entry['last_used'] = time.time()
+                return
+            entry = self.retired.get(id(client))
+            if entry and entry['client'] is client:
+                self._release_retired(entry)
+                return
+        #Not (or no longer) pooled, this caller owns it
+        client.close()
+
+    def discard(self, key, client=None):
+        """
+        Remove the pooled connection for 'key' so the next get_connection() creates a new one, ie after a reboot.
+        When 'client' is given the caller's holder reference is dropped as well. The old client is closed once
+        its last holder releases it, other holders re-establish their connection on their next command.
+        :param key: pool key
+        :param client: optional, only discard if the pooled client is this client
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and (client is None or entry['client'] is client):
+                self.discarded += 1
+                self.entries.pop(key)
+                if entry['proxy_key'] in self.entries:
+                    self.entries[entry['proxy_key']]['last_used'] = time.time()
+                #Wake channel waiters, they must not wait on a slot of a transport which has left the pool
+                entry['cond'].notify_all()
+                self.retired[id(entry['client'])] = entry
+                if client is None:
+                    entry['holders'] += 1
+                self._release_retired(entry)
+            elif client is not None and id(client) in self.retired:
+                self._release_retired(self.retired[id(client)])
+
+    def _release_retired(self, entry):
+        entry['holders'] = max(0, entry['holders'] - 1)
+        if not entry['holders']:
+            self.retired.pop(id(entry['client']), None)
+            try:
+                entry['client'].close()
+            except Exception:
+                pass
+
+    def open_session(self, key, transport, timeout=None):
+        """
+        Lease a session channel on 'transport', blocking while the per host channel cap is reached.
+        Leased channels must be returned with release_session().
+        :param key: pool key of the transport
+        :param transport: paramiko transport to open the channel on
+        :param timeout: seconds to wait for a free channel slot before raising an exception, None waits forever
+        :return: paramiko channel
+        """
+        leased = False
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['client'].get_transport() is transport:
+                start = time.time()
+                if entry['channels'] >= self.max_channels_per_host:
+                    self.channel_waits += 1
+                while entry['channels'] >= self.max_channels_per_host and self.entries.get(key) is entry:
+                    remaining = None
+                    if timeout is not None:
+                        remaining = timeout - (time.time() - start)
+                        if remaining <= 0:
+                            raise Exception('Timed out after ' + str(timeout) + ' seconds waiting for a free ssh '
+                                            'channel to:' + str(key[0]) + ', max channels per host:'
+                                            + str(self.max_channels_per_host))
+                    entry['cond'].wait(remaining)
+                #A transport discarded while waiting is no longer capped, opening the channel will fail if it is closed
+                if self.entries.get(key) is entry:
+                    entry['channels'] += 1
+                    entry['last_used'] = time.time()
+                    leased = True
+        try:
+            return transport.open_session()
+        except:
+            if leased:
+                self.release_session(key, transport)
+            raise
+
+    def release_session(self, key, transport):
+        """
+        Return a channel slot leased by open_session()
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['client'].get_transport() is transport:
+                entry['channels'] = max(0, entry['channels'] - 1)
+                entry['last_used'] = time.time()
+                entry['cond'].notify()
+
+    def reap_idle(self, idle_timeout=None):
+        """
+        Close pooled transports with no holders and no leased channels, idle for more than idle_timeout seconds.
+        Transports which are no longer active are removed regardless of idle time.
+        :param idle_timeout: optional override of self.idle_timeout
+        :return: number of transports reaped
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        count = 0
+        now = time.time()
+        with self.lock:
+            for key, entry in self.entries.items():
+                transport = entry['client'].get_transport()
+                if not transport or not transport.is_active() or \
+                        (not entry['holders'] and not entry['channels'] and
+                         (now - entry['last_used']) > idle_timeout):
+                    #Dont reap proxies which still have tunneled transports pooled through them
+                    if transport and transport.is_active() and \
+                            [e for e in self.entries.values() if e['proxy_key'] == key]:
+                        continue
+                    self._remove_entry(key)
+                    count += 1
+            self.reaped += count
+        return count
+
+    def _remove_entry(self, key):
+        entry = self.entries.pop(key)
+        try:
+            entry['client'].close()
+        except Exception:
+            pass
+        if entry['proxy_key'] in self.entries:
+            self.entries[entry['proxy_key']]['last_used'] = time.time()
+        entry['cond'].notify_all()
+
+    def close_all(self):
+        with self.lock:
+            for key in self.entries.keys():
+                if key in self.entries:
+                    self._remove_entry(key)
+            for entry in self.retired.values():
+                try:
+                    entry['client'].close()
+                except Exception:
+                    pass
+            self.retired = {}
+
+    def get_stats(self):
+        """
+        :return: dict of pool hit/miss counters and per host transport/channel usage
+        """
+        with self.lock:
+            hosts = {}
+            for key, entry in self.entries.iteritems():
+                hosts[key] = {'holders': entry['holders'],
+                              'channels': entry['channels'],
+                              'idle': int(time.time() - entry['last_used']),
+                              'age': int(time.time() - entry['created'])}
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'reaped': self.reaped,
+                    'discarded': self.discarded,
+                    'channel_waits': self.channel_waits,
+                    'transports': len(self.entries),
+                    'hosts': hosts}
+
+    def show_stats(self, printmethod=None):
+        printmethod = printmethod or sys.stdout.write
+        stats = self.get_stats()
+        buf = "SSH POOL: hits:" + str(stats['hits']) + ", misses:" + str(stats['misses']) + ", reaped:" + \
+              str(stats['reaped']) + ", discarded:" + str(stats['discarded']) + ", channel waits:" + \
+              str(stats['channel_waits']) + ", open transports:" + str(stats['transports']) + "\n"
+        for key, host in stats['hosts'].iteritems():
+            buf += "    " + str(key[1]) + "@" + str(key[0]) + ":" + str(key[3]) + " proxy:" + str(key[2]) + ", holders:" + \
+                   str(host['holders']) + ", channels:" + str(host['channels']) + ", idle:" + str(host['idle']) + \
+                   ", age:" + str(host['age']) + "\n"
+        printmethod(buf)
+        return buf
+
+
 class SshConnection():
     cmd_timeout_err_code = -100
     cmd_not_executed_code = -99
+    #Process wide pool of ssh transports shared by all SshConnection objects created with use_pool=True
+    transport_pool = SshTransportPool()
+    #Max bytes read from a channel per recv() call in cmd()
+    recv_chunk_size = 65536
 
     def __init__(self,
                  host,
@@ -137,6 +403,7 @@ class SshConnection():
                  password=None,
                  keypair=None,
                  keypath=None,
+                 port=22,
                  proxy=None,
                  proxy_username='root',
                  proxy_password=None,
@@ -149,13 +416,15 @@ class SshConnection():
                  retry=1,
                  debugmethod=None,
                  verbose=False,
-                 debug_connect=False):
+                 debug_connect=False,
+                 use_pool=True):
         """
         :param host: -mandatory - string, hostname or ip address to establish ssh connection to
         :param username: - optional - string, username used to establish ssh session when keypath is not provided
         :param password: - optional - string, password used to establish ssh session when keypath is not provided
         :param keypair: - optional - boto keypair object, used to attept to derive local path to ssh key if present
         :param keypath:  - optional - string, path to ssh key
+        :param port: - optional - integer, ssh port of host
         :param proxy: - optional - host to proxy ssh connection through
         :param proxy_username:  - optional ssh username of proxy host for authentication
         :param proxy_password: - optional ssh password of proxy host for authentication
@@ -168,6 +437,9 @@ class SshConnection():
         :param debugmethod: - method, used to handle debug msgs
         :param verbose: - optional - boolean to flag debug output on or off mainly for cmd execution
         :param debug_connect: - optional - boolean to flag debug output on or off for connection related operations
+        :param use_pool: - optional - boolean, share an authenticated transport with other SshConnections to the same
+                           host/username/proxy/port/credentials through SshConnection.transport_pool instead of
+                           connecting per object
         """
 
         self.host = host
@@ -175,6 +447,7 @@ class SshConnection():
         self.password = password
         self.keypair = keypair
         self.keypath = keypath
+        self.port = port
         self.proxy = proxy
         self.proxy_username = proxy_username
         self.proxy_password = proxy_password
@@ -191,6 +464,7 @@ class SshConnection():
             self.key_files = str(self.key_files).split(',')
         self.find_keys = find_keys
         self.debug_connect = debug_connect
+        self.use_pool = use_pool
 
         #Used to store the last cmd attempted and it's exit code
         self.lastcmd = ""
@@ -214,20 +488,14 @@ class SshConnection():
                 self.debug("SSH proxy has hostname:" + str(self.proxy) + " user:" +
                            str(proxy_username) + " password:" + str(self.mask_password(proxy_password)))
 
+        self.pool_key = SshTransportPool.get_key(self.host, self.username, self.proxy, port=self.port,
+                                                 credentials=(self.password, self.keypath, self.key_files,
+                                                              self.find_keys, self.proxy_username,
+                                                              self.get_proxy_credentials()))
         if self.find_keys or \
                 self.keypath is not None or \
                 ((self.username is not None) and (self.password is not None)):
-            self.connection = self.get_ssh_connection(self.host,
-                                                      username=self.username,
-                                                      password=self.password,
-                                                      keypath=self.keypath,
-                                                      proxy_username=self.proxy_username,
-                                                      proxy_password=self.proxy_password,
-                                                      proxy_keypath=self.proxy_keypath,
-                                                      enable_ipv6_dns=self.enable_ipv6_dns,
-                                                      timeout=self.timeout,
-                                                      retry=self.retry,
-                                                      verbose=self.debug_connect)
+            self.connection = self.get_pooled_connection()
         else:
             raise Exception("Need either a keypath or username+password to create ssh connection")
 
@@ -264,22 +532,34 @@ class SshConnection():
             key_files = key_files.split(',')
 
         #Make sure there is at least one likely way to authenticate...
-        ssh = paramiko.SSHClient()
         if (proxy_username is not None) and (key_files or self.find_keys or proxy_keypath is not None or \
                          proxy_password is not None ):
-            p_transport = paramiko.Transport(proxy_host)
-            ssh._transport = p_transport
-            p_transport.start_client()
-            if proxy_keypath:
-                priv_key = paramiko.RSAKey.from_private_key_file(proxy_keypath)
-                p_transport.auth_publickey(proxy_username,priv_key)
-            elif proxy_password:
-                p_transport.auth_password(proxy_username, proxy_password)
-            elif self.find_keys:
-                self.debug("Proxy auth -Using local keys, no keypath/password provided",
-                           verbose=verbose)
-                ssh._auth(proxy_username, None,None,key_files, True, True)
-                p_transport = ssh._transport
+            def connect_proxy():
+                ssh = paramiko.SSHClient()
+                p_transport = paramiko.Transport(proxy_host)
+                ssh._transport = p_transport
+                p_transport.start_client()
+                if proxy_keypath:
+                    priv_key = paramiko.RSAKey.from_private_key_file(proxy_keypath)
+                    p_transport.auth_publickey(proxy_username,priv_key)
+                elif proxy_password:
+                    p_transport.auth_password(proxy_username, proxy_password)
+                elif self.find_keys:
+                    self.debug("Proxy auth -Using local keys, no keypath/password provided",
+                               verbose=verbose)
+                    ssh._auth(proxy_username, None,None,key_files, True, True)
+                return ssh
+            if self.use_pool:
+                #Share one proxy transport across all connections tunneled through this proxy host
+                proxy_key = SshTransportPool.get_key(proxy_host[0], proxy_username, port=proxy_host[1],
+                                                     credentials=(proxy_password, proxy_keypath, key_files,
+                                                                  self.find_keys))
+                ssh = self.transport_pool.get_connection(proxy_key, connect_proxy)
+                #The pool keeps the proxy open while tunneled connections use it, dont hold it here
+                self.transport_pool.release_connection(proxy_key, ssh)
+            else:
+                ssh = connect_proxy()
+            p_transport = ssh.get_transport()
             #forward from 127.0.0.1:<free_random_port> to |dest_host|
             channel = p_transport.open_channel('direct-tcpip', dest_host, ('127.0.0.1', 0))
             return paramiko.Transport(channel)
@@ -360,12 +640,14 @@ class SshConnection():
                         if cb nextargs is set, the next time cb is called these args will be passed instead of cbargs
         :param cbargs: - optional - list of arguments to be appended to output buffer and passed to cb
         :param enable_debug: - optional - boolean, if set will use self.debug() to print additional messages during cmd()
+        :param get_pty: - optional - boolean, run the cmd in a pty. Without one stderr is still merged into the output
 
         """
         if verbose is None:
             verbose = self.verbose
         ret = {}
         cbfired = False
+        leased = None
         cmd = str(cmd)
         self.lastcmd = cmd
         self.lastexitcode = SshConnection.cmd_not_executed_code
@@ -376,118 +658,112 @@ class SshConnection():
                 self.debug(msg)
         if verbose:
             self.debug("[" + self.username + "@" + str(self.host) + "]# " + cmd)
+        span = tracing.tracer.start('ssh', (cmd.split() or [''])[0], host=self.host, cmd=cmd[:200])
         try:
             tran = self.connection.get_transport()
-            if tran is None:
+            if tran is None or not tran.is_active():
                 self.debug("SSH transport was None, attempting to restablish ssh to: "+str(self.host))
                 self.refresh_connection()
                 tran = self.connection.get_transport()
-            chan = tran.open_session()
+            chan = self.open_session(tran, timeout=timeout)
+            leased = tran
             chan.settimeout(timeout)
             if get_pty:
                 chan.get_pty()
+            else:
+                #Without a pty stderr arrives separately, it would wake select() but never be read by recv()
+                chan.set_combine_stderr(True)
             chan.exec_command(cmd)
-            output = None
+            #Received data is collected as a list of chunks and joined once when the cmd completes
+            output = []
             fd = chan.fileno()
             chan.setblocking(0)
             cmdstart = start = time.time()
-            newdebug = "\n"
-            while not chan.closed:
-                time.sleep(0.05)
+            eof = False
+            while not chan.closed and not eof:
+                #Block in select until data, eof, or the cmd timer fires. No fixed sleep between passes.
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    elapsed = int(time.time() - start)
+                    raise CommandTimeoutException(
+                        "SSH Command timer fired after " + str(int(elapsed)) + " seconds. Cmd:'" + str(cmd) + "'")
                 try:
-                    rl, wl, xl = select.select([fd], [], [], timeout)
+                    rl, wl, xl = select.select([fd], [], [], remaining)
                 except select.error:
                     break
-                elapsed = int(time.time() - start)
-                if elapsed >= timeout:
-                    raise CommandTimeoutException(
-                        "SSH Command timer fired after " + str(int(elapsed)) + " seconds. Cmd:'" + str(cmd) + "'")
-                if len(rl) > 0:
-                    cmddebug('ssh cmd: got input on recv channel')
-                    while chan.recv_ready():
-                        new = chan.recv(1024)
-                        if verbose:
-                            cmddebug('ssh cmd: got new data on channel:"' + str(new) + '"')
-                        if new is not None:
-                            #We have data to handle...
-                            #Run call back if there is one, let call back handle data read in
-                            if cb is not None:
-                                if enable_debug:
-                                    cbname = 'unknown'
-                                    try:
-                                        cbname = str(cb.im_func.func_code.co_name)
-                                    except: pass
-                                    self.debug('ssh cmd: sending new data to callback: ' + str(cbname))
-                                #If cb returns false break, end rx loop, return cmd outcome/output dict. 
-                                #cbreturn = SshCbReturn()
-                                cbreturn = cb(new, *cbargs)
-                                #Let the callback control whether or not to continue
-                                if cbreturn.stop:
-                                    cmddebug('ssh cmd: callback sent stop')
-                                    if cbreturn.buf:
-                                        if output is None:
-                                            output = cbreturn.buf
-                                        else:
-                                            output += cbreturn.buf
-                                    cbfired = True
-                                    #Let the callback dictate the return code, otherwise -1 for connection err may occur
-                                    if cbreturn.statuscode != -1:
-                                        status = cbreturn.statuscode
-                                    else:
-                                        status = self.lastexitcode = chan.recv_exit_status()
-                                    chan.close()
-                                    break
-                                else:
-
-                                    #Let the callback update its calling args if needed
-                                    if cbreturn.nextargs is not None:
-                                        cbargs = cbreturn.nextargs
-                                    #Let the callback update/reset the timeout if needed
-                                    if cbreturn.settimer > 0:
-                                        start = time.time()
-                                        timeout = cbreturn.settimer
-                                    #Let the callback update the output buffer to be returned
-                                    if cbreturn.buf:
-                                        cmddebug('ssh cmd: cb returned buf:"' + str(cbreturn.buf) + '"')
-                                        if output is None:
-                                            output = cbreturn.buf
-                                        else:
-                                            output += cbreturn.buf
-                                    #Change the callback to handle future output from this cmd
-                                    if cbreturn.nextcb:
-                                        cmddebug('ssh cmd: updating to new callback provided in cb return nextcb')
-                                        cb = cbreturn.nextcb
-                                    #Remove all callbacks
-                                    if cbreturn.removecb:
-                                        cmddebug('ssh cmd: removing all callbacks per cb return removecb value')
-                                        cb = None
-                                    #Send a string to the channel provided in callback (similar to expect)
-                                    if cbreturn.sendstring is not None:
-                                        if verbose:
-                                            cmddebug('Sending string:' + str(cbreturn.sendstring))
-                                        chan.send(s=str(cbreturn.sendstring))
-                                        cmddebug('channel status after sending string. Is closed = ' + str(chan.closed))
+                if not rl:
+                    if enable_debug:
+                        self.debug('ssh cmd: len of rl was < 0')
+                    continue
+                cmddebug('ssh cmd: got input on recv channel')
+                #Drain everything currently buffered on the channel before going back to select
+                while True:
+                    try:
+                        new = chan.recv(self.recv_chunk_size)
+                    except socket.timeout:
+                        #Channel fd was readable but no data remained in the buffer
+                        break
+                    if not new:
+                        #Remote side sent eof, exit status will be read below
+                        eof = True
+                        break
+                    if verbose:
+                        cmddebug('ssh cmd: got new data on channel:"' + str(new) + '"')
+                    #We have data to handle...
+                    #Run call back if there is one, let call back handle data read in
+                    if cb is not None:
+                        if enable_debug:
+                            cbname = 'unknown'
+                            try:
+                                cbname = str(cb.im_func.func_code.co_name)
+                            except: pass
+                            self.debug('ssh cmd: sending new data to callback: ' + str(cbname))
+                        #If cb returns false break, end rx loop, return cmd outcome/output dict.
+                        cbreturn = cb(new, *cbargs)
+                        #Let the callback update the output buffer to be returned
+                        if cbreturn.buf:
+                            cmddebug('ssh cmd: cb returned buf:"' + str(cbreturn.buf) + '"')
+                            output.append(cbreturn.buf)
+                        #Let the callback control whether or not to continue
+                        if cbreturn.stop:
+                            cmddebug('ssh cmd: callback sent stop')
+                            cbfired = True
+                            #Let the callback dictate the return code, otherwise -1 for connection err may occur
+                            if cbreturn.statuscode != -1:
+                                status = cbreturn.statuscode
                             else:
-                                #if no call back then append output to return dict and handle debug
-                                if output == None:
-                                    output = new
-                                else:
-                                    output += new
-                                if verbose:
-                                    #Dont print line by line output if cb is used, let cb handle that 
-                                    newdebug += new
-                        else:
-                            status = self.lastexitcode = chan.recv_exit_status()
+                                status = self.lastexitcode = chan.recv_exit_status()
                             chan.close()
                             break
-                    if newdebug and verbose:
-                        self.debug(str(newdebug))
-                        newdebug = ''
-                elif enable_debug:
-                    self.debug('ssh cmd: len of rl was < 0')
+                        #Let the callback update its calling args if needed
+                        if cbreturn.nextargs is not None:
+                            cbargs = cbreturn.nextargs
+                        #Let the callback update/reset the timeout if needed
+                        if cbreturn.settimer > 0:
+                            start = time.time()
+                            timeout = cbreturn.settimer
+                        #Change the callback to handle future output from this cmd
+                        if cbreturn.nextcb:
+                            cmddebug('ssh cmd: updating to new callback provided in cb return nextcb')
+                            cb = cbreturn.nextcb
+                        #Remove all callbacks
+                        if cbreturn.removecb:
+                            cmddebug('ssh cmd: removing all callbacks per cb return removecb value')
+                            cb = None
+                        #Send a string to the channel provided in callback (similar to expect)
+                        if cbreturn.sendstring is not None:
+                            if verbose:
+                                cmddebug('Sending string:' + str(cbreturn.sendstring))
+                            chan.send(s=str(cbreturn.sendstring))
+                            cmddebug('channel status after sending string. Is closed = ' + str(chan.closed))
+                    else:
+                        #if no call back then append output to return list and handle debug
+                        #Dont print line by line output if cb is used, let cb handle that
+                        output.append(new)
+                        if verbose:
+                            self.debug(str(new))
             cmddebug('ssh cmd: channel closed')
-            if output is None:
-                output = ""
+            output = "".join(output)
             if listformat:
                 #return output as list of lines
                 output = output.splitlines()
@@ -508,7 +784,13 @@ class SshConnection():
             self.lastexitcode = SshConnection.cmd_timeout_err_code
             elapsed = str(int(time.time() - start))
             self.debug("Command (" + cmd + ") timeout exception after " + str(elapsed) + " seconds\nException")
+            span.set(error='timeout')
             raise cte
+        finally:
+            span.finish(status=status)
+            if leased:
+                chan.close()
+                self.release_session(leased)
         return ret
 
     def refresh_connection(self):
@@ -517,8 +799,24 @@ class SshConnection():
         ssh obj.
         """
         if self.connection:
-            self.connection.close()
-        self.connection = self.get_ssh_connection(self.host,
+            if self.use_pool:
+                self.transport_pool.discard(self.pool_key, self.connection)
+            else:
+                self.connection.close()
+        self.connection = self.get_pooled_connection()
+
+    def get_proxy_credentials(self):
+        """
+        Credentials used to authenticate to the proxy, as passed to SshTransportPool.get_key() for the proxy transport
+        """
+        return (self.proxy_password, self.proxy_keypath, self.key_files, self.find_keys)
+
+    def get_pooled_connection(self):
+        """
+        Returns a paramiko ssh client for this obj's host, username and proxy. If use_pool is set the client is
+        leased from SshConnection.transport_pool, otherwise a new connection is established.
+        """
+        connect = lambda: self.get_ssh_connection(self.host,
                                                   username=self.username,
                                                   password=self.password,
                                                   keypath=self.keypath,
@@ -526,9 +824,30 @@ class SshConnection():
                                                   proxy_password=self.proxy_password,
                                                   proxy_keypath=self.proxy_keypath,
                                                   enable_ipv6_dns=self.enable_ipv6_dns,
+                                                  port=self.port,
                                                   timeout=self.timeout,
                                                   retry=self.retry,
                                                   verbose=self.debug_connect)
+        if not self.use_pool:
+            return connect()
+        proxy_key = None
+        if self.proxy:
+            proxy_key = SshTransportPool.get_key(self.proxy, self.proxy_username, port=self.port,
+                                                 credentials=self.get_proxy_credentials())
+        return self.transport_pool.get_connection(self.pool_key, connect, proxy_key=proxy_key)
+
+    def open_session(self, transport, timeout=None):
+        """
+        Open a session channel on transport. Pooled transports lease the channel from the transport pool and
+        must be returned with release_session()
+        """
+        if self.use_pool:
+            return self.transport_pool.open_session(self.pool_key, transport, timeout=timeout)
+        return transport.open_session()
+
+    def release_session(self, transport):
+        if self.use_pool:
+            self.transport_pool.release_session(self.pool_key, transport)
 
     def get_ssh_connection(self,
                            hostname,
@@ -620,7 +939,7 @@ class SshConnection():
                 if proxy_transport:
                     ssh._transport = proxy_transport
                 else:
-                    ssh._transport = paramiko.Transport(ip)
+                    ssh._transport = paramiko.Transport((ip, int(port)))
                 ssh._transport.start_client()
                 ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
                 try:
@@ -906,8 +1225,19 @@ class SshConnection():
         self.close_sftp()
 
 
-    def close(self):
-        self.connection.close()
+    def close(self, discard=False):
+        """
+        Close this obj's ssh connection. Pooled connections are released back to the transport pool, and left
+        open for reuse by other SshConnections unless discard is set.
+        :param discard: - optional - boolean, remove a pooled connection from the pool and close it
+        """
+        if self.use_pool:
+            if discard:
+                self.transport_pool.discard(self.pool_key, self.connection)
+            else:
+                self.transport_pool.release_connection(self.pool_key, self.connection)
+        else:
+            self.connection.close()
 
 
 class CommandExitCodeException(Exception):
@@ -0,0 +1,420 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Dependency ordered, parallel teardown of the resources a test run created.
+
+Resources are removed in phases so each phase only starts once whatever depends on its resources is gone:
+    instances -> load balancers -> volumes (detach, then delete) -> images -> snapshots -> security groups ->
+    keypairs -> buckets (and keys) -> anything else with a delete() method
+Within a phase the delete/terminate/detach requests are sent concurrently (instances are terminated with batched
+requests), and all of the phase's resources are then polled together with one ResourceStateMonitor, ie one
+describe request per poll for all pending volumes rather than one per volume. A single deadline bounds the whole
+teardown; whatever is left when it passes is reported as a failure. Images are deregistered before snapshots are
+deleted since a registered EBS image keeps its snapshots from being deleted.
+
+example usage:
+    engine = TeardownEngine(tester, deadline=900, concurrency=20)
+    engine.run()
+    engine.show_summary()
+    if engine.errors:
+        raise Exception("\n".join(engine.errors))
+'''
+import time
+from concurrent.futures import ThreadPoolExecutor
+from boto.ec2.instance import Instance, Reservation
+from boto.ec2.image import Image
+from boto.exception import BotoServerError, S3ResponseError
+from eutester.resource_monitor import ResourceStateMonitor
+
+
+class TeardownEngine():
+    phases = ['instances', 'load_balancers', 'volumes', 'images', 'snapshots', 'security-groups', 'keypairs',
+              'buckets', 'other']
+
+    #test_resources keys handled by a dedicated phase, everything else is handled by the 'other' phase
+    resource_keys = {'instances': 'reservations',
+                     'load_balancers': 'load_balancers',
+                     'volumes': 'volumes',
+                     'images': 'images',
+                     'snapshots': 'snapshots',
+                     'security-groups': 'security-groups',
+                     'keypairs': 'keypairs',
+                     'buckets': 'buckets'}
+
+    #Error codes which mean the resource could not be deleted yet because something still depends on it
+    in_use_codes = ['InvalidGroup.InUse', 'DependencyViolation', 'VolumeInUse', 'InvalidSnapshot.InUse']
+
+    def __init__(self,
+                 tester,
+                 deadline=1800,
+                 concurrency=10,
+                 poll_interval=10,
+                 max_ids_per_request=200,
+                 resources=None,
+                 debugmethod=None):
+        """
+        :param tester: eutester obj with test_resources to clean up, ie Eucaops
+        :param deadline: seconds allowed for the entire teardown
+        :param concurrency: max number of delete requests in flight
+        :param poll_interval: max seconds between state polls of pending resources
+        :param max_ids_per_request: max ids per batched terminate or describe request
+        :param resources: dict in the form of test_resources to clean up instead of tester.test_resources
+        :param debugmethod: method used for logging, defaults to tester.debug
+        """
+        self.tester = tester
+        if resources is None:
+            resources = tester.test_resources
+        self.resources = resources
+        self.deadline = deadline
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_ids_per_request = max_ids_per_request
+        self.debugmethod = debugmethod or tester.debug
+        self.monitor = ResourceStateMonitor(tester, max_interval=poll_interval,
+                                            max_ids_per_request=max_ids_per_request, debugmethod=self.debugmethod)
+        #Phases may also be called on their own, in which case the deadline runs from creation of the engine
+        self.end = time.time() + deadline
+        self.errors = []
+        self.summary = {}
+
+    def debug(self, msg):
+        self.debugmethod(msg)
+
+    def remaining(self):
+        return max(0, self.end - time.time())
+
+    @classmethod
+    def get_error_code(cls, error):
+        return str(getattr(error, 'error_code', None) or getattr(error, 'code', None) or '')
+
+    @classmethod
+    def is_not_found(cls, error):
+        """
+        True if the error says the resource no longer exists, which for a teardown is success
+        """
+        code = cls.get_error_code(error)
+        return (code.endswith('NotFound') or code.startswith('NoSuch') or
+                (isinstance(error, BotoServerError) and error.status == 404))
+
+    def add_error(self, phase, resource, error):
+        self.errors.append(str(phase) + ': ' + str(resource) + ', ' + str(error))
+        self.debug('Teardown ' + str(phase) + ' error, ' + str(resource) + ': ' + str(error))
+
+    def send_all(self, phase, resources, method):
+        """
+        Calls method(resource) for each resource with up to 'concurrency' requests in flight.
+        Not found errors count as success, errors for resources still in use are retried until the deadline.
+        :return: list of resources the request succeeded for
+        """
+        done = []
+        pending = list(resources)
+        retry_wait = 2
+        while pending:
+            in_use = []
+
+            def send(resource):
+                try:
+                    method(resource)
+                except Exception, e:
+                    return e
+                return None
+            with ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(pending)))) as executor:
+                results = list(executor.map(send, pending))
+            for resource, error in zip(pending, results):
+                if error is None or self.is_not_found(error):
+                    done.append(resource)
+                elif self.get_error_code(error) in self.in_use_codes and self.remaining() > retry_wait:
+                    in_use.append(resource)
+                else:
+                    self.add_error(phase, resource, error)
+            pending = in_use
+            if pending:
+                self.debug('Teardown ' + str(phase) + ': ' + str(len(pending)) + ' still in use, retrying in ' +
+                           str(retry_wait) + 's')
+                time.sleep(retry_wait)
+                retry_wait = min(retry_wait * 2, self.poll_interval)
+        return done
+
+    def wait_for(self, phase, resources, is_done, description):
+        """
+        Polls resources with the shared state monitor until is_done(resource) for all, or the deadline passes
+        :return: list of resources which did not reach the desired state
+        """
+        pending = [resource for resource in resources if not is_done(resource)]
+        if pending:
+            self.debug('Teardown ' + str(phase) + ': waiting for ' + str(len(pending)) + ' to be ' + description)
+        while pending and self.remaining():
+            self.monitor.update(pending)
+            pending = [resource for resource in pending if not is_done(resource)]
+            if pending:
+                self.monitor.wait(pending, max_wait=self.remaining())
+        for resource in pending:
+            self.add_error(phase, resource, 'not ' + description + ' within teardown deadline, state:' +
+                           str(self.monitor.get_state(resource)))
+        return pending
+
+    def get_resources(self, key):
+        return list(self.resources.get(key, []) or [])
+
+    def forget(self, key, resources):
+        """
+        Removes resources which were torn down from the tester's test_resources
+        """
+        remaining = self.resources.get(key)
+        if remaining is None:
+            return
+        for resource in resources:
+            if resource in remaining:
+                remaining.remove(resource)
+
+    def teardown_instances(self, reservations=None):
+        reservations = reservations or self.get_resources('reservations')
+        instances = []
+        for reservation in reservations:
+            if isinstance(reservation, Reservation):
+                instances.extend(reservation.instances or [])
+            elif isinstance(reservation, Instance):
+                instances.append(reservation)
+        if not instances:
+            return 0
+        ec2 = self.tester.ec2
+        ids = list(set([instance.id for instance in instances]))
+        chunks = [ids[index:index + self.max_ids_per_request]
+                  for index in xrange(0, len(ids), self.max_ids_per_request)]
+
+        def terminate(chunk):
+            try:
+                ec2.terminate_instances(instance_ids=chunk)
+            except Exception, e:
+                if not self.is_not_found(e):
+                    raise
+                #One of the ids is already gone, which fails the whole batch. Send the rest one at a time.
+                for instance_id in chunk:
+                    try:
+                        ec2.terminate_instances(instance_ids=[instance_id])
+                    except Exception, e:
+                        if not self.is_not_found(e):
+                            raise
+        self.debug('Teardown instances: terminating ' + str(len(ids)) + ' instances in ' + str(len(chunks)) +
+                   ' requests')
+        #Only wait on instances whose terminate request went through, failed chunks were already reported
+        terminated_ids = set()
+        for chunk in self.send_all('instances', chunks, terminate):
+            terminated_ids.update(chunk)
+        terminating = [instance for instance in instances if instance.id in terminated_ids]
+        failed = [instance for instance in instances if instance.id not in terminated_ids]
+        left = self.wait_for('instances', terminating, lambda instance: instance.state == 'terminated',
+                             'terminated') + failed
+        self.forget('reservations', [reservation for reservation in reservations
+                                     if not [instance for instance in left
+                                             if instance in getattr(reservation, 'instances', [reservation])]])
+        return len(instances)
+
+    def teardown_load_balancers(self, lbs=None):
+        lbs = lbs or self.get_resources('load_balancers')
+        if not lbs:
+            return 0
+        done = self.send_all('load_balancers', lbs, lambda lb: self.tester.elb.delete_load_balancer(lb.name))
+        self.forget('load_balancers', done)
+        return len(lbs)
+
+    def teardown_volumes(self, volumes=None):
+        volumes = volumes or self.get_resources('volumes')
+        if not volumes:
+            return 0
+        ec2 = self.tester.ec2
+        self.monitor.update(volumes, force=True)
+        attached = [volume for volume in volumes if volume.status == 'in-use']
+        if attached:
+            self.debug('Teardown volumes: detaching ' + str(len(attached)) + ' volumes')
+            detached = self.send_all('volumes', attached, lambda volume: ec2.detach_volume(volume.id))
+            self.wait_for('volumes', detached, lambda volume: volume.status in ['available', 'deleted', 'error'],
+                          'detached')
+            #Volumes which failed to detach were already reported, deleting them would only retry until the deadline
+            deletable = [volume for volume in volumes if volume not in attached or volume in detached]
+        else:
+            deletable = volumes
+        #Volumes still being created can not be deleted yet
+        self.wait_for('volumes', deletable, lambda volume: volume.status not in ['creating', 'attaching', 'detaching'],
+                      'in a deletable state')
+        deleting = [volume for volume in deletable if volume.status != 'deleted']
+        self.debug('Teardown volumes: deleting ' + str(len(deleting)) + ' volumes')
+        deleting = self.send_all('volumes', deleting, lambda volume: ec2.delete_volume(volume.id))
+        left = self.wait_for('volumes', deleting, lambda volume: volume.status == 'deleted', 'deleted')
+        self.forget('volumes', [volume for volume in deletable if volume not in left and volume.status == 'deleted'])
+        return len(volumes)
+
+    def teardown_images(self, images=None):
+        images = images or self.get_resources('images')
+        if not images:
+            return 0
+        ec2 = self.tester.ec2
+
+        def deregister(image):
+            if isinstance(image, Image):
+                image = image.id
+            ec2.deregister_image(str(image))
+        done = self.send_all('images', images, deregister)
+        self.forget('images', done)
+        return len(images)
+
+    def teardown_snapshots(self, snapshots=None):
+        snapshots = snapshots or self.get_resources('snapshots')
+        if not snapshots:
+            return 0
+        ec2 = self.tester.ec2
+        self.wait_for('snapshots', snapshots,
+                      lambda snapshot: snapshot.status in ['completed', 'failed', 'error', 'deleted'],
+                      'completed or failed')
+        deleting = [snapshot for snapshot in snapshots if snapshot.status != 'deleted']
+        self.debug('Teardown snapshots: deleting ' + str(len(deleting)) + ' snapshots')
+        deleting = self.send_all('snapshots', deleting, lambda snapshot: ec2.delete_snapshot(snapshot.id))
+        left = self.wait_for('snapshots', deleting, lambda snapshot: snapshot.status == 'deleted', 'deleted')
+        self.forget('snapshots', [snapshot for snapshot in snapshots
+                                  if snapshot not in left and snapshot.status == 'deleted'])
+        return len(snapshots)
+
+    def teardown_security_groups(self, groups=None):
+        groups = groups or self.get_resources('security-groups')
+        if not groups:
+            return 0
+        done = self.send_all('security-groups', groups, lambda group: group.delete())
+        self.forget('security-groups', done)
+        return len(groups)
+
+    def teardown_keypairs(self, keypairs=None):
+        keypairs = keypairs or self.get_resources('keypairs')
+        if not keypairs:
+            return 0
+        done = self.send_all('keypairs', keypairs, lambda keypair: keypair.delete())
+        self.forget('keypairs', done)
+        return len(keypairs)
+
+    def teardown_buckets(self):
+        buckets = self.get_resources('buckets')
+        keys = self.get_resources('keys')
+        if not buckets and not keys:
+            return 0
+        bucket_names = [bucket.name for bucket in buckets]
+        #Keys in buckets being deleted go with their bucket, delete the others grouped by bucket
+        by_bucket = {}
+        for key in keys:
+            if key.bucket.name not in bucket_names:
+                by_bucket.setdefault(key.bucket.name, (key.bucket, []))[1].append(key)
+        deleted_keys = []
+        for bucket, bucket_keys in by_bucket.values():
+            result = self.tester.delete_keys_bulk(bucket, bucket_keys, concurrency=self.concurrency)
+            failed_names = []
+            for failure in result['failed']:
+                self.add_error('buckets', failure[0], failure[2])
+                failed_names.append(failure[0])
+            deleted_keys.extend([key for key in bucket_keys if key.name not in failed_names])
+
+        def clear(bucket, listing):
+            result = self.tester.delete_keys_bulk(bucket, listing, concurrency=self.concurrency)
+            if result['failed']:
+                raise Exception(str(len(result['failed'])) + ' keys could not be deleted, first:' +
+                                str(result['failed'][0]))
+
+        def delete_bucket(bucket):
+            clear(bucket, bucket.list())
+            try:
+                bucket.delete()
+            except S3ResponseError, e:
+                if e.status != 409:
+                    raise
+                #Bucket still holds versions or delete markers
+                clear(bucket, bucket.list_versions())
+                bucket.delete()
+        done = self.send_all('buckets', buckets, delete_bucket)
+        self.forget('buckets', done)
+        #Keys which failed to delete, or whose bucket failed to delete, are kept for a later teardown or reaper run
+        done_names = [bucket.name for bucket in done]
+        deleted_keys.extend([key for key in keys if key.bucket.name in done_names])
+        self.forget('keys', deleted_keys)
+        return len(buckets) + len(keys)
+
+    def teardown_other(self):
+        count = 0
+        handled = self.resource_keys.values() + ['keys']
+        for key in self.resources.keys():
+            if key in handled:
+                continue
+            resources = self.get_resources(key)
+            if not resources:
+                continue
+            count += len(resources)
+            done = self.send_all(key, resources, lambda resource: resource.delete())
+            self.forget(key, done)
+        return count
+
+    def run(self, skip=None):
+        """
+        Runs each teardown phase in order
+        :param skip: list of phase names not to run, ie ['instances', 'snapshots']
+        :return: list of error strings, empty if everything was removed
+        """
+        skip = skip or []
+        start = time.time()
+        self.end = start + self.deadline
+        self.errors = []
+        self.summary = {}
+        for phase in self.phases:
+            if phase in skip:
+                continue
+            if not self.remaining():
+                self.add_error(phase, 'phase', 'not started, teardown deadline of ' + str(self.deadline) +
+                               's passed')
+                continue
+            phase_start = time.time()
+            errors = len(self.errors)
+            try:
+                count = getattr(self, 'teardown_' + phase.replace('-', '_'))()
+            except Exception, e:
+                count = None
+                self.add_error(phase, 'phase', e)
+            self.summary[phase] = {'count': count,
+                                   'errors': len(self.errors) - errors,
+                                   'elapsed': time.time() - phase_start}
+        self.debug('Teardown finished in ' + str(int(time.time() - start)) + 's, describe requests:' +
+                   str(self.monitor.api_calls) + ', errors:' + str(len(self.errors)))
+        return self.errors
+
+    def show_summary(self, printmethod=None):
+        printmethod = printmethod or self.debug
+        buf = 'PHASE'.ljust(18) + 'COUNT'.ljust(8) + 'ERRORS'.ljust(8) + 'ELAPSED\n'
+        for phase in self.phases:
+            if phase not in self.summary:
+                continue
+            result = self.summary[phase]
+            buf += phase.ljust(18) + str(result['count']).ljust(8) + str(result['errors']).ljust(8) + \
+                   '%.1f' % result['elapsed'] + 's\n'
+        printmethod(buf)
+        return buf
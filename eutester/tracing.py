@@ -0,0 +1,398 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Timing and tracing spans for cloud api calls, remote commands, waits and test units.
+
+A span records the kind ('boto', 'ssh', 'winrm', 'wait', 'sleep', 'testunit'), a name (ie the api action or
+command), start/duration, and kind specific attributes (service, http status, retries, host, exit status...).
+Spans nest per thread, so boto requests and ssh commands made while a test unit runs are children of that
+unit's span, and a wait's 'self' time (its duration minus its children) is the time eutester spent sleeping.
+
+Tracing is off by default and costs a single attribute check per instrumented call until enabled.
+When enabled each finished span is written as one json line to the trace file, and per kind/name totals are
+kept for an end of run summary of the top time sinks.
+
+example usage:
+    from eutester import tracing
+    tracing.enable('/tmp/mytest.trace.jsonl')
+    with tracing.span('wait', 'my_wait_loop', timeout=60):
+        ...
+    print tracing.tracer.get_summary()
+
+Boto connections are instrumented with trace_boto_connection(), which eucaops does for each connection it
+creates. EutesterTestCase enables tracing when the --trace-file arg is given.
+'''
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+
+class Span():
+    def __init__(self, tracer, kind, name, attrs=None):
+        self.tracer = tracer
+        self.kind = kind
+        self.name = str(name)
+        self.attrs = attrs or {}
+        self.id = None
+        self.parent = None
+        self.start = None
+        self.duration = None
+        self.child_time = 0.0
+        self.thread = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, **attrs):
+        self.attrs.update(attrs)
+        self.tracer.finish(self)
+
+    def __enter__(self):
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.attrs['error'] = str(exc_value)[:200] or exc_type.__name__
+        self.tracer.finish(self)
+        return False
+
+    def to_dict(self):
+        ret = {'id': self.id,
+               'parent': self.parent and self.parent.id,
+               'kind': self.kind,
+               'name': self.name,
+               'start': round(self.start, 6),
+               'duration': round(self.duration, 6),
+               'self_time': round(self.duration - self.child_time, 6),
+               'thread': self.thread}
+        ret.update(self.attrs)
+        return ret
+
+
+class NullSpan():
+    '''
+    Returned when tracing is disabled, all operations are no-ops
+    '''
+    id = None
+
+    def set(self, **attrs):
+        pass
+
+    def finish(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+null_span = NullSpan()
+
+
+class Tracer():
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.fh = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.next_id = 0
+        self.stats = {}
+        self.kind_stats = {}
+
+    def enable(self, path=None):
+        '''
+        Starts recording spans.
+        :param path: optional file path json lines are appended to. Summary stats are kept either way.
+        '''
+        self.lock.acquire()
+        try:
+            if path and path != self.path:
+                if self.fh:
+                    self.fh.close()
+                dirname = os.path.dirname(path)
+                if dirname and not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                self.fh = open(path, 'a')
+                self.path = path
+            self.enabled = True
+        finally:
+            self.lock.release()
+
+    def disable(self):
+        self.lock.acquire()
+        try:
+            self.enabled = False
+            if self.fh:
+                self.fh.close()
+            self.fh = None
+            self.path = None
+        finally:
+            self.lock.release()
+
+    def reset_stats(self):
+        self.lock.acquire()
+        try:
+            self.stats = {}
+            self.kind_stats = {}
+        finally:
+            self.lock.release()
+
+    def get_stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def current(self):
+        '''
+        Returns the innermost open span for this thread, or None
+        '''
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return None
+
+    def span(self, kind, name, **attrs):
+        '''
+        Returns a span to be used as a context manager; 'with tracer.span(...) as span:'
+        '''
+        if not self.enabled:
+            return null_span
+        return Span(self, kind, name, attrs)
+
+    def start(self, kind, name, **attrs):
+        '''
+        Opens and returns a span, the caller must call span.finish()
+        '''
+        if not self.enabled:
+            return null_span
+        span = Span(self, kind, name, attrs)
+        self.push(span)
+        return span
+
+    def push(self, span):
+        stack = self.get_stack()
+        self.lock.acquire()
+        try:
+            self.next_id += 1
+            span.id = self.next_id
+        finally:
+            self.lock.release()
+        span.parent = stack and stack[-1] or None
+        span.thread = threading.current_thread().name
+        span.start = time.time()
+        stack.append(span)
+
+    def finish(self, span):
+        if span.start is None or span.duration is not None:
+            return
+        span.duration = time.time() - span.start
+        stack = self.get_stack()
+        #Close any children left open by an exception path along with this span
+        if span in stack:
+            del stack[stack.index(span):]
+        if span.parent is not None:
+            span.parent.child_time += span.duration
+        self_time = span.duration - span.child_time
+        line = None
+        if self.fh:
+            line = json.dumps(span.to_dict(), default=str)
+        self.lock.acquire()
+        try:
+            stat = self.stats.setdefault((span.kind, span.name), {'count': 0, 'total': 0.0, 'self': 0.0,
+                                                                 'max': 0.0, 'errors': 0})
+            stat['count'] += 1
+            stat['total'] += span.duration
+            stat['self'] += self_time
+            stat['max'] = max(stat['max'], span.duration)
+            if 'error' in span.attrs:
+                stat['errors'] += 1
+            kind_stat = self.kind_stats.setdefault(span.kind, {'count': 0, 'self': 0.0})
+            kind_stat['count'] += 1
+            kind_stat['self'] += self_time
+            if line and self.fh:
+                self.fh.write(line + "\n")
+                self.fh.flush()
+        finally:
+            self.lock.release()
+
+    def get_summary(self, top=15):
+        '''
+        Returns a string table of the top time sinks by total time, plus the self time spent per kind
+        (ie boto vs ssh vs waiting/sleeping in eutester itself).
+        '''
+        self.lock.acquire()
+        try:
+            stats = sorted(self.stats.items(), key=lambda item: item[1]['total'], reverse=True)
+            kind_stats = sorted(self.kind_stats.items(), key=lambda item: item[1]['self'], reverse=True)
+        finally:
+            self.lock.release()
+        line = "\n" + "-" * 118 + "\n"
+        buf = line + "TRACE SUMMARY, TOP " + str(top) + " TIME SINKS" + line
+        buf += str('KIND').ljust(10) + "|" + str('NAME').ljust(50) + "|" + str('COUNT').center(8) + "|" + \
+               str('TOTAL(s)').center(11) + "|" + str('SELF(s)').center(11) + "|" + str('AVG(s)').center(9) + \
+               "|" + str('MAX(s)').center(9) + "|" + str('ERRS').center(6) + line
+        for (kind, name), stat in stats[:top]:
+            buf += str(kind).ljust(10) + "|" + str(name)[:50].ljust(50) + "|" + str(stat['count']).center(8) + \
+                   "|" + str("%.3f" % stat['total']).center(11) + "|" + str("%.3f" % stat['self']).center(11) + \
+                   "|" + str("%.3f" % (stat['total'] / stat['count'])).center(9) + \
+                   "|" + str("%.3f" % stat['max']).center(9) + "|" + str(stat['errors']).center(6) + "\n"
+        buf += line.lstrip("\n") + "SELF TIME BY KIND:\n"
+        for kind, stat in kind_stats:
+            buf += str(kind).ljust(10) + "|" + str(stat['count']).center(8) + "|" + \
+                   str("%.3f" % stat['self']).center(11) + "\n"
+        return buf
+
+    def show_summary(self, printmethod=None, top=15):
+        summary = self.get_summary(top=top)
+        if printmethod:
+            printmethod(summary)
+        else:
+            print summary
+        return summary
+
+
+tracer = Tracer()
+
+
+def enable(path=None):
+    tracer.enable(path)
+
+
+def disable():
+    tracer.disable()
+
+
+def span(kind, name, **attrs):
+    return tracer.span(kind, name, **attrs)
+
+
+def traced(kind, name=None):
+    '''
+    Decorator which records a span around each call of the decorated method.
+    usage:
+    @traced('wait')
+    def wait_for_volume(self, volume, status="available"):
+    '''
+    def decorator(func):
+        spanname = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(kind, spanname):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+#Query params which select an S3 operation rather than filter it, ie '?uploads' or '?delete'
+s3_subresources = ['acl', 'cors', 'delete', 'lifecycle', 'location', 'logging', 'notification', 'partNumber',
+                   'policy', 'requestPayment', 'restore', 'tagging', 'torrent', 'uploadId', 'uploads', 'versionId',
+                   'versioning', 'versions', 'website']
+
+
+def get_rest_operation(method, path):
+    '''
+    Returns a bounded span name for a REST (ie S3) request which has no 'Action' param: the method, whether the
+    request is for the service, a bucket or an object, and any subresources. ie "PUT object?partNumber&uploadId"
+    The bucket and key names are left out, so the stats do not grow with every object used.
+    :param method: http method
+    :param path: path style request path, ie '/bucket/key?uploads'
+    '''
+    path, _, query = str(path).partition('?')
+    segments = [segment for segment in path.split('/') if segment]
+    if not segments:
+        target = 'service'
+    elif len(segments) == 1:
+        target = 'bucket'
+    else:
+        target = 'object'
+    subresources = sorted(set([param.split('=')[0] for param in query.split('&')
+                               if param.split('=')[0] in s3_subresources]))
+    if subresources:
+        target += '?' + '&'.join(subresources)
+    return str(method) + " " + target
+
+
+def trace_boto_connection(connection, service=None):
+    '''
+    Records a 'boto' span for every request made through the given boto connection, including the
+    service, action, http status and number of retries. Only this connection object is modified.
+    :param connection: boto connection object, ie tester.ec2
+    :param service: service name used in the span, defaults to the connection's class name
+    '''
+    if connection is None or getattr(connection, '_eutester_traced', False):
+        return connection
+    service = service or connection.__class__.__name__
+    mexe = connection._mexe
+
+    def traced_mexe(request, *args, **kwargs):
+        if not tracer.enabled:
+            return mexe(request, *args, **kwargs)
+        params = getattr(request, 'params', None) or {}
+        action = params.get('Action')
+        attrs = {}
+        if not action:
+            #S3 requests carry the bucket in the host for virtual hosted calling formats, auth_path is path style
+            path = getattr(request, 'auth_path', None) or request.path
+            action = get_rest_operation(request.method, path)
+            attrs['path'] = str(request.path)[:200]
+        span = tracer.start('boto', str(service) + "." + str(action), service=service, host=request.host, **attrs)
+        attempts = [0]
+        authorize = request.authorize
+
+        def counting_authorize(*auth_args, **auth_kwargs):
+            #boto re-signs the request on each attempt
+            attempts[0] += 1
+            return authorize(*auth_args, **auth_kwargs)
+        request.authorize = counting_authorize
+        try:
+            response = mexe(request, *args, **kwargs)
+            span.set(status=getattr(response, 'status', None))
+            return response
+        except Exception, e:
+            span.set(error=str(e)[:200], status=getattr(e, 'status', None))
+            raise
+        finally:
+            try:
+                del request.authorize
+            except AttributeError:
+                pass
+            span.finish(attempts=attempts[0], retries=max(attempts[0] - 1, 0))
+    connection._mexe = traced_mexe
+    connection._eutester_traced = True
+    return connection
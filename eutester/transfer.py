@@ -0,0 +1,485 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Parallel, resumable, verified file transfer for large artifacts (images, kernels, logs) between the local host and
+remote machines, or directly between two remote machines.
+
+A file is split into chunks, and a pool of streams transfers chunks concurrently. Each stream has its own sftp
+channel to each remote end; reads are issued as many outstanding requests (readv) and writes are pipelined, so a
+stream is not limited by one request per round trip. Machine to machine copies read each chunk from the source's
+sftp channel and write it into the destination's channel(s) in memory, nothing is written to local disk. A copy
+may fan out to several destinations, reading the source once.
+
+The md5 of each chunk is computed as the data passes through. When resuming, chunks already present at the
+destination are found by comparing sizes, then per chunk md5s computed on each end (with dd | md5sum on remote
+machines), and only missing or differing chunks are sent. After the transfer the destination's chunk md5s are
+checked against those of the source data.
+
+example usage:
+    transfer = FileTransfer(streams=4, chunk_size=8388608)
+    transfer.put(clc, '/tmp/centos.img', '/disk1/storage/centos.img')
+    transfer.get(clc, '/var/log/eucalyptus/cloud-output.log', '/tmp/cloud-output.log')
+    #Copy from the clc to 2 nodes without staging on the test host
+    transfer.copy(clc, '/disk1/storage/centos.img', [nc1, nc2], '/disk1/storage/centos.img')
+'''
+import hashlib
+import os
+import Queue
+import threading
+import time
+import paramiko
+from concurrent.futures import ThreadPoolExecutor
+
+DefaultChunkSize = 8388608
+#Max data per sftp read/write request
+DefaultRequestSize = 32768
+
+
+def shell_quote(value):
+    return "'" + str(value).replace("'", "'\\''") + "'"
+
+
+class LocalFile():
+    '''
+    A file on the local host as a transfer source or destination
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return 'localhost:' + str(self.path)
+
+    def get_size(self):
+        if not os.path.exists(self.path):
+            return None
+        return os.path.getsize(self.path)
+
+    def prepare(self):
+        '''
+        Create the file if it does not exist, leaving any existing data for resume
+        '''
+        open(self.path, 'ab').close()
+
+    def truncate(self, size):
+        with open(self.path, 'r+b') as out:
+            out.truncate(size)
+
+    def open(self, write=False):
+        if write:
+            return open(self.path, 'r+b')
+        return open(self.path, 'rb')
+
+    def read(self, handle, offset, length):
+        handle.seek(offset)
+        return handle.read(length)
+
+    def write(self, handle, offset, data):
+        handle.seek(offset)
+        handle.write(data)
+
+    def close(self, handle):
+        handle.close()
+
+    def get_chunk_digests(self, chunks):
+        '''
+        :param chunks: list of (index, offset, length)
+        :returns: dict of {index: md5 hex digest}
+        '''
+        digests = {}
+        with open(self.path, 'rb') as infile:
+            for index, offset, length in chunks:
+                infile.seek(offset)
+                digests[index] = hashlib.md5(infile.read(length)).hexdigest()
+        return digests
+
+
+class RemoteFile():
+    '''
+    A file on a remote machine as a transfer source or destination
+    '''
+    def __init__(self, ssh, path, request_size=DefaultRequestSize, timeout=120):
+        '''
+        :param ssh: SshConnection, or Machine obj with an ssh connection
+        :param path: path of the file on the remote machine
+        '''
+        self.ssh = getattr(ssh, 'ssh', ssh)
+        self.path = path
+        self.request_size = request_size
+        self.timeout = timeout
+
+    def __str__(self):
+        return str(self.ssh.host) + ':' + str(self.path)
+
+    def open_sftp(self):
+        '''
+        Opens an sftp client on its own channel, leased from the transport pool if the connection is pooled
+        '''
+        if not self.ssh.connection.get_transport():
+            self.ssh.refresh_connection()
+        transport = self.ssh.connection.get_transport()
+        channel = self.ssh.open_session(transport, timeout=self.timeout)
+        try:
+            channel.invoke_subsystem('sftp')
+            return paramiko.SFTPClient(channel), transport
+        except:
+            channel.close()
+            self.ssh.release_session(transport)
+            raise
+
+    def close_sftp(self, sftp, transport):
+        try:
+            sftp.close()
+        finally:
+            self.ssh.release_session(transport)
+
+    def get_size(self):
+        sftp, transport = self.open_sftp()
+        try:
+            return sftp.stat(self.path).st_size
+        except IOError, io:
+            #IOError: [Errno 2] No such file
+            if io.errno == 2:
+                return None
+            raise
+        finally:
+            self.close_sftp(sftp, transport)
+
+    def prepare(self):
+        sftp, transport = self.open_sftp()
+        try:
+            sftp.open(self.path, 'a').close()
+        finally:
+            self.close_sftp(sftp, transport)
+
+    def truncate(self, size):
+        sftp, transport = self.open_sftp()
+        try:
+            sftp.truncate(self.path, size)
+        finally:
+            self.close_sftp(sftp, transport)
+
+    def open(self, write=False):
+        sftp, transport = self.open_sftp()
+        try:
+            if write:
+                remote_file = sftp.open(self.path, 'r+b')
+                #Don't wait for each write to be acknowledged, errors are raised when the file is closed
+                remote_file.set_pipelined(True)
+            else:
+                remote_file = sftp.open(self.path, 'rb')
+        except:
+            self.close_sftp(sftp, transport)
+            raise
+        return sftp, transport, remote_file
+
+    def read(self, handle, offset, length):
+        remote_file = handle[2]
+        requests = []
+        position = offset
+        end = offset + length
+        while position < end:
+            requests.append((position, min(self.request_size, end - position)))
+            position += self.request_size
+        #readv sends all the read requests before waiting on the replies
+        return "".join(remote_file.readv(requests))
+
+    def write(self, handle, offset, data):
+        remote_file = handle[2]
+        remote_file.seek(offset)
+        remote_file.write(data)
+
+    def close(self, handle):
+        sftp, transport, remote_file = handle
+        try:
+            remote_file.close()
+        finally:
+            self.close_sftp(sftp, transport)
+
+    def get_chunk_digests(self, chunks):
+        '''
+        Computes chunk md5s on the remote machine rather than reading the data back. Falls back to reading over
+        sftp if dd/md5sum are not available.
+        :param chunks: list of (index, offset, length) with all offsets a multiple of the first chunk's length
+        :returns: dict of {index: md5 hex digest}
+        '''
+        if not chunks:
+            return {}
+        chunk_size = max(length for index, offset, length in chunks)
+        if all(offset == index * chunk_size for index, offset, length in chunks):
+            full = [index for index, offset, length in chunks if length == chunk_size]
+            dd = 'dd if=' + shell_quote(self.path) + ' bs=' + str(chunk_size)
+            cmds = []
+            if full:
+                cmds.append('for i in ' + " ".join(str(index) for index in full) + '; do ' + dd +
+                            ' skip=$i count=1 2>/dev/null | md5sum; done')
+            #The file's last chunk is short, the remote file may extend past it
+            for index, offset, length in chunks:
+                if length != chunk_size:
+                    cmds.append(dd + ' skip=' + str(index) + ' count=1 2>/dev/null | head -c ' + str(length) +
+                                ' | md5sum')
+            cmd = '; '.join(cmds)
+            order = full + [index for index, offset, length in chunks if length != chunk_size]
+            total = sum(length for index, offset, length in chunks)
+            try:
+                output = self.ssh.sys(cmd, code=0, timeout=max(self.timeout, total / 20971520))
+                digests = [line.split()[0] for line in output if line.strip()]
+                if len(digests) == len(chunks):
+                    return dict(zip(order, digests))
+                self.ssh.debug('Unexpected md5sum output for ' + str(self) + ', reading chunks over sftp instead')
+            except Exception, e:
+                self.ssh.debug('Could not md5sum chunks of ' + str(self) + ', reading chunks over sftp instead:' +
+                               str(e))
+        digests = {}
+        handle = self.open()
+        try:
+            for index, offset, length in chunks:
+                digests[index] = hashlib.md5(self.read(handle, offset, length)).hexdigest()
+        finally:
+            self.close(handle)
+        return digests
+
+
+class FileTransfer():
+    def __init__(self,
+                 streams=4,
+                 chunk_size=DefaultChunkSize,
+                 request_size=DefaultRequestSize,
+                 resume=True,
+                 verify=True,
+                 timeout=120,
+                 debugmethod=None):
+        """
+        :param streams: number of chunks transferred concurrently, each stream opens its own channel per remote end.
+                        Note sshd's MaxSessions (10) and SshTransportPool.max_channels_per_host limit the channels
+                        to a single host.
+        :param chunk_size: bytes per chunk, the unit of concurrency, resume and verification
+        :param request_size: max bytes per sftp read/write request
+        :param resume: if the destination exists, only send chunks that are missing or differ
+        :param verify: compare the destination's chunk md5s with the source data's after the transfer
+        :param timeout: seconds to wait for a free pooled channel, and min timeout for remote md5sum commands
+        :param debugmethod: method used for debug output
+        """
+        self.streams = streams
+        self.chunk_size = chunk_size
+        self.request_size = request_size
+        self.resume = resume
+        self.verify = verify
+        self.timeout = timeout
+        self.debugmethod = debugmethod
+
+    def debug(self, msg):
+        if self.debugmethod:
+            self.debugmethod(msg)
+        else:
+            print msg
+
+    def get_endpoint(self, ssh, path):
+        if ssh is None:
+            return LocalFile(path)
+        return RemoteFile(ssh, path, request_size=self.request_size, timeout=self.timeout)
+
+    def put(self, ssh, localpath, remotepath):
+        '''
+        Copy a local file to a remote machine
+        :param ssh: SshConnection or Machine
+        :returns: dict of transfer stats, see transfer()
+        '''
+        return self.transfer(LocalFile(localpath), [self.get_endpoint(ssh, remotepath)])
+
+    def get(self, ssh, remotepath, localpath):
+        '''
+        Copy a file from a remote machine to the local host
+        :param ssh: SshConnection or Machine
+        :returns: dict of transfer stats, see transfer()
+        '''
+        return self.transfer(self.get_endpoint(ssh, remotepath), [LocalFile(localpath)])
+
+    def copy(self, src_ssh, src_path, dst_ssh, dst_path=None):
+        '''
+        Copy a file from one remote machine to one or more others, streaming through memory on this host.
+        :param src_ssh: SshConnection or Machine to copy from
+        :param dst_ssh: SshConnection or Machine, or list of them, to copy to
+        :param dst_path: destination path, defaults to src_path
+        :returns: dict of transfer stats, see transfer()
+        '''
+        if not isinstance(dst_ssh, (list, tuple)):
+            dst_ssh = [dst_ssh]
+        dst_path = dst_path or src_path
+        return self.transfer(self.get_endpoint(src_ssh, src_path),
+                             [self.get_endpoint(ssh, dst_path) for ssh in dst_ssh])
+
+    def get_chunks(self, size):
+        chunks = []
+        for index, offset in enumerate(xrange(0, size, self.chunk_size)):
+            chunks.append((index, offset, min(self.chunk_size, size - offset)))
+        return chunks
+
+    def transfer(self, source, destinations):
+        '''
+        Transfer source to each of the destinations.
+        :param source: LocalFile or RemoteFile
+        :param destinations: list of LocalFile or RemoteFile
+        :returns: dict with 'size', 'chunks', 'chunks_sent', 'chunks_skipped', 'bytes_sent', 'elapsed', 'mbps'
+                  and 'md5', the md5 of the concatenated chunk md5s
+        '''
+        start = time.time()
+        size = source.get_size()
+        if size is None:
+            raise Exception('Transfer source not found:' + str(source))
+        chunks = self.get_chunks(size)
+        source_digests = {}
+        needed = {}
+        for dest in destinations:
+            needed[dest] = self.get_needed_chunks(source, dest, chunks, source_digests)
+            dest.prepare()
+        indexes = sorted(set().union(*needed.values()))
+        self.debug('Transferring ' + str(source) + ' to ' + ", ".join(str(dest) for dest in destinations) +
+                   ', size:' + str(size) + ', chunks:' + str(len(indexes)) + '/' + str(len(chunks)) +
+                   ', streams:' + str(self.streams))
+        work = Queue.Queue()
+        for index in indexes:
+            work.put(chunks[index])
+        stop = threading.Event()
+        bytes_sent = 0
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.streams, len(indexes))))
+        try:
+            futures = [executor.submit(self._run_stream, source, destinations, needed, work, source_digests, stop)
+                       for x in xrange(min(self.streams, len(indexes)))]
+            try:
+                for future in futures:
+                    bytes_sent += future.result()
+            except:
+                stop.set()
+                raise
+        finally:
+            executor.shutdown(wait=True)
+        for dest in destinations:
+            dest_size = dest.get_size()
+            if dest_size != size:
+                dest.truncate(size)
+        if self.verify:
+            self.verify_chunks(source_digests, destinations, chunks)
+        elapsed = time.time() - start
+        result = {'size': size,
+                  'chunks': len(chunks),
+                  'chunks_sent': len(indexes),
+                  'chunks_skipped': len(chunks) - len(indexes),
+                  'bytes_sent': bytes_sent,
+                  'elapsed': elapsed,
+                  'mbps': bytes_sent / 1048576.0 / max(elapsed, 0.001),
+                  'md5': self.get_combined_digest(source_digests, chunks)}
+        self.debug('Transferred ' + str(source) + ', sent ' + str(bytes_sent) + ' bytes in ' +
+                   str(len(indexes)) + ' chunks, skipped ' + str(result['chunks_skipped']) + ' chunks, ' +
+                   "%.2f" % elapsed + 's (' + "%.2f" % result['mbps'] + 'MB/s)')
+        return result
+
+    def get_needed_chunks(self, source, dest, chunks, source_digests):
+        '''
+        Returns the set of chunk indexes which need to be sent to dest. Without resume, or if dest does not exist,
+        all chunks are needed. Otherwise chunks which lie within the destination's current size are compared by
+        md5 and only those that differ are needed.
+        '''
+        all_chunks = set(index for index, offset, length in chunks)
+        if not self.resume:
+            return all_chunks
+        dest_size = dest.get_size()
+        if not dest_size:
+            return all_chunks
+        candidates = [chunk for chunk in chunks if chunk[1] + chunk[2] <= dest_size]
+        if not candidates:
+            return all_chunks
+        missing = [chunk for chunk in candidates if chunk[0] not in source_digests]
+        #Compute both ends' digests at the same time
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            source_future = executor.submit(source.get_chunk_digests, missing)
+            dest_digests = dest.get_chunk_digests(candidates)
+            source_digests.update(source_future.result())
+        finally:
+            executor.shutdown(wait=True)
+        present = set(index for index, offset, length in candidates
+                      if dest_digests.get(index) == source_digests.get(index))
+        self.debug('Resuming transfer to ' + str(dest) + ', size:' + str(dest_size) + ', ' + str(len(present)) +
+                   '/' + str(len(chunks)) + ' chunks already present')
+        return all_chunks - present
+
+    def _run_stream(self, source, destinations, needed, work, source_digests, stop):
+        '''
+        Transfers chunks from the work queue until it is empty, using its own handle to each end.
+        Returns the number of bytes read from the source.
+        '''
+        sent = 0
+        handles = {}
+        completed = False
+        try:
+            handles[source] = source.open()
+            for dest in destinations:
+                handles[dest] = dest.open(write=True)
+            while not stop.is_set():
+                try:
+                    index, offset, length = work.get_nowait()
+                except Queue.Empty:
+                    break
+                data = source.read(handles[source], offset, length)
+                if len(data) != length:
+                    raise Exception('Short read from ' + str(source) + ' at offset:' + str(offset) + ', got ' +
+                                    str(len(data)) + ' of ' + str(length) + ' bytes')
+                source_digests[index] = hashlib.md5(data).hexdigest()
+                for dest in destinations:
+                    if index in needed[dest]:
+                        dest.write(handles[dest], offset, data)
+                sent += length
+            completed = True
+        finally:
+            errors = []
+            for endpoint, handle in handles.iteritems():
+                try:
+                    endpoint.close(handle)
+                except Exception, e:
+                    errors.append(str(endpoint) + ':' + str(e))
+            #Don't mask an error already being raised
+            if errors and completed:
+                raise Exception('Errors closing transfer streams:' + ", ".join(errors))
+        return sent
+
+    def verify_chunks(self, source_digests, destinations, chunks):
+        for dest in destinations:
+            dest_digests = dest.get_chunk_digests(chunks)
+            bad = [index for index, offset, length in chunks if dest_digests.get(index) != source_digests.get(index)]
+            if bad:
+                raise Exception('Transfer to ' + str(dest) + ' failed verification, ' + str(len(bad)) +
+                                ' chunks differ from the source, first:' + str(bad[:10]))
+            self.debug('Verified ' + str(len(chunks)) + ' chunks of ' + str(dest))
+
+    def get_combined_digest(self, digests, chunks):
+        combined = hashlib.md5()
+        for index, offset, length in chunks:
+            combined.update(digests.get(index, ''))
+        return combined.hexdigest()
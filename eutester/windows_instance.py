@@ -53,6 +53,7 @@ from eutester import Eutester
 from eutester.euvolume import EuVolume
 from eutester import eulogger
 from eutester.taggedresource import TaggedResource
+from eutester.blockdev_index import BlockDevIndex
 from random import randint
 from datetime import datetime
 import winrm_connection
@@ -69,6 +70,9 @@ import operator
 class WinInstanceDiskType():
     gigabyte = 1073741824
     megabyte = 1048576
+    #wmic keys which, if changed, require this object to be rebuilt rather than refreshed in place
+    signature_keys = ['size']
+
     def __init__(self, win_instance, wmic_dict):
         self.check_dict_requires(wmic_dict)
         self.__dict__ =  self.convert_numbers_in_dict(copy.copy(wmic_dict))
@@ -85,6 +89,29 @@ class WinInstanceDiskType():
     def check_dict_requires(self, wmic_dict):
         raise Exception('Not Implemented')
 
+    def matches_signature(self, wmic_dict):
+        '''
+        Returns True if the signature_keys values in wmic_dict match this object, meaning the underlying
+        device has not changed and the object can be refreshed in place
+        '''
+        wmic_dict = self.convert_numbers_in_dict(copy.copy(wmic_dict))
+        for key in self.signature_keys:
+            if str(wmic_dict.get(key, '')).strip() != str(getattr(self, key, '')).strip():
+                return False
+        return True
+
+    def refresh(self, wmic_dict):
+        '''
+        Updates the wmic derived attributes of this object in place, attributes derived during setup()
+        (ie: cygwin device, ebs info, md5) are kept.
+        '''
+        self.check_dict_requires(wmic_dict)
+        self.__dict__.update(self.convert_numbers_in_dict(copy.copy(wmic_dict)))
+        self.size_in_gb = self.get_size_in_gb()
+        self.size_in_mb = self.get_size_in_mb()
+        self.size = long(self.size or 0)
+        self.last_updated = time.time()
+
     def convert_numbers_in_dict(self, dict):
         #convert strings representing numbers to ints
         for key in dict:
@@ -148,6 +175,16 @@ class WinInstanceDiskType():
 
 
 class WinInstanceDiskDrive(WinInstanceDiskType):
+    signature_keys = ['index', 'serialnumber', 'size', 'pnpdeviceid', 'signature']
+
+    def matches_signature(self, wmic_dict):
+        '''
+        Guests which report no serial number can swap a same size volume in at the same index. Without a serial
+        number or disk signature there is nothing to tell the volumes apart, so always rebuild in that case.
+        '''
+        if not str(wmic_dict.get('serialnumber', '')).strip() and not str(wmic_dict.get('signature', '')).strip():
+            return False
+        return WinInstanceDiskType.matches_signature(self, wmic_dict)
 
     def setup(self):
         if not hasattr(self, 'serialnumber'):
@@ -275,6 +312,7 @@ class WinInstanceDiskDrive(WinInstanceDiskType):
 
 
 class WinInstanceDiskPartition(WinInstanceDiskType):
+    signature_keys = ['name', 'index', 'size']
 
     def setup(self):
         #self.cygwin_scsi_drive = self.win_instance.get_cygwin_scsi_dev_for_windows_drive(drive_id=self.deviceid)
@@ -340,6 +378,7 @@ class WinInstanceDiskPartition(WinInstanceDiskType):
 
 
 class WinInstanceLogicalDisk(WinInstanceDiskType):
+    signature_keys = ['size', 'filesystem', 'volumeserialnumber']
 
     def setup(self):
         self.cygwin_scsi_drive = self.win_instance.get_cygwin_scsi_dev_for_windows_drive(windisk=self)
@@ -389,6 +428,12 @@ class WinInstanceLogicalDisk(WinInstanceDiskType):
 class WinInstance(Instance, TaggedResource):
     gigabyte = 1073741824
     megabyte = 1048576
+    #wmic queries run together in a single round trip by get_disk_inventory()
+    disk_inventory_cmds = {'diskdrive': 'wmic diskdrive list full',
+                           'partition': 'wmic partition list brief /format:textvaluelist.xsl',
+                           'logicaldisk': 'wmic logicaldisk list /format:textvaluelist.xsl',
+                           'partition_to_logicaldisk': 'wmic path Win32_LogicalDiskToPartition get '
+                                                       'Antecedent,Dependent /format:textvaluelist.xsl'}
 
     @classmethod
     def make_euinstance_from_instance(cls,
@@ -408,6 +453,7 @@ class WinInstance(Instance, TaggedResource):
                                       try_non_root_exec=True,
                                       winrm_port='5985',
                                       winrm_protocol='http',
+                                      winrm_persist_shell=True,
                                       rdp_port='3389',
                                       rootfs_device = "sda",
                                       block_device_prefix = "sd",
@@ -432,6 +478,8 @@ class WinInstance(Instance, TaggedResource):
         debugmethod - optional - method, used for debug output
         verbose - optional - boolean to determine if debug is to be printed using debug()
         retry - optional - integer, ssh connection attempts for non-authentication failures
+        winrm_persist_shell - optional - boolean, if True one winrm shell is reused across commands rather than
+                              opening a new shell per command
         '''
         newins = WinInstance(instance.connection)
         newins.__dict__ = instance.__dict__
@@ -439,6 +487,7 @@ class WinInstance(Instance, TaggedResource):
         newins.winrm_port = winrm_port
         newins.rdp_port = rdp_port
         newins.winrm_protocol = winrm_protocol
+        newins.winrm_persist_shell = winrm_persist_shell
         newins.debugmethod = debugmethod
         if newins.debugmethod is None:
             newins.logger = eulogger.Eulogger(identifier= str(instance.id))
@@ -479,7 +528,11 @@ class WinInstance(Instance, TaggedResource):
         newins.diskdrives = []
         newins.disk_partitions = []
         newins.logicaldisks = []
+        newins.diskdrive_map = {}
+        newins.partition_map = {}
+        newins.logicaldisk_map = {}
         newins.cygwin_dev_map  = {}
+        newins.blockdev_index = None
         #newins.set_block_device_prefix()
         if newins.root_device_type == 'ebs':
             try:
@@ -642,7 +695,8 @@ class WinInstance(Instance, TaggedResource):
                                                            port = self.winrm_port,
                                                            protocol = self.winrm_protocol,
                                                            debug_method = self.debug,
-                                                           verbose=True
+                                                           verbose=True,
+                                                           persist_shell = self.winrm_persist_shell
                                                            )
 
 
@@ -768,6 +822,19 @@ class WinInstance(Instance, TaggedResource):
             raise Exception("WinInstance winrm connection is None")
         return self.winrm.sys(command=cmd, include_stderr=include_stderr, timeout=timeout, verbose=verbose, code=code)
 
+    def sys_batch(self, cmds, verbose=True, code=None, timeout=None):
+        '''
+        Issues a list of commands against the winrm connection to this instance in a single shell round trip
+        Returns a list containing the list of stdout lines for each command
+        cmds - mandatory - list of strings, the commands to be executed in order
+        verbose - optional - boolean flag to enable debug
+        code - optional - if not None, each command must return this status code or an exception is raised
+        timeout - optional - timeout in seconds for the batch
+        '''
+        if (self.winrm is None):
+            raise Exception("WinInstance winrm connection is None")
+        return self.winrm.sys_batch(cmds, timeout=timeout, verbose=verbose, code=code)
+
 
 
 
@@ -987,18 +1054,103 @@ class WinInstance(Instance, TaggedResource):
 
 
     def update_disk_info(self , forceupdate=False):
+        '''
+        Updates self.diskdrives, self.disk_partitions, self.logicaldisks and their associations from a single
+        inventory round trip, see get_disk_inventory(). Existing objects whose device is unchanged are refreshed
+        in place; only new devices, or those whose serial number or size changed, are rebuilt.
+        :param forceupdate: boolean. Will force an update, otherwise this method will wait a minimum of
+        self.disk_update_interval before updating again.
+        '''
         if self.diskdrives:
             if not forceupdate and (time.time() - self.diskdrives[0].last_updated) <= self.disk_update_interval:
                 return
         self.debug('Fetching updated disk info...')
-        self.diskdrives = []
-        self.disk_partitions = []
-        self.logicaldisks = []
-        self.diskdrives =  self.get_updated_diskdrive_info()
-        self.disk_partitions = self.get_updated_partition_info()
-        self.logicaldisks = self.get_updated_logicaldisk_info()
+        inventory = self.get_disk_inventory()
+        self.diskdrives = self.merge_disk_info(WinInstanceDiskDrive, self.diskdrives,
+                                               inventory['diskdrive'], key='deviceid')
+        self.disk_partitions = self.merge_disk_info(WinInstanceDiskPartition, self.disk_partitions,
+                                                    inventory['partition'], key='name')
+        self.logicaldisks = self.merge_disk_info(WinInstanceLogicalDisk, self.logicaldisks,
+                                                 inventory['logicaldisk'], key='deviceid')
+        self.update_disk_maps()
         self.associate_diskdrives_to_partitions()
-        self.associate_partitions_to_logicaldrives()
+        self.associate_partitions_to_logicaldrives(associations=inventory['partition_to_logicaldisk'])
+
+    def get_disk_inventory(self, verbose=False):
+        '''
+        Fetches diskdrive, partition, logicaldisk and partition to logicaldisk association info from the guest in
+        a single winrm round trip.
+        :returns dict with keys 'diskdrive', 'partition' and 'logicaldisk' containing lists of parsed wmic dicts,
+                 and 'partition_to_logicaldisk' containing a list of (partition deviceid, logicaldisk deviceid)
+        '''
+        keys = ['diskdrive', 'partition', 'logicaldisk', 'partition_to_logicaldisk']
+        outputs = self.sys_batch([self.disk_inventory_cmds[key] for key in keys], verbose=verbose, code=0)
+        inventory = {}
+        for key, output in zip(keys, outputs):
+            inventory[key] = self.parse_wmic_output(output)
+        associations = []
+        for assoc in inventory['partition_to_logicaldisk']:
+            part_id = self.get_wmic_path_deviceid(assoc.get('antecedent'))
+            drive_id = self.get_wmic_path_deviceid(assoc.get('dependent'))
+            if part_id and drive_id:
+                associations.append((part_id, drive_id))
+        inventory['partition_to_logicaldisk'] = associations
+        return inventory
+
+    @staticmethod
+    def get_wmic_path_deviceid(path):
+        '''
+        Returns the DeviceID from a wmi object path,
+        ie: Win32_LogicalDisk.DeviceID="C:" returns C:, escaped backslashes are unescaped
+        '''
+        match = re.search('DeviceID="(.*)"', str(path or ''))
+        if not match:
+            return None
+        return match.group(1).replace('\\\\', '\\')
+
+    def merge_disk_info(self, disk_class, current, wmic_dicts, key='deviceid'):
+        '''
+        Builds a new list of disk_class objects from wmic_dicts, reusing the objects in current whose key and
+        signature (see WinInstanceDiskType.signature_keys) are unchanged
+        :param disk_class: WinInstanceDiskType subclass
+        :param current: list of existing disk_class objects
+        :param wmic_dicts: list of parsed wmic dicts
+        :param key: wmic key identifying a device
+        :returns list of disk_class objects
+        '''
+        existing = {}
+        for disk in current or []:
+            existing[str(getattr(disk, key, ''))] = disk
+        disks = []
+        for wmic_dict in wmic_dicts:
+            disk = existing.get(str(wmic_dict.get(key, '')))
+            try:
+                if disk and disk.matches_signature(wmic_dict):
+                    disk.refresh(wmic_dict)
+                else:
+                    self.debug('Building ' + str(disk_class.__name__) + ' for ' + str(wmic_dict.get(key)))
+                    disk = disk_class(self, wmic_dict)
+            except Exception, e:
+                tb = self.tester.get_traceback()
+                self.debug('Error attempting to create ' + str(disk_class.__name__) + ' from following dict:')
+                self.print_dict(dict=wmic_dict)
+                raise Exception(str(tb) + "\n Error attempting to create " + str(disk_class.__name__) + ":" + str(e))
+            disks.append(disk)
+        return disks
+
+    def update_disk_maps(self):
+        '''
+        Indexes the current disk objects by deviceid
+        '''
+        self.diskdrive_map = {}
+        self.partition_map = {}
+        self.logicaldisk_map = {}
+        for disk in self.diskdrives:
+            self.diskdrive_map[disk.deviceid] = disk
+        for part in self.disk_partitions:
+            self.partition_map[part.deviceid] = part
+        for disk in self.logicaldisks:
+            self.logicaldisk_map[disk.deviceid] = disk
 
     def get_updated_diskdrive_info(self):
         '''
@@ -1066,32 +1218,43 @@ class WinInstance(Instance, TaggedResource):
 
 
     def associate_diskdrives_to_partitions(self):
+        disks_by_index = {}
         for disk in self.diskdrives:
             disk.disk_partitions = []
-            for part in self.disk_partitions:
-                if part.diskindex == disk.index:
-                    disk.disk_partitions.append(part)
-
-    def associate_partitions_to_logicaldrives(self, verbose=False):
+            disks_by_index[disk.index] = disk
+        for part in self.disk_partitions:
+            disk = disks_by_index.get(part.diskindex)
+            if disk:
+                disk.disk_partitions.append(part)
+
+    def associate_partitions_to_logicaldrives(self, associations=None, verbose=False):
+        '''
+        :param associations: list of (partition deviceid, logicaldisk deviceid) tuples, if None these are fetched
+                             from the guest
+        '''
+        if associations is None:
+            associations = []
+            output = self.get_parsed_wmic_command_output(self.disk_inventory_cmds['partition_to_logicaldisk'],
+                                                         verbose=verbose)
+            for assoc in output:
+                part_id = self.get_wmic_path_deviceid(assoc.get('antecedent'))
+                drive_id = self.get_wmic_path_deviceid(assoc.get('dependent'))
+                if part_id and drive_id:
+                    associations.append((part_id, drive_id))
+        partition_map = {}
+        logicaldisk_map = {}
         for part in self.disk_partitions:
-            drive_id = None
             part.logicaldisks = []
-            cmd = 'wmic partition where (DeviceID="Disk #' + str(part.diskindex) + \
-                  ', Partition #' + str(part.index) + '") assoc /assocclass:Win32_LogicalDiskToPartition'
-            output = self.sys(cmd, verbose=verbose, code=0)
-            for line in output:
-                if re.search('Win32_LogicalDisk.DeviceID',line):
-                    try:
-                        drive_id =  str(line.split()[0].split('=')[1]).replace('"','').strip()
-                    except Exception, e:
-                        tb = self.tester.get_traceback()
-                        self.debug(str(tb)+ "\nError getting logical drive info:" + str(e))
-                    if drive_id:
-                        for disk in self.logicaldisks:
-                            if re.match(disk.deviceid, drive_id):
-                                part.logicaldisks.append(disk)
-                                disk.partition = part
-                                break
+            partition_map[part.deviceid] = part
+        for disk in self.logicaldisks:
+            disk.partition = None
+            logicaldisk_map[disk.deviceid] = disk
+        for part_id, drive_id in associations:
+            part = partition_map.get(part_id)
+            disk = logicaldisk_map.get(drive_id)
+            if part and disk:
+                part.logicaldisks.append(disk)
+                disk.partition = part
 
     def get_cygwin_scsi_dev_for_windows_drive(self, windisk=None, drive_id=""):
         '''
@@ -1138,8 +1301,14 @@ class WinInstance(Instance, TaggedResource):
 
         '''
         self.debug('get_parsed_wmic_command_output, command:' + str(wmic_command))
-        ret_dicts = []
         output = self.sys(wmic_command, verbose=verbose, code=0)
+        return self.parse_wmic_output(output)
+
+    def parse_wmic_output(self, output):
+        '''
+        Parses the lines of key value formatted wmic output into a list of dicts, keys are lowercase
+        '''
+        ret_dicts = []
         newdict = {}
         for line in output:
             if not re.match(r"^\w",line):
@@ -1158,6 +1327,8 @@ class WinInstance(Instance, TaggedResource):
                     else:
                         value = ''
                 newdict[key] = value
+        if newdict:
+            ret_dicts.append(newdict)
         return ret_dicts
 
     def get_logicaldisk_ids(self, forceupdate=False):
@@ -1187,6 +1358,9 @@ class WinInstance(Instance, TaggedResource):
         return ret
 
     def get_diskdrive_by_deviceid(self, deviceid):
+        disk = self.diskdrive_map.get(deviceid)
+        if disk in self.diskdrives:
+            return disk
         for disk in self.diskdrives:
             if disk.deviceid == deviceid:
                 return disk
@@ -1406,13 +1580,13 @@ class WinInstance(Instance, TaggedResource):
                         self.debug("Cloud has detached" + str(vol.id) + ", Wait for device:"+str(dev)+" to be removed on guest...")
                         while (elapsed < timeout):
                             diskdrive_ids = []
+                            disk_drives = []
                             try:
-                                disk_drives = self.get_updated_diskdrive_info()
-                                for disk in disk_drives:
-                                    if dev == disk.deviceid:
-                                        found = True
-                                        break
-                                    found = False
+                                #Unchanged disks are refreshed in place, only the inventory query is repeated
+                                self.update_disk_info(forceupdate=True)
+                                disk_drives = self.diskdrives
+                                found = self.get_diskdrive_by_deviceid(dev) is not None
+                                if not found:
                                     self.debug('Diskdrive associated with ' + str(vol.id) + ' has been removed from guest.')
                                     #if device is not present remove it
                                     self.attached_vols.remove(vol)
@@ -1425,7 +1599,7 @@ class WinInstance(Instance, TaggedResource):
                                 except Exception, re:
                                     self.debug('Warning: Error while trying to rescan disks after detaching volume:' + str(re))
                                 try:
-                                    self.update_disk_info()
+                                    self.update_disk_info(forceupdate=True)
                                 except Exception, ue:
                                     self.debug('Warning: Error while trying to update disk info:' + str(ue))
                                 try:
@@ -1646,6 +1820,32 @@ class WinInstance(Instance, TaggedResource):
 
 
 
+    def get_blockdev_index(self):
+        '''
+        Returns the BlockDevIndex used to match volumes to diskdrives by md5
+        '''
+        index = getattr(self, 'blockdev_index', None)
+        if index is None:
+            index = BlockDevIndex(lambda cmd, timeout: self.cygwin_cmd(cmd, timeout=timeout, code=0),
+                                  debugmethod=self.debug)
+            self.blockdev_index = index
+        return index
+
+    def update_blockdev_index(self, lengths, force=False):
+        '''
+        Fingerprints the head of each diskdrive's cygwin device in a single cygwin command. Diskdrives are only
+        re-hashed when their deviceid, size or serial number changes.
+        Returns the updated BlockDevIndex.
+        '''
+        devs = []
+        signatures = {}
+        for disk in self.diskdrives:
+            if disk.cygwin_scsi_drive and disk.cygwin_scsi_drive not in signatures:
+                devs.append(disk.cygwin_scsi_drive)
+                signatures[disk.cygwin_scsi_drive] = str(disk.deviceid) + '-' + str(getattr(disk, 'size', '')) + \
+                                                     '-' + str(getattr(disk, 'serialnumber', ''))
+        return self.get_blockdev_index().update(devs, lengths, signatures=signatures, force=force)
+
     def find_diskdrive_for_volume_by_md5(self, volume, md5=None, length=None, force_check=False):
         if not force_check and not self.is_volume_attached_to_this_instance(volume):
             return None
@@ -1655,12 +1855,16 @@ class WinInstance(Instance, TaggedResource):
         if not md5:
             return None
         length = length or volume.md5len
-        for disk in self.diskdrives:
-            if disk.cygwin_scsi_drive:
-                disk_md5 = self.get_dev_md5(disk.cygwin_scsi_drive, length=length)
-                if disk_md5 == md5:
+        index = self.update_blockdev_index([length])
+        dev = index.find(md5, length)
+        if not dev and index.cached_devs:
+            self.debug('No diskdrive fingerprint match for md5:' + str(md5) + ', re-hashing cached drives')
+            dev = self.update_blockdev_index([length], force=True).find(md5, length)
+        if dev:
+            for disk in self.diskdrives:
+                if disk.cygwin_scsi_drive == dev:
                     volume.guestdev = disk.deviceid
-                    volume.md5 = disk_md5
+                    volume.md5 = md5
                     volume.md5len = length
                     disk.ebs_volume = volume.id
                     return disk
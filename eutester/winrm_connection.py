@@ -11,7 +11,12 @@ import socket
 import copy
 import sys
 import time
+import uuid
 import re
+import tracing
+
+#cmd.exe rejects command lines longer than 8191 chars, batches are split to stay below this
+MaxBatchCommandLength = 8000
 
 
 class Winrm_Connection:
@@ -26,7 +31,19 @@ class Winrm_Connection:
                  default_command_timeout=600,
                  url=None,
                  debug_method=None,
-                 verbose=True):
+                 verbose=True,
+                 persist_shell=False,
+                 shell_max_idle=60,
+                 poll_delay=0.1,
+                 max_poll_delay=2):
+        """
+        :param persist_shell: boolean, if True one shell is kept open and reused across commands instead of
+                              creating and deleting a shell per command. The shell is re-opened when it has been
+                              idle for more than shell_max_idle seconds, or after a command fails on it.
+        :param shell_max_idle: seconds a persistent shell may sit unused before it is replaced
+        :param poll_delay: initial seconds to wait between output polls which returned no data (timed commands)
+        :param max_poll_delay: max seconds between output polls, the delay doubles per empty poll up to this value
+        """
         self.debug_method = debug_method
         self.hostname = hostname
         self.username = username
@@ -40,6 +57,10 @@ class Winrm_Connection:
         self.shell_id = None
         self.command_id = None
         self.last_used = None
+        self.persist_shell = persist_shell
+        self.shell_max_idle = shell_max_idle
+        self.poll_delay = poll_delay
+        self.max_poll_delay = max_poll_delay
 
         self.verbose = verbose
 
@@ -64,7 +85,11 @@ class Winrm_Connection:
         retry = 0
         tb = ""
         e = None
-        self.close_shell()
+        try:
+            self.close_shell()
+        except Exception, ce:
+            #The old shell may already be gone on the guest, ie after a reboot
+            self.debug('Error closing winrm shell:' + str(ce))
         timeout = timeout or self.default_command_timeout
         self.winproto.transport.timeout = timeout #self.default_command_timeout
         #self.debug('reset_shell connection, Host:' + str(self.hostname) + ":" + str(self.port) + ", Username:" + str(self.username) + ', Password:' + str(self.password))
@@ -84,6 +109,32 @@ class Winrm_Connection:
         self.debug(str(tb))
         raise Exception('Could not open shell to ' + str(self.url) + str(e))
 
+    def get_shell(self, timeout=None):
+        """
+        Returns a shell id to run a command in. With persist_shell the current shell is reused unless it has
+        been idle longer than shell_max_idle, otherwise a new shell is opened.
+        """
+        timeout = timeout or self.default_command_timeout
+        if self.persist_shell and self.shell_id and self.last_used and \
+                (time.time() - self.last_used) < self.shell_max_idle:
+            self.winproto.transport.timeout = timeout
+            return self.shell_id
+        return self.reset_shell(timeout=timeout)
+
+    def release_shell(self, failed=False):
+        """
+        Called when a command is done with the shell. Non-persistent shells are always closed, a persistent
+        shell is only closed if the command failed on it so the next command gets a fresh one.
+        """
+        if self.persist_shell and not failed:
+            self.last_used = time.time()
+            return
+        try:
+            self.close_shell()
+        except Exception, e:
+            self.debug('Error closing winrm shell:' + str(e))
+            self.shell_id = None
+
     def cmd(self, command, console_mode_stdin=True, skip_cmd_shell=False, timeout=None, verbose=None):
         errmsg = ""
         if verbose is None:
@@ -96,16 +147,35 @@ class Winrm_Connection:
         #if timeout is not None:
             #convert timeout to ISO8601 format
             #timeout = self.convert_iso8601_timeout(timeout)
-        self.reset_shell(timeout=timeout)
+        reused = self.persist_shell and self.shell_id is not None
+        self.get_shell(timeout=timeout)
+        reused = reused and self.last_used is not None
+        span = tracing.tracer.start('winrm', command, host=self.hostname, cmd=orig_cmd[:200])
+        statuscode = None
+        sockdefault = None
         try:
-            self.command_id= self.winproto.run_command(self.shell_id,
-                                      command,
-                                      arguments=arguments,
-                                      console_mode_stdin=console_mode_stdin,
-                                      skip_cmd_shell=skip_cmd_shell)
+            try:
+                self.command_id= self.winproto.run_command(self.shell_id,
+                                          command,
+                                          arguments=arguments,
+                                          console_mode_stdin=console_mode_stdin,
+                                          skip_cmd_shell=skip_cmd_shell)
+            except Exception, e:
+                if not reused:
+                    raise
+                #The reused shell may have been deleted on the server side, the command never started so
+                #it is safe to run it again in a new shell
+                self.debug('Failed to run command in existing shell, reconnecting. Err:' + str(e))
+                self.shell_id = None
+                self.reset_shell(timeout=timeout)
+                self.command_id= self.winproto.run_command(self.shell_id,
+                                          command,
+                                          arguments=arguments,
+                                          console_mode_stdin=console_mode_stdin,
+                                          skip_cmd_shell=skip_cmd_shell)
             self.debug('winrm timeout:' + str(timeout) + ', cmd:' + str(orig_cmd))
             if timeout is not None:
-                sockdefault = socket.getdefaulttimeout()
+                sockdefault = socket.getdefaulttimeout() or 0
                 socket.setdefaulttimeout(timeout)
                 stdout, stderr, statuscode = self.get_timed_command_output(self.shell_id, self.command_id, active_timeout=timeout)
             else:
@@ -119,11 +189,14 @@ class Winrm_Connection:
         finally:
             try:
                 #self.winproto.transport.timeout = self.default_command_timeout
-                if timeout is not None:
+                if timeout is not None and sockdefault is not None:
                     socket.setdefaulttimeout(sockdefault)
                 self.winproto.cleanup_command(self.shell_id, self.command_id)
             except: pass
-            self.close_shell()
+            self.release_shell(failed=(statuscode is None))
+            if errmsg:
+                span.set(error=errmsg[:200])
+            span.finish(status=statuscode)
         if errmsg:
             if re.search('timed out', errmsg, re.IGNORECASE):
                 raise CommandTimeoutException('ERROR: Timed out after:' +
@@ -148,6 +221,7 @@ class Winrm_Connection:
         """
         stdout_buffer, stderr_buffer = [], []
         command_done = False
+        delay = self.poll_delay
         start = time.time()
         while not command_done:
             elapsed = time.time()-start
@@ -157,12 +231,25 @@ class Winrm_Connection:
                 self.winproto._raw_get_command_output(shell_id, command_id)
             stdout_buffer.append(stdout)
             stderr_buffer.append(stderr)
+            if command_done:
+                break
+            if stdout or stderr:
+                delay = self.poll_delay
+            else:
+                #Nothing to read yet, back off instead of hammering the guest with receive requests
+                if active_timeout:
+                    delay = min(delay, max(0, active_timeout - (time.time() - start)))
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_poll_delay)
         return ''.join(stdout_buffer), ''.join(stderr_buffer), return_code
 
 
     def close_shell(self):
         if self.shell_id:
-            self.winproto.close_shell(self.shell_id)
+            shell_id = self.shell_id
+            self.shell_id = None
+            self.last_used = None
+            self.winproto.close_shell(shell_id)
         self.shell_id = None
 
     def sys(self, command, include_stderr=False, listformat=True, carriage_return=False, timeout=None, code=None, verbose=None):
@@ -186,6 +273,117 @@ class Winrm_Connection:
                 ret = ret.extend(output['stderr'].splitlines())
         return ret
 
+    def cmd_batch(self, commands, timeout=None, verbose=None):
+        """
+        Runs a list of commands in a single shell round trip and returns a result dict per command in the same
+        format as cmd(), ie: [{'command':..., 'stdout':..., 'stderr':..., 'statuscode':...}, ...]
+        The commands are joined into one cmd.exe command line with a unique marker echoed to stdout and stderr
+        after each command, delayed expansion is used to capture each command's own errorlevel. Commands run in
+        order regardless of the previous command's status. Commands which would push the command line past
+        MaxBatchCommandLength are sent in an additional round trip.
+        A command whose marker is missing (ie: the batch timed out or the shell died) gets statuscode None.
+        Note: commands should not rely on '!' characters, these are subject to delayed expansion.
+
+        :param commands: list of command strings
+        :param timeout: timeout applied to each round trip
+        :param verbose: print per command output
+        :returns: list of dicts
+        """
+        if verbose is None:
+            verbose = self.verbose
+        results = []
+        chunk = []
+        marker = self._get_batch_marker()
+        length = len(self._get_batch_command(''))
+        for command in commands:
+            line = self._get_batch_line(len(chunk), command, marker)
+            if chunk:
+                line = ' & ' + line
+            if chunk and (length + len(line)) > MaxBatchCommandLength:
+                results.extend(self._run_batch(chunk, marker, timeout=timeout, verbose=verbose))
+                chunk = []
+                length = len(self._get_batch_command(''))
+                line = self._get_batch_line(0, command, marker)
+            chunk.append(command)
+            length += len(line)
+        if chunk:
+            results.extend(self._run_batch(chunk, marker, timeout=timeout, verbose=verbose))
+        return results
+
+    def sys_batch(self, commands, listformat=True, carriage_return=False, timeout=None, code=None, verbose=None):
+        """
+        Batch version of sys(), runs commands in a single shell round trip. See cmd_batch()
+        :param code: if not None, every command must exit with this status code or CommandExitCodeException is raised
+        :returns: list of outputs, one per command in the same format as sys()
+        """
+        ret = []
+        for result in self.cmd_batch(commands, timeout=timeout, verbose=verbose):
+            if code is not None and result['statuscode'] != code:
+                raise CommandExitCodeException('Cmd:' + str(result['command']) + ' failed with status code:'
+                                               + str(result['statuscode'])
+                                               + "\n, stdout:" + str(result['stdout'])
+                                               + "\n, stderr:" + str(result['stderr']))
+            out = result['stdout'] or ''
+            if not carriage_return:
+                out = out.replace('\r', '')
+            if listformat:
+                out = out.splitlines()
+            ret.append(out)
+        return ret
+
+    @staticmethod
+    def _get_batch_marker():
+        return 'EUTESTER_BATCH_' + uuid.uuid4().hex
+
+    @staticmethod
+    def _get_batch_command(line):
+        #/S strips only the outer quotes, leaving any quotes used within the commands intact
+        return 'cmd /S /V:ON /C "' + line + '"'
+
+    @staticmethod
+    def _get_batch_line(index, command, marker):
+        #Parenthesis keep cmd.exe from echoing the trailing space before '&'
+        return str(command) + ' & (echo ' + marker + ':' + str(index) + ':!errorlevel!) & (1>&2 echo ' + \
+               marker + ':' + str(index) + ')'
+
+    def _run_batch(self, commands, marker, timeout=None, verbose=None):
+        line = " & ".join(self._get_batch_line(index, command, marker) for index, command in enumerate(commands))
+        output = self.cmd(self._get_batch_command(line), timeout=timeout, verbose=False)
+        stdout_chunks = self._split_batch_output(output['stdout'] or '', marker, codes=True)
+        stderr_chunks = self._split_batch_output(output['stderr'] or '', marker, codes=False)
+        results = []
+        for index, command in enumerate(commands):
+            stdout, statuscode = stdout_chunks.get(index, ('', None))
+            stderr = stderr_chunks.get(index, ('', None))[0]
+            if verbose:
+                self.debug('Batch cmd:"' + str(command) + '", status:' + str(statuscode) +
+                           "\n" + str(stdout) + "\n" + str(stderr))
+            results.append({'command': command, 'stdout': stdout, 'stderr': stderr, 'statuscode': statuscode})
+        return results
+
+    @staticmethod
+    def _split_batch_output(output, marker, codes=True):
+        """
+        Splits batch output on the markers, returns a dict of {index: (output, statuscode)}
+        Output after the last marker (ie: from a command cut off by a timeout) belongs to the next index.
+        """
+        if codes:
+            pattern = re.compile(re.escape(marker) + r':(\d+):(-?\d+)[ ]*\r?\n?')
+        else:
+            pattern = re.compile(re.escape(marker) + r':(\d+)[ ]*\r?\n?')
+        chunks = {}
+        pos = 0
+        index = 0
+        for match in pattern.finditer(output):
+            index = int(match.group(1))
+            statuscode = int(match.group(2)) if codes else None
+            chunks[index] = (output[pos:match.start()], statuscode)
+            pos = match.end()
+            index += 1
+        if output[pos:]:
+            chunks[index] = (output[pos:], None)
+        return chunks
+
     @classmethod
     def get_traceback(cls):
         '''
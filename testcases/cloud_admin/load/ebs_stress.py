@@ -318,9 +318,9 @@ class LoadGenerator(unittest.TestCase):
         storagestats_file= None
         db_dump = None
 
-    def run_command_list(self,machine, list):
+    def run_command_list(self, machines, list):
         for command in list:
-            machine.sys(command)
+            self.tester.run_on_machines(machines, command, verbose=True)
 
     def get_clc_stats(self):
 
@@ -332,9 +332,8 @@ class LoadGenerator(unittest.TestCase):
         clc_commands = ['euca-describe-properties | grep volume']
 
         clc_status = clc_commands + basic_commands
-        for machine in self.tester.get_component_machines("clc"):
-            for command in clc_status:
-                machine.sys("source " + self.tester.credpath + "/eucarc && " + command)
+        self.run_command_list(self.tester.get_component_machines("clc"),
+                              ["source " + self.tester.credpath + "/eucarc && " + command for command in clc_status])
 
     def get_sc_stats(self):
 
@@ -361,8 +360,7 @@ class LoadGenerator(unittest.TestCase):
                        'ls -l ' + volumes_dir[0]]
 
         sc_status = basic_commands + sc_commands
-        for machine in self.tester.get_component_machines("sc"):
-            self.run_command_list(machine, sc_status)
+        self.run_command_list(self.tester.get_component_machines("sc"), sc_status)
 
     def GenerateVolumesLoad(self):
         """
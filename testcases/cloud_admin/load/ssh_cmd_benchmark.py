@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+#
+# Description:  Microbenchmark for eutester's SshConnection.cmd() receive loop.
+#
+#               Measures against a single ssh host (ie a local sshd):
+#                   * per-command overhead, average wall time of a trivial command ('true')
+#                   * output throughput in MB/s, for a command producing a large amount of output
+#
+#               Run against the same host before and after changes to sshconnection to compare numbers.
+#
+# example:
+#     ssh_cmd_benchmark.py --host 127.0.0.1 --password foobar -n 200 --size 256
+#
+
+import argparse
+import time
+from eutester.sshconnection import SshConnection
+
+
+def get_options():
+    parser = argparse.ArgumentParser(prog="ssh_cmd_benchmark.py",
+        description='Measure per-command overhead and large output throughput of SshConnection.cmd()')
+    parser.add_argument("--host", dest="host", help="Host to run ssh commands against", default="127.0.0.1")
+    parser.add_argument("-U", "--username", dest="username", help="ssh username", default="root")
+    parser.add_argument("--password", dest="password", help="ssh password", default=None)
+    parser.add_argument("--keypath", dest="keypath", help="path to ssh key", default=None)
+    parser.add_argument("-n", "--number", dest="number", type=int,
+        help="Number of trivial commands to run for the overhead measurement", default=100)
+    parser.add_argument("--size", dest="size", type=int,
+        help="Size in MB of output produced for the throughput measurement", default=64)
+    parser.add_argument("--passes", dest="passes", type=int,
+        help="Number of throughput passes to average", default=3)
+    parser.add_argument("--no-pty", dest="get_pty", action="store_false", default=True,
+        help="Do not request a pty for benchmark commands")
+    return parser.parse_args()
+
+
+def overhead(ssh, number, get_pty=True):
+    start = time.time()
+    for x in xrange(number):
+        ssh.cmd('true', verbose=False, get_pty=get_pty)
+    return (time.time() - start) / number
+
+
+def throughput(ssh, size, passes, get_pty=True):
+    nbytes = size * 1024 * 1024
+    cmd = 'head -c ' + str(nbytes) + ' /dev/zero | tr "\\000" "a"'
+    elapsed = 0
+    for x in xrange(passes):
+        start = time.time()
+        out = ssh.cmd(cmd, verbose=False, timeout=600, get_pty=get_pty)
+        elapsed += time.time() - start
+        if len(out['output']) < nbytes:
+            raise Exception('Short read, expected ' + str(nbytes) + ' bytes, got:' + str(len(out['output'])))
+    return (float(size) * passes) / elapsed
+
+
+if __name__ == "__main__":
+    options = get_options()
+    ssh = SshConnection(options.host,
+                        username=options.username,
+                        password=options.password,
+                        keypath=options.keypath)
+    per_cmd = overhead(ssh, options.number, get_pty=options.get_pty)
+    print 'Per command overhead: ' + str(round(per_cmd * 1000, 2)) + 'ms (' + str(options.number) + ' cmds)'
+    mbps = throughput(ssh, options.size, options.passes, get_pty=options.get_pty)
+    print 'Output throughput: ' + str(round(mbps, 2)) + 'MB/s (' + str(options.size) + 'MB x ' + \
+          str(options.passes) + ' passes)'
+    ssh.close()
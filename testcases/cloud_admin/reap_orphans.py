@@ -0,0 +1,63 @@
+#!/usr/bin/python
+'''
+Removes resources left behind by test runs which died before cleaning up, using the resource inventory recorded
+by runs with inventory tracking enabled (tester.enable_inventory() or $EUTESTER_INVENTORY). See eutester.inventory
+
+example:
+    reap_orphans.py --credpath ~/.euca --inventory /var/tmp/eutester_inventory.db --stale-hours 6
+    reap_orphans.py --credpath ~/.euca --inventory /var/tmp/eutester_inventory.db --dry-run
+'''
+from eucaops import Eucaops
+from eutester.eutestcase import EutesterTestCase
+from eutester.inventory import ResourceInventory, OrphanReaper
+
+class ReapOrphans(EutesterTestCase):
+    def __init__(self):
+        self.setuptestcase()
+        self.setup_parser()
+        self.parser.add_argument("--inventory", default=None,
+                                 help="Inventory file, defaults to $EUTESTER_INVENTORY or ~/.eutester/inventory.db")
+        self.parser.add_argument("--stale-hours", dest="stale_hours", type=float, default=6,
+                                 help="Hours without a heartbeat after which a run is considered dead")
+        self.parser.add_argument("--run-ids", dest="run_ids", nargs='+', default=None,
+                                 help="Only reap these runs, default is all dead runs")
+        self.parser.add_argument("--dry-run", dest="dry_run", action='store_true', default=False,
+                                 help="Only list the orphans")
+        self.parser.add_argument("--concurrency", type=int, default=20, help="Max delete requests in flight")
+        self.parser.add_argument("--timeout", type=int, default=1800, help="Seconds allowed for the teardown")
+        self.get_args()
+        # Setup basic eutester object
+        self.tester = Eucaops( credpath=self.args.credpath, config_file=self.args.config,password=self.args.password)
+        self.tester.disable_inventory()
+        self.inventory = ResourceInventory(path=self.args.inventory, debugmethod=self.tester.debug)
+
+    def clean_method(self):
+        pass
+
+    def Reap(self):
+        """
+        Delete the resources of dead runs which still exist on this cloud and drop them from the inventory
+        """
+        reaper = OrphanReaper(self.tester, self.inventory,
+                              stale_after=self.args.stale_hours * 3600,
+                              run_ids=self.args.run_ids,
+                              deadline=self.args.timeout,
+                              concurrency=self.args.concurrency)
+        errors = reaper.reap(dry_run=self.args.dry_run)
+        if errors:
+            raise Exception("Failed to reap " + str(len(errors)) + " resources:\n" + "\n".join(errors))
+
+if __name__ == "__main__":
+    testcase = ReapOrphans()
+    ### Use the list of tests passed from config/command line to determine what subset of tests to run
+    ### or use a predefined list
+    list = testcase.args.tests or ["Reap"]
+
+    ### Convert test suite methods to EutesterUnitTest objects
+    unit_list = [ ]
+    for test in list:
+        unit_list.append( testcase.create_testunit_by_name(test) )
+
+    ### Run the EutesterUnitTest objects
+    result = testcase.run_test_case_list(unit_list,clean_on_exit=False)
+    exit(result)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from eucaops import Eucaops
+from eucaops import CWops
+from eutester.eutestcase import EutesterTestCase
+from eutester.cwload import CWLoadGenerator
+
+class CloudWatchLoad(EutesterTestCase):
+    def __init__(self):
+        self.setuptestcase()
+        self.setup_parser()
+        self.parser.add_argument("--namespaces", type=int, default=1, help="Number of namespaces to generate")
+        self.parser.add_argument("--metrics", type=int, default=10, help="Number of metric names per namespace")
+        self.parser.add_argument("--dimensions", type=int, default=10,
+                                 help="Number of dimension values per metric name")
+        self.parser.add_argument("--rate", type=float, default=100,
+                                 help="Target datapoints/sec, 0 for unthrottled")
+        self.parser.add_argument("--batch-size", dest="batch_size", type=int, default=20,
+                                 help="Datapoints per PutMetricData request, max 20")
+        self.parser.add_argument("-c", "--concurrent", type=int, default=4, help="Number of worker threads")
+        self.parser.add_argument("--alarms", type=int, default=0,
+                                 help="Number of alarms to create on the generated metrics")
+        self.parser.add_argument("--duration", type=int, default=60, help="Seconds to run the load")
+        self.parser.add_argument("--warmup", type=int, default=5, help="Seconds of load not recorded")
+        self.parser.add_argument("--probe-interval", dest="probe_interval", type=int, default=10,
+                                 help="Seconds between visibility probes, 0 to disable")
+        self.parser.add_argument("--visibility-timeout", dest="visibility_timeout", type=int, default=300,
+                                 help="Seconds to wait for a probe datapoint to become visible")
+        self.parser.add_argument("--json", default=None, help="Path to write results as JSON")
+        self.get_args()
+        # Setup basic eutester object
+        if self.args.region:
+            self.tester = CWops( credpath=self.args.credpath, region=self.args.region)
+        else:
+            self.tester = Eucaops( credpath=self.args.credpath, config_file=self.args.config,password=self.args.password)
+        self.load = CWLoadGenerator(self.tester,
+                                    namespaces=self.args.namespaces,
+                                    metrics=self.args.metrics,
+                                    dimensions=self.args.dimensions,
+                                    rate=self.args.rate or None,
+                                    batch_size=self.args.batch_size,
+                                    concurrency=self.args.concurrent,
+                                    duration=self.args.duration,
+                                    warmup=self.args.warmup,
+                                    alarms=self.args.alarms,
+                                    probe_interval=self.args.probe_interval,
+                                    visibility_timeout=self.args.visibility_timeout)
+
+    def clean_method(self):
+        self.load.clean_up()
+
+    def MetricLoad(self):
+        self.load.run()
+        self.load.show_results()
+        if self.args.json:
+            self.load.write_json(self.args.json)
+        results = self.load.get_results()
+        if results['probes_not_visible']:
+            raise Exception(str(results['probes_not_visible']) + ' of ' + str(results['probes']) +
+                            ' probe datapoints did not become visible within ' +
+                            str(self.args.visibility_timeout) + ' seconds')
+
+
+if __name__ == "__main__":
+    testcase = CloudWatchLoad()
+    ### Use the list of tests passed from config/command line to determine what subset of tests to run
+    ### or use a predefined list
+    list = testcase.args.tests or ["MetricLoad"]
+
+    ### Convert test suite methods to EutesterUnitTest objects
+    unit_list = [ ]
+    for test in list:
+        unit_list.append( testcase.create_testunit_by_name(test) )
+
+    ### Run the EutesterUnitTest objects
+    result = testcase.run_test_case_list(unit_list)
+    exit(result)
@@ -72,17 +72,19 @@ class CloudWatchBasics(EutesterTestCase):
             self.tester.debug("Waiting for minute edge")
             self.tester.sleep(1)
         start = datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds_to_put_data)
+        datapoints = []
         for i in xrange(seconds_to_put_data):
             timestamp = start + datetime.timedelta(seconds=i)
-            self.tester.debug("Adding metric: {metric} to namespace: {namespace} with value {value} at {timestamp}".format(
-                metric=metric_name, namespace = self.namespace, value=metric_data, timestamp=timestamp))
-            self.tester.cw.put_metric_data(self.namespace, [metric_name],[metric_data],timestamp=timestamp )
+            datapoints.append({'name': metric_name, 'value': metric_data, 'timestamp': timestamp})
             if metric_data == 600 or metric_data == 0:
                 incrementing = not incrementing
             if incrementing:
                 metric_data += 1
             else:
                 metric_data -= 1
+        self.tester.debug("Adding {count} datapoints for metric: {metric} to namespace: {namespace}".format(
+            count=len(datapoints), metric=metric_name, namespace=self.namespace))
+        self.tester.put_metric_data_batch(self.namespace, datapoints)
         end = start + datetime.timedelta(seconds=seconds_to_put_data)
         self.tester.sleep(60)
         metric = self.tester.cw.list_metrics(namespace=self.namespace)[0]
@@ -113,6 +115,12 @@ class CloudWatchBasics(EutesterTestCase):
         assert first_sample['Maximum'] < second_sample['Maximum']
         assert first_sample['Minimum'] < second_sample['Minimum']
 
+        ##Check every period against the statistics computed from the datapoints which were put
+        expected = self.tester.compute_expected_stats(datapoints, period=60)
+        reported = self.tester.get_all_metric_statistics(60, start - datetime.timedelta(seconds=60), end,
+                                                         metric_name, self.namespace, self.tester.get_stats_array())
+        self.tester.verify_metric_statistics(expected, reported)
+
     def ListMetrics(self, metricNames, dimension):
         self.debug('Get Metric list')
         metricList = self.tester.list_metrics(dimensions=dimension)
@@ -37,6 +37,7 @@ import httplib
 import sys
 from eutester.eutestcase import EutesterTestCase
 from eutester.sshconnection import SshCbReturn
+from eutester.imagebundle import ImageBundler
 
 
 class ImageUtils(EutesterTestCase):
@@ -269,6 +270,44 @@ class ImageUtils(EutesterTestCase):
         return upmanifest
     
     
+    def native_bundle_and_upload(self,
+                                 source,
+                                 bucketname=None,
+                                 prefix=None,
+                                 kernel=None,
+                                 ramdisk=None,
+                                 block_device_mapping=None,
+                                 arch='x86_64',
+                                 uniquebucket=True,
+                                 part_size=10485760,
+                                 concurrency=4):
+        '''
+        Bundle and upload an image from this test machine using eutester's in-process bundle pipeline rather
+        than euca2ools on a component. The image is streamed, no local copy or intermediate files are written.
+        :param source: local image path or http(s) url of the image
+        :returns: upload manifest location to register
+        '''
+        filename = str(source).split('?')[0].rstrip('/').split('/')[-1]
+        basename = bucketname or filename.replace('_','').replace('.','').lower()
+        bname = basename
+        if uniquebucket:
+            bx = 0
+            bname = basename+"test"+str(bx)
+            while self.tester.get_bucket_by_name(bname) is not None:
+                bx += 1
+                bname = basename+"test"+str(bx)
+        self.debug('native_bundle_and_upload:'+str(source)+', bucket:'+str(bname))
+        bundler = ImageBundler(self.tester, part_size=part_size, concurrency=concurrency)
+        upmanifest = bundler.bundle_and_upload(source,
+                                               bname,
+                                               prefix=prefix,
+                                               arch=arch,
+                                               kernel=kernel,
+                                               ramdisk=ramdisk,
+                                               block_device_mapping=block_device_mapping)
+        self.debug('native_bundle_and_upload:'+str(source)+'. manifest:'+str(upmanifest))
+        return upmanifest
+
     def bundle_status_cb(self,buf, cmdtimeout, parttimeout, starttime,lasttime, check_image_stage):
         #self.debug('bundle_status_cb: cmdtimeout:'+str(cmdtimeout)+", partimeout:"+str(parttimeout)+", starttime:"+str(starttime)+", lasttime:"+str(lasttime)+", check_image_stage:"+str(check_image_stage))
         ret = SshCbReturn(stop=False)
@@ -368,10 +407,26 @@ class ImageUtils(EutesterTestCase):
                             bundle_manifest=None,
                             upload_manifest=None,
                             time_per_gig=300,
+                            native_bundle=False,
                             ):
-        
+        '''
+        Download, bundle, upload and register an image from url.
+        native_bundle - optional - boolean, if True the image is streamed from url (or filepath on this machine)
+                        through eutester's in-process bundle pipeline and uploaded, instead of being downloaded to
+                        and bundled on a component with euca2ools.
+        '''
         start = time.time() 
         self.debug('create_emi_from_url:'+str(url)+", starting...")
+        if native_bundle and upload_manifest is None:
+            self.status('create_emi_from_url: Streaming image through native bundle and upload...')
+            upload_manifest = self.native_bundle_and_upload(filepath or url,
+                                                            bucketname=bucketname,
+                                                            prefix=prefix,
+                                                            kernel=kernel,
+                                                            ramdisk=ramdisk,
+                                                            block_device_mapping=block_device_mapping,
+                                                            arch=architecture or 'x86_64',
+                                                            uniquebucket=uniquebucket)
         if filepath is None and bundle_manifest is None and upload_manifest is None:
             filename = str(url).split('/')[-1]
             dir = destpath or self.destpath
@@ -4,6 +4,7 @@ from concurrent.futures import ThreadPoolExecutor
 from eucaops import Eucaops
 from eucaops import S3ops
 from eutester.eutestcase import EutesterTestCase
+from eutester.s3load import S3LoadGenerator
 
 class WalrusConcurrent(EutesterTestCase):
     def __init__(self):
@@ -12,6 +13,17 @@ class WalrusConcurrent(EutesterTestCase):
         self.parser.add_argument("-n", "--number", type=int, default=100)
         self.parser.add_argument("-c", "--concurrent", type=int, default=10)
         self.parser.add_argument("-s", "--size", type=int, default=1024)
+        self.parser.add_argument("--mix", default="put:50,get:40,head:5,delete:5",
+                                 help="Load operation mix for the LoadMix test, ie: put:50,get:40,head:5,delete:5")
+        self.parser.add_argument("--sizes", default=None,
+                                 help="Object size distribution for the LoadMix test, ie: 4K:80,1M:20. "
+                                      "Defaults to --size")
+        self.parser.add_argument("--rate", type=float, default=None,
+                                 help="Target requests/sec for the LoadMix test, default is unthrottled")
+        self.parser.add_argument("--duration", type=int, default=60, help="Seconds to run the LoadMix test")
+        self.parser.add_argument("--warmup", type=int, default=5, help="Seconds of LoadMix requests not recorded")
+        self.parser.add_argument("--json", default=None, help="Path to write LoadMix results as JSON")
+        self.parser.add_argument("--csv", default=None, help="Path to write LoadMix results as CSV")
         self.get_args()
         # Setup basic eutester object
         if self.args.region:
@@ -27,18 +39,39 @@ class WalrusConcurrent(EutesterTestCase):
 
     def Concurrent(self):
         key_payload = self.tester.id_generator(self.args.size)
-        thread_count = self.args.number
-        thread_pool = []
-        with ThreadPoolExecutor(max_workers=thread_count) as executor:
-                for i in xrange(thread_count):
-                        thread_pool.append(executor.submit(self.tester.upload_object, bucket_name=self.bucket_name, key_name="test" + str(i), contents=key_payload))
-        end = time.time()
-        total = end - self.start
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.args.concurrent) as executor:
+            futures = [executor.submit(self.tester.upload_object, bucket_name=self.bucket_name,
+                                       key_name="test" + str(i), contents=key_payload)
+                       for i in xrange(self.args.number)]
+            keys = [future.result() for future in futures]
+        total = time.time() - start
         self.tester.debug("\nExecution time: {0}\n# of Objects: {1}\nObject Size: {2}B\nConcurrency Level of {3}".format(
                             total, self.args.number, self.args.size, self.args.concurrent))
-        with ThreadPoolExecutor(max_workers=thread_count) as executor:
-                for object in thread_pool:
-                        thread_pool.append(executor.submit(self.tester.delete_object, object))
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.args.concurrent) as executor:
+            for future in [executor.submit(self.tester.delete_object, key) for key in keys]:
+                future.result()
+        self.tester.debug("Delete time: {0}".format(time.time() - start))
+
+    def LoadMix(self):
+        sizes = [(self.args.size, 1)]
+        if self.args.sizes:
+            sizes = S3LoadGenerator.parse_sizes(self.args.sizes)
+        load = S3LoadGenerator(self.tester, self.bucket_name,
+                               op_mix=S3LoadGenerator.parse_op_mix(self.args.mix),
+                               sizes=sizes,
+                               concurrency=self.args.concurrent,
+                               rate=self.args.rate,
+                               duration=self.args.duration,
+                               warmup=self.args.warmup,
+                               preload=self.args.number)
+        load.run()
+        load.show_results()
+        if self.args.json:
+            load.write_json(self.args.json)
+        if self.args.csv:
+            load.write_csv(self.args.csv)
 
 
 if __name__ == "__main__":
@@ -54,4 +87,4 @@ if __name__ == "__main__":
 
     ### Run the EutesterUnitTest objects
     result = testcase.run_test_case_list(unit_list)
-    exit(result)
\ No newline at end of file
+    exit(result)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import datetime
+import mock
+import unittest
+from eucaops import cwops
+from eucaops.cwops import CWops
+
+T0 = datetime.datetime(2014, 1, 1, 12, 0, 0)
+
+
+class ComputeExpectedStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.cw = CWops.__new__(CWops)
+        self.cw.debug = mock.Mock()
+        self.datapoints = [{'timestamp': T0, 'value': 1},
+                           {'timestamp': T0 + datetime.timedelta(seconds=59), 'value': 5},
+                           {'timestamp': T0 + datetime.timedelta(seconds=60, microseconds=500), 'value': 2},
+                           {'timestamp': T0 + datetime.timedelta(seconds=90),
+                            'statistics': {'sum': 10, 'samplecount': 4, 'minimum': -1, 'maximum': 7}}]
+        self.expected = {T0: {'Sum': 6.0, 'Average': 3.0, 'Minimum': 1.0, 'Maximum': 5.0, 'SampleCount': 2.0},
+                         T0 + datetime.timedelta(seconds=60): {'Sum': 12.0, 'Average': 2.4, 'Minimum': -1.0,
+                                                               'Maximum': 7.0, 'SampleCount': 5.0}}
+
+    def assertStatsEqual(self, expected, computed):
+        self.assertEqual(sorted(expected), sorted(computed))
+        for start in expected:
+            for stat, value in expected[start].iteritems():
+                self.assertAlmostEqual(computed[start][stat], value)
+
+    def test_pure_python(self):
+        with mock.patch.object(cwops, 'numpy', None):
+            self.assertStatsEqual(self.expected, self.cw.compute_expected_stats(self.datapoints, period=60))
+
+    def test_numpy(self):
+        #unittest.skipIf is not available on python 2.6
+        if cwops.numpy is None:
+            return
+        self.assertStatsEqual(self.expected, self.cw.compute_expected_stats(self.datapoints, period=60))
+
+    def test_no_datapoints(self):
+        self.assertEqual(self.cw.compute_expected_stats([], period=60), {})
+
+    def test_verify_match(self):
+        reported = [dict(self.expected[start], Timestamp=start.replace(microsecond=1)) for start in self.expected]
+        self.assertEqual(self.cw.verify_metric_statistics(self.expected, reported), [])
+
+    def test_verify_mismatches(self):
+        start = T0 + datetime.timedelta(seconds=60)
+        reported = [dict(self.expected[start], Timestamp=start, Sum=13.0),
+                    dict(self.expected[T0], Timestamp=T0 + datetime.timedelta(seconds=120))]
+        mismatches = self.cw.verify_metric_statistics(self.expected, reported, raise_error=False)
+        self.assertEqual(len(mismatches), 3)
+        self.assertTrue('missing datapoint' in mismatches[0])
+        self.assertTrue('Sum' in mismatches[1])
+        self.assertTrue('unexpected datapoint' in mismatches[2])
+        self.assertRaises(Exception, self.cw.verify_metric_statistics, self.expected, reported)
+
+if __name__ == "__main__":
+    unittest.main()
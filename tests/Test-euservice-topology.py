@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import mock
+import unittest
+from eutester.euservice import TopologySnapshot, TopologyEvent, EuserviceManager
+
+
+def summarize(events):
+    return [(event.type, event.key, event.old, event.new) for event in events]
+
+
+class TopologySnapshotTest(unittest.TestCase):
+    def test_no_changes(self):
+        old = TopologySnapshot(services={'SC_61': 'ENABLED'}, nodes={'10.0.0.5': 'ENABLED'},
+                               placements={'i-1': '10.0.0.5'})
+        new = TopologySnapshot(services={'SC_61': 'ENABLED'}, nodes={'10.0.0.5': 'ENABLED'},
+                               placements={'i-1': '10.0.0.5'})
+        self.assertEqual(new.diff(old), [])
+
+    def test_from_empty(self):
+        new = TopologySnapshot(services={'SC_61': 'ENABLED', 'CC_61': 'ENABLED'}, nodes={'10.0.0.5': 'ENABLED'},
+                               placements={'i-1': '10.0.0.5'})
+        self.assertEqual(summarize(new.diff(TopologySnapshot())),
+                         [(TopologyEvent.SERVICE_ADDED, 'CC_61', None, 'ENABLED'),
+                          (TopologyEvent.SERVICE_ADDED, 'SC_61', None, 'ENABLED'),
+                          (TopologyEvent.NODE_ADDED, '10.0.0.5', None, 'ENABLED'),
+                          (TopologyEvent.INSTANCE_ADDED, 'i-1', None, '10.0.0.5')])
+
+    def test_changes(self):
+        old = TopologySnapshot(services={'SC_61': 'ENABLED', 'WS_61': 'ENABLED'},
+                               nodes={'10.0.0.5': 'ENABLED', '10.0.0.6': 'ENABLED'},
+                               placements={'i-1': '10.0.0.5', 'i-2': '10.0.0.6'})
+        new = TopologySnapshot(services={'SC_61': 'NOTREADY', 'SC_62': 'DISABLED'},
+                               nodes={'10.0.0.5': 'ENABLED', '10.0.0.6': 'DISABLED'},
+                               placements={'i-1': '10.0.0.6', 'i-3': '10.0.0.5'})
+        self.assertEqual(summarize(new.diff(old)),
+                         [(TopologyEvent.SERVICE_STATE, 'SC_61', 'ENABLED', 'NOTREADY'),
+                          (TopologyEvent.SERVICE_ADDED, 'SC_62', None, 'DISABLED'),
+                          (TopologyEvent.SERVICE_REMOVED, 'WS_61', 'ENABLED', None),
+                          (TopologyEvent.NODE_STATE, '10.0.0.6', 'ENABLED', 'DISABLED'),
+                          (TopologyEvent.INSTANCE_MOVED, 'i-1', '10.0.0.5', '10.0.0.6'),
+                          (TopologyEvent.INSTANCE_ADDED, 'i-3', None, '10.0.0.5'),
+                          (TopologyEvent.INSTANCE_REMOVED, 'i-2', '10.0.0.6', None)])
+
+
+class PublishTopologyTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.object(EuserviceManager, 'update'):
+            self.manager = EuserviceManager(mock.Mock(credpath='/tmp', eucapath='/usr'))
+        self.manager.services = {'SC_61': mock.Mock(state='ENABLED')}
+
+    def test_publish_and_listener_errors(self):
+        received = []
+        failing = mock.Mock(side_effect=Exception('listener failure'))
+        self.manager.add_topology_listener(failing)
+        self.manager.add_topology_listener(received.append)
+        events = self.manager.publish_topology()
+        self.assertEqual(summarize(events), [(TopologyEvent.SERVICE_ADDED, 'SC_61', None, 'ENABLED')])
+        self.assertEqual(received, events)
+        self.assertEqual(failing.call_count, 1)
+        #Nothing changed since the last published snapshot
+        self.assertEqual(self.manager.publish_topology(), [])
+        self.manager.services['SC_61'].state = 'DISABLED'
+        self.assertEqual(summarize(self.manager.publish_topology()),
+                         [(TopologyEvent.SERVICE_STATE, 'SC_61', 'ENABLED', 'DISABLED')])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import StringIO
+import tarfile
+import unittest
+import zlib
+from eutester.imagebundle import iter_tar, iter_parts, iter_gzip, iter_threaded
+
+
+class IterTarTest(unittest.TestCase):
+    def build(self, data, size=None, chunk_size=1000):
+        chunks = [data[offset:offset + chunk_size] for offset in xrange(0, len(data), chunk_size)]
+        return "".join(iter_tar(chunks, 'image.img', len(data) if size is None else size, mtime=1400000000))
+
+    def test_readable_by_tarfile(self):
+        for length in [0, 1, 511, 512, 513, 10240, 12345]:
+            data = ''.join(chr(index % 251) for index in xrange(length))
+            stream = self.build(data)
+            self.assertEqual(len(stream) % tarfile.RECORDSIZE, 0)
+            archive = tarfile.open(fileobj=StringIO.StringIO(stream))
+            members = archive.getmembers()
+            self.assertEqual([member.name for member in members], ['image.img'])
+            self.assertEqual(members[0].size, length)
+            self.assertEqual(members[0].mtime, 1400000000)
+            self.assertEqual(archive.extractfile(members[0]).read(), data)
+
+    def test_matches_tarfile_output(self):
+        data = 'x' * 3000
+        info = tarfile.TarInfo(name='image.img')
+        info.size = len(data)
+        info.mode = 0644
+        info.mtime = 1400000000
+        out = StringIO.StringIO()
+        archive = tarfile.open(fileobj=out, mode='w', format=tarfile.GNU_FORMAT)
+        archive.addfile(info, StringIO.StringIO(data))
+        archive.close()
+        self.assertEqual(self.build(data), out.getvalue())
+
+    def test_short_data_raises(self):
+        self.assertRaises(Exception, self.build, 'x' * 100, size=200)
+
+    def test_long_data_raises(self):
+        self.assertRaises(Exception, self.build, 'x' * 300, size=200)
+
+
+class IterPartsTest(unittest.TestCase):
+    def test_part_sizes(self):
+        data = ''.join(chr(index % 256) for index in xrange(10000))
+        for chunk_size in [1, 7, 100, 1024, 10000]:
+            chunks = [data[offset:offset + chunk_size] for offset in xrange(0, len(data), chunk_size)]
+            parts = list(iter_parts(chunks, 1024))
+            self.assertEqual("".join(parts), data)
+            self.assertEqual([len(part) for part in parts], [1024] * 9 + [784])
+
+    def test_exact_multiple(self):
+        parts = list(iter_parts(['a' * 2048], 1024))
+        self.assertEqual([len(part) for part in parts], [1024, 1024])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_parts([], 1024)), [])
+
+
+class PipelineTest(unittest.TestCase):
+    def test_gzip_round_trip(self):
+        data = 'eutester image ' * 5000
+        chunks = [data[offset:offset + 777] for offset in xrange(0, len(data), 777)]
+        compressed = "".join(iter_gzip(iter_threaded(iter(chunks))))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), data)
+
+    def test_threaded_reraises(self):
+        def failing():
+            yield 'a'
+            raise ValueError('upstream failure')
+        self.assertRaises(ValueError, list, iter_threaded(failing()))
+
+if __name__ == "__main__":
+    unittest.main()
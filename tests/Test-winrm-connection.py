@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2011, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import mock
+import unittest
+from eutester.winrm_connection import Winrm_Connection, MaxBatchCommandLength
+
+MARKER = 'EUTESTER_BATCH_0123'
+
+
+class SplitBatchOutputTest(unittest.TestCase):
+    def test_split_stdout_codes(self):
+        output = 'one\r\n' + MARKER + ':0:0 \r\n' + 'two\r\n' + MARKER + ':1:5\r\n'
+        chunks = Winrm_Connection._split_batch_output(output, MARKER, codes=True)
+        self.assertEqual(chunks, {0: ('one\r\n', 0), 1: ('two\r\n', 5)})
+
+    def test_split_negative_code(self):
+        output = MARKER + ':0:-1073741510\r\n'
+        chunks = Winrm_Connection._split_batch_output(output, MARKER, codes=True)
+        self.assertEqual(chunks, {0: ('', -1073741510)})
+
+    def test_split_stderr_no_codes(self):
+        output = 'err\r\n' + MARKER + ':0 \r\n' + MARKER + ':1\r\n'
+        chunks = Winrm_Connection._split_batch_output(output, MARKER, codes=False)
+        self.assertEqual(chunks, {0: ('err\r\n', None), 1: ('', None)})
+
+    def test_trailing_output_belongs_to_next_index(self):
+        output = 'one\r\n' + MARKER + ':0:0\r\n' + 'partial'
+        chunks = Winrm_Connection._split_batch_output(output, MARKER, codes=True)
+        self.assertEqual(chunks, {0: ('one\r\n', 0), 1: ('partial', None)})
+
+    def test_other_markers_ignored(self):
+        output = 'EUTESTER_BATCH_other:0:0\r\n' + MARKER + ':0:0\r\n'
+        chunks = Winrm_Connection._split_batch_output(output, MARKER, codes=True)
+        self.assertEqual(chunks, {0: ('EUTESTER_BATCH_other:0:0\r\n', 0)})
+
+    def test_empty_output(self):
+        self.assertEqual(Winrm_Connection._split_batch_output('', MARKER), {})
+
+
+class CmdBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = Winrm_Connection('127.0.0.1', 'Administrator', 'password', verbose=False)
+        self.sent = []
+
+    def fake_cmd(self, command, timeout=None, verbose=None):
+        self.sent.append(command)
+        lines = command[len('cmd /S /V:ON /C "'):-1].split(' & (echo ')
+        marker = lines[1].split(':')[0]
+        count = len(lines) - 1
+        stdout = ''.join(marker + ':' + str(index) + ':0\r\n' for index in xrange(count))
+        stderr = ''.join(marker + ':' + str(index) + '\r\n' for index in xrange(count))
+        return {'stdout': stdout, 'stderr': stderr, 'statuscode': 0}
+
+    def test_batches_stay_under_max_length(self):
+        commands = ['echo ' + str(index) * 100 for index in xrange(200)]
+        with mock.patch.object(self.conn, 'cmd', side_effect=self.fake_cmd):
+            results = self.conn.cmd_batch(commands)
+        self.assertTrue(len(self.sent) > 1)
+        for command in self.sent:
+            self.assertTrue(len(command) <= MaxBatchCommandLength)
+        self.assertEqual([result['command'] for result in results], commands)
+        self.assertEqual([result['statuscode'] for result in results], [0] * len(commands))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,22 +7,106 @@ import sys
 import time
 import commands
 import tarfile
-import urllib2
+import socket
+import httplib
+import urlparse
+import threading
 import cStringIO
 import errno
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
     
+class Tar_Index_Cache():
+    '''
+    On disk cache of tarball member indexes, so a tarball is only scanned once as long as it is unchanged.
+    Entries are keyed by uri and hold a validator (ie etag, last-modified and size for remote files) which
+    must match the tarball's current validator for the cached members to be used.
+    '''
+    #Tarinfo attributes stored per member
+    member_attrs = ['name', 'offset', 'offset_data', 'size', 'mode', 'type', 'mtime', 'uid', 'gid', 'uname',
+                    'gname', 'linkname', 'devmajor', 'devminor']
+
+    def __init__(self, cachedir=None):
+        self.cachedir = cachedir or os.path.join(os.path.expanduser('~'), '.eutester', 'tar_index')
+
+    def get_path(self, uri):
+        return os.path.join(self.cachedir, hashlib.sha1(str(uri)).hexdigest() + '.json')
+
+    def load(self, uri, validator):
+        '''
+        Returns the list of cached tarinfo members for uri, or None if there is no entry or
+        the entry's validator does not match 'validator'
+        '''
+        if not validator:
+            return None
+        path = self.get_path(uri)
+        try:
+            with open(path) as cachefile:
+                entry = json.load(cachefile)
+        except (IOError, ValueError):
+            return None
+        if entry.get('uri') != uri or entry.get('validator') != validator:
+            return None
+        members = []
+        for values in entry['members']:
+            member = tarfile.TarInfo()
+            for attr, value in zip(self.member_attrs, values):
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                setattr(member, attr, value)
+            members.append(member)
+        return members
+
+    def save(self, uri, validator, members):
+        if not validator:
+            return
+        if not os.path.isdir(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError as exception:
+                if exception.errno != errno.EEXIST:
+                    raise
+        entry = {'uri': uri,
+                 'validator': validator,
+                 'members': [[getattr(member, attr) for attr in self.member_attrs] for member in members]}
+        path = self.get_path(uri)
+        #Write to a temp file and rename so concurrent runs never read a partial entry
+        tmppath = path + '.' + str(os.getpid())
+        with open(tmppath, 'w') as cachefile:
+            json.dump(entry, cachefile)
+        os.rename(tmppath, path)
+
+    def remove(self, uri):
+        path = self.get_path(uri)
+        if os.path.exists(path):
+            os.remove(path)
+
+
 class Tarutils():
     '''
     Basic tar utilities interface to be extended
     '''
-    def __init__(self,uri, headersize=512, printmethod=None, fileformat=None, verbose=True):
+    #A tarball can hold the same name more than once, get_member returns the first one unless this is set
+    last_member_wins = False
+
+    def __init__(self,uri, headersize=512, printmethod=None, fileformat=None, verbose=True, cachedir=None,
+                 use_cache=True):
+        '''
+        cachedir - optional - dir of the member index cache, defaults to ~/.eutester/tar_index
+        use_cache - optional - if False always scan the tarball for its members
+        '''
         self.uri = uri
         self.headersize=headersize
         self.verbose = verbose
         self.printmethod = printmethod
         self.fileformat = fileformat
         self.members = None
+        self.member_index = {}
         self.filesize = None
+        self.index_cache = None
+        if use_cache:
+            self.index_cache = Tar_Index_Cache(cachedir)
         self.update()
         
         
@@ -38,7 +122,31 @@ class Tarutils():
     def update(self):
         self.get_fileformat()
         self.filesize = self.get_file_size(self.uri)
-        self.members = self.get_members(self.uri, headersize=self.headersize)
+        validator = self.get_validator()
+        members = None
+        if self.index_cache:
+            members = self.index_cache.load(self.uri, validator)
+        if members is None:
+            members = self.get_members(self.uri, headersize=self.headersize)
+            if self.index_cache:
+                self.index_cache.save(self.uri, validator, members)
+        else:
+            self.debug('Using cached member index for:' + str(self.uri))
+        self.set_members(members)
+
+    def set_members(self, members):
+        self.members = members
+        self.member_index = {}
+        for member in members:
+            if self.last_member_wins or member.name not in self.member_index:
+                self.member_index[member.name] = member
+
+    def get_validator(self):
+        '''
+        Returns a dict which changes whenever the tarball changes, used to validate the member index cache.
+        Returns None if the tarball can not be validated, in which case the cache is not used.
+        '''
+        return None
     
     def get_fileformat(self):
         if re.search('.gz$',self.uri):
@@ -50,7 +158,12 @@ class Tarutils():
         raise NotImplementedError( "Mandatory tar method not implemented" )
     
     def get_member(self, name):
-        raise NotImplementedError( "Mandatory tar method not implemented" )
+        '''
+        Returns the tarinfo member object whose member.name matches name, or None if not found
+        '''
+        if not self.member_index:
+            self.set_members(self.members or self.get_members())
+        return self.member_index.get(name)
     
     def extract_member(self, memberpath,destpath=''):
         raise NotImplementedError( "Mandatory tar method not implemented" )
@@ -118,25 +231,37 @@ class Local_Tarutils(Tarutils):
     '''
     Tar utilties for local files
     '''
+    #Match tarfile.getmember(), which returns the last occurrence of a name
+    last_member_wins = True
+
     
-    def __init__(self, uri, headersize=512, printmethod=None, verbose=True):
+    def __init__(self, uri, headersize=512, printmethod=None, verbose=True, cachedir=None, use_cache=True):
         self.tarfile = None
-        tarutil.__init__(self, uri, headersize=512, printmethod=None, verbose=True)
+        Tarutils.__init__(self, uri, headersize=headersize, printmethod=printmethod, verbose=verbose,
+                          cachedir=cachedir, use_cache=use_cache)
         
         
     def update(self):
         self.uri = str(self.uri).replace('file://', '')
         #reset file in case it has changed since last update
         self.close()
+        self.get_fileformat()
         self.tarfile = tarfile.open(name=self.uri, mode = self.fileformat)
-        tarutil.update(self)
+        Tarutils.update(self)
     
     
     def get_members(self, uri=None, headersize=None):
         return self.tarfile.getmembers()
+
+    def get_validator(self):
+        stat = os.stat(self.uri)
+        return {'mtime': stat.st_mtime, 'size': stat.st_size}
     
     def get_member(self, membername):
-        return self.tarfile.getmember(membername)
+        member = Tarutils.get_member(self, membername)
+        if member is None:
+            raise KeyError("filename %r not found" % membername)
+        return member
     
     def extract_member(self, memberpath, destpath='.'):
         member = self.get_member(memberpath)
@@ -164,13 +289,232 @@ class Local_Tarutils(Tarutils):
     
     
 
+class Http_Range_Reader():
+    '''
+    Reads byte ranges of a remote file over persistent keep-alive http connections.
+    Each thread gets its own connection so ranges can be read in parallel.
+    Redirects are followed (up to max_redirects) and the final location is used for the requests that follow.
+    '''
+    redirect_codes = [301, 302, 303, 307, 308]
+
+    def __init__(self, url, timeout=60, printmethod=None, max_redirects=5):
+        self.url = url
+        self.timeout = timeout
+        self.printmethod = printmethod
+        self.max_redirects = max_redirects
+        self.set_location(url)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.requests = 0
+
+    def set_location(self, url):
+        parsed = urlparse.urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        self.scheme, self.netloc, self.path = (parsed.scheme or 'http', parsed.netloc, path)
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        #Drop this thread's connection if a redirect moved the file to another host
+        if conn is not None and getattr(self.local, 'netloc', None) != (self.scheme, self.netloc):
+            self.reset_connection()
+            conn = None
+        if conn is None:
+            if self.scheme == 'https':
+                conn = httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+            self.local.conn = conn
+            self.local.netloc = (self.scheme, self.netloc)
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def reset_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn:
+            conn.close()
+            with self.lock:
+                if conn in self.connections:
+                    self.connections.remove(conn)
+        self.local.conn = None
+
+    def request(self, method='GET', start=None, end=None):
+        '''
+        Send a request on this thread's connection, reconnecting once if the server closed the idle connection.
+        Returns the httplib response, the body must be read completely before the next request.
+        '''
+        headers = {}
+        if start is not None:
+            headers['Range'] = 'bytes=%s-%s' % (start, end)
+        redirects = 0
+        while True:
+            response = self.send(method, headers)
+            location = response.getheader('location')
+            if response.status not in self.redirect_codes or not location:
+                break
+            response.read()
+            self.release_response(response)
+            redirects += 1
+            if redirects > self.max_redirects:
+                raise Exception(str(method) + " " + str(self.url) + " failed, more than " + str(self.max_redirects) +
+                                " redirects")
+            location = urlparse.urljoin(urlparse.urlunparse((self.scheme, self.netloc, self.path, '', '', '')),
+                                        location)
+            if self.printmethod:
+                self.printmethod('Following redirect (' + str(response.status) + ') to ' + str(location))
+            with self.lock:
+                self.set_location(location)
+        if response.status >= 300:
+            response.read()
+            self.release_response(response)
+            raise Exception(str(method) + " " + str(self.url) + " failed, status:" + str(response.status) + " " +
+                            str(response.reason))
+        self.release_response(response)
+        return response
+
+    def send(self, method, headers):
+        for attempt in [1, 2]:
+            conn = self.get_connection()
+            try:
+                conn.request(method, self.path, headers=headers)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                self.reset_connection()
+                if attempt == 2:
+                    raise
+        with self.lock:
+            self.requests += 1
+        return response
+
+    def release_response(self, response):
+        '''
+        Drop this thread's connection if the server is closing it after this response. httplib has already handed
+        the socket to the response, so the body can still be read.
+        '''
+        if response.getheader('connection', '').lower() == 'close':
+            self.reset_connection()
+
+    def head(self):
+        '''
+        Returns a dict of the remote file's http headers
+        '''
+        response = self.request('HEAD')
+        response.read()
+        return dict(response.getheaders())
+
+    def open_range(self, start, end):
+        '''
+        Request bytes start through end (inclusive) and validate the returned range.
+        Returns the httplib response to read the data from.
+        '''
+        response = self.request('GET', start, end)
+        total = (end + 1) - start
+        # Note: content range in bytes is formated like: "byte <start>-<end>/<total bytes>
+        crange = response.getheader('content-range')
+        clength = int(response.getheader('content-length'))
+        if response.status != 206 or clength != total:
+            response.close()
+            self.reset_connection()
+            raise Exception("Content-length:" + str(clength) + " not equal to expected total:" + str(total) +
+                            ", status:" + str(response.status) + ", is range supported on remote server?")
+        rangestart, rangeend = re.search("\d+-\d+", crange).group().split('-')
+        if int(rangestart) != int(start) or int(rangeend) != int(end):
+            response.close()
+            self.reset_connection()
+            raise Exception("Range request not met. (start:" + str(start) + " vs rangestart:" + str(rangestart) +
+                            ") (end:" + str(end) + " vs rangeend:" + str(rangeend) +
+                            "), is range supported on remote server?")
+        return response
+
+    def read_range(self, start, end):
+        response = self.open_range(start, end)
+        data = response.read()
+        if len(data) != (end + 1) - start:
+            self.reset_connection()
+            raise Exception("Short read of range " + str(start) + "-" + str(end) + ", got " + str(len(data)) +
+                            " bytes")
+        return data
+
+    def read_range_to_file(self, start, end, fileobj, readsize=65536):
+        '''
+        Stream bytes start through end (inclusive) into fileobj at its current position
+        '''
+        response = self.open_range(start, end)
+        remaining = (end + 1) - start
+        while remaining > 0:
+            data = response.read(min(readsize, remaining))
+            if not data:
+                self.reset_connection()
+                raise Exception("Connection closed with " + str(remaining) + " bytes of range " + str(start) +
+                                "-" + str(end) + " remaining")
+            fileobj.write(data)
+            remaining -= len(data)
+
+    def close_worker_connections(self):
+        '''
+        Close the connections opened by other (ie finished worker pool) threads, keeping this thread's connection
+        '''
+        mine = getattr(self.local, 'conn', None)
+        with self.lock:
+            for conn in self.connections:
+                if conn is not mine:
+                    conn.close()
+            self.connections = [conn for conn in self.connections if conn is mine]
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+
 class Http_Tarutils(Tarutils):
     '''
     Utility class for navigating and operating on remote tarfiles via http
     '''
+    def __init__(self, uri, headersize=512, printmethod=None, fileformat=None, verbose=True, readahead=1048576,
+                 chunksize=8388608, concurrency=4, retries=3, cachedir=None, use_cache=True):
+        '''
+        readahead - size of the region read in one request when reading tar headers
+        chunksize - size of each range request when extracting members
+        concurrency - number of range requests to run in parallel when extracting
+        retries - number of attempts for each range when extracting
+        '''
+        self.readahead = readahead
+        self.chunksize = chunksize
+        self.concurrency = concurrency
+        self.retries = retries
+        self.reader = Http_Range_Reader(uri, printmethod=printmethod)
+        self.readahead_start = 0
+        self.readahead_buf = ''
+        self.remote_headers = {}
+        Tarutils.__init__(self, uri, headersize=headersize, printmethod=printmethod, fileformat=fileformat,
+                          verbose=verbose, cachedir=cachedir, use_cache=use_cache)
+
+    def read_buffered(self, start, length, filesize=None):
+        '''
+        Returns 'length' bytes at 'start' from the read ahead buffer, refilling the buffer with a single
+        request of at least self.readahead bytes when the region isn't already buffered.
+        '''
+        filesize = filesize or self.filesize
+        bufend = self.readahead_start + len(self.readahead_buf)
+        if start < self.readahead_start or start + length > bufend:
+            end = min(start + max(self.readahead, length), filesize) - 1
+            self.readahead_buf = self.reader.read_range(start, end)
+            self.readahead_start = start
+        offset = start - self.readahead_start
+        return self.readahead_buf[offset:offset + length]
+
     def get_members(self, url = None, headersize=None, mode=None):
         '''
         Attempts to step through all tarball headers and gather the members/file info contained within.
+        Headers are read through a read ahead buffer, so a single request covers all the headers of many
+        small members.
         Will update self.members with the returned list of members.
         url - optional - remote http address of tarball
         headersize - optional - tar header size to be used
@@ -180,52 +524,64 @@ class Http_Tarutils(Tarutils):
         headersize = headersize or self.headersize
         mode = mode or self.fileformat
         url = url or self.uri
+        if url != self.reader.url:
+            self.reader = Http_Range_Reader(url, printmethod=self.printmethod)
         filesize = self.filesize or self.get_file_size(url)
         start = 0
         headers=[]
-        end = 0 
+        end = 0
+        longname = None
+        requests = self.reader.requests
         self.debug("get_members for url:"+str(url)+", headersize:"+str(headersize)+", filesize:"+str(filesize))
         while (start+headersize) <= filesize and end < 2:
-            data = self.download_http_offset(url, start=start, offset=headersize)
-            if not len(data.getvalue().replace('\x00','')):
+            data = self.read_buffered(start, headersize, filesize=filesize)
+            if not len(data.replace('\x00','')):
                 #End of Tar markers are 2 consecutive zero filled 512byte buffers
                 self.debug('Got empty header, count:'+str(end))
                 end += 1
                 start += headersize
+                continue
+            end = 0
+            #get tar member info from this header
+            member = tarfile.TarInfo.frombuf(data)
+            if member.type == tarfile.GNUTYPE_LONGNAME:
+                #The data of a GNU longname header is the full name of the next member
+                longname = self.read_buffered(start + headersize, member.size, filesize=filesize).rstrip('\x00')
             else:
-                end = 0
-                #print 'got data:'+str(data.read())
-                data.seek(0)
-                #get tar member info from this header
-                member = tarfile.TarInfo.frombuf(data.getvalue())
+                if longname:
+                    member.name = longname
+                    longname = None
                 member.offset = start
                 member.offset_data = start + headersize
                 #append tar header/member to the list
                 self.debug("Got header:"+member.name)
                 headers.append(member)
-                #move start point forward by the size of the file and header info. 
-                start = headersize + member.size
-            #must end in an increment of headersize 512 ...or maybe tarfile.fileobject.blocksize ie:1024? 
+            #move start point forward by the size of the file and header info.
+            start = start + headersize + member.size
+            #must end in an increment of headersize 512
             if start%headersize != 0:
                 start = ((start/headersize)+1)*headersize
-        self.members = headers
+        self.readahead_buf = ''
+        self.debug("Found " + str(len(headers)) + " members using " + str(self.reader.requests - requests) +
+                   " range requests")
+        self.set_members(headers)
         return headers
-            
-    def get_member(self, memberpath):
+
+    def get_validator(self):
         '''
-        Traverses our self.members list and attempts to return a tarinfo member object 
-        which member.name matches the provided memberpath
+        Validates the member index cache with the etag, last-modified and size of the remote tarball,
+        as returned by the HEAD request in get_file_size()
         '''
-        members = self.members or self.get_members()
-        for member in members:
-            if member.name == memberpath:
-                return member
-        return None
+        headers = self.remote_headers
+        if not headers.get('etag') and not headers.get('last-modified'):
+            return None
+        return {'etag': headers.get('etag'),
+                'last_modified': headers.get('last-modified'),
+                'size': self.filesize}
     
     def extract_member(self,memberpath, uri=None, filesize=None, readsize=None, destpath='.'):
         '''
         Extracts a tarball member to a file at destpath/<member name>
-        if destpath is None, will write to a stringIO object in memory instead. 
         member - mandatory - string, relative path with tarball of file/member to extract
         uri - optional - remote url of the tarball
         filesize - optional - size of remote tarball 
@@ -239,27 +595,27 @@ class Http_Tarutils(Tarutils):
             fileobj.close()
         
      
-    def extract_member_obj(self, member, uri=None, filesize=None, readsize=None, destpath='.'):
+    def extract_member_obj(self, member, uri=None, filesize=None, readsize=None, destpath='.', concurrency=None):
         '''
-        Extracts a tarball member to a file at destpath/<member name>
-        if destpath is None, will write to a stringIO object in memory instead. 
-        Returns the file or file like object 
+        Extracts a tarball member to a file at destpath/<member name> using parallel range requests.
+        An interrupted extraction is resumed from its partial file on the next attempt.
+        Returns the file object opened for reading
         member - mandatory - tarfile.TarInfo member object 
         uri - optional - remote url of the tarball
         filesize - optional - size of remote tarball 
         readsize - optional - size to read/write per iteration 
         destpath - destination dir/path to download the member data to
+        concurrency - optional - number of parallel range requests, defaults to self.concurrency
         '''
         self.debug('Attempting to extract member: '+str(member.name)+' to dir: '+str(destpath))
         uri = uri or self.uri
-        filesize = filesize or self.filesize
         freespace = self.get_freespace(destpath)
         if member.size > freespace:
-            raise Exception(str(memberpath)+":"+str(member.size)+" exceeds destpath freespace:"+(destpath)+":"+str(freespace) )
-        start = member.offset_data
-        offset = member.size
+            raise Exception(str(member.name)+":"+str(member.size)+" exceeds destpath freespace:"+(destpath)+":"+str(freespace) )
         destfile=str(destpath).rstrip('/')+'/'+str(member.name)
-        file = self.get_file_offset(uri, start, offset, filesize, readsize=None,destfile=destfile)
+        self.download_ranges(member.offset_data, member.size, destfile, uri=uri, readsize=readsize,
+                             concurrency=concurrency)
+        file = open(destfile, 'r')
         self.debug('Extracted member: '+str(member.name)+' to file: '+str(file.name))
         return file
     
@@ -267,6 +623,8 @@ class Http_Tarutils(Tarutils):
         '''
         Attempts to extract all members from list to local destination at 'destpath'
         Attempts to guesstimate the the size needed and check available space at destpath before extracting
+        Members larger than self.chunksize are extracted one at a time with parallel range requests,
+        smaller members are extracted in parallel with each other.
         memberlist - optional - list of tarinfo member objects
         destpath - optional - local destination to download/extract to
         '''
@@ -277,12 +635,76 @@ class Http_Tarutils(Tarutils):
         freespace = self.get_freespace(destpath)
         if size > freespace:
             raise Exception("Extract_all size:"+str(size)+" exceeds destpath freespace:"+(destpath)+":"+str(freespace) )
-        for member in self.members:
-            file = self.extract_member_obj(member, destpath=destpath)
-            if not file.closed:
-                file.close()
-        
-        
+        files = [member for member in list if member.isfile()]
+        for member in list:
+            if member.isdir():
+                self.make_path(str(destpath).rstrip('/') + '/' + str(member.name) + '/')
+        for member in [member for member in files if member.size > self.chunksize]:
+            self.extract_member_obj(member, destpath=destpath).close()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.extract_member_obj, member, destpath=destpath, concurrency=1)
+                       for member in files if member.size <= self.chunksize]
+            for future in futures:
+                future.result().close()
+        self.reader.close_worker_connections()
+
+    def download_ranges(self, start, length, destfile, uri=None, readsize=None, concurrency=None):
+        '''
+        Download 'length' bytes at 'start' of the remote file to destfile using parallel range requests
+        of self.chunksize. Data is written to <destfile>.part and completed chunks are recorded in
+        <destfile>.part.done, so an interrupted download only fetches the missing chunks when run again.
+        The part file is renamed to destfile when all chunks have completed.
+        '''
+        uri = uri or self.uri
+        reader = self.reader
+        if uri != reader.url:
+            reader = Http_Range_Reader(uri, printmethod=self.printmethod)
+        concurrency = concurrency or self.concurrency
+        readsize = readsize or (64 * 1024)
+        destfile = self.make_path(destfile)
+        partfile = destfile + '.part'
+        donefile = partfile + '.done'
+        done = set()
+        if os.path.exists(partfile) and os.path.exists(donefile) and os.path.getsize(partfile) == length:
+            with open(donefile) as df:
+                done = set([int(line) for line in df.read().split()])
+            self.debug('Resuming ' + str(destfile) + ', ' + str(len(done)) + ' chunks already downloaded')
+        else:
+            with open(partfile, 'wb') as pf:
+                pf.truncate(length)
+            open(donefile, 'w').close()
+        chunks = [offset for offset in xrange(0, length, self.chunksize) if offset not in done]
+        lock = threading.Lock()
+
+        def get_chunk(offset):
+            end = min(offset + self.chunksize, length) - 1
+            for attempt in xrange(1, self.retries + 1):
+                try:
+                    with open(partfile, 'r+b') as pf:
+                        pf.seek(offset)
+                        reader.read_range_to_file(start + offset, start + end, pf, readsize=readsize)
+                    break
+                except Exception, e:
+                    self.debug('Chunk ' + str(offset) + ' of ' + str(destfile) + ' failed, attempt:' +
+                               str(attempt) + ', err:' + str(e))
+                    if attempt == self.retries:
+                        raise
+            with lock:
+                with open(donefile, 'a') as df:
+                    df.write(str(offset) + '\n')
+
+        if concurrency == 1 or len(chunks) <= 1:
+            for offset in chunks:
+                get_chunk(offset)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for future in [executor.submit(get_chunk, offset) for offset in chunks]:
+                    future.result()
+            reader.close_worker_connections()
+        os.rename(partfile, destfile)
+        os.remove(donefile)
+        return destfile
+
     def get_file_offset(self, uri=None, start=0, offset=None, filesize=None, readsize=None,destfile=None):
         '''
         mapped method to down_load_http_offset
@@ -302,10 +724,11 @@ class Http_Tarutils(Tarutils):
         destfile: the local file to write to, if not specified method will store/write to string buffer      
         '''
         url = url or self.uri
-        readsize = readsize or (16 * 1024)
-        filesize = self.filesize or int(self.get_file_size(url))
-        dfile = None #potential destination file desc. to write downloaded data to
-        retbuf = "" #potential buffer to hold downloaded data
+        readsize = readsize or (64 * 1024)
+        filesize = filesize or self.filesize or int(self.get_file_size(url))
+        reader = self.reader
+        if url != reader.url:
+            reader = Http_Range_Reader(url, printmethod=self.printmethod)
         self.debug("download_http_offset starting: url:"+str(url)+", start:"+str(start)+", offset:"+str(offset)+
                    ", filesize:"+str(filesize)+", readsize:"+str(readsize)+", filename:"+str(destfile))
         #Validate our start and offset
@@ -319,54 +742,31 @@ class Http_Tarutils(Tarutils):
                 end = filesize - 1
         else:
             end = filesize - 1 
-        #calc total to check against later
-        total = (end + 1) - start 
         #see if we can open our dest file before we download
         if destfile:
             destfile = self.make_path(destfile)
             dfile = open(destfile, 'w+')
         else:
             dfile = cStringIO.StringIO()
-        #form our http request
-        request = urllib2.Request(url)
-        request.headers['Range'] = 'bytes=%s-%s' % (start, end)
-        #open http connection
-        remotefile = urllib2.urlopen(request)
-        # If content length or range is not what we expected throw an error...
-        # Note: content range in bytes is formated like: "byte <start>-<end>/<total bytes>
-        range=remotefile.headers.get('Content-Range')
-        clength = int(remotefile.headers.get('Content-Length'))
-        print('Content-Range:' +str(range)+", Content-Length:"+str(clength) ) 
-        if clength != total:
-            raise Exception("Content-length:"+str(clength)+" not equal to expected total:"+str(total)+", is range supported on remote server?")
-        #Now try to parse the ranges...
-        try:
-            rangestart, rangeend = re.search("\d+-\d+", range).group().split('-')
-        except Exception, e:
-            print "Couldn't derive rangestart and rangeend from string:"+str(range)+", err:"+str(e)
-        if int(rangestart) != int(start) or int(rangeend) != int(end):
-            raise Exception("Range request not met. (start:"+str(start)+" vs rangestart:"+str(rangestart)+") (end:"+str(end)+" vs rangeend:"+str(rangeend)+"), is range supported on remote server?") 
-        #finally get the data and return it as a filelike cString object
-        for data in iter(lambda: remotefile.read(readsize), ''):
-            dfile.write(data)
+        reader.read_range_to_file(start, end, dfile, readsize=readsize)
         dfile.seek(0)
         return dfile
     
     
     def get_file_size(self,uri=None):
         '''
-        Get remote file size for the http header
+        Get remote file size from the http headers of a HEAD request
         '''
-        url = uri or self.uri   
-        site = urllib2.urlopen(url)
-        size =  int(site.headers.get('Content-Length'))
+        url = uri or self.uri
+        reader = self.reader
+        if url != reader.url:
+            reader = Http_Range_Reader(url, printmethod=self.printmethod)
+        headers = reader.head()
+        if url == self.uri:
+            self.remote_headers = headers
+        size = int(headers.get('content-length'))
         self.filesize = size
         return size
     
     def close(self):
-        return 
-        
-            
-        
-            
-            
\ No newline at end of file
+        self.reader.close()